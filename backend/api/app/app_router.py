@@ -11,6 +11,7 @@ import uuid
 
 from database.database import get_db
 from models.models import Patient, Encounter, Provider, Organization, Observation, Condition, Medication
+from services.dashboard_stats_service import get_dashboard_snapshot, refresh_dashboard_stats
 from ..auth import get_current_user_optional
 from .schemas import (
     PatientCreate, PatientUpdate, PatientResponse,
@@ -400,30 +401,18 @@ async def get_dashboard_stats(
     db: Session = Depends(get_db),
     current_user: Optional[Provider] = Depends(get_current_user_optional)
 ):
-    """Get dashboard statistics"""
-    total_patients = db.query(Patient).count()
-    total_encounters = db.query(Encounter).count()
-    total_providers = db.query(Provider).filter(Provider.active == True).count()
-    
-    # Recent activity
-    recent_encounters = db.query(Encounter).filter(
-        Encounter.encounter_date >= datetime.now() - timedelta(days=7)
-    ).count()
-    
-    # Common conditions
-    common_conditions = db.query(
-        Condition.description,
-        db.query(Condition).filter(Condition.description == Condition.description).count()
-    ).group_by(Condition.description).limit(5).all()
+    """Get dashboard statistics, served from the pre-aggregated snapshot"""
+    snapshot = get_dashboard_snapshot(db)
+    stats = snapshot.stats
     
     result = {
-        "total_patients": total_patients,
-        "total_encounters": total_encounters,
-        "active_providers": total_providers,
-        "recent_encounters": recent_encounters,
-        "common_conditions": [
-            {"name": desc, "count": count} for desc, count in common_conditions
-        ]
+        "total_patients": stats["total_patients"],
+        "total_encounters": stats["total_encounters"],
+        "active_providers": stats["active_providers"],
+        "recent_encounters": stats["recent_encounters"],
+        "common_conditions": stats["common_conditions"],
+        "refreshed_at": snapshot.refreshed_at.isoformat(),
+        "age_seconds": round((datetime.utcnow() - snapshot.refreshed_at).total_seconds(), 1)
     }
     
     # Add provider-specific stats if logged in
@@ -437,6 +426,21 @@ async def get_dashboard_stats(
     
     return result
 
+@router.post("/dashboard/stats/refresh")
+async def refresh_dashboard_stats_snapshot(
+    db: Session = Depends(get_db),
+    current_user: Optional[Provider] = Depends(get_current_user_optional)
+):
+    """Recount the dashboard statistics now instead of waiting for the background refresh"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    snapshot = refresh_dashboard_stats(db)
+    return {
+        "refreshed_at": snapshot.refreshed_at.isoformat(),
+        "elapsed_ms": snapshot.elapsed_ms
+    }
+
 @router.get("/dashboard/recent-activity")
 async def get_recent_activity(db: Session = Depends(get_db)):
     """Get recent activity for dashboard"""
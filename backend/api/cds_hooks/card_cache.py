@@ -0,0 +1,52 @@
+"""
+CDS Hooks Card Cache
+Per-worker LRU cache of the cards a hook produced for a patient
+
+Entries are keyed by (hook_id, hook_version, patient_id, data_version,
+evaluation date): editing the hook or writing the patient's clinical data
+moves a version and the old entry is simply never asked for again, while
+the date keeps age and timeframe conditions from outliving the day they were
+evaluated on. Cards are copied with fresh UUIDs on every hit, as CDS Hooks
+requires each returned card and suggestion to have a unique id.
+"""
+
+import copy
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from services.lru_cache import LRUCache
+
+CDS_CARD_CACHE_SIZE = int(os.getenv("CDS_CARD_CACHE_SIZE", "10000"))
+
+
+def restamp(cards: List[dict]) -> List[dict]:
+    """Copy cards, giving every card and suggestion a new UUID"""
+    cards = copy.deepcopy(cards)
+    for card in cards:
+        card["uuid"] = str(uuid.uuid4())
+        for suggestion in card.get("suggestions", []):
+            suggestion["uuid"] = str(uuid.uuid4())
+    return cards
+
+
+class CardCache(LRUCache):
+    """Bounded LRU cache of hook cards keyed by hook and patient data versions"""
+
+    def __init__(self, max_entries: int = CDS_CARD_CACHE_SIZE):
+        super().__init__(max_entries)
+
+    def get(self, key: Tuple) -> Optional[List[dict]]:
+        """Cached cards for the key, re-stamped with fresh UUIDs"""
+        cards = super().get(key)
+        return None if cards is None else restamp(cards)
+
+    def set(self, key: Tuple, cards: List[dict]) -> None:
+        super().set(key, copy.deepcopy(cards))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+card_cache = CardCache()
@@ -3,21 +3,40 @@ CDS Hooks Router
 Implements CDS Hooks v1.0 specification with management endpoints
 """
 
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
 from typing import List, Optional, Dict, Any
 from datetime import datetime, date, timedelta
+import asyncio
 import json
+import logging
+import os
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from database.database import get_db
 from models.models import Patient, Encounter, Provider, Organization, Observation, Condition, Medication
+from models.cds_hook_models import CDSHook
+from services.patient_data_version_service import get_data_version
+from .card_cache import card_cache
+from .cds_services import execute_services, services_for_hook
+from .hook_registry import HookRegistry, hook_registry
+from .patient_context import PatientContext
+from .rules import CompiledCondition, CompiledHook, RuleError, population_query
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["CDS Hooks"])
 
-# In-memory storage for hooks (in production, use database)
-hooks_storage = {}
+# Seconds the fan-out may spend loading the shared patient snapshot before
+# the hooks that need it are answered with no cards (status "snapshot-timeout");
+# evaluation itself runs in memory and is not bounded per hook
+SNAPSHOT_TIMEOUT_SECONDS = float(os.getenv("CDS_SNAPSHOT_TIMEOUT_SECONDS", "2.0"))
+# Threads loading fanned-out patient snapshots
+HOOK_FANOUT_WORKERS = int(os.getenv("CDS_HOOK_FANOUT_WORKERS", "8"))
+
+_hook_pool: Optional[ThreadPoolExecutor] = None
 
 class IndicatorType(str, Enum):
     INFO = "info"
@@ -30,289 +49,41 @@ class CDSHookEngine:
     def __init__(self, db: Session):
         self.db = db
     
-    def evaluate_hook(self, hook_config: dict, context: dict) -> List[dict]:
-        """Evaluate a CDS hook against the given context"""
+    def evaluate_hook(self, hook: CompiledHook, context: dict,
+                      patient_context: Optional[PatientContext] = None) -> List[dict]:
+        """
+        Evaluate a compiled CDS hook against the given context.
+
+        The patient's data is loaded once into a PatientContext (or taken from
+        the caller, when several hooks share one) and every condition is
+        evaluated against that snapshot in memory.
+        """
+        if hook.conditions and patient_context is None:
+            patient_context = self.load_patient_context(context, hook.conditions)
+        
+        return self.evaluate_with_context(hook, context, patient_context)
+    
+    def evaluate_with_context(self, hook: CompiledHook, context: dict,
+                              patient_context: Optional[PatientContext]) -> List[dict]:
+        """Evaluate a compiled CDS hook against an already loaded snapshot (no database access)"""
         cards = []
         
         # Check if conditions are met
-        if self._evaluate_conditions(hook_config.get('conditions', []), context):
+        if hook.matches(patient_context):
             # Execute actions
-            for action in hook_config.get('actions', []):
+            for action in hook.actions:
                 card = self._execute_action(action, context)
                 if card:
                     cards.append(card)
         
         return cards
     
-    def _evaluate_conditions(self, conditions: List[dict], context: dict) -> bool:
-        """Evaluate all conditions (AND logic)"""
-        if not conditions:
-            return True  # No conditions means always trigger
-        
-        for condition in conditions:
-            if not self._evaluate_condition(condition, context):
-                return False
-        
-        return True
-    
-    def _evaluate_condition(self, condition: dict, context: dict) -> bool:
-        """Evaluate a single condition"""
-        condition_type = condition.get('type')
-        parameters = condition.get('parameters', {})
+    def load_patient_context(self, context: dict, conditions: List[CompiledCondition]) -> Optional[PatientContext]:
+        """Load the patient snapshot needed by the given compiled conditions"""
         patient_id = context.get('patientId')
-        
         if not patient_id:
-            return False
-        
-        # Get patient data
-        patient = self.db.query(Patient).filter(Patient.id == patient_id).first()
-        if not patient:
-            return False
-        
-        if condition_type == 'patient-age':
-            return self._check_patient_age(patient, parameters)
-        elif condition_type == 'patient-gender':
-            return self._check_patient_gender(patient, parameters)
-        elif condition_type == 'diagnosis-code':
-            return self._check_diagnosis_code(patient_id, parameters)
-        elif condition_type == 'medication-active':
-            return self._check_active_medication(patient_id, parameters)
-        elif condition_type == 'medication-missing':
-            return not self._check_active_medication(patient_id, parameters)
-        elif condition_type == 'lab-value':
-            return self._check_lab_value(patient_id, parameters)
-        elif condition_type == 'lab-missing':
-            return self._check_lab_missing(patient_id, parameters)
-        elif condition_type == 'vital-sign':
-            return self._check_vital_sign(patient_id, parameters)
-        
-        return False
-    
-    def _check_patient_age(self, patient: Patient, parameters: dict) -> bool:
-        """Check patient age condition"""
-        if not patient.date_of_birth:
-            return False
-        
-        age = (datetime.now().date() - patient.date_of_birth).days / 365.25
-        operator = parameters.get('operator', 'eq')
-        value = float(parameters.get('value', 0))
-        
-        if operator == 'eq':
-            return abs(age - value) < 1  # Within 1 year
-        elif operator == 'gt':
-            return age > value
-        elif operator == 'ge':
-            return age >= value
-        elif operator == 'lt':
-            return age < value
-        elif operator == 'le':
-            return age <= value
-        
-        return False
-    
-    def _check_patient_gender(self, patient: Patient, parameters: dict) -> bool:
-        """Check patient gender condition"""
-        target_gender = parameters.get('value', '').lower()
-        patient_gender = (patient.gender or '').lower()
-        return patient_gender == target_gender
-    
-    def _check_diagnosis_code(self, patient_id: str, parameters: dict) -> bool:
-        """Check for specific diagnosis codes"""
-        codes = parameters.get('codes', '').split(',')
-        codes = [code.strip() for code in codes if code.strip()]
-        
-        if not codes:
-            return False
-        
-        # Check both SNOMED and ICD-10 codes (SNOMED is primary)
-        conditions = self.db.query(Condition).filter(
-            and_(
-                Condition.patient_id == patient_id,
-                Condition.clinical_status == 'active',
-                or_(
-                    Condition.snomed_code.in_(codes),
-                    Condition.icd10_code.in_(codes) if Condition.icd10_code else False
-                )
-            )
-        ).all()
-        
-        operator = parameters.get('operator', 'in')
-        if operator == 'in':
-            return len(conditions) > 0
-        elif operator == 'not-in':
-            return len(conditions) == 0
-        
-        return False
-    
-    def _check_active_medication(self, patient_id: str, parameters: dict) -> bool:
-        """Check for active medications"""
-        medications = parameters.get('medications', '').split(',')
-        medications = [med.strip().lower() for med in medications if med.strip()]
-        
-        if not medications:
-            return False
-        
-        active_meds = self.db.query(Medication).filter(
-            and_(
-                Medication.patient_id == patient_id,
-                Medication.status == 'active'
-            )
-        ).all()
-        
-        for med in active_meds:
-            med_name = med.medication_name.lower()
-            for target_med in medications:
-                if target_med in med_name:
-                    return True
-        
-        return False
-    
-    def _check_lab_value(self, patient_id: str, parameters: dict) -> bool:
-        """Check lab values against thresholds"""
-        code = parameters.get('code')
-        operator = parameters.get('operator', 'gt')
-        value = float(parameters.get('value', 0))
-        timeframe = int(parameters.get('timeframe', 30))  # days
-        
-        if not code:
-            return False
-        
-        # Get recent lab results
-        cutoff_date = datetime.now().date() - timedelta(days=timeframe)
-        labs = self.db.query(Observation).filter(
-            and_(
-                Observation.patient_id == patient_id,
-                Observation.observation_type == 'laboratory',
-                Observation.loinc_code == code,
-                Observation.observation_date >= cutoff_date
-            )
-        ).order_by(Observation.observation_date.desc()).all()
-        
-        if operator == 'missing':
-            return len(labs) == 0
-        
-        if not labs:
-            return False
-        
-        latest_lab = labs[0]
-        try:
-            # Try value_quantity first, then value
-            if latest_lab.value_quantity is not None:
-                lab_value = float(latest_lab.value_quantity)
-            elif latest_lab.value:
-                lab_value = float(latest_lab.value)
-            else:
-                return False
-        except (ValueError, TypeError):
-            return False
-        
-        if operator == 'gt':
-            return lab_value > value
-        elif operator == 'ge':
-            return lab_value >= value
-        elif operator == 'lt':
-            return lab_value < value
-        elif operator == 'le':
-            return lab_value <= value
-        elif operator == 'eq':
-            return abs(lab_value - value) < 0.01
-        
-        return False
-    
-    def _check_lab_missing(self, patient_id: str, parameters: dict) -> bool:
-        """Check if a lab test is missing within a timeframe"""
-        code = parameters.get('code') or parameters.get('labTest')
-        timeframe = int(parameters.get('timeframe', 90))  # days
-        
-        if not code:
-            return False
-        
-        # Get recent lab results
-        cutoff_date = datetime.now().date() - timedelta(days=timeframe)
-        labs = self.db.query(Observation).filter(
-            and_(
-                Observation.patient_id == patient_id,
-                Observation.observation_type == 'laboratory',
-                Observation.loinc_code == code,
-                Observation.observation_date >= cutoff_date
-            )
-        ).count()
-        
-        # Return True if no labs found (missing)
-        return labs == 0
-    
-    def _check_vital_sign(self, patient_id: str, parameters: dict) -> bool:
-        """Check vital signs against normal ranges"""
-        vital_type = parameters.get('type')
-        operator = parameters.get('operator', 'gt')
-        value = float(parameters.get('value', 0))
-        timeframe = int(parameters.get('timeframe', 7))  # days
-        component = parameters.get('component', 'systolic')  # For blood pressure
-        
-        if not vital_type:
-            return False
-        
-        # Get recent vital signs
-        cutoff_date = datetime.now().date() - timedelta(days=timeframe)
-        
-        # Special handling for blood pressure
-        if vital_type == '85354-9':  # Blood pressure panel LOINC code
-            vitals = self.db.query(Observation).filter(
-                and_(
-                    Observation.patient_id == patient_id,
-                    Observation.observation_type == 'vital-signs',
-                    Observation.loinc_code == '85354-9',  # Blood pressure panel
-                    Observation.observation_date >= cutoff_date
-                )
-            ).order_by(Observation.observation_date.desc()).all()
-        else:
-            # Use LOINC code for other vital signs
-            vitals = self.db.query(Observation).filter(
-                and_(
-                    Observation.patient_id == patient_id,
-                    Observation.observation_type == 'vital-signs',
-                    Observation.loinc_code == vital_type,
-                    Observation.observation_date >= cutoff_date
-                )
-            ).order_by(Observation.observation_date.desc()).all()
-        
-        if not vitals:
-            return False
-        
-        latest_vital = vitals[0]
-        try:
-            # Handle blood pressure values (e.g., "126/76")
-            if vital_type == '85354-9' and latest_vital.value:
-                if '/' in latest_vital.value:
-                    systolic, diastolic = latest_vital.value.split('/')
-                    if component == 'systolic':
-                        vital_value = float(systolic)
-                    elif component == 'diastolic':
-                        vital_value = float(diastolic)
-                    else:
-                        return False
-                else:
-                    return False
-            # Try value_quantity first, then value
-            elif latest_vital.value_quantity is not None:
-                vital_value = float(latest_vital.value_quantity)
-            elif latest_vital.value:
-                vital_value = float(latest_vital.value)
-            else:
-                return False
-        except (ValueError, TypeError):
-            return False
-        
-        if operator == 'gt':
-            return vital_value > value
-        elif operator == 'ge':
-            return vital_value >= value
-        elif operator == 'lt':
-            return vital_value < value
-        elif operator == 'le':
-            return vital_value <= value
-        
-        return False
+            return None
+        return PatientContext.load(self.db, patient_id, conditions)
     
     def _execute_action(self, action: dict, context: dict) -> Optional[dict]:
         """Execute an action and return a CDS card"""
@@ -387,49 +158,168 @@ class CDSHookEngine:
             "uuid": str(uuid.uuid4())
         }
 
+def _request_context(request: dict) -> dict:
+    """Convert a CDS Hooks request to the engine's evaluation context"""
+    return {
+        "hookInstance": request.get("hookInstance"),
+        "fhirServer": request.get("fhirServer"),
+        "hook": request.get("hook"),
+        "patientId": request.get("context", {}).get("patientId"),
+        "userId": request.get("context", {}).get("userId"),
+        "encounterId": request.get("context", {}).get("encounterId"),
+        **request.get("context", {})
+    }
+
+def _card_cache_key(hook: CompiledHook, patient_id: str, data_version: int) -> tuple:
+    """Cache key of a hook's cards for a patient, valid for the day it was evaluated"""
+    return (hook.id, hook.version, patient_id, data_version, date.today())
+
+def get_hook_pool() -> ThreadPoolExecutor:
+    """The pool fanned-out patient snapshots are loaded on, shared by every request"""
+    global _hook_pool
+    if _hook_pool is None:
+        _hook_pool = ThreadPoolExecutor(max_workers=HOOK_FANOUT_WORKERS, thread_name_prefix="cds-hook")
+    return _hook_pool
+
+def _load_snapshot(bind, context: dict, conditions: List[CompiledCondition]) -> Optional[PatientContext]:
+    """
+    Load a patient snapshot on a session of its own.
+
+    A load that outlives its timeout keeps running on its thread; with its
+    own session it never touches the request's session after the response.
+    """
+    db = Session(bind=bind)
+    try:
+        return CDSHookEngine(db).load_patient_context(context, conditions)
+    finally:
+        db.close()
+
+def _evaluate_service(engine: CDSHookEngine, hook: CompiledHook, context: dict,
+                      patient_context: Optional[PatientContext], snapshot_loaded: bool) -> dict:
+    """Evaluate one fanned-out hook in memory; a failing hook returns no cards"""
+    started = time.perf_counter()
+    if hook.conditions and not snapshot_loaded:
+        cards, status = [], "snapshot-timeout"
+    else:
+        try:
+            cards = engine.evaluate_with_context(hook, context, patient_context)
+            status = "ok"
+        except Exception as e:
+            logger.error(f"CDS hook {hook.id} failed: {e}")
+            cards, status = [], "error"
+    
+    return {
+        "id": hook.id,
+        "status": status,
+        "cached": False,
+        "elapsedMs": round((time.perf_counter() - started) * 1000, 1),
+        "cards": cards
+    }
+
 # CDS Hooks Discovery Endpoint
 @router.get("/")
-async def discover_hooks():
+async def discover_hooks(db: Session = Depends(get_db)):
     """CDS Hooks discovery endpoint"""
     return {
-        "services": [
-            {
-                "hook": hook_config.get("hook"),
-                "title": hook_config.get("title"),
-                "description": hook_config.get("description"),
-                "id": hook_id,
-                "prefetch": hook_config.get("prefetch", {}),
-                "usageRequirements": hook_config.get("usageRequirements", "")
-            }
-            for hook_id, hook_config in hooks_storage.items()
-            if hook_config.get("enabled", True)
-        ]
+        "services": [hook.service for hook in hook_registry.hooks(db) if hook.enabled]
     }
 
 # Hook Management Endpoints (must come before the generic /{hook_id} route)
 @router.get("/hooks")
-async def list_hooks():
+async def list_hooks(db: Session = Depends(get_db)):
     """List all CDS hooks"""
-    return list(hooks_storage.values())
+    return [HookRegistry.to_response(record) for record in db.query(CDSHook).order_by(CDSHook.id)]
 
 @router.post("/hooks")
-async def create_hook(hook_config: dict):
+async def create_hook(hook_config: dict, db: Session = Depends(get_db)):
     """Create a new CDS hook"""
     hook_id = hook_config.get("id")
     if not hook_id:
         raise HTTPException(status_code=400, detail="Hook ID is required")
     
-    if hook_id in hooks_storage:
+    if db.query(CDSHook.id).filter(CDSHook.id == hook_id).first():
         raise HTTPException(status_code=409, detail="Hook ID already exists")
     
-    # Add metadata
-    hook_config.update({
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat()
-    })
+    try:
+        record = hook_registry.save(db, hook_id, hook_config)
+    except RuleError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid hook: {e}")
+    return HookRegistry.to_response(record)
+
+@router.post("/fan-out/{hook_type}")
+async def fan_out_hooks(
+    hook_type: str,
+    request: dict,
+    db: Session = Depends(get_db)
+):
+    """
+    Execute every enabled hook of a hook type (e.g. patient-view).
+    
+    The patient snapshot is loaded once for all of them. That load is the
+    only database work and gets SNAPSHOT_TIMEOUT_SECONDS; if it runs out,
+    hooks with conditions are answered with no cards (status
+    "snapshot-timeout") while hooks without conditions still fire. Hooks
+    are then evaluated against the snapshot in memory, and a hook that
+    fails returns no cards without affecting the others.
+    """
+    hooks = hook_registry.for_hook_type(db, hook_type)
+    context = _request_context({"hook": hook_type, **request})
+    engine = CDSHookEngine(db)
+    
+    # Hooks already evaluated at this patient data version are answered from the cache
+    patient_id = context.get("patientId")
+    data_version = get_data_version(db, patient_id) if patient_id else None
+    cached = {}
+    if patient_id:
+        for hook in hooks:
+            cards = card_cache.get(_card_cache_key(hook, patient_id, data_version))
+            if cards is not None:
+                cached[hook.id] = {"id": hook.id, "status": "ok", "cached": True, "elapsedMs": 0.0, "cards": cards}
+    pending = [hook for hook in hooks if hook.id not in cached]
+    
+    conditions = [condition for hook in pending for condition in hook.conditions]
+    patient_context = None
+    snapshot_loaded = True
+    if conditions:
+        loop = asyncio.get_running_loop()
+        try:
+            patient_context = await asyncio.wait_for(
+                loop.run_in_executor(get_hook_pool(), _load_snapshot, db.get_bind(), context, conditions),
+                timeout=SNAPSHOT_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            snapshot_loaded = False
+    
+    evaluated = [
+        _evaluate_service(engine, hook, context, patient_context, snapshot_loaded) for hook in pending
+    ]
+    for hook, service in zip(pending, evaluated):
+        if patient_id and service["status"] == "ok":
+            card_cache.set(_card_cache_key(hook, patient_id, data_version), service["cards"])
+        cached[hook.id] = service
+    services = [cached[hook.id] for hook in hooks]
+    
+    return {
+        "cards": [card for service in services for card in service["cards"]],
+        "services": services
+    }
+
+@router.post("/services/{hook_type}")
+async def execute_builtin_services(
+    hook_type: str,
+    request: dict,
+    db: Session = Depends(get_db)
+):
+    """
+    Execute the built-in CDS services of a hook type (e.g. patient-view).
     
-    hooks_storage[hook_id] = hook_config
-    return hook_config
+    Their prefetch templates are resolved together, one read per resource
+    type, before the services run.
+    """
+    services = services_for_hook(hook_type)
+    if not services:
+        raise HTTPException(status_code=404, detail="No services for this hook")
+    return execute_services(db, services, _request_context({"hook": hook_type, **request}))
 
 # CDS Hook Execution Endpoints (generic route must come after specific routes)
 @router.post("/{hook_id}")
@@ -439,62 +329,65 @@ async def execute_hook(
     db: Session = Depends(get_db)
 ):
     """Execute a specific CDS hook"""
-    hook_config = hooks_storage.get(hook_id)
-    if not hook_config:
+    hook = hook_registry.get(db, hook_id)
+    if not hook:
         raise HTTPException(status_code=404, detail="Hook not found")
     
-    if not hook_config.get("enabled", True):
+    if not hook.enabled:
         return {"cards": []}
     
     # Create execution engine
     engine = CDSHookEngine(db)
     
     # Convert request to context
-    context = {
-        "hookInstance": request.get("hookInstance"),
-        "fhirServer": request.get("fhirServer"),
-        "hook": request.get("hook"),
-        "patientId": request.get("context", {}).get("patientId"),
-        "userId": request.get("context", {}).get("userId"),
-        "encounterId": request.get("context", {}).get("encounterId"),
-        **request.get("context", {})
-    }
+    context = _request_context(request)
+    
+    # Answer from the card cache while neither the hook nor the patient's data changed
+    patient_id = context.get("patientId")
+    cache_key = None
+    if patient_id:
+        cache_key = _card_cache_key(hook, patient_id, get_data_version(db, patient_id))
+        cards = card_cache.get(cache_key)
+        if cards is not None:
+            return {"cards": cards}
     
     # Execute hook
-    cards = engine.evaluate_hook(hook_config, context)
+    cards = engine.evaluate_hook(hook, context)
     
+    if cache_key is not None:
+        card_cache.set(cache_key, cards)
     return {"cards": cards}
 
 @router.get("/hooks/{hook_id}")
-async def get_hook(hook_id: str):
+async def get_hook(hook_id: str, db: Session = Depends(get_db)):
     """Get a specific CDS hook"""
-    hook_config = hooks_storage.get(hook_id)
-    if not hook_config:
+    record = db.query(CDSHook).filter(CDSHook.id == hook_id).first()
+    if not record:
         raise HTTPException(status_code=404, detail="Hook not found")
-    return hook_config
+    return HookRegistry.to_response(record)
 
 @router.put("/hooks/{hook_id}")
-async def update_hook(hook_id: str, hook_config: dict):
+async def update_hook(hook_id: str, hook_config: dict, db: Session = Depends(get_db)):
     """Update a CDS hook"""
-    if hook_id not in hooks_storage:
+    record = db.query(CDSHook).filter(CDSHook.id == hook_id).first()
+    if not record:
         raise HTTPException(status_code=404, detail="Hook not found")
     
-    # Preserve creation date, update modification date
-    hook_config.update({
-        "created_at": hooks_storage[hook_id].get("created_at"),
-        "updated_at": datetime.now().isoformat()
-    })
-    
-    hooks_storage[hook_id] = hook_config
-    return hook_config
+    # Creation date is preserved; the version and modification date move forward
+    try:
+        record = hook_registry.save(db, hook_id, hook_config, record)
+    except RuleError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid hook: {e}")
+    return HookRegistry.to_response(record)
 
 @router.delete("/hooks/{hook_id}")
-async def delete_hook(hook_id: str):
+async def delete_hook(hook_id: str, db: Session = Depends(get_db)):
     """Delete a CDS hook"""
-    if hook_id not in hooks_storage:
+    record = db.query(CDSHook).filter(CDSHook.id == hook_id).first()
+    if not record:
         raise HTTPException(status_code=404, detail="Hook not found")
     
-    del hooks_storage[hook_id]
+    hook_registry.delete(db, record)
     return {"message": "Hook deleted successfully"}
 
 @router.post("/hooks/{hook_id}/test")
@@ -504,15 +397,15 @@ async def test_hook(
     db: Session = Depends(get_db)
 ):
     """Test a CDS hook with sample data"""
-    hook_config = hooks_storage.get(hook_id)
-    if not hook_config:
+    hook = hook_registry.get(db, hook_id)
+    if not hook:
         raise HTTPException(status_code=404, detail="Hook not found")
     
     # Create execution engine
     engine = CDSHookEngine(db)
     
     # Execute hook with test context
-    cards = engine.evaluate_hook(hook_config, test_context)
+    cards = engine.evaluate_hook(hook, test_context)
     
     return {
         "hookId": hook_id,
@@ -521,9 +414,54 @@ async def test_hook(
         "timestamp": datetime.now().isoformat()
     }
 
+@router.get("/hooks/{hook_id}/dry-run")
+async def dry_run_hook(
+    hook_id: str,
+    limit: int = Query(50, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db)
+):
+    """
+    Evaluate a CDS hook for every patient at once, without producing cards.
+    
+    The hook's conditions are compiled into one set-based query, returning how
+    many patients the hook would fire for and a page of those patients.
+    Works for disabled hooks, so a hook can be checked before enabling it.
+    """
+    hook = hook_registry.get(db, hook_id)
+    if not hook:
+        raise HTTPException(status_code=404, detail="Hook not found")
+    
+    query = population_query(db, hook)
+    count = query.order_by(None).count()
+    patients = query.order_by(Patient.last_name, Patient.first_name, Patient.id).offset(offset).limit(limit).all()
+    
+    return {
+        "hookId": hook_id,
+        "version": hook.version,
+        "count": count,
+        "offset": offset,
+        "limit": limit,
+        "patients": [
+            {
+                "id": patient.id,
+                "mrn": patient.mrn,
+                "first_name": patient.first_name,
+                "last_name": patient.last_name,
+                "date_of_birth": patient.date_of_birth.isoformat() if patient.date_of_birth else None,
+                "gender": patient.gender
+            }
+            for patient in patients
+        ],
+        "timestamp": datetime.now().isoformat()
+    }
+
 # Initialize with some sample hooks
-def initialize_sample_hooks():
-    """Initialize with sample CDS hooks for demonstration - updated for Synthea data"""
+def initialize_sample_hooks(db: Session):
+    """Seed an empty registry with sample CDS hooks for demonstration - updated for Synthea data"""
+    if db.query(CDSHook.id).first():
+        return
+    
     sample_hooks = {
         "diabetes-a1c-monitoring": {
             "id": "diabetes-a1c-monitoring",
@@ -912,7 +850,5 @@ def initialize_sample_hooks():
         }
     }
     
-    hooks_storage.update(sample_hooks)
-
-# Initialize sample hooks on startup
-initialize_sample_hooks()
\ No newline at end of file
+    for hook_id, hook_config in sample_hooks.items():
+        hook_registry.save(db, hook_id, hook_config)
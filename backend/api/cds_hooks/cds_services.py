@@ -4,8 +4,28 @@ from typing import Dict, Any, List, Optional
 from datetime import datetime, date, timedelta
 import uuid
 
+from sqlalchemy.orm import Session
+
+from .prefetch import PrefetchResolver
+from .rules import BLOOD_PRESSURE_PANEL
+
+ACTIVE_MEDICATIONS = "MedicationRequest?patient={{context.patientId}}&status=active"
+
+def _blood_pressure(text: Optional[str]) -> Optional[tuple]:
+    """(systolic, diastolic) of a "126/76" panel value, None when it is not a reading"""
+    try:
+        systolic, diastolic = (text or '').split('/')
+        return float(systolic), float(diastolic)
+    except ValueError:
+        return None
+
 class BaseCDSService:
     """Base class for CDS services"""
+
+    id: str = ''
+    hook: str = 'patient-view'
+    # Prefetch templates by key, resolved by PrefetchResolver before execute()
+    prefetch: Dict[str, str] = {}
     
     def create_card(
         self,
@@ -38,6 +58,13 @@ class BaseCDSService:
 
 class DiabetesManagementService(BaseCDSService):
     """Diabetes management CDS service"""
+
+    id = "diabetes-management"
+    prefetch = {
+        "conditions": "Condition?patient={{context.patientId}}&code=44054006,E11.9&clinical-status=active",
+        "a1c": "Observation?patient={{context.patientId}}&code=4548-4&_sort=-date&_count=1",
+        "medications": ACTIVE_MEDICATIONS
+    }
     
     def execute(self, context: Dict[str, Any], prefetch: Dict[str, Any]) -> Dict[str, Any]:
         cards = []
@@ -49,7 +76,7 @@ class DiabetesManagementService(BaseCDSService):
         
         # Check latest A1C
         a1c = prefetch.get("a1c")
-        if a1c and hasattr(a1c, 'value'):
+        if a1c and getattr(a1c, 'value', None) is not None:
             a1c_value = a1c.value
             
             if a1c_value >= 9.0:
@@ -136,6 +163,13 @@ class DiabetesManagementService(BaseCDSService):
 
 class HypertensionManagementService(BaseCDSService):
     """Hypertension management CDS service"""
+
+    id = "hypertension-management"
+    prefetch = {
+        # Readings are stored as panels ("126/76") or as separate components
+        "bp": "Observation?patient={{context.patientId}}&code=85354-9,8480-6,8462-4&_sort=-date",
+        "medications": ACTIVE_MEDICATIONS
+    }
     
     def execute(self, context: Dict[str, Any], prefetch: Dict[str, Any]) -> Dict[str, Any]:
         cards = []
@@ -150,11 +184,17 @@ class HypertensionManagementService(BaseCDSService):
         diastolic_readings = []
         
         for obs in bp_observations:
-            if hasattr(obs, 'code') and hasattr(obs, 'value'):
-                if obs.code == "8480-6":  # Systolic
-                    systolic_readings.append(obs.value)
-                elif obs.code == "8462-4":  # Diastolic
-                    diastolic_readings.append(obs.value)
+            if obs.code == BLOOD_PRESSURE_PANEL:
+                reading = _blood_pressure(obs.text)
+                if reading:
+                    systolic_readings.append(reading[0])
+                    diastolic_readings.append(reading[1])
+            elif obs.value is None:
+                continue
+            elif obs.code == "8480-6":  # Systolic
+                systolic_readings.append(obs.value)
+            elif obs.code == "8462-4":  # Diastolic
+                diastolic_readings.append(obs.value)
         
         if systolic_readings and diastolic_readings:
             avg_systolic = sum(systolic_readings[:3]) / min(3, len(systolic_readings))
@@ -205,6 +245,10 @@ class HypertensionManagementService(BaseCDSService):
 
 class DrugInteractionService(BaseCDSService):
     """Drug interaction checking service"""
+
+    id = "drug-interactions"
+    hook = "medication-prescribe"
+    prefetch = {"medications": ACTIVE_MEDICATIONS}
     
     # Simplified interaction database
     INTERACTIONS = {
@@ -263,6 +307,9 @@ class DrugInteractionService(BaseCDSService):
 
 class PreventiveCareService(BaseCDSService):
     """Preventive care reminder service"""
+
+    id = "preventive-care"
+    prefetch = {"patient": "Patient/{{context.patientId}}"}
     
     def execute(self, context: Dict[str, Any], prefetch: Dict[str, Any]) -> Dict[str, Any]:
         cards = []
@@ -314,4 +361,21 @@ class PreventiveCareService(BaseCDSService):
             indicator="info"
         ))
         
-        return {"cards": cards}
\ No newline at end of file
+        return {"cards": cards}
+
+
+BUILTIN_SERVICES: List[BaseCDSService] = [
+    DiabetesManagementService(), HypertensionManagementService(),
+    DrugInteractionService(), PreventiveCareService()
+]
+
+def services_for_hook(hook_type: str) -> List[BaseCDSService]:
+    """Built-in services answering a hook type"""
+    return [service for service in BUILTIN_SERVICES if service.hook == hook_type]
+
+def execute_services(db: Session, services: List[BaseCDSService], context: Dict[str, Any]) -> Dict[str, Any]:
+    """Run several services for one hook invocation, resolving their prefetch data together"""
+    cards = []
+    for service, prefetch in zip(services, PrefetchResolver(db).resolve(services, context)):
+        cards.extend(service.execute(context, prefetch).get("cards", []))
+    return {"cards": cards}
@@ -0,0 +1,155 @@
+"""
+CDS Hooks Registry
+Hook definitions stored in the database, compiled once per worker
+
+Every write (deletes included) moves a registry version counter forward and
+stamps the hook with the new value. Each worker keeps the compiled hooks in
+memory and checks the counter before serving; only hooks whose version
+changed are recompiled, so discovery and execution never re-read hook JSON
+while the registry is unchanged.
+"""
+
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models.cds_hook_models import CDSHook, CDSHookRegistryVersion
+from .rules import CompiledHook, RuleError
+
+logger = logging.getLogger(__name__)
+
+# Bookkeeping fields returned with a hook but not part of its definition
+METADATA_FIELDS = ("version", "created_at", "updated_at")
+
+REGISTRY_VERSION_ID = "cds_hooks"
+
+
+class HookRegistry:
+    """Per-worker cache of compiled hooks, refreshed from the cds_hooks table"""
+
+    def __init__(self):
+        self._hooks: Dict[str, CompiledHook] = {}
+        self._version: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def refresh(self, db: Session) -> Dict[str, CompiledHook]:
+        """Bring the compiled hooks up to date with the database; returns them by id"""
+        version = self.registry_version(db)
+        if version == self._version:
+            return self._hooks
+
+        with self._lock:
+            current = dict(db.query(CDSHook.id, CDSHook.version))
+            stale = [hook_id for hook_id, hook_version in current.items()
+                     if hook_id not in self._hooks or self._hooks[hook_id].version != hook_version]
+
+            hooks = {hook_id: hook for hook_id, hook in self._hooks.items() if current.get(hook_id) == hook.version}
+            if stale:
+                for record in db.query(CDSHook).filter(CDSHook.id.in_(stale)):
+                    try:
+                        hooks[record.id] = CompiledHook(record.id, record.definition, record.version)
+                    except RuleError as e:
+                        # One stored definition that no longer compiles must not take down the others
+                        logger.error(f"CDS hook {record.id} (version {record.version}) does not compile: {e}")
+
+            # Swapped in whole, so concurrent readers see either the old or the new set
+            self._hooks = hooks
+            self._version = version
+        return hooks
+
+    def clear(self) -> None:
+        """Forget the compiled hooks (the next refresh recompiles everything)"""
+        with self._lock:
+            self._hooks = {}
+            self._version = None
+
+    def hooks(self, db: Session) -> List[CompiledHook]:
+        """All hooks, in priority order"""
+        return sorted(self.refresh(db).values(), key=lambda hook: (hook.priority or 99, hook.id))
+
+    def get(self, db: Session, hook_id: str) -> Optional[CompiledHook]:
+        return self.refresh(db).get(hook_id)
+
+    def for_hook_type(self, db: Session, hook_type: str) -> List[CompiledHook]:
+        """Enabled hooks of a hook type (patient-view, ...), in priority order"""
+        return [hook for hook in self.hooks(db) if hook.hook == hook_type and hook.enabled]
+
+    # Writes
+
+    def save(self, db: Session, hook_id: str, definition: Dict[str, Any],
+             record: Optional[CDSHook] = None) -> CDSHook:
+        """
+        Validate and store a hook definition at the next registry version.
+
+        Raises RuleError when the definition does not compile.
+        """
+        definition = {key: value for key, value in definition.items() if key not in METADATA_FIELDS}
+        definition["id"] = hook_id
+        CompiledHook(hook_id, definition)
+
+        version = self.next_version(db)
+        if record is None:
+            record = CDSHook(id=hook_id, created_at=datetime.utcnow())
+            db.add(record)
+        record.hook = definition.get("hook") or ""
+        record.enabled = bool(definition.get("enabled", True))
+        record.priority = definition.get("priority")
+        record.definition = definition
+        record.version = version
+        record.updated_at = datetime.utcnow()
+        db.commit()
+        db.refresh(record)
+        return record
+
+    def delete(self, db: Session, record: CDSHook) -> None:
+        self.next_version(db)
+        db.delete(record)
+        db.commit()
+
+    @staticmethod
+    def registry_version(db: Session) -> int:
+        """Current registry version, 0 before the first write"""
+        return db.query(CDSHookRegistryVersion.version).filter(
+            CDSHookRegistryVersion.id == REGISTRY_VERSION_ID
+        ).scalar() or 0
+
+    @staticmethod
+    def next_version(db: Session) -> int:
+        """
+        Move the registry version forward in the caller's transaction.
+
+        The increment locks the counter row until the caller commits, so two
+        writers never get the same version.
+        """
+        counter = CDSHookRegistryVersion.__table__
+        moved = db.execute(
+            update(counter).where(counter.c.id == REGISTRY_VERSION_ID).values(version=counter.c.version + 1)
+        ).rowcount
+        if not moved:
+            # First write: start above any version already stored
+            start = (db.query(func.max(CDSHook.version)).scalar() or 0) + 1
+            try:
+                with db.begin_nested():
+                    db.add(CDSHookRegistryVersion(id=REGISTRY_VERSION_ID, version=start))
+            except IntegrityError:
+                # Another worker created the counter at the same time
+                return HookRegistry.next_version(db)
+        return HookRegistry.registry_version(db)
+
+    @staticmethod
+    def to_response(record: CDSHook) -> Dict[str, Any]:
+        """The hook as submitted, with its version and timestamps"""
+        return {
+            **record.definition,
+            "version": record.version,
+            "created_at": record.created_at.isoformat() if record.created_at else None,
+            "updated_at": record.updated_at.isoformat() if record.updated_at else None
+        }
+
+
+hook_registry = HookRegistry()
@@ -0,0 +1,138 @@
+"""
+CDS Hooks Patient Context
+Per-invocation snapshot of the patient data hook conditions are evaluated against
+
+The snapshot is loaded once per hook invocation with a fixed number of
+queries - demographics, active conditions, active medications and the latest
+observation for every LOINC code the conditions ask about (one lookup in the
+latest_observation projection) - so evaluating a hook costs the same number
+of queries however many conditions it has.
+"""
+
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_
+from sqlalchemy.orm import Session
+
+from models.models import Patient, Condition, Medication, LatestObservation
+
+# Condition types that read the patient's active conditions / medications
+DIAGNOSIS_CONDITION_TYPES = ("diagnosis-code",)
+MEDICATION_CONDITION_TYPES = ("medication-active", "medication-missing")
+
+
+class ObservationValue:
+    """The most recent Observation of one code for the patient"""
+
+    __slots__ = ("observation_date", "value", "value_quantity")
+
+    def __init__(self, observation_date: datetime, value: Optional[str], value_quantity: Optional[float]):
+        self.observation_date = observation_date
+        self.value = value
+        self.value_quantity = value_quantity
+
+    def within(self, cutoff_date: date) -> bool:
+        """Whether the observation was recorded on or after cutoff_date"""
+        observed = self.observation_date
+        if isinstance(observed, datetime):
+            observed = observed.date()
+        return observed >= cutoff_date
+
+
+def observation_keys(conditions: Iterable[Any]) -> Set[Tuple[str, str]]:
+    """(observation_type, loinc_code) pairs whose latest value the compiled conditions need"""
+    return {condition.observation_key for condition in conditions if condition.observation_key}
+
+
+class PatientContext:
+    """In-memory view of one patient's data for condition evaluation"""
+
+    def __init__(self, patient_id: str, date_of_birth: Optional[date], gender: Optional[str],
+                 condition_codes: Set[str], medication_names: List[str],
+                 observations: Dict[Tuple[str, str], ObservationValue]):
+        self.patient_id = patient_id
+        self.date_of_birth = date_of_birth
+        self.gender = gender
+        self.condition_codes = condition_codes
+        self.medication_names = medication_names
+        self.observations = observations
+
+    @classmethod
+    def load(cls, db: Session, patient_id: str, conditions: Iterable[Any]) -> Optional["PatientContext"]:
+        """
+        Load the snapshot needed to evaluate compiled `conditions` for a patient.
+
+        Conditions and medications are only read when a condition needs them,
+        and all requested observation codes are resolved in a single query.
+        Returns None when the patient does not exist.
+        """
+        conditions = list(conditions)
+        demographics = db.query(Patient.date_of_birth, Patient.gender).filter(
+            Patient.id == patient_id
+        ).first()
+        if demographics is None:
+            return None
+
+        condition_types = {condition.type for condition in conditions}
+
+        condition_codes = set()
+        if condition_types.intersection(DIAGNOSIS_CONDITION_TYPES):
+            for snomed_code, icd10_code in db.query(Condition.snomed_code, Condition.icd10_code).filter(
+                and_(Condition.patient_id == patient_id, Condition.clinical_status == 'active')
+            ):
+                condition_codes.update(code for code in (snomed_code, icd10_code) if code)
+
+        medication_names = []
+        if condition_types.intersection(MEDICATION_CONDITION_TYPES):
+            medication_names = [
+                (name or '').lower()
+                for (name,) in db.query(Medication.medication_name).filter(
+                    and_(Medication.patient_id == patient_id, Medication.status == 'active')
+                )
+            ]
+
+        return cls(
+            patient_id=patient_id,
+            date_of_birth=demographics.date_of_birth,
+            gender=demographics.gender,
+            condition_codes=condition_codes,
+            medication_names=medication_names,
+            observations=cls._load_latest_observations(db, patient_id, observation_keys(conditions))
+        )
+
+    @staticmethod
+    def _load_latest_observations(db: Session, patient_id: str,
+                                  keys: Set[Tuple[str, str]]) -> Dict[Tuple[str, str], ObservationValue]:
+        """Latest observation per (observation_type, loinc_code), from the latest_observation projection"""
+        if not keys:
+            return {}
+
+        rows = db.query(
+            LatestObservation.observation_type,
+            LatestObservation.loinc_code,
+            LatestObservation.observation_date,
+            LatestObservation.value,
+            LatestObservation.value_quantity
+        ).filter(
+            LatestObservation.patient_id == patient_id,
+            LatestObservation.loinc_code.in_(sorted({code for _, code in keys}))
+        )
+        # The projection holds the latest observation of each code; it answers
+        # a condition when it is of the observation type the condition reads
+        return {
+            (row.observation_type, row.loinc_code): ObservationValue(
+                row.observation_date, row.value, row.value_quantity
+            )
+            for row in rows
+            if (row.observation_type, row.loinc_code) in keys
+        }
+
+    def latest_observation(self, observation_type: str, code: str) -> Optional[ObservationValue]:
+        return self.observations.get((observation_type, code))
+
+    def has_condition(self, codes: Iterable[str]) -> bool:
+        return any(code in self.condition_codes for code in codes)
+
+    def has_medication(self, medications: Iterable[str]) -> bool:
+        return any(target in name for name in self.medication_names for target in medications)
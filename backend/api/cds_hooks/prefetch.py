@@ -0,0 +1,203 @@
+"""
+CDS Hooks Prefetch
+Resolves the prefetch templates CDS services declare, once per hook invocation
+
+Each service lists its templates (CDS Hooks prefetch syntax, e.g.
+"Observation?patient={{context.patientId}}&code=4548-4&_sort=-date&_count=1").
+The resolver renders the templates of every service being invoked, reads each
+distinct query only once, and batches all queries of a resource type into one
+database read (the union of their codes), which is then split back per query
+in memory. Services asking for the same data - most of them want the active
+medications - share one result instead of each issuing its own read.
+
+Supported templates:
+    Patient/{{context.patientId}}                       -> FHIR-style patient dict
+    Condition?patient=...[&code=a,b][&clinical-status=active]
+    MedicationRequest?patient=...[&status=active]       -> Medication rows
+    Observation?patient=...[&code=a,b][&_sort=-date][&_count=n]
+A query with _count=1 resolves to the single newest resource (or None).
+Observations carry their value as a float (None when it is not numeric) and
+the value string as text, e.g. "126/76" for blood pressure panels.
+"""
+
+import re
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from models.models import Patient, Condition, Medication, Observation
+from .rules import numeric_value
+
+TEMPLATE_TOKEN = re.compile(r"\{\{\s*context\.(\w+)\s*\}\}")
+
+# Search parameters understood per resource type (besides patient)
+SUPPORTED_RESOURCES = {
+    "Condition": {"code", "clinical-status"},
+    "MedicationRequest": {"status"},
+    "Observation": {"code", "_sort", "_count"},
+}
+
+
+class PrefetchObservation:
+    """An Observation as handed to services: code, numeric value when there is one, value string"""
+
+    __slots__ = ("id", "code", "display", "value", "text", "unit", "date")
+
+    def __init__(self, observation: Observation):
+        self.id = observation.id
+        self.code = observation.loinc_code
+        self.display = observation.display
+        self.value = numeric_value(observation)
+        self.text = observation.value
+        self.unit = observation.value_unit
+        self.date = observation.observation_date
+
+
+class PrefetchQuery:
+    """A rendered prefetch template, parsed into resource type and search parameters"""
+
+    def __init__(self, query: str):
+        self.query = query
+        path, _, search = query.partition("?")
+        self.resource_type, _, self.resource_id = path.partition("/")
+        self.params = dict(parse_qsl(search))
+        self.patient_id = self.resource_id if self.resource_type == "Patient" else self.params.get("patient")
+
+        # Codes may carry a system ("http://loinc.org|4548-4"); only the code is stored
+        codes = self.params.get("code")
+        self.codes = {code.rpartition("|")[2] for code in codes.split(",")} if codes else None
+        self.count = int(self.params["_count"]) if "_count" in self.params else None
+
+    @property
+    def supported(self) -> bool:
+        if not self.patient_id:
+            return False
+        if self.resource_type == "Patient":
+            return not self.params
+        allowed = SUPPORTED_RESOURCES.get(self.resource_type)
+        return allowed is not None and set(self.params) - {"patient"} <= allowed
+
+
+def render_template(template: str, context: Dict[str, Any]) -> Optional[str]:
+    """Fill in {{context.x}} tokens; None when the context lacks a value"""
+    missing = []
+
+    def substitute(match):
+        value = context.get(match.group(1))
+        if value is None:
+            missing.append(match.group(1))
+            return ""
+        return str(value)
+
+    rendered = TEMPLATE_TOKEN.sub(substitute, template)
+    return None if missing else rendered
+
+
+class PrefetchResolver:
+    """Reads the prefetch data of several services with one query per resource type"""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def resolve(self, services: Iterable[Any], context: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """The prefetch dict of each service, in order, built from shared query results"""
+        services = list(services)
+        rendered = []
+        for service in services:
+            keys = {}
+            for key, template in (getattr(service, "prefetch", None) or {}).items():
+                query = render_template(template, context)
+                if query is not None:
+                    keys[key] = query
+            rendered.append(keys)
+
+        # Identical queries across services are read once
+        queries = {query: PrefetchQuery(query) for keys in rendered for query in keys.values()}
+        results = self.fetch([query for query in queries.values() if query.supported])
+
+        # Keys whose query could not be resolved are left out, as CDS Hooks allows
+        return [{key: results[query] for key, query in keys.items() if query in results} for keys in rendered]
+
+    def fetch(self, queries: List[PrefetchQuery]) -> Dict[str, Any]:
+        """Results by query string, reading each (resource type, patient) group once"""
+        groups: Dict[Tuple[str, str], List[PrefetchQuery]] = defaultdict(list)
+        for query in queries:
+            groups[(query.resource_type, query.patient_id)].append(query)
+
+        loaders = {
+            "Patient": self._patients,
+            "Condition": self._conditions,
+            "MedicationRequest": self._medications,
+            "Observation": self._observations,
+        }
+        results = {}
+        for (resource_type, patient_id), group in groups.items():
+            results.update(loaders[resource_type](patient_id, group))
+        return results
+
+    @staticmethod
+    def _all_codes(group: List[PrefetchQuery]) -> Optional[List[str]]:
+        """Union of the group's codes, or None when any query reads every code"""
+        if any(query.codes is None for query in group):
+            return None
+        return sorted(set().union(*(query.codes for query in group)))
+
+    def _patients(self, patient_id: str, group: List[PrefetchQuery]) -> Dict[str, Any]:
+        patient = self.db.query(Patient).filter(Patient.id == patient_id).first()
+        resource = None
+        if patient:
+            resource = {
+                "resourceType": "Patient",
+                "id": patient.id,
+                "birthDate": patient.date_of_birth.isoformat() if patient.date_of_birth else None,
+                "gender": patient.gender,
+                "name": [{"family": patient.last_name, "given": [patient.first_name]}]
+            }
+        return {query.query: resource for query in group}
+
+    def _conditions(self, patient_id: str, group: List[PrefetchQuery]) -> Dict[str, Any]:
+        rows = self.db.query(Condition).filter(Condition.patient_id == patient_id)
+        codes = self._all_codes(group)
+        if codes is not None:
+            rows = rows.filter(or_(Condition.snomed_code.in_(codes), Condition.icd10_code.in_(codes)))
+        rows = rows.order_by(Condition.onset_date.desc()).all()
+
+        results = {}
+        for query in group:
+            status = query.params.get("clinical-status")
+            results[query.query] = [
+                row for row in rows
+                if (query.codes is None or row.snomed_code in query.codes or row.icd10_code in query.codes)
+                and (status is None or row.clinical_status == status)
+            ]
+        return results
+
+    def _medications(self, patient_id: str, group: List[PrefetchQuery]) -> Dict[str, Any]:
+        rows = self.db.query(Medication).filter(
+            Medication.patient_id == patient_id
+        ).order_by(Medication.start_date.desc()).all()
+        return {
+            query.query: [row for row in rows if query.params.get("status") in (None, row.status)]
+            for query in group
+        }
+
+    def _observations(self, patient_id: str, group: List[PrefetchQuery]) -> Dict[str, Any]:
+        rows = self.db.query(Observation).filter(Observation.patient_id == patient_id)
+        codes = self._all_codes(group)
+        if codes is not None:
+            rows = rows.filter(Observation.loinc_code.in_(codes))
+        observations = [PrefetchObservation(row) for row in rows.order_by(Observation.observation_date.desc())]
+
+        results = {}
+        for query in group:
+            matched = [obs for obs in observations if query.codes is None or obs.code in query.codes]
+            if query.params.get("_sort") == "date":
+                matched.reverse()
+            if query.count == 1:
+                results[query.query] = matched[0] if matched else None
+            else:
+                results[query.query] = matched[:query.count] if query.count else matched
+        return results
@@ -0,0 +1,428 @@
+"""
+CDS Hooks Rules
+Compiled, validated form of hook definitions
+
+A hook's conditions are parsed once - thresholds to floats, timeframes to
+days, code lists to sets - into condition objects that evaluate directly
+against a PatientContext. Invalid definitions are rejected when the hook is
+saved instead of silently never firing.
+
+Each condition also compiles to a SQL predicate over patients, so a hook can
+be evaluated for the whole population in one set-based query (dry runs).
+Lab and vital values are read from the latest_observation projection there:
+value_quantity, or a value string that is a plain decimal number, exactly as
+evaluate() reads them.
+"""
+
+import math
+import operator
+import re
+from abc import ABC, abstractmethod
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from sqlalchemy import and_, case, cast, exists, func, not_, or_, true, Float
+from sqlalchemy.orm import Session
+
+from models.models import Patient, Condition, Medication, LatestObservation
+from .patient_context import PatientContext
+
+COMPARATORS = {
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'lt': operator.lt,
+    'le': operator.le,
+}
+
+BLOOD_PRESSURE_PANEL = '85354-9'  # Blood pressure panel LOINC code
+
+# Value strings read as numbers: an optional sign and digits with at most one
+# decimal point, surrounded by spaces (the same rule is spelled out in SQL)
+DECIMAL_VALUE = re.compile(r'[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)')
+
+
+class RuleError(ValueError):
+    """A hook definition that cannot be compiled"""
+
+
+def _number(parameters: dict, name: str, default: Any = None) -> float:
+    value = parameters.get(name, default)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise RuleError(f"Parameter '{name}' must be a number, got {value!r}")
+
+
+def _days(parameters: dict, default: int) -> int:
+    value = parameters.get('timeframe', default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RuleError(f"Parameter 'timeframe' must be a number of days, got {value!r}")
+
+
+def _operator(parameters: dict, default: str, allowed) -> str:
+    value = parameters.get('operator', default)
+    if value not in allowed:
+        raise RuleError(f"Operator {value!r} is not one of {', '.join(sorted(allowed))}")
+    return value
+
+
+def _code_list(parameters: dict, name: str, lower: bool = False) -> Tuple[str, ...]:
+    codes = [code.strip() for code in str(parameters.get(name) or '').split(',') if code.strip()]
+    if not codes:
+        raise RuleError(f"Parameter '{name}' is required")
+    return tuple(code.lower() for code in codes) if lower else tuple(codes)
+
+
+def numeric_value(observation) -> Optional[float]:
+    """value_quantity first, then a plain decimal value string; None when neither is numeric"""
+    if observation.value_quantity is not None:
+        return float(observation.value_quantity)
+    text = (observation.value or '').strip(' ')
+    if DECIMAL_VALUE.fullmatch(text):
+        return float(text)
+    return None
+
+
+def _numeric_latest_value(dialect: str):
+    """numeric_value() of the latest observation in SQL (NULL when neither is numeric)"""
+    text = func.trim(LatestObservation.value)
+    if dialect == "postgresql":
+        is_decimal = text.op('~')(r'^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)$')
+    else:
+        # Digits and at most one point, with at least one digit, after an optional sign
+        unsigned = case((func.substr(text, 1, 1).in_(('+', '-')), func.substr(text, 2)), else_=text)
+        is_decimal = and_(
+            unsigned.op('GLOB')('*[0-9]*'),
+            not_(unsigned.op('GLOB')('*[^0-9.]*')),
+            not_(unsigned.op('GLOB')('*.*.*'))
+        )
+    return func.coalesce(LatestObservation.value_quantity, case((is_decimal, cast(text, Float)), else_=None))
+
+
+def _latest_observation_exists(observation_key: Tuple[str, str], since: date, *criteria):
+    """EXISTS a latest observation of the key, recorded since a date, for the outer patient"""
+    observation_type, code = observation_key
+    return exists().where(
+        LatestObservation.patient_id == Patient.id,
+        LatestObservation.loinc_code == code,
+        LatestObservation.observation_type == observation_type,
+        LatestObservation.observation_date >= datetime.combine(since, time.min),
+        *criteria
+    )
+
+
+def _blood_pressure_component(component: str, dialect: str):
+    """Systolic or diastolic part of a "126/76" value string (NULL when not a reading)"""
+    value = LatestObservation.value
+    if dialect == "postgresql":
+        # Only well-formed readings may be cast, other text would raise
+        well_formed = value.op('~')(r'^\s*[0-9.]+\s*/\s*[0-9.]+\s*$')
+        part = func.split_part(value, '/', 1 if component == 'systolic' else 2)
+    else:
+        slash = func.instr(value, '/')
+        well_formed = slash > 0
+        part = func.substr(value, 1, slash - 1) if component == 'systolic' else func.substr(value, slash + 1)
+    return case((well_formed, cast(part, Float)), else_=None)
+
+
+class CompiledCondition(ABC):
+    """A condition ready to evaluate against a PatientContext"""
+
+    type: str = ''
+    # (observation_type, loinc_code) whose latest value the condition reads
+    observation_key: Optional[Tuple[str, str]] = None
+
+    @abstractmethod
+    def evaluate(self, patient: PatientContext) -> bool:
+        """Whether the condition holds for a loaded patient snapshot"""
+
+    @abstractmethod
+    def predicate(self, today: date, dialect: str):
+        """SQL condition over Patient rows, true exactly where evaluate() would be"""
+
+
+class PatientAgeCondition(CompiledCondition):
+    type = 'patient-age'
+
+    def __init__(self, parameters: dict):
+        self.operator = _operator(parameters, 'eq', {'eq', *COMPARATORS})
+        self.value = _number(parameters, 'value', 0)
+
+    def evaluate(self, patient: PatientContext) -> bool:
+        if not patient.date_of_birth:
+            return False
+        age = (date.today() - patient.date_of_birth).days / 365.25
+        if self.operator == 'eq':
+            return abs(age - self.value) < 1  # Within 1 year
+        return COMPARATORS[self.operator](age, self.value)
+
+    def predicate(self, today: date, dialect: str):
+        # Age is whole days lived / 365.25; bound the birth date by the
+        # equivalent number of days so the comparison stays on the index
+        def born_days_ago(days: int):
+            return today - timedelta(days=days)
+
+        threshold = self.value * 365.25
+        dob = Patient.date_of_birth
+        if self.operator == 'gt':
+            return dob <= born_days_ago(math.floor(threshold) + 1)
+        if self.operator == 'ge':
+            return dob <= born_days_ago(math.ceil(threshold))
+        if self.operator == 'lt':
+            return dob >= born_days_ago(math.ceil(threshold) - 1)
+        if self.operator == 'le':
+            return dob >= born_days_ago(math.floor(threshold))
+        # Within 1 year: threshold - 365.25 < days < threshold + 365.25
+        return and_(
+            dob <= born_days_ago(math.floor(threshold - 365.25) + 1),
+            dob >= born_days_ago(math.ceil(threshold + 365.25) - 1)
+        )
+
+
+class PatientGenderCondition(CompiledCondition):
+    type = 'patient-gender'
+
+    def __init__(self, parameters: dict):
+        self.value = str(parameters.get('value', '')).lower()
+
+    def evaluate(self, patient: PatientContext) -> bool:
+        return (patient.gender or '').lower() == self.value
+
+    def predicate(self, today: date, dialect: str):
+        return func.lower(func.coalesce(Patient.gender, '')) == self.value
+
+
+class DiagnosisCodeCondition(CompiledCondition):
+    type = 'diagnosis-code'
+
+    def __init__(self, parameters: dict):
+        self.codes: FrozenSet[str] = frozenset(_code_list(parameters, 'codes'))
+        self.operator = _operator(parameters, 'in', {'in', 'not-in'})
+
+    def evaluate(self, patient: PatientContext) -> bool:
+        # Active SNOMED and ICD-10 codes are both in the snapshot (SNOMED is primary)
+        found = patient.has_condition(self.codes)
+        return found if self.operator == 'in' else not found
+
+    def predicate(self, today: date, dialect: str):
+        codes = sorted(self.codes)
+        found = exists().where(
+            Condition.patient_id == Patient.id,
+            Condition.clinical_status == 'active',
+            or_(Condition.snomed_code.in_(codes), Condition.icd10_code.in_(codes))
+        )
+        return found if self.operator == 'in' else not_(found)
+
+
+class MedicationCondition(CompiledCondition):
+    """medication-active, or medication-missing when `missing`"""
+
+    def __init__(self, parameters: dict, missing: bool = False):
+        self.type = 'medication-missing' if missing else 'medication-active'
+        self.medications = _code_list(parameters, 'medications', lower=True)
+        self.missing = missing
+
+    def evaluate(self, patient: PatientContext) -> bool:
+        return patient.has_medication(self.medications) != self.missing
+
+    def predicate(self, today: date, dialect: str):
+        name = func.lower(Medication.medication_name)
+        found = exists().where(
+            Medication.patient_id == Patient.id,
+            Medication.status == 'active',
+            or_(*[name.contains(medication, autoescape=True) for medication in self.medications])
+        )
+        return not_(found) if self.missing else found
+
+
+class LabValueCondition(CompiledCondition):
+    type = 'lab-value'
+
+    def __init__(self, parameters: dict):
+        code = parameters.get('code')
+        if not code:
+            raise RuleError("Parameter 'code' is required")
+        self.observation_key = ('laboratory', code)
+        self.operator = _operator(parameters, 'gt', {'eq', 'missing', *COMPARATORS})
+        self.value = _number(parameters, 'value', 0)
+        self.timeframe = _days(parameters, 30)
+
+    def evaluate(self, patient: PatientContext) -> bool:
+        # Latest lab result, if it falls within the timeframe
+        latest_lab = patient.latest_observation(*self.observation_key)
+        if latest_lab is not None and not latest_lab.within(date.today() - timedelta(days=self.timeframe)):
+            latest_lab = None
+
+        if self.operator == 'missing':
+            return latest_lab is None
+        if latest_lab is None:
+            return False
+
+        lab_value = numeric_value(latest_lab)
+        if lab_value is None:
+            return False
+        if self.operator == 'eq':
+            return abs(lab_value - self.value) < 0.01
+        return COMPARATORS[self.operator](lab_value, self.value)
+
+    def predicate(self, today: date, dialect: str):
+        since = today - timedelta(days=self.timeframe)
+        if self.operator == 'missing':
+            return not_(_latest_observation_exists(self.observation_key, since))
+        quantity = _numeric_latest_value(dialect)
+        if self.operator == 'eq':
+            matches = func.abs(quantity - self.value) < 0.01
+        else:
+            matches = COMPARATORS[self.operator](quantity, self.value)
+        return _latest_observation_exists(self.observation_key, since, matches)
+
+
+class LabMissingCondition(CompiledCondition):
+    type = 'lab-missing'
+
+    def __init__(self, parameters: dict):
+        code = parameters.get('code') or parameters.get('labTest')
+        if not code:
+            raise RuleError("Parameter 'code' or 'labTest' is required")
+        self.observation_key = ('laboratory', code)
+        self.timeframe = _days(parameters, 90)
+
+    def evaluate(self, patient: PatientContext) -> bool:
+        # Missing when the latest result is older than the timeframe (or absent)
+        latest_lab = patient.latest_observation(*self.observation_key)
+        return latest_lab is None or not latest_lab.within(date.today() - timedelta(days=self.timeframe))
+
+    def predicate(self, today: date, dialect: str):
+        return not_(_latest_observation_exists(self.observation_key, today - timedelta(days=self.timeframe)))
+
+
+class VitalSignCondition(CompiledCondition):
+    type = 'vital-sign'
+
+    def __init__(self, parameters: dict):
+        code = parameters.get('type')
+        if not code:
+            raise RuleError("Parameter 'type' is required")
+        self.observation_key = ('vital-signs', code)
+        self.operator = _operator(parameters, 'gt', set(COMPARATORS))
+        self.value = _number(parameters, 'value', 0)
+        self.timeframe = _days(parameters, 7)
+        self.component = parameters.get('component', 'systolic')  # For blood pressure
+        if code == BLOOD_PRESSURE_PANEL and self.component not in ('systolic', 'diastolic'):
+            raise RuleError(f"Blood pressure component {self.component!r} is not systolic or diastolic")
+
+    def evaluate(self, patient: PatientContext) -> bool:
+        # Latest vital sign (by LOINC code), if it falls within the timeframe
+        latest_vital = patient.latest_observation(*self.observation_key)
+        if latest_vital is None or not latest_vital.within(date.today() - timedelta(days=self.timeframe)):
+            return False
+
+        if self.observation_key[1] == BLOOD_PRESSURE_PANEL and latest_vital.value:
+            # Blood pressure values are stored as "126/76"
+            if '/' not in latest_vital.value:
+                return False
+            try:
+                systolic, diastolic = latest_vital.value.split('/')
+                vital_value = float(systolic if self.component == 'systolic' else diastolic)
+            except (ValueError, TypeError):
+                return False
+        else:
+            vital_value = numeric_value(latest_vital)
+            if vital_value is None:
+                return False
+
+        return COMPARATORS[self.operator](vital_value, self.value)
+
+    def predicate(self, today: date, dialect: str):
+        since = today - timedelta(days=self.timeframe)
+        if self.observation_key[1] != BLOOD_PRESSURE_PANEL:
+            return _latest_observation_exists(self.observation_key, since, COMPARATORS[self.operator](
+                _numeric_latest_value(dialect), self.value
+            ))
+        quantity_matches = COMPARATORS[self.operator](LatestObservation.value_quantity, self.value)
+
+        # Panels with a value string are read as "systolic/diastolic", others by quantity
+        has_value = and_(LatestObservation.value.isnot(None), LatestObservation.value != '')
+        component = _blood_pressure_component(self.component, dialect)
+        return _latest_observation_exists(self.observation_key, since, or_(
+            and_(has_value, COMPARATORS[self.operator](component, self.value)),
+            and_(not_(has_value), quantity_matches)
+        ))
+
+
+CONDITION_TYPES = {
+    'patient-age': PatientAgeCondition,
+    'patient-gender': PatientGenderCondition,
+    'diagnosis-code': DiagnosisCodeCondition,
+    'medication-active': MedicationCondition,
+    'medication-missing': lambda parameters: MedicationCondition(parameters, missing=True),
+    'lab-value': LabValueCondition,
+    'lab-missing': LabMissingCondition,
+    'vital-sign': VitalSignCondition,
+}
+
+ACTION_TYPES = ('info-card', 'warning-card', 'critical-card', 'suggestion', 'link')
+
+
+def compile_condition(condition: dict) -> CompiledCondition:
+    condition_type = condition.get('type')
+    factory = CONDITION_TYPES.get(condition_type)
+    if factory is None:
+        raise RuleError(f"Unknown condition type {condition_type!r}")
+    try:
+        return factory(condition.get('parameters') or {})
+    except RuleError as e:
+        raise RuleError(f"Condition {condition.get('id', condition_type)}: {e}")
+
+
+class CompiledHook:
+    """A hook definition with its conditions compiled, at a given registry version"""
+
+    def __init__(self, hook_id: str, definition: Dict[str, Any], version: int = 0):
+        self.id = hook_id
+        self.version = version
+        self.definition = definition
+        self.hook = definition.get('hook')
+        self.enabled = definition.get('enabled', True)
+        self.priority = definition.get('priority')
+        self.conditions: List[CompiledCondition] = [
+            compile_condition(condition) for condition in definition.get('conditions') or []
+        ]
+
+        self.actions: List[dict] = []
+        for action in definition.get('actions') or []:
+            if action.get('type') not in ACTION_TYPES:
+                raise RuleError(f"Unknown action type {action.get('type')!r}")
+            self.actions.append({'type': action['type'], 'parameters': action.get('parameters') or {}})
+
+        # CDS Hooks discovery entry
+        self.service = {
+            "hook": self.hook,
+            "title": definition.get("title"),
+            "description": definition.get("description"),
+            "id": hook_id,
+            "prefetch": definition.get("prefetch", {}),
+            "usageRequirements": definition.get("usageRequirements", "")
+        }
+
+    def population_filter(self, today: date, dialect: str):
+        """SQL condition selecting every patient the hook fires for (AND of all conditions)"""
+        if not self.conditions:
+            return true()
+        return and_(*[condition.predicate(today, dialect) for condition in self.conditions])
+
+    def matches(self, patient: Optional[PatientContext]) -> bool:
+        """Evaluate all conditions (AND logic); no conditions means always trigger"""
+        if not self.conditions:
+            return True
+        if patient is None:
+            return False
+        return all(condition.evaluate(patient) for condition in self.conditions)
+
+
+def population_query(db: Session, hook: CompiledHook, today: Optional[date] = None):
+    """Query of the patients a hook would fire for, evaluated as one set-based query"""
+    today = today or date.today()
+    return db.query(Patient).filter(hook.population_filter(today, db.get_bind().dialect.name))
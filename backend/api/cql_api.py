@@ -10,6 +10,7 @@ import json
 
 from database.database import get_db
 from services.cql_engine import CQLTranslationEngine, SimplifiedCQLExecutor
+from services.cql_library_cache import cql_library_cache
 from api.auth import get_current_user
 
 
@@ -18,7 +19,7 @@ router = APIRouter(prefix="/api/cql", tags=["CQL"])
 
 class CQLExecutionRequest(BaseModel):
     cql_content: str
-    patient_id: Optional[int] = None
+    patient_id: Optional[str] = None
     parameters: Optional[Dict[str, Any]] = None
 
 
@@ -95,7 +96,7 @@ async def parse_cql(
         from database.database import SessionLocal
         db = SessionLocal()
         engine = CQLTranslationEngine(db)
-        parsed = engine.parse_cql(request.cql_content)
+        parsed = engine.compile_library(request.cql_content).parsed
         db.close()
         
         return {
@@ -135,6 +136,14 @@ async def create_value_set(
     }
 
 
+@router.get("/cache")
+async def get_library_cache_stats(
+    current_user: dict = Depends(get_current_user)
+):
+    """Hit/miss counters and contents of the compiled library cache"""
+    return cql_library_cache.stats()
+
+
 @router.post("/execute-simplified")
 async def execute_simplified_measure(
     request: SimplifiedMeasureRequest,
@@ -175,7 +184,7 @@ async def validate_cql(
         from database.database import SessionLocal
         db = SessionLocal()
         engine = CQLTranslationEngine(db)
-        parsed = engine.parse_cql(cql_content)
+        parsed = engine.compile_library(cql_content).parsed
         db.close()
         
         # Basic validation
@@ -188,7 +197,7 @@ async def validate_cql(
             issues.append("No definitions found")
         
         # Check for required measure components
-        definition_names = [d["name"] for d in parsed["definitions"]]
+        definition_names = [d["name"].replace(" ", "") for d in parsed["definitions"]]
         required_components = ["InitialPopulation", "Denominator", "Numerator"]
         missing_components = [c for c in required_components if c not in definition_names]
         
@@ -4,38 +4,64 @@ Implements the FHIR Bulk Data Access (Flat FHIR) specification
 """
 
 import asyncio
-import json
+import logging
 import uuid
-import gzip
 import os
 import aiofiles
+from collections import deque
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from pathlib import Path
-import ndjson
+from urllib.parse import parse_qs
 
+from fastapi import HTTPException
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, func, select
 
-from models.synthea_models import Patient, Encounter, Observation, Condition, Medication, Provider, Organization, Location
+from database.database import SessionLocal
+from models.export_models import ExportJob, ExportJobFile
+from models.clinical.tasks import PatientListMembership
+from services.background_tasks import run_in_background
+from .pagination import get_keyset_columns, apply_keyset_order, apply_keyset_seek, encode_cursor, decode_cursor
+from .export_pipeline import (
+    NDJSONGzipWriter, convert_rows, export_columns, get_process_pool,
+    EXPORT_BATCH_SIZE, EXPORT_BATCHES_IN_FLIGHT, EXPORT_TYPE_CONCURRENCY
+)
 
-# Export status storage (in production, use Redis or database)
-EXPORT_JOBS = {}
+logger = logging.getLogger(__name__)
 
 # Export directory
 EXPORT_DIR = Path("exports")
 EXPORT_DIR.mkdir(exist_ok=True)
 
+# Group members per compartment chunk
+GROUP_CHUNK_SIZE = int(os.getenv("FHIR_EXPORT_GROUP_CHUNK_SIZE", "1000"))
+
+# Seconds without a heartbeat after which another worker may resume a job
+EXPORT_JOB_STALE_SECONDS = int(os.getenv("FHIR_EXPORT_JOB_STALE_SECONDS", "120"))
+
+ACTIVE_STATUSES = ["accepted", "in-progress"]
+
+
+class JobReleased(Exception):
+    """Raised when a job was cancelled or claimed by another worker while running"""
+
+
 class BulkExportJob:
     """Represents a bulk export job"""
     
     def __init__(self, job_id: str, export_type: str, resource_types: List[str], 
-                 since: Optional[datetime] = None, patient_ids: Optional[List[str]] = None):
+                 since: Optional[datetime] = None, patient_ids: Optional[List[str]] = None,
+                 type_filters: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+                 group_id: Optional[str] = None):
         self.job_id = job_id
         self.export_type = export_type  # system, patient, group
         self.resource_types = resource_types
         self.since = since
         self.patient_ids = patient_ids
+        self.group_id = group_id
+        # _typeFilter search parameters per resource type (alternatives are OR'ed)
+        self.type_filters = type_filters or {}
         self.status = "accepted"
         self.transaction_time = datetime.utcnow()
         self.request_time = datetime.utcnow()
@@ -43,6 +69,33 @@ class BulkExportJob:
         self.error = []
         self.progress = 0
         self.total = 0
+        self.completed_types = []
+        # Token of the worker run that owns the job
+        self.worker_id = str(uuid.uuid4())
+    
+    @classmethod
+    def from_record(cls, record: ExportJob) -> "BulkExportJob":
+        """Load a job and its output manifest from the database"""
+        job = cls(record.id, record.export_type, list(record.resource_types or []),
+                  record.since, record.patient_ids, record.type_filters, record.group_id)
+        job.status = record.status
+        job.transaction_time = record.transaction_time
+        job.request_time = record.request_time
+        job.progress = record.progress or 0
+        job.total = record.total or 0
+        job.completed_types = list(record.completed_types or [])
+        job.error = list(record.errors or [])
+        job.worker_id = record.worker_id
+        job.output = [
+            {
+                "type": file.resource_type,
+                "url": f"/exports/{record.id}/{file.filename}",
+                "count": file.count,
+                "size": file.size
+            }
+            for file in record.files
+        ]
+        return job
         
     def to_status_response(self) -> Dict[str, Any]:
         """Convert to FHIR bulk export status response"""
@@ -70,228 +123,450 @@ class BulkExportJob:
         return response
 
 
+class BulkExportJobStore:
+    """Export jobs, progress and output manifests kept in the database"""
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def create(self, job: BulkExportJob) -> None:
+        self.db.add(ExportJob(
+            id=job.job_id,
+            export_type=job.export_type,
+            resource_types=job.resource_types,
+            since=job.since,
+            patient_ids=job.patient_ids,
+            type_filters=job.type_filters,
+            group_id=job.group_id,
+            status=job.status,
+            transaction_time=job.transaction_time,
+            request_time=job.request_time,
+            completed_types=[],
+            errors=[],
+            worker_id=job.worker_id,
+            heartbeat_at=datetime.utcnow()
+        ))
+        self.db.commit()
+    
+    def get(self, job_id: str) -> Optional[BulkExportJob]:
+        record = self.db.query(ExportJob).filter(ExportJob.id == job_id).first()
+        return BulkExportJob.from_record(record) if record else None
+    
+    def save_progress(self, job: BulkExportJob) -> None:
+        """
+        Persist status and progress, refreshing the heartbeat.
+
+        Raises JobReleased if the job was cancelled or another worker took it over.
+        """
+        updated = self.db.query(ExportJob).filter(
+            ExportJob.id == job.job_id,
+            ExportJob.worker_id == job.worker_id,
+            ExportJob.status.in_(ACTIVE_STATUSES)
+        ).update({
+            "status": job.status,
+            "progress": job.progress,
+            "total": job.total,
+            "completed_types": list(job.completed_types),
+            "errors": list(job.error),
+            "heartbeat_at": datetime.utcnow()
+        }, synchronize_session=False)
+        self.db.commit()
+        if not updated:
+            raise JobReleased(job.job_id)
+    
+    def add_file(self, job: BulkExportJob, resource_type: str, file_number: int,
+                 filename: str, count: int, size: int, last_key: Optional[str]) -> None:
+        """Record a finished output file; a resumed job continues after its last key"""
+        self.db.add(ExportJobFile(
+            job_id=job.job_id,
+            resource_type=resource_type,
+            file_number=file_number,
+            filename=filename,
+            count=count,
+            size=size,
+            last_key=last_key
+        ))
+        self.save_progress(job)
+    
+    def last_file(self, job_id: str, resource_type: str) -> Optional[ExportJobFile]:
+        return self.db.query(ExportJobFile).filter(
+            ExportJobFile.job_id == job_id,
+            ExportJobFile.resource_type == resource_type
+        ).order_by(ExportJobFile.file_number.desc()).first()
+    
+    def exported_count(self, job_id: str) -> int:
+        """Number of resources in the job's finished files"""
+        return self.db.query(func.coalesce(func.sum(ExportJobFile.count), 0)).filter(
+            ExportJobFile.job_id == job_id
+        ).scalar()
+    
+    def cancel(self, job_id: str) -> bool:
+        updated = self.db.query(ExportJob).filter(
+            ExportJob.id == job_id,
+            ExportJob.status.in_(ACTIVE_STATUSES)
+        ).update({"status": "cancelled"}, synchronize_session=False)
+        self.db.commit()
+        return bool(updated)
+    
+    def claim_stale(self) -> List[BulkExportJob]:
+        """Take over active jobs whose worker stopped sending heartbeats"""
+        cutoff = datetime.utcnow() - timedelta(seconds=EXPORT_JOB_STALE_SECONDS)
+        candidates = self.db.query(ExportJob.id, ExportJob.heartbeat_at).filter(
+            ExportJob.status.in_(ACTIVE_STATUSES),
+            or_(ExportJob.heartbeat_at.is_(None), ExportJob.heartbeat_at < cutoff)
+        ).all()
+        
+        claimed = []
+        for job_id, heartbeat_at in candidates:
+            worker_id = str(uuid.uuid4())
+            # Compare-and-set on the heartbeat so only one worker wins the claim
+            heartbeat_filter = (ExportJob.heartbeat_at.is_(None) if heartbeat_at is None
+                                else ExportJob.heartbeat_at == heartbeat_at)
+            updated = self.db.query(ExportJob).filter(
+                ExportJob.id == job_id, heartbeat_filter
+            ).update({"worker_id": worker_id, "heartbeat_at": datetime.utcnow()},
+                     synchronize_session=False)
+            self.db.commit()
+            if updated:
+                claimed.append(self.get(job_id))
+        return claimed
+    
+    def expired_job_ids(self, cutoff: datetime) -> List[str]:
+        return [job_id for (job_id,) in
+                self.db.query(ExportJob.id).filter(ExportJob.request_time < cutoff).all()]
+    
+    def delete(self, job_id: str) -> None:
+        self.db.query(ExportJobFile).filter(ExportJobFile.job_id == job_id).delete()
+        self.db.query(ExportJob).filter(ExportJob.id == job_id).delete()
+        self.db.commit()
+
+
+async def run_export_job(job: BulkExportJob, bind) -> None:
+    """Process (or resume) a job in its own session, independent of the request"""
+    db = Session(bind=bind)
+    try:
+        await BulkExportService(db)._process_export(job)
+    finally:
+        db.close()
+
+
+async def resume_stale_exports(bind=None) -> int:
+    """Claim and resume jobs left behind by a crashed or restarted worker"""
+    db = Session(bind=bind) if bind is not None else SessionLocal()
+    try:
+        jobs = BulkExportJobStore(db).claim_stale()
+        bind = db.get_bind()
+    finally:
+        db.close()
+    
+    for job in jobs:
+        run_in_background(run_export_job(job, bind))
+    return len(jobs)
+
+
 class BulkExportService:
     """Service for handling bulk FHIR exports"""
     
     def __init__(self, db: Session):
         self.db = db
+        self.store = BulkExportJobStore(db)
         
     async def create_export_job(self, export_type: str, resource_types: List[str], 
                                since: Optional[datetime] = None, 
-                               patient_ids: Optional[List[str]] = None) -> str:
+                               patient_ids: Optional[List[str]] = None,
+                               type_filters: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+                               group_id: Optional[str] = None) -> str:
         """Create a new export job and start processing"""
         job_id = str(uuid.uuid4())
-        job = BulkExportJob(job_id, export_type, resource_types, since, patient_ids)
+        job = BulkExportJob(job_id, export_type, resource_types, since, patient_ids,
+                            type_filters, group_id)
         
-        EXPORT_JOBS[job_id] = job
+        self.store.create(job)
         
-        # Start export in background
-        asyncio.create_task(self._process_export(job))
+        # Start export in background, with its own session
+        run_in_background(run_export_job(job, self.db.get_bind()))
         
         return job_id
     
     def get_export_status(self, job_id: str) -> Optional[BulkExportJob]:
         """Get the status of an export job"""
-        return EXPORT_JOBS.get(job_id)
+        return self.store.get(job_id)
     
     def cancel_export(self, job_id: str) -> bool:
         """Cancel an export job"""
-        job = EXPORT_JOBS.get(job_id)
-        if job and job.status in ["accepted", "in-progress"]:
-            job.status = "cancelled"
-            return True
-        return False
+        return self.store.cancel(job_id)
     
     async def _process_export(self, job: BulkExportJob):
-        """Process the export job asynchronously"""
+        """Process the export job asynchronously, skipping work a previous run finished"""
         try:
             job.status = "in-progress"
             
             # Create export directory for this job
             job_dir = EXPORT_DIR / job.job_id
-            job_dir.mkdir(exist_ok=True)
+            job_dir.mkdir(parents=True, exist_ok=True)
             
-            # Export each resource type
-            for resource_type in job.resource_types:
-                if job.status == "cancelled":
-                    break
-                    
-                await self._export_resource_type(job, resource_type, job_dir)
+            # Progress counts what is already in finished files
+            await asyncio.to_thread(self._count_progress, job)
+            await asyncio.to_thread(self.store.save_progress, job)
+            
+            # Export resource types concurrently, each through its own session
+            semaphore = asyncio.Semaphore(EXPORT_TYPE_CONCURRENCY)
+            
+            async def export_type(resource_type: str):
+                async with semaphore:
+                    await self._export_resource_type(job, resource_type, job_dir)
             
-            if job.status != "cancelled":
-                job.status = "completed"
+            tasks = [
+                asyncio.create_task(export_type(resource_type))
+                for resource_type in job.resource_types
+                if resource_type not in job.completed_types
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+            
+            job.status = "completed"
+            await asyncio.to_thread(self.store.save_progress, job)
                 
+        except JobReleased:
+            # Cancelled, or another worker resumed the job
+            return
         except Exception as e:
+            await asyncio.to_thread(self.db.rollback)
             job.status = "error"
             job.error.append({
                 "type": "exception",
                 "diagnostics": str(e)
             })
+            try:
+                await asyncio.to_thread(self.store.save_progress, job)
+            except JobReleased:
+                pass
     
-    async def _export_resource_type(self, job: BulkExportJob, resource_type: str, job_dir: Path):
-        """Export a specific resource type"""
-        # Import converters dynamically to avoid circular imports
-        from .fhir_router import (
-            patient_to_fhir, encounter_to_fhir, observation_to_fhir, 
-            condition_to_fhir, medication_request_to_fhir, practitioner_to_fhir,
-            organization_to_fhir, location_to_fhir
-        )
-        
-        # Map resource types to models and converters
-        resource_config = {
-            "Patient": {
-                "model": Patient,
-                "converter": patient_to_fhir,
-                "relationships": ["encounters", "observations", "conditions", "medications"]
-            },
-            "Encounter": {
-                "model": Encounter,
-                "converter": encounter_to_fhir,
-                "patient_field": "patient_id"
-            },
-            "Observation": {
-                "model": Observation,
-                "converter": observation_to_fhir,
-                "patient_field": "patient_id"
-            },
-            "Condition": {
-                "model": Condition,
-                "converter": condition_to_fhir,
-                "patient_field": "patient_id"
-            },
-            "MedicationRequest": {
-                "model": Medication,
-                "converter": medication_request_to_fhir,
-                "patient_field": "patient_id"
-            },
-            "Practitioner": {
-                "model": Provider,
-                "converter": practitioner_to_fhir
-            },
-            "Organization": {
-                "model": Organization,
-                "converter": organization_to_fhir
-            },
-            "Location": {
-                "model": Location,
-                "converter": location_to_fhir
-            }
-        }
+    def _resource_config(self, resource_type: str) -> Optional[Dict[str, Any]]:
+        """Model, converter and patient link of an exportable resource type"""
+        # Import lazily to avoid circular imports
+        from .fhir_router import RESOURCE_MAPPINGS, RESOURCE_CONVERTERS
         
-        if resource_type not in resource_config:
-            return
+        if resource_type not in RESOURCE_MAPPINGS:
+            return None
         
-        config = resource_config[resource_type]
+        model = RESOURCE_MAPPINGS[resource_type]["model"]
+        config = {
+            "model": model,
+            "converter": RESOURCE_CONVERTERS[resource_type]
+        }
+        # Resources in the patient compartment
+        if hasattr(model, "patient_id"):
+            config["patient_field"] = "patient_id"
+        return config
+    
+    def _build_query(self, job: BulkExportJob, resource_type: str):
+        """Query for every resource of a type in the export, or None if the type is skipped"""
+        config = self._resource_config(resource_type)
+        if not config:
+            return None
         model = config["model"]
-        converter = config["converter"]
         
-        # Build query
-        query = self.db.query(model)
+        # Build query, with any _typeFilter searches pushed into SQL
+        query = self._filtered_query(resource_type, model, job.type_filters.get(resource_type))
         
         # Apply filters based on export type
-        if job.export_type == "patient" and job.patient_ids:
-            # Patient-specific export
-            if resource_type == "Patient":
-                query = query.filter(model.id.in_(job.patient_ids))
-            elif "patient_field" in config:
-                patient_field = getattr(model, config["patient_field"])
-                query = query.filter(patient_field.in_(job.patient_ids))
-            else:
+        if job.export_type in ("patient", "group"):
+            compartment = self._compartment_column(resource_type, config)
+            if compartment is None:
                 # Skip resources without patient association
-                return
+                return None
+            if job.export_type == "group":
+                # Group members are joined in the database, never loaded into Python
+                query = query.filter(compartment.in_(self._group_members(job.group_id)))
+            elif job.patient_ids:
+                # Patient-specific export
+                query = query.filter(compartment.in_(job.patient_ids))
         
         # Apply since filter
         if job.since and hasattr(model, "updated_at"):
             query = query.filter(model.updated_at >= job.since)
         
-        # Count total for progress
-        total = query.count()
-        if total == 0:
-            return
-            
-        job.total += total
-        
-        # Export in batches
-        batch_size = 1000
-        file_number = 1
-        current_file_resources = []
-        max_file_size = 50 * 1024 * 1024  # 50MB per file
+        return query.order_by(None)
+    
+    @staticmethod
+    def _compartment_column(resource_type: str, config: Dict[str, Any]):
+        """Column holding the patient of a resource, or None outside the patient compartment"""
+        model = config["model"]
+        if resource_type == "Patient":
+            return model.id
+        if "patient_field" in config:
+            return getattr(model, config["patient_field"])
+        return None
+    
+    @staticmethod
+    def _group_members(group_id: str):
+        return select(PatientListMembership.patient_id).where(
+            PatientListMembership.patient_list_id == group_id
+        )
+    
+    def _seek_columns(self, job: BulkExportJob, resource_type: str):
+        """
+        Keyset columns a resource type is exported in.
+
+        Group exports walk the compartment patient by patient so each chunk of
+        members is an index range; everything else is exported in id order.
+        """
+        config = self._resource_config(resource_type)
+        model = config["model"]
+        sort_keys = []
+        if job.export_type == "group" and resource_type != "Patient":
+            sort_keys = [(self._compartment_column(resource_type, config), False)]
+        return get_keyset_columns(model, sort_keys)
+    
+    def _filtered_query(self, resource_type: str, model, filters: Optional[List[Dict[str, Any]]]):
+        """Base query for a resource type, restricted by its _typeFilter searches"""
+        if not filters:
+            return self.db.query(model)
         
-        for offset in range(0, total, batch_size):
-            if job.status == "cancelled":
-                break
-                
-            # Fetch batch
-            batch = query.offset(offset).limit(batch_size).all()
+        from .fhir_router import FHIRSearchProcessor
+        searches = [FHIRSearchProcessor(resource_type, self.db).build_query(params) for params in filters]
+        if len(searches) == 1:
+            return searches[0]
+        # Several filters for one type match resources that satisfy any of them
+        return self.db.query(model).filter(or_(*[
+            model.id.in_(search.with_entities(model.id).order_by(None)) for search in searches
+        ]))
+    
+    def _remaining_query(self, job: BulkExportJob, resource_type: str):
+        """The part of a resource type not yet written to a finished file"""
+        query = self._build_query(job, resource_type)
+        last = self.store.last_file(job.job_id, resource_type)
+        if query is not None and last and last.last_key:
+            columns = self._seek_columns(job, resource_type)
+            query = apply_keyset_seek(query, columns, decode_cursor(columns, last.last_key))
+        return query
+    
+    def _count_progress(self, job: BulkExportJob) -> None:
+        """Set progress from the finished files and total from what is left to export"""
+        job.progress = self.store.exported_count(job.job_id)
+        remaining = 0
+        for resource_type in job.resource_types:
+            if resource_type in job.completed_types:
+                continue
+            query = self._remaining_query(job, resource_type)
+            if query is not None:
+                remaining += query.count()
+        job.total = job.progress + remaining
+    
+    async def _export_resource_type(self, job: BulkExportJob, resource_type: str, job_dir: Path):
+        """Export a specific resource type through a session of its own"""
+        db = Session(bind=self.db.get_bind())
+        try:
+            await BulkExportService(db)._write_resource_type(job, resource_type, job_dir)
+        finally:
+            db.close()
+    
+    async def _write_resource_type(self, job: BulkExportJob, resource_type: str, job_dir: Path):
+        """
+        Stream a resource type into gzip NDJSON files, continuing after its last finished file.
+
+        Batches are read with a keyset seek while earlier batches are still
+        being converted in the process pool; the writer consumes them in order.
+        """
+        query = await asyncio.to_thread(self._build_query, job, resource_type)
+        if query is not None:
+            config = self._resource_config(resource_type)
+            model = config["model"]
+            columns = self._seek_columns(job, resource_type)
+            rows_query = apply_keyset_order(query.with_entities(*export_columns(model)), columns)
             
-            for resource in batch:
-                if job.status == "cancelled":
-                    break
-                    
-                # Convert to FHIR
-                try:
-                    fhir_resource = converter(resource)
-                    current_file_resources.append(fhir_resource)
-                    job.progress += 1
+            last = await asyncio.to_thread(self.store.last_file, job.job_id, resource_type)
+            cursor = last.last_key if last else None
+            writer = NDJSONGzipWriter(job_dir, resource_type, last.file_number + 1 if last else 1)
+            loop = asyncio.get_running_loop()
+            pool = get_process_pool()
+            in_flight = deque()
+            
+            async for chunk_query in self._compartment_chunks(job, resource_type, rows_query):
+                while True:
+                    batch_query = chunk_query
+                    if cursor:
+                        batch_query = apply_keyset_seek(chunk_query, columns, decode_cursor(columns, cursor))
+                    rows, last_row = await asyncio.to_thread(self._fetch_rows, batch_query)
+                    if not rows:
+                        break
+                    cursor = encode_cursor(columns, last_row)
                     
-                    # Check if we should start a new file
-                    estimated_size = len(json.dumps(current_file_resources).encode())
-                    if estimated_size >= max_file_size:
-                        await self._write_ndjson_file(
-                            job_dir, resource_type, file_number, 
-                            current_file_resources, job
-                        )
-                        current_file_resources = []
-                        file_number += 1
-                        
-                except Exception as e:
-                    job.error.append({
-                        "type": "processing",
-                        "diagnostics": f"Error processing {resource_type}/{resource.id}: {str(e)}"
-                    })
+                    conversion = loop.run_in_executor(pool, convert_rows, model, config["converter"], rows)
+                    in_flight.append((conversion, len(rows), cursor))
+                    if len(in_flight) >= EXPORT_BATCHES_IN_FLIGHT:
+                        await self._write_batch(job, resource_type, writer, *in_flight.popleft())
             
-            # Allow other tasks to run
-            await asyncio.sleep(0)
-        
-        # Write remaining resources
-        if current_file_resources and job.status != "cancelled":
-            await self._write_ndjson_file(
-                job_dir, resource_type, file_number, 
-                current_file_resources, job
-            )
-    
-    async def _write_ndjson_file(self, job_dir: Path, resource_type: str, 
-                                 file_number: int, resources: List[Dict], 
-                                 job: BulkExportJob):
-        """Write resources to NDJSON file"""
-        filename = f"{resource_type}-{file_number}.ndjson"
-        filepath = job_dir / filename
-        
-        # Write NDJSON file
-        with open(filepath, 'w') as f:
-            writer = ndjson.writer(f)
-            for resource in resources:
-                writer.writerow(resource)
-        
-        # Compress with gzip
-        compressed_filename = f"{filename}.gz"
-        compressed_filepath = job_dir / compressed_filename
+            while in_flight:
+                await self._write_batch(job, resource_type, writer, *in_flight.popleft())
+            
+            for finished in await asyncio.to_thread(writer.close):
+                await asyncio.to_thread(self.store.add_file, job, resource_type, **finished)
         
-        with open(filepath, 'rb') as f_in:
-            with gzip.open(compressed_filepath, 'wb') as f_out:
-                f_out.writelines(f_in)
+        job.completed_types.append(resource_type)
+        await asyncio.to_thread(self.store.save_progress, job)
+    
+    async def _compartment_chunks(self, job: BulkExportJob, resource_type: str, query):
+        """
+        Split a group export into chunks of GROUP_CHUNK_SIZE members.
+
+        Each chunk is a (lower, upper] range of member patient ids found with
+        one small query on the membership table, so the resource query only
+        joins against that slice of the group. Other exports are one chunk.
+        """
+        if job.export_type != "group":
+            yield query
+            return
         
-        # Remove uncompressed file
-        filepath.unlink()
+        compartment = self._compartment_column(resource_type, self._resource_config(resource_type))
+        lower = None
+        while True:
+            upper = await asyncio.to_thread(self._chunk_upper_bound, job.group_id, lower)
+            chunk = query
+            if lower is not None:
+                chunk = chunk.filter(compartment > lower)
+            if upper is not None:
+                chunk = chunk.filter(compartment <= upper)
+            yield chunk
+            if upper is None:
+                return
+            lower = upper
+    
+    def _chunk_upper_bound(self, group_id: str, lower: Optional[str]) -> Optional[str]:
+        """Patient id closing the next chunk of group members, or None for the last chunk"""
+        members = self.db.query(PatientListMembership.patient_id).filter(
+            PatientListMembership.patient_list_id == group_id
+        )
+        if lower is not None:
+            members = members.filter(PatientListMembership.patient_id > lower)
+        row = members.order_by(PatientListMembership.patient_id).offset(GROUP_CHUNK_SIZE - 1).first()
+        return row[0] if row else None
+    
+    @staticmethod
+    def _fetch_rows(query):
+        """One batch as column dicts (for the pool) plus the last row (for the cursor)"""
+        rows = query.limit(EXPORT_BATCH_SIZE).all()
+        return [row._asdict() for row in rows], (rows[-1] if rows else None)
+    
+    async def _write_batch(self, job: BulkExportJob, resource_type: str, writer: NDJSONGzipWriter,
+                           conversion, row_count: int, last_key: str):
+        """Write one converted batch, recording any files it completed"""
+        data, errors = await conversion
+        job.error.extend(errors)
+        count = row_count - len(errors)
+        job.progress += count
         
-        # Add to output
-        file_size = compressed_filepath.stat().st_size
-        job.output.append({
-            "type": resource_type,
-            "url": f"/exports/{job.job_id}/{compressed_filename}",
-            "count": len(resources),
-            "size": file_size
-        })
+        finished_files = await asyncio.to_thread(writer.write, data, count, last_key)
+        for finished in finished_files:
+            await asyncio.to_thread(self.store.add_file, job, resource_type, **finished)
+        if not finished_files:
+            # Heartbeat; also notices cancellation by another request or worker
+            await asyncio.to_thread(self.store.save_progress, job)
 
 
 class BulkExportRouter:
@@ -301,16 +576,23 @@ class BulkExportRouter:
     async def initiate_export(export_type: str, db: Session, 
                              type_filter: Optional[str] = None,
                              since: Optional[str] = None,
-                             patient_ids: Optional[List[str]] = None):
+                             patient_ids: Optional[List[str]] = None,
+                             search_filters: Optional[List[str]] = None,
+                             group_id: Optional[str] = None):
         """Initiate a bulk export operation"""
+        # Import lazily to avoid circular imports
+        from .fhir_router import RESOURCE_MAPPINGS
+        
         # Parse resource types
-        resource_types = ["Patient", "Encounter", "Observation", "Condition", 
-                         "MedicationRequest", "Practitioner", "Organization", "Location"]
+        resource_types = list(RESOURCE_MAPPINGS.keys())
         
         if type_filter:
             requested_types = [t.strip() for t in type_filter.split(",")]
             resource_types = [t for t in requested_types if t in resource_types]
         
+        # Parse _typeFilter searches
+        type_filters = BulkExportRouter.parse_type_filters(search_filters, resource_types, db)
+        
         # Parse since parameter
         since_datetime = None
         if since:
@@ -322,11 +604,53 @@ class BulkExportRouter:
         # Create export job
         service = BulkExportService(db)
         job_id = await service.create_export_job(
-            export_type, resource_types, since_datetime, patient_ids
+            export_type, resource_types, since_datetime, patient_ids, type_filters, group_id
         )
         
         return job_id
     
+    @staticmethod
+    def parse_type_filters(search_filters: Optional[List[str]], resource_types: List[str],
+                           db: Session) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Parse _typeFilter values such as Observation?code=8867-4&date=ge2023.
+
+        Each value may hold several comma-separated searches. Searches are
+        validated with the FHIR search processor up front, so an invalid
+        filter fails the kick-off request instead of the job.
+        """
+        from .fhir_router import FHIRSearchProcessor
+        
+        type_filters: Dict[str, List[Dict[str, Any]]] = {}
+        for value in search_filters or []:
+            for search in value.split(","):
+                resource_type, _, query_string = search.strip().partition("?")
+                if resource_type not in resource_types:
+                    # Filters for types that are not exported have no effect
+                    continue
+                
+                params = {
+                    key: values[0] if len(values) == 1 else values
+                    for key, values in parse_qs(query_string, keep_blank_values=True).items()
+                }
+                if not params:
+                    raise HTTPException(
+                        status_code=400,
+                        detail={
+                            "resourceType": "OperationOutcome",
+                            "issue": [{
+                                "severity": "error",
+                                "code": "invalid",
+                                "diagnostics": f"Invalid _typeFilter value '{search}'",
+                                "expression": ["_typeFilter"]
+                            }]
+                        }
+                    )
+                FHIRSearchProcessor(resource_type, db).build_query(params)
+                type_filters.setdefault(resource_type, []).append(params)
+        
+        return type_filters
+    
     @staticmethod
     def get_export_status(job_id: str, db: Session):
         """Get the status of an export job"""
@@ -372,11 +696,12 @@ async def cleanup_old_exports():
     """Remove export files older than 24 hours"""
     while True:
         try:
-            cutoff_time = datetime.now() - timedelta(hours=24)
+            cutoff_time = datetime.utcnow() - timedelta(hours=24)
             
-            for job_id in list(EXPORT_JOBS.keys()):
-                job = EXPORT_JOBS[job_id]
-                if job.request_time < cutoff_time:
+            db = SessionLocal()
+            try:
+                store = BulkExportJobStore(db)
+                for job_id in store.expired_job_ids(cutoff_time):
                     # Remove files
                     job_dir = EXPORT_DIR / job_id
                     if job_dir.exists():
@@ -384,8 +709,10 @@ async def cleanup_old_exports():
                             file.unlink()
                         job_dir.rmdir()
                     
-                    # Remove from memory
-                    del EXPORT_JOBS[job_id]
+                    # Remove the job and its manifest
+                    store.delete(job_id)
+            finally:
+                db.close()
             
         except Exception as e:
             print(f"Error cleaning up exports: {e}")
@@ -394,5 +721,16 @@ async def cleanup_old_exports():
         await asyncio.sleep(3600)
 
 
+async def export_job_watchdog():
+    """Resume jobs whose worker died, checking twice per stale interval"""
+    while True:
+        try:
+            await resume_stale_exports()
+        except Exception as e:
+            logger.exception(f"Error resuming exports: {e}")
+        
+        await asyncio.sleep(EXPORT_JOB_STALE_SECONDS / 2)
+
+
 # Cleanup task will be started by the application when needed
-# To avoid RuntimeWarning about unawaited coroutine during imports
\ No newline at end of file
+# To avoid RuntimeWarning about unawaited coroutine during imports
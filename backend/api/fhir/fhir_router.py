@@ -6,10 +6,10 @@ Reference: HAPI FHIR Server specifications
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, BackgroundTasks
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import and_, or_, func, text
+from sqlalchemy.orm import Session, joinedload, aliased
+from sqlalchemy import and_, or_, not_, false, func, text
 from typing import List, Optional, Dict, Any, Union
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from urllib.parse import unquote, parse_qs
 import json
 import uuid
@@ -19,9 +19,15 @@ from enum import Enum
 
 from database.database import get_db
 from models.synthea_models import Patient, Encounter, Organization, Location, Observation, Condition, Medication, Provider, Allergy, Immunization, Procedure, CarePlan, Device, DiagnosticReport, ImagingStudy
+from models.clinical.tasks import PatientList
 from .schemas import *
 from .bulk_export import BulkExportRouter
 from .batch_transaction import BatchProcessor
+from .pagination import paginate_keyset, keyset_page_query, encode_cursor
+from .search_totals import count_search_results
+from .search_parameters import SearchRegistry, SearchParamType, SearchStep, split_search_value, parse_date_value
+from .includes import IncludeGraph, IncludeResolver
+from .streaming import SearchsetStream, STREAM_MIN_COUNT, stream_rows
 from .converters import (
     patient_to_fhir, encounter_to_fhir, observation_to_fhir,
     condition_to_fhir, medication_request_to_fhir, practitioner_to_fhir,
@@ -149,6 +155,30 @@ RESOURCE_MAPPINGS = {
     }
 }
 
+# FHIR converters per resource type
+RESOURCE_CONVERTERS = {
+    "Patient": patient_to_fhir,
+    "Encounter": encounter_to_fhir,
+    "Observation": observation_to_fhir,
+    "Condition": condition_to_fhir,
+    "MedicationRequest": medication_request_to_fhir,
+    "Practitioner": practitioner_to_fhir,
+    "Organization": organization_to_fhir,
+    "Location": location_to_fhir,
+    "AllergyIntolerance": allergy_intolerance_to_fhir,
+    "Immunization": immunization_to_fhir,
+    "Procedure": procedure_to_fhir,
+    "CarePlan": care_plan_to_fhir,
+    "Device": device_to_fhir,
+    "DiagnosticReport": diagnostic_report_to_fhir,
+    "ImagingStudy": imaging_study_to_fhir
+}
+
+# Search parameter registry and reference graph, compiled once at import
+RESOURCE_MODELS = {resource_type: config["model"] for resource_type, config in RESOURCE_MAPPINGS.items()}
+SEARCH_REGISTRY = SearchRegistry(RESOURCE_MODELS)
+INCLUDE_GRAPH = IncludeGraph(RESOURCE_MODELS, SEARCH_REGISTRY)
+
 class SearchModifier(str, Enum):
     EXACT = "exact"
     CONTAINS = "contains"
@@ -162,6 +192,16 @@ class SearchModifier(str, Enum):
 class FHIRSearchProcessor:
     """Processes FHIR search parameters and builds database queries"""
     
+    # Search parameter type -> method applying it
+    STEP_HANDLERS = {
+        SearchParamType.STRING: "_apply_string_param",
+        SearchParamType.TOKEN: "_apply_token_param",
+        SearchParamType.DATE: "_apply_date_param",
+        SearchParamType.QUANTITY: "_apply_quantity_param",
+        SearchParamType.REFERENCE: "_apply_reference_param",
+        SearchParamType.SPECIAL: "_apply_special_param",
+    }
+    
     def __init__(self, resource_type: str, db: Session):
         self.resource_type = resource_type
         self.db = db
@@ -169,18 +209,20 @@ class FHIRSearchProcessor:
         if not self.resource_config:
             raise HTTPException(status_code=404, detail=f"Resource type {resource_type} not supported")
         self.model = self.resource_config["model"]
+        # (column, descending) pairs collected from _sort, used for keyset paging
+        self.sort_keys = []
     
     def _validate_search_parameters(self, params: Dict[str, Any]) -> None:
         """Validate search parameters against allowed list"""
         allowed_params = set(self.resource_config["search_params"])
         # Add common control parameters
-        allowed_params.update(['_count', '_offset', '_sort', '_include', 
+        allowed_params.update(['_count', '_offset', '_cursor', '_sort', '_include', 
                               '_revinclude', '_summary', '_total', '_format'])
         
         errors = []
         for param in params:
             # Skip pagination parameters that are handled separately
-            if param in ['_count', '_offset', '_total', '_include', '_revinclude']:
+            if param in ['_count', '_offset', '_cursor', '_total', '_include', '_revinclude']:
                 continue
                 
             # Extract base parameter name (remove modifiers and chains)
@@ -211,37 +253,14 @@ class FHIRSearchProcessor:
         
         query = self.db.query(self.model)
         
-        # Handle include parameters for joins
-        if "_include" in search_params:
-            query = self._add_includes(query, search_params["_include"])
-        
-        # Process search parameters
+        # Process control parameters
         for param, value in search_params.items():
             if param.startswith("_"):
                 query = self._handle_control_parameter(query, param, value)
-            else:
-                query = self._handle_search_parameter(query, param, value)
-        
-        return query
-    
-    def _add_includes(self, query, include_params):
-        """Add JOIN clauses for _include parameters"""
-        if isinstance(include_params, str):
-            include_params = [include_params]
         
-        for include in include_params:
-            # Parse include: ResourceType:field or ResourceType:field:target
-            parts = include.split(":")
-            if len(parts) >= 2:
-                source_type, field = parts[0], parts[1]
-                
-                if source_type == self.resource_type:
-                    if field == "subject" and hasattr(self.model, "patient_id"):
-                        query = query.options(joinedload(self.model.patient))
-                    elif field == "encounter" and hasattr(self.model, "encounter_id"):
-                        query = query.options(joinedload(self.model.encounter))
-                    elif field == "performer" and hasattr(self.model, "provider_id"):
-                        query = query.options(joinedload(self.model.provider))
+        # Apply the compiled search plan for the remaining parameters
+        for step in SEARCH_REGISTRY.plan(self.resource_type, search_params):
+            query = self._apply_search_step(query, step)
         
         return query
     
@@ -249,20 +268,11 @@ class FHIRSearchProcessor:
         """Parse search value that may contain comma-separated values for OR logic"""
         if isinstance(value, list):
             return value
-        if ',' in value:
-            return [v.strip() for v in value.split(',')]
-        return [value]
-    
-    def _parse_token_value(self, value: str) -> tuple[Optional[str], str]:
-        """Parse token value that may contain system|code format"""
-        if '|' in value:
-            parts = value.split('|', 1)
-            return parts[0] if parts[0] else None, parts[1]
-        return None, value
+        return split_search_value(value)
     
     def _handle_control_parameter(self, query, param, value):
         """Handle FHIR control parameters like _count, _sort, etc."""
-        if param == "_count":
+        if param in ("_count", "_offset", "_cursor"):
             # Handled separately in the endpoint
             pass
         elif param == "_sort":
@@ -279,833 +289,136 @@ class FHIRSearchProcessor:
         
         return query
     
-    def _handle_search_parameter(self, query, param, value):
-        """Handle resource-specific search parameters"""
-        # Parse modifiers (e.g., name:exact, birthdate:ge)
-        param_parts = param.split(":")
-        base_param = param_parts[0]
-        modifier = param_parts[1] if len(param_parts) > 1 else None
+    def _apply_search_step(self, query, step: SearchStep):
+        """Apply one step of a compiled search plan"""
+        entity = self.model
+        parameter = step.effective_parameter
         
-        # Check for chained parameters (e.g., subject.family)
-        if "." in base_param:
-            reference_param, chain_param = base_param.split(".", 1)
-            # Handle chained queries by passing both the reference and chain parts
-            base_param = reference_param
-            value = f"{chain_param}.{value}"
+        if step.chain_parameter:
+            # Chained search: join the referenced resource and search on it
+            entity = aliased(RESOURCE_MAPPINGS[step.chain_type]["model"])
+            reference_column = step.parameter.get_columns(self.model)[0]
+            query = query.join(entity, reference_column == entity.id)
         
-        # Resource-specific parameter handling
-        if self.resource_type == "Patient":
-            query = self._handle_patient_params(query, base_param, value, modifier)
-        elif self.resource_type == "Encounter":
-            query = self._handle_encounter_params(query, base_param, value, modifier)
-        elif self.resource_type == "Observation":
-            query = self._handle_observation_params(query, base_param, value, modifier)
-        elif self.resource_type == "Condition":
-            query = self._handle_condition_params(query, base_param, value, modifier)
-        elif self.resource_type == "MedicationRequest":
-            query = self._handle_medication_params(query, base_param, value, modifier)
-        elif self.resource_type == "Practitioner":
-            query = self._handle_practitioner_params(query, base_param, value, modifier)
-        elif self.resource_type == "Organization":
-            query = self._handle_organization_params(query, base_param, value, modifier)
-        elif self.resource_type == "Location":
-            query = self._handle_location_params(query, base_param, value, modifier)
-        elif self.resource_type == "AllergyIntolerance":
-            query = self._handle_allergy_params(query, base_param, value, modifier)
-        elif self.resource_type == "Immunization":
-            query = self._handle_immunization_params(query, base_param, value, modifier)
-        elif self.resource_type == "Procedure":
-            query = self._handle_procedure_params(query, base_param, value, modifier)
-        elif self.resource_type == "CarePlan":
-            query = self._handle_careplan_params(query, base_param, value, modifier)
-        elif self.resource_type == "Device":
-            query = self._handle_device_params(query, base_param, value, modifier)
-        elif self.resource_type == "DiagnosticReport":
-            query = self._handle_diagnostic_report_params(query, base_param, value, modifier)
-        elif self.resource_type == "ImagingStudy":
-            query = self._handle_imaging_study_params(query, base_param, value, modifier)
-        
-        return query
-    
-    def _handle_patient_params(self, query, param, value, modifier):
-        """Handle Patient-specific search parameters"""
-        if param == "family":
-            query = self._apply_string_filter(query, Patient.last_name, value, modifier)
-        elif param == "given":
-            query = self._apply_string_filter(query, Patient.first_name, value, modifier)
-        elif param == "name":
-            # Search both first and last name
-            query = query.filter(
-                or_(
-                    Patient.first_name.ilike(f"%{value}%"),
-                    Patient.last_name.ilike(f"%{value}%")
-                )
-            )
-        elif param == "birthdate":
-            query = self._apply_date_filter(query, Patient.date_of_birth, value, modifier)
-        elif param == "gender":
-            # Token search - exact match
-            query = query.filter(Patient.gender == value)
-        elif param == "identifier":
-            query = query.filter(Patient.mrn == value)
-        elif param == "address":
-            # Search across all address fields
-            query = query.filter(
-                or_(
-                    Patient.address.ilike(f"%{value}%"),
-                    Patient.city.ilike(f"%{value}%"),
-                    Patient.state.ilike(f"%{value}%"),
-                    Patient.zip_code.ilike(f"%{value}%")
-                )
-            )
-        elif param == "telecom":
-            # Search phone and email
-            query = query.filter(
-                or_(
-                    Patient.phone.ilike(f"%{value}%"),
-                    Patient.email.ilike(f"%{value}%")
-                )
-            )
-        elif param == "address-city":
-            query = self._apply_string_filter(query, Patient.city, value, modifier)
-        elif param == "address-state":
-            query = self._apply_string_filter(query, Patient.state, value, modifier)
-        elif param == "address-postalcode":
-            query = self._apply_string_filter(query, Patient.zip_code, value, modifier)
-        elif param == "active":
-            # Token search - exact match for boolean
-            is_active = value == "true"
-            query = query.filter(Patient.is_active == is_active)
-        elif param == "deceased":
-            # Handle deceased status - check if deceased_date is set
-            if modifier == "missing":
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(Patient.date_of_death.is_(None))
-                else:
-                    query = query.filter(Patient.date_of_death.isnot(None))
+        handler = getattr(self, self.STEP_HANDLERS[parameter.type])
+        for operand in step.operands:
+            if step.modifier == "missing" and parameter.type != SearchParamType.SPECIAL:
+                query = self._apply_missing_filter(query, parameter, entity, operand)
             else:
-                # If value is "true", find deceased patients
-                is_deceased = value == "true"
-                if is_deceased:
-                    query = query.filter(Patient.date_of_death.isnot(None))
-                else:
-                    query = query.filter(Patient.date_of_death.is_(None))
+                query = handler(query, parameter, entity, step.modifier, operand)
         
         return query
     
-    def _handle_encounter_params(self, query, param, value, modifier):
-        """Handle Encounter-specific search parameters"""
-        if param == "subject" or param == "patient":
-            # Check if this is a chained parameter (modifier contains Patient.xxx)
-            if modifier and "Patient." in modifier:
-                # Parse the chain: Patient.family, Patient.given, etc.
-                _, chain_param = modifier.split(".", 1)
-                if chain_param == "family":
-                    query = query.join(Patient).filter(Patient.last_name.ilike(f"%{value}%"))
-                elif chain_param == "given":
-                    query = query.join(Patient).filter(Patient.first_name.ilike(f"%{value}%"))
-                elif chain_param == "name":
-                    query = query.join(Patient).filter(
-                        or_(
-                            Patient.first_name.ilike(f"%{value}%"),
-                            Patient.last_name.ilike(f"%{value}%")
-                        )
-                    )
-                elif chain_param == "gender":
-                    query = query.join(Patient).filter(Patient.gender == value)
-            else:
-                # Handle FHIR reference format: Patient/123 or just 123
-                patient_id = value.replace("Patient/", "") if value.startswith("Patient/") else value
-                query = query.filter(Encounter.patient_id == patient_id)
-        elif param == "status":
-            # Token search - exact match
-            query = query.filter(Encounter.status == value)
-        elif param == "type":
-            query = query.filter(Encounter.encounter_type.ilike(f"%{value}%"))
-        elif param == "date" or param == "period":
-            # Handle multiple date values (e.g., period=ge2024-01-01&period=le2024-12-31)
-            if isinstance(value, list):
-                for v in value:
-                    query = self._apply_date_filter(query, Encounter.encounter_date, v, modifier)
-            else:
-                query = self._apply_date_filter(query, Encounter.encounter_date, value, modifier)
-        elif param == "location":
-            if modifier == "missing":
-                # Handle :missing modifier
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(Encounter.location_id.is_(None))
-                else:
-                    query = query.filter(Encounter.location_id.isnot(None))
-            else:
-                # Handle FHIR reference format: Location/123 or just 123
-                location_id = value.replace("Location/", "") if value.startswith("Location/") else value
-                query = query.filter(Encounter.location_id == location_id)
-        elif param == "participant":
-            if modifier == "missing":
-                # Handle :missing modifier
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(Encounter.provider_id.is_(None))
-                else:
-                    query = query.filter(Encounter.provider_id.isnot(None))
-            else:
-                # Handle FHIR reference format: Practitioner/123 or just 123
-                provider_id = value.replace("Practitioner/", "") if value.startswith("Practitioner/") else value
-                query = query.filter(Encounter.provider_id == provider_id)
-        elif param == "class":
-            # Token search - exact match
-            query = query.filter(Encounter.encounter_class == value)
-        elif param == "reason-code":
-            # Search in chief complaint
-            query = self._apply_string_filter(query, Encounter.chief_complaint, value, modifier)
-        elif param == "service-provider":
-            # Search by organization
-            if modifier == "missing":
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(Encounter.organization_id.is_(None))
+    def _apply_missing_filter(self, query, parameter, entity, is_missing):
+        """Apply the :missing modifier to any parameter"""
+        columns = parameter.get_code_columns(entity)
+        if parameter.type == SearchParamType.STRING:
+            missing = [or_(column == None, column == "") for column in columns]
+        else:
+            missing = [column == None for column in columns]
+        
+        if is_missing:
+            return query.filter(and_(*missing))
+        return query.filter(not_(and_(*missing)))
+    
+    def _apply_string_param(self, query, parameter, entity, modifier, value):
+        """String search across one or more columns"""
+        conditions = [self._string_condition(column, value, modifier)
+                      for column in parameter.get_columns(entity)]
+        return query.filter(or_(*conditions))
+    
+    def _apply_token_param(self, query, parameter, entity, modifier, tokens):
+        """Token search; comma-separated tokens are OR-ed"""
+        conditions = []
+        
+        if parameter.systems:
+            # Coded token: pick the column for the code system
+            text_column = parameter.get_text_column(entity)
+            for system, code in tokens:
+                if system:
+                    column = parameter.get_system_column(entity, system)
+                    if column is not None:
+                        conditions.append(column == code)
                 else:
-                    query = query.filter(Encounter.organization_id.isnot(None))
-            else:
-                # Handle FHIR reference format: Organization/123 or just 123
-                org_id = value.replace("Organization/", "") if value.startswith("Organization/") else value
-                query = query.filter(Encounter.organization_id == org_id)
-        
-        return query
-    
-    def _handle_observation_params(self, query, param, value, modifier):
-        """Handle Observation-specific search parameters"""
-        if param == "subject" or param == "patient":
-            if "." in value:
-                # Chained parameter
-                chain_param, chain_value = value.split(".", 1)
-                query = query.join(Patient).filter(
-                    Patient.last_name.ilike(f"%{chain_value}%") if chain_param == "family"
-                    else Patient.first_name.ilike(f"%{chain_value}%")
-                )
-            else:
-                # Handle FHIR reference format: Patient/123 or just 123
-                patient_id = value.replace("Patient/", "") if value.startswith("Patient/") else value
-                query = query.filter(Observation.patient_id == patient_id)
-        elif param == "code":
-            # Support comma-separated LOINC codes with system|code format
-            codes = self._parse_search_value(value)
-            or_conditions = []
-            
-            for code in codes:
-                system, code_value = self._parse_token_value(code)
-                
-                if system == "http://loinc.org" or not system:
-                    # LOINC code search - exact match for tokens
-                    or_conditions.append(Observation.loinc_code == code_value)
+                    conditions.extend(column == code for column in parameter.get_code_columns(entity))
+                    if parameter.match_text and text_column is not None:
+                        conditions.append(text_column.ilike(f"%{code}%"))
                 
                 # Support :text modifier for display text search
-                if modifier == "text":
-                    or_conditions.append(Observation.display.ilike(f"%{code_value}%"))
-            
-            if or_conditions:
-                query = query.filter(or_(*or_conditions))
-        elif param == "category":
-            # Token search - exact match
-            query = query.filter(Observation.observation_type == value)
-        elif param == "value-quantity":
-            # Handle quantity searches with units
-            query = self._apply_quantity_filter(query, Observation.value_quantity, value, modifier)
-        elif param == "effective" or param == "date":
-            query = self._apply_date_filter(query, Observation.observation_date, value, modifier)
-        elif param == "status":
-            # Token search - exact match
-            query = query.filter(Observation.status == value)
-        elif param == "performer":
-            # Handle performer reference
-            if modifier == "missing":
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(Observation.provider_id.is_(None))
-                else:
-                    query = query.filter(Observation.provider_id.isnot(None))
-            else:
-                # Handle FHIR reference format: Practitioner/123 or just 123
-                provider_id = value.replace("Practitioner/", "") if value.startswith("Practitioner/") else value
-                query = query.filter(Observation.provider_id == provider_id)
-        elif param == "encounter":
-            # Handle encounter reference
-            if modifier == "missing":
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(Observation.encounter_id.is_(None))
-                else:
-                    query = query.filter(Observation.encounter_id.isnot(None))
-            else:
-                # Handle FHIR reference format: Encounter/123 or just 123
-                encounter_id = value.replace("Encounter/", "") if value.startswith("Encounter/") else value
-                query = query.filter(Observation.encounter_id == encounter_id)
-        elif param == "value-string":
-            # Search string values
-            query = self._apply_string_filter(query, Observation.value, value, modifier)
-        elif param == "value-concept":
-            # Search coded values
-            query = self._apply_string_filter(query, Observation.value_code, value, modifier)
-        
-        return query
-    
-    def _handle_condition_params(self, query, param, value, modifier):
-        """Handle Condition-specific search parameters"""
-        if param == "subject" or param == "patient":
-            if "." in value:
-                chain_param, chain_value = value.split(".", 1)
-                query = query.join(Patient).filter(
-                    Patient.last_name.ilike(f"%{chain_value}%") if chain_param == "family"
-                    else Patient.first_name.ilike(f"%{chain_value}%")
-                )
-            else:
-                # Handle FHIR reference format: Patient/123 or just 123
-                patient_id = value.replace("Patient/", "") if value.startswith("Patient/") else value
-                query = query.filter(Condition.patient_id == patient_id)
-        elif param == "code":
-            # Support comma-separated values for OR logic
-            codes = self._parse_search_value(value)
-            or_conditions = []
-            
-            for code in codes:
-                system, code_value = self._parse_token_value(code)
-                
-                if system == "http://snomed.info/sct":
-                    # SNOMED code search
-                    or_conditions.append(Condition.snomed_code == code_value)
-                elif system == "http://hl7.org/fhir/sid/icd-10":
-                    # ICD-10 code search
-                    or_conditions.append(Condition.icd10_code == code_value)
-                elif not system:
-                    # No system specified, search all code fields and description
-                    or_conditions.extend([
-                        Condition.snomed_code == code_value,
-                        Condition.icd10_code == code_value,
-                        Condition.description.ilike(f"%{code_value}%")
-                    ])
-                
-                # Support :text modifier for description search
-                if modifier == "text":
-                    or_conditions.append(Condition.description.ilike(f"%{code_value}%"))
-            
-            if or_conditions:
-                query = query.filter(or_(*or_conditions))
-        elif param == "clinical-status":
-            # Token search - exact match
-            query = query.filter(Condition.clinical_status == value)
-        elif param == "verification-status":
-            # Token search - exact match
-            query = query.filter(Condition.verification_status == value)
-        elif param == "severity":
-            # Token search - exact match
-            query = query.filter(Condition.severity == value)
-        elif param == "onset-date":
-            query = self._apply_date_filter(query, Condition.onset_date, value, modifier)
-        elif param == "recorded-date":
-            # Map to recorded_date field
-            query = self._apply_date_filter(query, Condition.recorded_date, value, modifier)
-        elif param == "abatement-date":
-            query = self._apply_date_filter(query, Condition.abatement_date, value, modifier)
-        elif param == "encounter":
-            # Handle encounter reference
-            if modifier == "missing":
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(Condition.encounter_id.is_(None))
-                else:
-                    query = query.filter(Condition.encounter_id.isnot(None))
-            else:
-                # Handle FHIR reference format: Encounter/123 or just 123
-                encounter_id = value.replace("Encounter/", "") if value.startswith("Encounter/") else value
-                query = query.filter(Condition.encounter_id == encounter_id)
-        
-        return query
-    
-    def _handle_medication_params(self, query, param, value, modifier):
-        """Handle MedicationRequest-specific search parameters"""
-        if param == "subject" or param == "patient":
-            if "." in value:
-                chain_param, chain_value = value.split(".", 1)
-                query = query.join(Patient).filter(
-                    Patient.last_name.ilike(f"%{chain_value}%") if chain_param == "family"
-                    else Patient.first_name.ilike(f"%{chain_value}%")
-                )
-            else:
-                # Handle FHIR reference format: Patient/123 or just 123
-                patient_id = value.replace("Patient/", "") if value.startswith("Patient/") else value
-                query = query.filter(Medication.patient_id == patient_id)
-        elif param == "medication":
-            query = query.filter(Medication.medication_name.ilike(f"%{value}%"))
-        elif param == "status":
-            # Token search - exact match
-            query = query.filter(Medication.status == value)
-        elif param == "authored-on":
-            query = self._apply_date_filter(query, Medication.start_date, value, modifier)
-        elif param == "requester":
-            if modifier == "missing":
-                # Handle :missing modifier
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(Medication.prescriber_id.is_(None))
-                else:
-                    query = query.filter(Medication.prescriber_id.isnot(None))
-            else:
-                # Handle FHIR reference format: Practitioner/123 or just 123
-                prescriber_id = value.replace("Practitioner/", "") if value.startswith("Practitioner/") else value
-                query = query.filter(Medication.prescriber_id == prescriber_id)
-        elif param == "code":
-            # Search by RxNorm code with system|code support
-            codes = self._parse_search_value(value)
-            or_conditions = []
-            
-            for code in codes:
-                system, code_value = self._parse_token_value(code)
-                
-                if system == "http://www.nlm.nih.gov/research/umls/rxnorm" or not system:
-                    # RxNorm code search - exact match for tokens
-                    or_conditions.append(Medication.rxnorm_code == code_value)
-                
-                # Support :text modifier for medication name search
-                if modifier == "text":
-                    or_conditions.append(Medication.medication_name.ilike(f"%{code_value}%"))
-            
-            if or_conditions:
-                query = query.filter(or_(*or_conditions))
-        elif param == "encounter":
-            # Handle encounter reference
-            if modifier == "missing":
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(Medication.encounter_id.is_(None))
-                else:
-                    query = query.filter(Medication.encounter_id.isnot(None))
-            else:
-                # Handle FHIR reference format: Encounter/123 or just 123
-                encounter_id = value.replace("Encounter/", "") if value.startswith("Encounter/") else value
-                query = query.filter(Medication.encounter_id == encounter_id)
-        elif param == "intent":
-            # Intent is always "order" for prescriptions in our system
-            if value == "order":
-                # Return all results since all are orders
-                pass
-            else:
-                # No results if searching for other intents
-                query = query.filter(False)
-        
-        return query
-    
-    def _handle_practitioner_params(self, query, param, value, modifier):
-        """Handle Practitioner-specific search parameters"""
-        if param == "name":
-            query = query.filter(
-                or_(
-                    Provider.first_name.ilike(f"%{value}%"),
-                    Provider.last_name.ilike(f"%{value}%")
-                )
-            )
-        elif param == "family":
-            if modifier == "exact":
-                query = query.filter(Provider.last_name == value)
-            else:
-                query = query.filter(Provider.last_name.ilike(f"%{value}%"))
-        elif param == "given":
-            if modifier == "exact":
-                query = query.filter(Provider.first_name == value)
-            else:
-                query = query.filter(Provider.first_name.ilike(f"%{value}%"))
-        elif param == "active":
-            # Token search - exact match for boolean
-            query = query.filter(Provider.active == (value == "true"))
-        elif param == "identifier":
-            query = query.filter(or_(Provider.id == value, Provider.npi == value))
-        elif param == "qualification":
-            # Search in specialty field
-            query = query.filter(Provider.specialty.ilike(f"%{value}%"))
-        
-        return query
-    
-    def _handle_organization_params(self, query, param, value, modifier):
-        """Handle Organization-specific search parameters"""
-        if param == "name":
-            if modifier == "exact":
-                query = query.filter(Organization.name == value)
-            else:
-                query = query.filter(Organization.name.ilike(f"%{value}%"))
-        elif param == "type":
-            # Token search - exact match
-            query = query.filter(Organization.type == value)
-        elif param == "active":
-            # Organization doesn't have active field, so return all if true
-            if value != "true":
-                query = query.filter(False)  # Return empty if searching for inactive
-        elif param == "identifier":
-            query = query.filter(Organization.id == value)
-        
-        return query
-    
-    def _handle_location_params(self, query, param, value, modifier):
-        """Handle Location-specific search parameters"""
-        if param == "name":
-            if modifier == "exact":
-                query = query.filter(Location.name == value)
-            else:
-                query = query.filter(Location.name.ilike(f"%{value}%"))
-        elif param == "type":
-            # Token search - exact match
-            query = query.filter(Location.type == value)
-        elif param == "status":
-            # Location doesn't have status field, so return all if active
-            if value != "active":
-                query = query.filter(False)  # Return empty if not active
-        elif param == "identifier":
-            query = query.filter(Location.id == value)
-        
-        return query
-    
-    def _handle_allergy_params(self, query, param, value, modifier):
-        """Handle AllergyIntolerance-specific search parameters"""
-        if param == "patient":
-            query = query.filter(Allergy.patient_id == value)
-        elif param == "clinical-status":
-            # Token search - exact match
-            query = query.filter(Allergy.clinical_status == value)
-        elif param == "verification-status":
-            # Token search - exact match
-            query = query.filter(Allergy.verification_status == value)
-        elif param == "type":
-            # Token search - exact match
-            query = query.filter(Allergy.allergy_type == value)
-        elif param == "category":
-            # Token search - exact match
-            query = query.filter(Allergy.category == value)
-        elif param == "criticality":
-            # Token search - exact match
-            query = query.filter(Allergy.severity == value)
-        elif param == "code":
-            # Token search - can search SNOMED code or description
-            system, code = self._parse_token_value(value)
-            if system and "snomed" in system.lower():
-                query = query.filter(Allergy.snomed_code == code)
-            else:
-                # Search description if no system specified
-                query = query.filter(
-                    or_(
-                        Allergy.snomed_code == value,
-                        Allergy.description.ilike(f"%{value}%")
-                    )
-                )
-        elif param == "encounter":
-            if modifier == "missing":
-                is_missing = value.lower() == "true"
-                if is_missing:
-                    query = query.filter(Allergy.encounter_id == None)
-                else:
-                    query = query.filter(Allergy.encounter_id != None)
-            else:
-                query = query.filter(Allergy.encounter_id == value)
-        elif param == "onset":
-            query = self._apply_date_filter(query, Allergy.onset_date, value, modifier)
-        elif param == "date":
-            # Use onset_date as the main date
-            query = self._apply_date_filter(query, Allergy.onset_date, value, modifier)
-        elif param == "identifier":
-            query = query.filter(Allergy.id == value)
-        
-        return query
-    
-    def _handle_immunization_params(self, query, param, value, modifier):
-        """Handle Immunization-specific search parameters"""
-        if param == "patient":
-            query = query.filter(Immunization.patient_id == value)
-        elif param == "status":
-            # Token search - exact match
-            query = query.filter(Immunization.status == value)
-        elif param == "vaccine-code":
-            # Token search - can search CVX code or description
-            system, code = self._parse_token_value(value)
-            if system and "cvx" in system.lower():
-                query = query.filter(Immunization.cvx_code == code)
-            else:
-                # Search description if no system specified
-                query = query.filter(
-                    or_(
-                        Immunization.cvx_code == value,
-                        Immunization.description.ilike(f"%{value}%")
-                    )
-                )
-        elif param == "date":
-            query = self._apply_date_filter(query, Immunization.immunization_date, value, modifier)
-        elif param == "identifier":
-            query = query.filter(Immunization.id == value)
-        
-        return query
-    
-    def _handle_procedure_params(self, query, param, value, modifier):
-        """Handle Procedure-specific search parameters"""
-        if param == "patient" or param == "subject":
-            query = query.filter(Procedure.patient_id == value)
-        elif param == "status":
-            # Token search - exact match
-            query = query.filter(Procedure.status == value)
-        elif param == "code":
-            # Token search - can search SNOMED code or description
-            system, code = self._parse_token_value(value)
-            if system and "snomed" in system.lower():
-                query = query.filter(Procedure.snomed_code == code)
-            else:
-                # Search description if no system specified
-                query = query.filter(
-                    or_(
-                        Procedure.snomed_code == value,
-                        Procedure.description.ilike(f"%{value}%")
-                    )
-                )
-        elif param == "encounter":
-            if modifier == "missing":
-                is_missing = value.lower() == "true"
-                if is_missing:
-                    query = query.filter(Procedure.encounter_id == None)
-                else:
-                    query = query.filter(Procedure.encounter_id != None)
-            else:
-                query = query.filter(Procedure.encounter_id == value)
-        elif param == "date":
-            query = self._apply_date_filter(query, Procedure.procedure_date, value, modifier)
-        elif param == "reason-code":
-            query = query.filter(
-                or_(
-                    Procedure.reason_code.ilike(f"%{value}%"),
-                    Procedure.reason_description.ilike(f"%{value}%")
-                )
-            )
-        elif param == "outcome":
-            query = query.filter(Procedure.outcome.ilike(f"%{value}%"))
-        elif param == "identifier":
-            query = query.filter(Procedure.id == value)
-        
-        return query
-    
-    def _handle_careplan_params(self, query, param, value, modifier):
-        """Handle CarePlan-specific search parameters"""
-        if param == "patient" or param == "subject":
-            query = query.filter(CarePlan.patient_id == value)
-        elif param == "status":
-            # Token search - exact match
-            query = query.filter(CarePlan.status == value)
-        elif param == "intent":
-            # Token search - exact match
-            query = query.filter(CarePlan.intent == value)
-        elif param == "category":
-            # Token search - can search SNOMED code or description
-            system, code = self._parse_token_value(value)
-            if system and "snomed" in system.lower():
-                query = query.filter(CarePlan.snomed_code == code)
-            else:
-                query = query.filter(
-                    or_(
-                        CarePlan.snomed_code == value,
-                        CarePlan.description.ilike(f"%{value}%")
-                    )
-                )
-        elif param == "encounter":
-            if modifier == "missing":
-                is_missing = value.lower() == "true"
-                if is_missing:
-                    query = query.filter(CarePlan.encounter_id == None)
-                else:
-                    query = query.filter(CarePlan.encounter_id != None)
-            else:
-                query = query.filter(CarePlan.encounter_id == value)
-        elif param == "date":
-            query = self._apply_date_filter(query, CarePlan.start_date, value, modifier)
-        elif param == "period":
-            query = self._apply_date_filter(query, CarePlan.start_date, value, modifier)
-        elif param == "identifier":
-            query = query.filter(CarePlan.id == value)
-        
-        return query
-    
-    def _handle_device_params(self, query, param, value, modifier):
-        """Handle Device-specific search parameters"""
-        if param == "patient":
-            query = query.filter(Device.patient_id == value)
-        elif param == "status":
-            # Token search - exact match
-            query = query.filter(Device.status == value)
-        elif param == "type":
-            # Token search - can search SNOMED code or description
-            system, code = self._parse_token_value(value)
-            if system and "snomed" in system.lower():
-                query = query.filter(Device.snomed_code == code)
-            else:
-                query = query.filter(
-                    or_(
-                        Device.snomed_code == value,
-                        Device.description.ilike(f"%{value}%")
-                    )
-                )
-        elif param == "udi-carrier" or param == "udi-di":
-            query = query.filter(Device.udi.ilike(f"%{value}%"))
-        elif param == "device-name":
-            query = query.filter(Device.description.ilike(f"%{value}%"))
-        elif param == "identifier":
-            query = query.filter(Device.id == value)
-        
-        return query
-    
-    def _handle_diagnostic_report_params(self, query, param, value, modifier):
-        """Handle DiagnosticReport-specific search parameters"""
-        if param == "patient" or param == "subject":
-            query = query.filter(DiagnosticReport.patient_id == value)
-        elif param == "status":
-            # Token search - exact match
-            query = query.filter(DiagnosticReport.status == value)
-        elif param == "code":
-            # Token search - can search LOINC code or description
-            system, code = self._parse_token_value(value)
-            if system and "loinc" in system.lower():
-                query = query.filter(DiagnosticReport.loinc_code == code)
-            else:
-                query = query.filter(
-                    or_(
-                        DiagnosticReport.loinc_code == value,
-                        DiagnosticReport.description.ilike(f"%{value}%")
-                    )
-                )
-        elif param == "encounter":
-            if modifier == "missing":
-                is_missing = value.lower() == "true"
-                if is_missing:
-                    query = query.filter(DiagnosticReport.encounter_id == None)
-                else:
-                    query = query.filter(DiagnosticReport.encounter_id != None)
-            else:
-                query = query.filter(DiagnosticReport.encounter_id == value)
-        elif param == "date" or param == "issued":
-            query = self._apply_date_filter(query, DiagnosticReport.report_date, value, modifier)
-        elif param == "identifier":
-            query = query.filter(DiagnosticReport.id == value)
-        
-        return query
-    
-    def _handle_imaging_study_params(self, query, param, value, modifier):
-        """Handle ImagingStudy-specific search parameters"""
-        if param == "patient" or param == "subject":
-            query = query.filter(ImagingStudy.patient_id == value)
-        elif param == "status":
-            # Token search - exact match
-            query = query.filter(ImagingStudy.status == value)
-        elif param == "modality":
-            # Token search - exact match
-            query = query.filter(ImagingStudy.modality == value)
-        elif param == "started":
-            query = self._apply_date_filter(query, ImagingStudy.study_date, value, modifier)
-        elif param == "body-site":
-            query = query.filter(ImagingStudy.body_part.ilike(f"%{value}%"))
-        elif param == "identifier":
-            query = query.filter(ImagingStudy.id == value)
-        
-        return query
-    
-    def _apply_date_filter(self, query, field, value, modifier):
-        """Apply date filters with FHIR prefixes (ge, le, gt, lt, eq, ne) and modifiers"""
-        if modifier in ["ge", "gt", "le", "lt", "eq", "ne", "above", "below", "missing"]:
-            prefix = modifier
-            date_value = value
+                if modifier == "text" and text_column is not None:
+                    conditions.append(text_column.ilike(f"%{code}%"))
         else:
-            # Extract prefix from value (e.g., "ge2021-01-01")
-            match = re.match(r"^(eq|ne|gt|ge|lt|le)(.+)$", value)
-            if match:
-                prefix, date_value = match.groups()
-            else:
-                prefix, date_value = "eq", value
-        
-        # Handle missing modifier
-        if prefix == "missing":
-            is_missing = value.lower() == "true"
-            if is_missing:
-                query = query.filter(field == None)
-            else:
-                query = query.filter(field != None)
+            values = [parameter.coerce(code) if parameter.coerce else code for _, code in tokens]
+            for column in parameter.get_columns(entity):
+                conditions.append(column == values[0] if len(values) == 1 else column.in_(values))
+        
+        if not conditions:
+            return query.filter(false())
+        return query.filter(or_(*conditions))
+    
+    def _apply_date_param(self, query, parameter, entity, modifier, operand):
+        """Date search with a parsed (prefix, start, end) operand"""
+        return self._apply_date_filter(query, parameter.get_columns(entity)[0], *operand)
+    
+    def _apply_quantity_param(self, query, parameter, entity, modifier, operand):
+        """Quantity search with a parsed (prefix, number, unit) operand"""
+        if operand is None:
+            # Unparseable quantities are ignored
             return query
-        
-        try:
-            date_obj = datetime.fromisoformat(date_value.replace("Z", "+00:00")).date()
-        except:
-            try:
-                date_obj = datetime.strptime(date_value, "%Y-%m-%d").date()
-            except:
-                # Invalid date format - raise proper error
-                raise HTTPException(
-                    status_code=400,
-                    detail={
-                        "resourceType": "OperationOutcome",
-                        "issue": [{
-                            "severity": "error",
-                            "code": "invalid",
-                            "diagnostics": f"Invalid date format: '{date_value}'. Use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ",
-                            "expression": ["Bundle.entry.request.url"]
-                        }]
-                    }
-                )
-        
-        # Convert date to string format for comparison with database strings
-        # Database format: "2003-11-12 23:17:36.000000"
-        date_str = date_obj.strftime('%Y-%m-%d')
+        return self._apply_quantity_filter(query, parameter.get_columns(entity)[0], *operand)
+    
+    def _apply_reference_param(self, query, parameter, entity, modifier, ids):
+        """Reference search by id; comma-separated ids are OR-ed"""
+        column = parameter.get_columns(entity)[0]
+        if len(ids) > 1:
+            return query.filter(column.in_(ids))
+        return query.filter(column == ids[0])
+    
+    def _apply_special_param(self, query, parameter, entity, modifier, value):
+        """Parameters with their own handler in the registry"""
+        return parameter.handler(query, entity, value, modifier)
+    
+    def _apply_date_filter(self, query, field, prefix, start, end):
+        """
+        Apply date filters with FHIR prefixes as half-open range predicates.
+        
+        The searched value covers [start, end) at its precision (year, month,
+        day or second). Comparing the bare column against the bounds keeps the
+        predicates sargable, so indexes on the date columns can be used.
+        """
+        if field.type.python_type is date:
+            # Date columns: widen the bounds to whole days
+            end = (end - timedelta(microseconds=1)).date() + timedelta(days=1)
+            start = start.date()
         
         if prefix == "eq":
-            # For equality, check if date starts with the date string
-            query = query.filter(func.substr(field, 1, 10) == date_str)
+            query = query.filter(field >= start, field < end)
         elif prefix == "ne":
-            query = query.filter(func.substr(field, 1, 10) != date_str)
-        elif prefix == "gt" or prefix == "above":
-            # For greater than, add time to ensure we get dates after midnight
-            query = query.filter(field > f"{date_str} 23:59:59")
+            query = query.filter(or_(field < start, field >= end))
+        elif prefix in ("gt", "sa", "above"):
+            query = query.filter(field >= end)
         elif prefix == "ge":
-            query = query.filter(field >= f"{date_str} 00:00:00")
-        elif prefix == "lt" or prefix == "below":
-            query = query.filter(field < f"{date_str} 00:00:00")
+            query = query.filter(field >= start)
+        elif prefix in ("lt", "eb", "below"):
+            query = query.filter(field < start)
         elif prefix == "le":
-            # For less than or equal, include the entire day
-            query = query.filter(field <= f"{date_str} 23:59:59")
+            query = query.filter(field < end)
         
         return query
     
-    def _apply_quantity_filter(self, query, field, value, modifier):
-        """Apply quantity filters for numeric values"""
-        # Handle modifier-based filtering
-        if modifier in ["above", "below", "missing"]:
-            if modifier == "missing":
-                is_missing = value == "true"
-                if is_missing:
-                    query = query.filter(field == None)
-                else:
-                    query = query.filter(field != None)
-                return query
-            else:
-                # For above/below, extract the numeric value
-                try:
-                    numeric_value = float(value.split("||")[0])
-                except:
-                    return query
-                
-                if modifier == "above":
-                    query = query.filter(field > numeric_value)
-                elif modifier == "below":
-                    query = query.filter(field < numeric_value)
-                return query
-        
-        # Parse quantity value (e.g., "5.4||mg", "100", "gt5.4")
-        match = re.match(r"^(eq|ne|gt|ge|lt|le)?([0-9.]+)(\|\|(.+))?$", value)
-        if not match:
+    def _apply_last_updated_filter(self, query, value):
+        """Apply _lastUpdated against the updated_at column, when the model has one"""
+        if not hasattr(self.model, "updated_at"):
             return query
         
-        prefix = match.group(1) or "eq"
-        numeric_value = float(match.group(2))
-        unit = match.group(4)
-        
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            prefix, start, end = parse_date_value(v, None)
+            query = self._apply_date_filter(query, self.model.updated_at, prefix, start, end)
+        return query
+    
+    def _apply_quantity_filter(self, query, field, prefix, numeric_value, unit=None):
+        """Apply quantity filters for numeric values"""
         # Filter out null values first
         query = query.filter(field.isnot(None))
         
@@ -1150,29 +463,23 @@ class FHIRSearchProcessor:
                 continue
                 
             query = query.order_by(field.desc() if desc else field.asc())
+            if hasattr(field, "property") and hasattr(field.property, "columns"):
+                self.sort_keys.append((field, desc))
         
         return query
     
-    def _apply_string_filter(self, query, field, value, modifier):
-        """Apply string filters with modifiers"""
+    def _string_condition(self, field, value, modifier):
+        """Build a string match condition honoring :exact and :contains"""
         if modifier == "exact":
-            query = query.filter(field == value)
+            return field == value
         elif modifier == "contains":
-            query = query.filter(field.contains(value))
-        elif modifier == "missing":
-            is_missing = value == "true"
-            if is_missing:
-                query = query.filter(or_(field == None, field == ""))
-            else:
-                query = query.filter(and_(field != None, field != ""))
-        elif modifier == "text":
-            # :text modifier searches across all text fields (simplified implementation)
-            query = query.filter(field.ilike(f"%{value}%"))
-        else:
-            # Default contains behavior
-            query = query.filter(field.ilike(f"%{value}%"))
-        
-        return query
+            return field.contains(value)
+        # Default (and :text) is a case-insensitive partial match
+        return field.ilike(f"%{value}%")
+    
+    def _apply_string_filter(self, query, field, value, modifier):
+        """Apply string filters with modifiers"""
+        return query.filter(self._string_condition(field, value, modifier))
 
 # Conversion functions are now imported from converters.py
 
@@ -1206,7 +513,7 @@ async def get_capability_statement():
                             {"code": "search-type"}
                         ],
                         "searchParam": [
-                            {"name": param, "type": "string"}
+                            {"name": param, "type": SEARCH_REGISTRY.parameter_type(resource_type, param)}
                             for param in RESOURCE_MAPPINGS[resource_type]["search_params"]
                         ]
                     }
@@ -1222,6 +529,7 @@ async def bulk_export_all(
     background_tasks: BackgroundTasks,
     _type: Optional[str] = Query(None),
     _since: Optional[str] = Query(None),
+    _typeFilter: Optional[List[str]] = Query(None),
     _outputFormat: str = Query("application/fhir+ndjson"),
     db: Session = Depends(get_db)
 ):
@@ -1235,7 +543,8 @@ async def bulk_export_all(
         export_type="system",
         db=db,
         type_filter=_type,
-        since=_since
+        since=_since,
+        search_filters=_typeFilter
     )
     
     return Response(
@@ -1251,20 +560,19 @@ async def bulk_export_patients(
     background_tasks: BackgroundTasks,
     _type: Optional[str] = Query(None),
     _since: Optional[str] = Query(None),
+    _typeFilter: Optional[List[str]] = Query(None),
     _outputFormat: str = Query("application/fhir+ndjson"),
     db: Session = Depends(get_db)
 ):
     """Bulk export all patient data"""
     
-    # Get all patient IDs for patient compartment export
-    patient_ids = [p.id for p in db.query(Patient.id).all()]
-    
+    # Without patient ids the export covers the whole patient compartment
     export_id = await BulkExportRouter.initiate_export(
         export_type="patient",
         db=db,
         type_filter=_type,
         since=_since,
-        patient_ids=patient_ids
+        search_filters=_typeFilter
     )
     
     return Response(
@@ -1342,6 +650,7 @@ async def search_resources(
     db: Session = Depends(get_db),
     _count: int = Query(50, le=1000),
     _offset: int = Query(0),
+    _cursor: Optional[str] = Query(None),
     _total: str = Query("accurate"),
     _include: Optional[List[str]] = Query(None),
     _revinclude: Optional[List[str]] = Query(None)
@@ -1364,44 +673,80 @@ async def search_resources(
     processor = FHIRSearchProcessor(resource_type, db)
     query = processor.build_query(search_params)
     
-    # Apply pagination
-    total_count = query.count() if _total == "accurate" else None
-    resources = query.offset(_offset).limit(_count).all()
+    # Bundle.total according to _total (accurate, estimate or none)
+    total_count = count_search_results(query, processor.model, resource_type, search_params, _total)
     
-    # Add pagination links if needed
-    next_url = None
-    if total_count and total_count > _offset + _count:
-        next_offset = _offset + _count
-        next_url = str(request.url.include_query_params(_offset=next_offset))
+    converter = RESOURCE_CONVERTERS.get(resource_type)
+    if not converter:
+        raise HTTPException(status_code=500, detail=f"No converter for {resource_type}")
     
-    # Convert to FHIR format
-    converter_map = {
-        "Patient": patient_to_fhir,
-        "Encounter": encounter_to_fhir,
-        "Observation": observation_to_fhir,
-        "Condition": condition_to_fhir,
-        "MedicationRequest": medication_request_to_fhir,
-        "Practitioner": practitioner_to_fhir,
-        "Organization": organization_to_fhir,
-        "Location": location_to_fhir,
-        "AllergyIntolerance": allergy_intolerance_to_fhir,
-        "Immunization": immunization_to_fhir,
-        "Procedure": procedure_to_fhir,
-        "CarePlan": care_plan_to_fhir,
-        "Device": device_to_fhir,
-        "DiagnosticReport": diagnostic_report_to_fhir,
-        "ImagingStudy": imaging_study_to_fhir
+    include_params = {
+        "includes": _include,
+        "revincludes": _revinclude,
+        "iterate_includes": request.query_params.getlist("_include:iterate"),
+        "iterate_revincludes": request.query_params.getlist("_revinclude:iterate")
     }
+    wants_includes = any(include_params.values())
     
-    converter = converter_map.get(resource_type)
-    if not converter:
-        raise HTTPException(status_code=500, detail=f"No converter for {resource_type}")
+    # Large pages are streamed entry by entry instead of built in memory
+    if _count >= STREAM_MIN_COUNT:
+        if "_offset" in request.query_params:
+            rows = query.offset(_offset).limit(_count)
+            
+            def next_url(last, emitted, has_more):
+                if total_count is not None:
+                    has_more = total_count > _offset + _count
+                else:
+                    has_more = emitted == _count
+                if has_more:
+                    return str(request.url.include_query_params(_offset=_offset + _count))
+                return None
+        else:
+            columns, rows = keyset_page_query(
+                query, processor.model, processor.sort_keys, _count, _cursor
+            )
+            
+            def next_url(last, emitted, has_more):
+                if has_more and last is not None:
+                    cursor = encode_cursor(columns, last)
+                    return str(request.url.include_query_params(_cursor=cursor))
+                return None
+        
+        stream = SearchsetStream(
+            resource_type, converter, str(request.url), total_count,
+            resolver=IncludeResolver(db, INCLUDE_GRAPH, RESOURCE_CONVERTERS) if wants_includes else None,
+            include_params=include_params
+        )
+        return StreamingResponse(
+            stream.iter_bytes(stream_rows(rows), _count, next_url),
+            media_type="application/json"
+        )
+    
+    # Apply pagination
+    next_url = None
+    if "_offset" in request.query_params:
+        # Offset paging is kept for clients that already page with _offset
+        resources = query.offset(_offset).limit(_count).all()
+        if total_count is not None:
+            has_more = total_count > _offset + _count
+        else:
+            # Without a count, a full page means there may be more
+            has_more = len(resources) == _count and _count > 0
+        if has_more:
+            next_offset = _offset + _count
+            next_url = str(request.url.include_query_params(_offset=next_offset))
+    else:
+        # Keyset paging: seek past the last (sort key, id) of the previous page
+        resources, next_cursor = paginate_keyset(
+            query, processor.model, processor.sort_keys, _count, _cursor
+        )
+        if next_cursor:
+            next_url = str(request.url.include_query_params(_cursor=next_cursor))
     
     # Create FHIR Bundle
     bundle = {
         "resourceType": "Bundle",
         "type": "searchset",
-        "total": total_count,
         "link": [
             {
                 "relation": "self",
@@ -1410,6 +755,8 @@ async def search_resources(
         ],
         "entry": []
     }
+    if total_count is not None:
+        bundle["total"] = total_count
     
     for resource in resources:
         entry = {
@@ -1428,12 +775,10 @@ async def search_resources(
             "url": next_url
         })
     
-    # Handle _include and _revinclude
-    if _include:
-        bundle["entry"].extend(await _process_includes(resources, _include, db, request.base_url))
-    
-    if _revinclude:
-        bundle["entry"].extend(await _process_revincludes(resources, _revinclude, db, request.base_url))
+    # Handle _include and _revinclude (including their :iterate forms)
+    if wants_includes:
+        resolver = IncludeResolver(db, INCLUDE_GRAPH, RESOURCE_CONVERTERS)
+        bundle["entry"].extend(resolver.resolve(resource_type, resources, **include_params))
     
     return bundle
 
@@ -1455,26 +800,7 @@ async def get_resource(
     if not resource:
         raise HTTPException(status_code=404, detail=f"{resource_type} not found")
     
-    # Convert to FHIR format
-    converter_map = {
-        "Patient": patient_to_fhir,
-        "Encounter": encounter_to_fhir,
-        "Observation": observation_to_fhir,
-        "Condition": condition_to_fhir,
-        "MedicationRequest": medication_request_to_fhir,
-        "Practitioner": practitioner_to_fhir,
-        "Organization": organization_to_fhir,
-        "Location": location_to_fhir,
-        "AllergyIntolerance": allergy_intolerance_to_fhir,
-        "Immunization": immunization_to_fhir,
-        "Procedure": procedure_to_fhir,
-        "CarePlan": care_plan_to_fhir,
-        "Device": device_to_fhir,
-        "DiagnosticReport": diagnostic_report_to_fhir,
-        "ImagingStudy": imaging_study_to_fhir
-    }
-    
-    converter = converter_map.get(resource_type)
+    converter = RESOURCE_CONVERTERS.get(resource_type)
     if not converter:
         raise HTTPException(status_code=500, detail=f"No converter for {resource_type}")
     
@@ -1521,6 +847,7 @@ async def bulk_export_patient(
     background_tasks: BackgroundTasks,
     _type: Optional[str] = Query(None),
     _since: Optional[str] = Query(None),
+    _typeFilter: Optional[List[str]] = Query(None),
     _outputFormat: str = Query("application/fhir+ndjson"),
     db: Session = Depends(get_db)
 ):
@@ -1536,6 +863,7 @@ async def bulk_export_patient(
         db=db,
         type_filter=_type,
         since=_since,
+        search_filters=_typeFilter,
         patient_ids=[patient_id]
     )
     
@@ -1547,123 +875,38 @@ async def bulk_export_patient(
         }
     )
 
-# Helper functions
-async def _process_includes(resources, include_params, db, base_url):
-    """Process _include parameters"""
-    include_entries = []
-    
-    for include in include_params:
-        parts = include.split(":")
-        if len(parts) >= 2:
-            source_type, field = parts[0], parts[1]
-            
-            # Get related resources based on include parameter
-            if field == "subject":
-                patient_ids = [r.patient_id for r in resources if hasattr(r, 'patient_id') and r.patient_id]
-                patients = db.query(Patient).filter(Patient.id.in_(patient_ids)).all()
-                for patient in patients:
-                    include_entries.append({
-                        "resource": patient_to_fhir(patient),
-                        "fullUrl": f"Patient/{patient.id}",
-                        "search": {"mode": "include"}
-                    })
-    
-    return include_entries
-
-async def _process_revincludes(resources, revinclude_params, db, base_url):
-    """Process _revinclude parameters"""
-    revinclude_entries = []
-    seen_resources = set()
+@router.get("/Group/{group_id}/$export")
+async def bulk_export_group(
+    group_id: str,
+    background_tasks: BackgroundTasks,
+    _type: Optional[str] = Query(None),
+    _since: Optional[str] = Query(None),
+    _typeFilter: Optional[List[str]] = Query(None),
+    _outputFormat: str = Query("application/fhir+ndjson"),
+    db: Session = Depends(get_db)
+):
+    """Bulk export data for the patients of a patient list"""
     
-    # Convert to list if single string
-    if isinstance(revinclude_params, str):
-        revinclude_params = [revinclude_params]
+    # Verify the group (patient list) exists
+    group = db.query(PatientList).filter(PatientList.id == group_id).first()
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
     
-    for revinclude in revinclude_params:
-        # Parse revinclude: ResourceType:field or ResourceType:field:target
-        parts = revinclude.split(":")
-        if len(parts) >= 2:
-            source_type, field = parts[0], parts[1]
-            
-            # Get IDs of current resources
-            resource_ids = [str(r.id) for r in resources]
-            
-            # Find resources that reference the current ones
-            if source_type == "Observation" and field in ["subject", "patient"]:
-                # Find observations that reference these patients
-                observations = db.query(Observation).filter(
-                    Observation.patient_id.in_(resource_ids)
-                ).all()
-                for obs in observations:
-                    resource_key = f"Observation/{obs.id}"
-                    if resource_key not in seen_resources:
-                        seen_resources.add(resource_key)
-                        revinclude_entries.append({
-                            "resource": observation_to_fhir(obs),
-                            "fullUrl": resource_key,
-                            "search": {"mode": "include"}
-                        })
-                        
-            elif source_type == "Encounter" and field in ["subject", "patient"]:
-                # Find encounters that reference these patients
-                encounters = db.query(Encounter).filter(
-                    Encounter.patient_id.in_(resource_ids)
-                ).all()
-                for enc in encounters:
-                    resource_key = f"Encounter/{enc.id}"
-                    if resource_key not in seen_resources:
-                        seen_resources.add(resource_key)
-                        revinclude_entries.append({
-                            "resource": encounter_to_fhir(enc),
-                            "fullUrl": resource_key,
-                            "search": {"mode": "include"}
-                        })
-                        
-            elif source_type == "Condition" and field in ["subject", "patient"]:
-                # Find conditions that reference these patients
-                conditions = db.query(Condition).filter(
-                    Condition.patient_id.in_(resource_ids)
-                ).all()
-                for cond in conditions:
-                    resource_key = f"Condition/{cond.id}"
-                    if resource_key not in seen_resources:
-                        seen_resources.add(resource_key)
-                        revinclude_entries.append({
-                            "resource": condition_to_fhir(cond),
-                            "fullUrl": resource_key,
-                            "search": {"mode": "include"}
-                        })
-                        
-            elif source_type == "MedicationRequest" and field in ["subject", "patient"]:
-                # Find medications that reference these patients
-                medications = db.query(Medication).filter(
-                    Medication.patient_id.in_(resource_ids)
-                ).all()
-                for med in medications:
-                    resource_key = f"MedicationRequest/{med.id}"
-                    if resource_key not in seen_resources:
-                        seen_resources.add(resource_key)
-                        revinclude_entries.append({
-                            "resource": medication_request_to_fhir(med),
-                            "fullUrl": resource_key,
-                            "search": {"mode": "include"}
-                        })
-                        
-            elif source_type == "Observation" and field == "encounter":
-                # Find observations that reference these encounters
-                observations = db.query(Observation).filter(
-                    Observation.encounter_id.in_(resource_ids)
-                ).all()
-                for obs in observations:
-                    resource_key = f"Observation/{obs.id}"
-                    if resource_key not in seen_resources:
-                        seen_resources.add(resource_key)
-                        revinclude_entries.append({
-                            "resource": observation_to_fhir(obs),
-                            "fullUrl": resource_key,
-                            "search": {"mode": "include"}
-                        })
+    export_id = await BulkExportRouter.initiate_export(
+        export_type="group",
+        db=db,
+        type_filter=_type,
+        since=_since,
+        search_filters=_typeFilter,
+        group_id=group_id
+    )
     
-    return revinclude_entries
+    return Response(
+        status_code=202,
+        headers={
+            "Content-Location": f"/fhir/R4/$export-status/{export_id}",
+            "X-Progress": "Accepted for processing"
+        }
+    )
 
 # The _process_bulk_export function is no longer needed as we're using BulkExportRouter
@@ -0,0 +1,223 @@
+"""
+FHIR _include and _revinclude Resolution
+Batched include engine driven by the models' foreign keys
+
+Every foreign key between two mapped resources is a reference link that can
+be followed forwards (_include) or backwards (_revinclude). Each hop is one
+IN query per link, :iterate directives are followed over newly included
+resources, and the number of included entries is capped.
+"""
+
+import os
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from .search_parameters import SearchParamType
+
+# Upper bound on included entries per searchset Bundle
+MAX_INCLUDED_RESOURCES = int(os.getenv("FHIR_MAX_INCLUDED_RESOURCES", "1000"))
+# Maximum number of :iterate rounds after the first hop
+MAX_ITERATE_DEPTH = 3
+# Ids per IN (...) list, below SQLite's bound parameter limit
+IN_CHUNK_SIZE = 500
+# Fewest rows read per query, so already included rows near the cap don't
+# cost a round trip each
+MIN_FETCH_BATCH = 100
+
+
+class ReferenceLink:
+    """A foreign key from one resource type to another"""
+
+    __slots__ = ("source_type", "names", "column_name", "target_type")
+
+    def __init__(self, source_type: str, names: Set[str], column_name: str, target_type: str):
+        self.source_type = source_type
+        # Search parameter names that can be used to follow the link
+        self.names = names
+        self.column_name = column_name
+        self.target_type = target_type
+
+
+class IncludeGraph:
+    """Reference links between resource types, built once from the models"""
+
+    def __init__(self, resource_models: Dict[str, Any], registry):
+        self.resource_models = resource_models
+        self.links: Dict[str, List[ReferenceLink]] = defaultdict(list)
+
+        table_types = {model.__tablename__: resource_type
+                       for resource_type, model in resource_models.items()}
+
+        for resource_type, model in resource_models.items():
+            parameters = registry.definitions.get(resource_type, {})
+            for foreign_key in model.__table__.foreign_keys:
+                target_type = table_types.get(foreign_key.column.table.name)
+                if target_type is None:
+                    continue
+
+                column_name = foreign_key.parent.name
+                names = {column_name[:-3] if column_name.endswith("_id") else column_name}
+                names.update(
+                    name for name, parameter in parameters.items()
+                    if parameter.type == SearchParamType.REFERENCE
+                    and parameter.column_names == [column_name]
+                )
+                self.links[resource_type].append(
+                    ReferenceLink(resource_type, names, column_name, target_type)
+                )
+
+    def find(self, source_type: str, name: str, target_type: Optional[str] = None) -> List[ReferenceLink]:
+        """Links of a source type matching an include parameter (or '*')"""
+        return [
+            link for link in self.links.get(source_type, [])
+            if (name == "*" or name in link.names)
+            and (target_type is None or link.target_type == target_type)
+        ]
+
+    def parse(self, directive: str) -> List[ReferenceLink]:
+        """Resolve an include directive such as Observation:encounter or Observation:subject:Patient"""
+        parts = directive.split(":")
+        if len(parts) < 2:
+            return []
+        target_type = parts[2] if len(parts) > 2 else None
+        return self.find(parts[0], parts[1], target_type)
+
+
+class IncludeResolver:
+    """
+    Resolves _include/_revinclude for one page of search results.
+
+    resolve() may be called once for the whole page or repeatedly for
+    batches of it; de-duplication and the cap apply across calls.
+    """
+
+    def __init__(self, db: Session, graph: IncludeGraph, converters: Dict[str, Any],
+                 limit: int = MAX_INCLUDED_RESOURCES):
+        self.db = db
+        self.graph = graph
+        self.converters = converters
+        self.limit = limit
+        self.entries: List[Dict[str, Any]] = []
+        self.included = 0
+        self.truncated = False
+        self._reported = False
+        self._seen: Set[Tuple[str, str]] = set()
+
+    @property
+    def remaining(self) -> int:
+        return self.limit - self.included
+
+    def resolve(self, resource_type: str, resources: List[Any],
+                includes: List[str] = None, revincludes: List[str] = None,
+                iterate_includes: List[str] = None, iterate_revincludes: List[str] = None) -> List[Dict[str, Any]]:
+        """Return the include entries for the matched resources"""
+        self.entries = []
+        include_links = self._links(includes) + self._links(iterate_includes)
+        revinclude_links = self._links(revincludes) + self._links(iterate_revincludes)
+        iterate_include_links = self._links(iterate_includes)
+        iterate_revinclude_links = self._links(iterate_revincludes)
+
+        for resource in resources:
+            self._seen.add((resource_type, str(resource.id)))
+
+        frontier = {resource_type: list(resources)}
+        new_resources = self._hop(frontier, include_links, revinclude_links)
+
+        depth = 0
+        while new_resources and (iterate_include_links or iterate_revinclude_links) \
+                and depth < MAX_ITERATE_DEPTH and not self.truncated:
+            new_resources = self._hop(new_resources, iterate_include_links, iterate_revinclude_links)
+            depth += 1
+
+        if self.truncated and not self._reported:
+            self.entries.append(self._truncation_outcome())
+            self._reported = True
+        return self.entries
+
+    def _links(self, directives: Optional[List[str]]) -> List[ReferenceLink]:
+        links = []
+        for directive in directives or []:
+            links.extend(self.graph.parse(directive))
+        return links
+
+    def _hop(self, frontier: Dict[str, List[Any]], include_links: List[ReferenceLink],
+             revinclude_links: List[ReferenceLink]) -> Dict[str, List[Any]]:
+        """Follow each link once from the frontier; returns the newly included resources"""
+        added: Dict[str, List[Any]] = defaultdict(list)
+
+        for link in include_links:
+            sources = frontier.get(link.source_type)
+            if not sources:
+                continue
+            ids = {getattr(source, link.column_name) for source in sources}
+            ids = [str(i) for i in ids if i is not None and (link.target_type, str(i)) not in self._seen]
+            model = self.graph.resource_models[link.target_type]
+            self._fetch(link.target_type, model, model.id, ids, added)
+
+        for link in revinclude_links:
+            targets = frontier.get(link.target_type)
+            if not targets:
+                continue
+            ids = [str(target.id) for target in targets]
+            model = self.graph.resource_models[link.source_type]
+            self._fetch(link.source_type, model, getattr(model, link.column_name), ids, added)
+
+        return added
+
+    def _fetch(self, resource_type: str, model, column, ids: List[str], added: Dict[str, List[Any]]) -> None:
+        """
+        Load resources whose column is in ids, one IN query per chunk, respecting the cap.
+
+        Rows are read in id order, seeking past the last one, until the cap is
+        reached or the chunk has no more matches, so resources that were already
+        included cannot hide unseen ones behind the LIMIT.
+        """
+        for start in range(0, len(ids), IN_CHUNK_SIZE):
+            chunk = ids[start:start + IN_CHUNK_SIZE]
+            last_id = None
+            while True:
+                if self.truncated:
+                    return
+
+                query = self.db.query(model).filter(column.in_(chunk))
+                if last_id is not None:
+                    query = query.filter(model.id > last_id)
+                # At least one row past the cap, to detect truncation; rows beyond
+                # it are never converted, the cap check below stops first
+                batch_size = max(self.remaining + 1, MIN_FETCH_BATCH)
+                rows = query.order_by(model.id).limit(batch_size).all()
+
+                for row in rows:
+                    key = (resource_type, str(row.id))
+                    if key in self._seen:
+                        continue
+                    if self.remaining <= 0:
+                        self.truncated = True
+                        return
+                    self._seen.add(key)
+                    self.included += 1
+                    added[resource_type].append(row)
+                    self.entries.append({
+                        "resource": self.converters[resource_type](row),
+                        "fullUrl": f"{resource_type}/{row.id}",
+                        "search": {"mode": "include"}
+                    })
+
+                if len(rows) < batch_size:
+                    break
+                last_id = rows[-1].id
+
+    def _truncation_outcome(self) -> Dict[str, Any]:
+        return {
+            "resource": {
+                "resourceType": "OperationOutcome",
+                "issue": [{
+                    "severity": "warning",
+                    "code": "too-costly",
+                    "diagnostics": f"Included resources were truncated at {self.limit} entries"
+                }]
+            },
+            "search": {"mode": "outcome"}
+        }
@@ -0,0 +1,184 @@
+"""
+FHIR Search Pagination
+Keyset (cursor) pagination for searchset Bundles
+
+Instead of OFFSET, each page seeks past the last row of the previous page on
+the (sort key, id) tuple, so every page costs the same as the first one.
+The position is handed to the client as an opaque `_cursor` parameter.
+
+NULLs sort last. Ordering and seeking NULLs takes an `IS NULL` term no index
+can serve, so it is only added for nullable columns that actually hold NULLs.
+"""
+
+import base64
+import json
+from datetime import datetime, date
+from typing import List, Tuple, Any, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+
+
+def _invalid_cursor(diagnostics: str) -> HTTPException:
+    """Build the OperationOutcome error for a cursor that cannot be used"""
+    return HTTPException(
+        status_code=400,
+        detail={
+            "resourceType": "OperationOutcome",
+            "issue": [{
+                "severity": "error",
+                "code": "invalid",
+                "diagnostics": diagnostics,
+                "expression": ["_cursor"]
+            }]
+        }
+    )
+
+
+def get_keyset_columns(model, sort_keys: List[Tuple[Any, bool]]) -> List[Tuple[Any, bool]]:
+    """Return the seek columns for a search: the requested sort keys plus id as tie-breaker"""
+    columns = list(sort_keys)
+    if not any(column.key == model.id.key for column, _ in columns):
+        columns.append((model.id, False))
+    return columns
+
+
+def _sort_signature(columns: List[Tuple[Any, bool]]) -> str:
+    """Describe the sort order a cursor was issued for"""
+    return ",".join(("-" if desc else "") + column.key for column, desc in columns)
+
+
+def _is_nullable(column) -> bool:
+    prop = column.property.columns[0]
+    return bool(prop.nullable) and not prop.primary_key
+
+
+def _holds_nulls(query, column) -> bool:
+    """
+    Whether a sort column has NULLs to place last.
+
+    Looked up once per session, so the order and the seek of a page agree.
+    """
+    if not _is_nullable(column):
+        return False
+    key = ("keyset_holds_nulls", str(column.property.columns[0]))
+    info = query.session.info
+    if key not in info:
+        info[key] = query.session.query(column).filter(column.is_(None)).limit(1).first() is not None
+    return info[key]
+
+
+def _to_json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _from_json_value(column, value):
+    if value is None:
+        return None
+    try:
+        python_type = column.property.columns[0].type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is date:
+        return date.fromisoformat(value)
+    return value
+
+
+def encode_cursor(columns: List[Tuple[Any, bool]], resource) -> str:
+    """Encode the position of the last resource on a page as an opaque cursor"""
+    payload = {
+        "s": _sort_signature(columns),
+        "k": [_to_json_value(getattr(resource, column.key)) for column, _ in columns]
+    }
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(columns: List[Tuple[Any, bool]], cursor: str) -> List[Any]:
+    """Decode a cursor back into the sort key values of the last resource seen"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values = payload["k"]
+        signature = payload["s"]
+    except Exception:
+        raise _invalid_cursor("Invalid _cursor value")
+
+    if signature != _sort_signature(columns) or len(values) != len(columns):
+        raise _invalid_cursor("_cursor does not match the _sort of this search")
+
+    try:
+        return [_from_json_value(column, value) for (column, _), value in zip(columns, values)]
+    except (TypeError, ValueError):
+        raise _invalid_cursor("Invalid _cursor value")
+
+
+def apply_keyset_order(query, columns: List[Tuple[Any, bool]]):
+    """Order the query by the seek columns, with NULLs last on every dialect"""
+    query = query.order_by(None)
+    for column, desc in columns:
+        if _holds_nulls(query, column):
+            query = query.order_by(column.is_(None))
+        query = query.order_by(column.desc() if desc else column.asc())
+    return query
+
+
+def apply_keyset_seek(query, columns: List[Tuple[Any, bool]], values: List[Any]):
+    """Filter the query to rows strictly after the given sort key values"""
+    predicate = None
+    for (column, desc), value in reversed(list(zip(columns, values))):
+        if value is None:
+            # NULLs sort last, so only other NULLs can follow in this column
+            equal, after = column.is_(None), None
+        else:
+            equal = column == value
+            after = column < value if desc else column > value
+            if _holds_nulls(query, column):
+                after = or_(after, column.is_(None))
+
+        if predicate is None:
+            predicate = after if after is not None else equal
+        elif after is None:
+            predicate = and_(equal, predicate)
+        else:
+            predicate = or_(after, and_(equal, predicate))
+
+    return query.filter(predicate)
+
+
+def keyset_page_query(query, model, sort_keys: List[Tuple[Any, bool]],
+                      count: int, cursor: Optional[str] = None):
+    """
+    Build the query for one keyset page without running it.
+
+    Returns the seek columns and a query for count + 1 rows; the extra row
+    tells whether another page exists.
+    """
+    columns = get_keyset_columns(model, sort_keys)
+    query = apply_keyset_order(query, columns)
+    if cursor:
+        query = apply_keyset_seek(query, columns, decode_cursor(columns, cursor))
+    return columns, query.limit(count + 1)
+
+
+def paginate_keyset(query, model, sort_keys: List[Tuple[Any, bool]],
+                    count: int, cursor: Optional[str] = None):
+    """
+    Fetch one page of a search with keyset pagination.
+
+    Returns the resources on the page and the cursor for the next page,
+    or None when this is the last page.
+    """
+    columns, page_query = keyset_page_query(query, model, sort_keys, count, cursor)
+    rows = page_query.all()
+    resources = rows[:count]
+
+    next_cursor = None
+    if len(rows) > count and resources:
+        next_cursor = encode_cursor(columns, resources[-1])
+
+    return resources, next_cursor
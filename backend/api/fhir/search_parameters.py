@@ -0,0 +1,532 @@
+"""
+FHIR Search Parameter Registry
+Declarative definitions of the search parameters supported for each resource
+
+Every parameter maps to one or more model columns and a search type
+(string, token, date, quantity, reference). The registry is compiled once at
+import, and each distinct query is turned into a search plan - modifiers,
+chains and prefixes already parsed - that is kept in an LRU plan cache keyed
+by the normalized query string.
+"""
+
+import re
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from typing import Dict, Any, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import or_, false
+
+from services.lru_cache import LRUCache
+
+SEARCH_PLAN_CACHE_SIZE = 512
+
+DATE_PREFIXES = ["eq", "ne", "gt", "ge", "lt", "le", "sa", "eb"]
+
+
+class SearchParamType(str, Enum):
+    STRING = "string"
+    TOKEN = "token"
+    DATE = "date"
+    QUANTITY = "quantity"
+    REFERENCE = "reference"
+    SPECIAL = "special"
+
+
+class SearchParameter:
+    """Definition of a single search parameter of a resource"""
+
+    def __init__(self, param_type: SearchParamType, *columns: str,
+                 target: Optional[str] = None,
+                 systems: Optional[Dict[str, str]] = None,
+                 text_column: Optional[str] = None,
+                 match_text: bool = False,
+                 coerce=None,
+                 handler=None):
+        self.type = param_type
+        self.column_names = list(columns)
+        # Reference parameters: the resource type being referenced
+        self.target = target
+        # Coded tokens: code system keyword -> column holding codes of that system
+        self.systems = systems or {}
+        # Column searched by the :text modifier
+        self.text_column = text_column
+        # Whether a code without a system also matches the text column
+        self.match_text = match_text
+        # Converts token values before comparison (e.g. "true" -> True)
+        self.coerce = coerce
+        # SPECIAL parameters: callable(query, entity, value, modifier) -> query
+        self.handler = handler
+
+    def bind(self, model, resource_type: str, name: str) -> None:
+        """Check every referenced column exists on the model"""
+        names = self.column_names + list(self.systems.values())
+        if self.text_column:
+            names.append(self.text_column)
+        for column_name in names:
+            if not hasattr(model, column_name):
+                raise AttributeError(
+                    f"Search parameter {resource_type}.{name} refers to unknown column '{column_name}'"
+                )
+
+    def get_columns(self, entity) -> List[Any]:
+        """Resolve the parameter's columns on a model or an alias of it"""
+        return [getattr(entity, column_name) for column_name in self.column_names]
+
+    def get_code_columns(self, entity) -> List[Any]:
+        """Columns compared against a code given without a system"""
+        if self.systems:
+            return [getattr(entity, column_name) for column_name in self.systems.values()]
+        return self.get_columns(entity)
+
+    def get_system_column(self, entity, system: str):
+        """Column holding codes of the given code system, if the parameter knows it"""
+        system = system.lower()
+        for keyword, column_name in self.systems.items():
+            if keyword in system:
+                return getattr(entity, column_name)
+        return None
+
+    def get_text_column(self, entity):
+        return getattr(entity, self.text_column) if self.text_column else None
+
+
+def _string(*columns: str) -> SearchParameter:
+    return SearchParameter(SearchParamType.STRING, *columns)
+
+
+def _token(*columns: str, coerce=None) -> SearchParameter:
+    return SearchParameter(SearchParamType.TOKEN, *columns, coerce=coerce)
+
+
+def _coded(systems: Dict[str, str], text_column: str, match_text: bool = True) -> SearchParameter:
+    return SearchParameter(SearchParamType.TOKEN, systems=systems,
+                           text_column=text_column, match_text=match_text)
+
+
+def _date(column: str) -> SearchParameter:
+    return SearchParameter(SearchParamType.DATE, column)
+
+
+def _quantity(column: str) -> SearchParameter:
+    return SearchParameter(SearchParamType.QUANTITY, column)
+
+
+def _reference(column: str, target: str) -> SearchParameter:
+    return SearchParameter(SearchParamType.REFERENCE, column, target=target)
+
+
+def _special(handler) -> SearchParameter:
+    return SearchParameter(SearchParamType.SPECIAL, handler=handler)
+
+
+def _parse_boolean(value: str) -> bool:
+    return value.lower() == "true"
+
+
+def _filter_deceased(query, entity, value, modifier):
+    """Patient deceased: true when a date of death is recorded"""
+    is_deceased = value.lower() == "true"
+    if modifier == "missing":
+        # deceased:missing=true means no death recorded
+        is_deceased = not is_deceased
+    if is_deceased:
+        return query.filter(entity.date_of_death.isnot(None))
+    return query.filter(entity.date_of_death.is_(None))
+
+
+def _filter_request_intent(query, entity, value, modifier):
+    """MedicationRequest intent: every prescription in the system is an order"""
+    if value == "order":
+        return query
+    return query.filter(false())
+
+
+# Search parameters per resource type, by FHIR parameter name
+SEARCH_PARAMETERS: Dict[str, Dict[str, SearchParameter]] = {
+    "Patient": {
+        "family": _string("last_name"),
+        "given": _string("first_name"),
+        "name": _string("first_name", "last_name"),
+        "birthdate": _date("date_of_birth"),
+        "gender": _token("gender"),
+        "identifier": _token("mrn"),
+        "address": _string("address", "city", "state", "zip_code"),
+        "address-city": _string("city"),
+        "address-state": _string("state"),
+        "address-postalcode": _string("zip_code"),
+        "telecom": _string("phone", "email"),
+        "active": _token("is_active", coerce=_parse_boolean),
+        "deceased": _special(_filter_deceased),
+    },
+    "Encounter": {
+        "subject": _reference("patient_id", "Patient"),
+        "patient": _reference("patient_id", "Patient"),
+        "status": _token("status"),
+        "class": _token("encounter_class"),
+        "type": _string("encounter_type"),
+        "date": _date("encounter_date"),
+        "period": _date("encounter_date"),
+        "location": _reference("location_id", "Location"),
+        "participant": _reference("provider_id", "Practitioner"),
+        "reason-code": _string("chief_complaint"),
+        "service-provider": _reference("organization_id", "Organization"),
+    },
+    "Observation": {
+        "subject": _reference("patient_id", "Patient"),
+        "patient": _reference("patient_id", "Patient"),
+        "encounter": _reference("encounter_id", "Encounter"),
+        "performer": _reference("provider_id", "Practitioner"),
+        "code": _coded({"loinc": "loinc_code"}, "display", match_text=False),
+        "category": _token("observation_type"),
+        "status": _token("status"),
+        "date": _date("observation_date"),
+        "effective": _date("observation_date"),
+        "value-quantity": _quantity("value_quantity"),
+        "value-string": _string("value"),
+        "value-concept": _string("value_code"),
+    },
+    "Condition": {
+        "subject": _reference("patient_id", "Patient"),
+        "patient": _reference("patient_id", "Patient"),
+        "encounter": _reference("encounter_id", "Encounter"),
+        "code": _coded({"snomed": "snomed_code", "icd-10": "icd10_code"}, "description"),
+        "clinical-status": _token("clinical_status"),
+        "verification-status": _token("verification_status"),
+        "severity": _token("severity"),
+        "onset-date": _date("onset_date"),
+        "recorded-date": _date("recorded_date"),
+        "abatement-date": _date("abatement_date"),
+    },
+    "MedicationRequest": {
+        "subject": _reference("patient_id", "Patient"),
+        "patient": _reference("patient_id", "Patient"),
+        "encounter": _reference("encounter_id", "Encounter"),
+        "requester": _reference("prescriber_id", "Practitioner"),
+        "code": _coded({"rxnorm": "rxnorm_code"}, "medication_name", match_text=False),
+        "medication": _string("medication_name"),
+        "status": _token("status"),
+        "intent": _special(_filter_request_intent),
+        "authored-on": _date("start_date"),
+    },
+    "Practitioner": {
+        "name": _string("first_name", "last_name"),
+        "family": _string("last_name"),
+        "given": _string("first_name"),
+        "active": _token("active", coerce=_parse_boolean),
+        "identifier": _token("id", "npi"),
+        "qualification": _string("specialty"),
+    },
+    "Organization": {
+        "name": _string("name"),
+        "type": _token("type"),
+        "active": _token("active", coerce=_parse_boolean),
+        "identifier": _token("id"),
+    },
+    "Location": {
+        "name": _string("name"),
+        "type": _token("type"),
+        "status": _token("status"),
+        "identifier": _token("id"),
+    },
+    "AllergyIntolerance": {
+        "patient": _reference("patient_id", "Patient"),
+        "encounter": _reference("encounter_id", "Encounter"),
+        "clinical-status": _token("clinical_status"),
+        "verification-status": _token("verification_status"),
+        "type": _token("allergy_type"),
+        "category": _token("category"),
+        "criticality": _token("severity"),
+        "code": _coded({"snomed": "snomed_code"}, "description"),
+        "onset": _date("onset_date"),
+        "date": _date("onset_date"),
+        "identifier": _token("id"),
+    },
+    "Immunization": {
+        "patient": _reference("patient_id", "Patient"),
+        "status": _token("status"),
+        "vaccine-code": _coded({"cvx": "cvx_code"}, "description"),
+        "date": _date("immunization_date"),
+        "identifier": _token("id"),
+    },
+    "Procedure": {
+        "subject": _reference("patient_id", "Patient"),
+        "patient": _reference("patient_id", "Patient"),
+        "encounter": _reference("encounter_id", "Encounter"),
+        "status": _token("status"),
+        "code": _coded({"snomed": "snomed_code"}, "description"),
+        "date": _date("procedure_date"),
+        "reason-code": _string("reason_code", "reason_description"),
+        "outcome": _string("outcome"),
+        "identifier": _token("id"),
+    },
+    "CarePlan": {
+        "subject": _reference("patient_id", "Patient"),
+        "patient": _reference("patient_id", "Patient"),
+        "encounter": _reference("encounter_id", "Encounter"),
+        "status": _token("status"),
+        "intent": _token("intent"),
+        "category": _coded({"snomed": "snomed_code"}, "description"),
+        "date": _date("start_date"),
+        "period": _date("start_date"),
+        "identifier": _token("id"),
+    },
+    "Device": {
+        "patient": _reference("patient_id", "Patient"),
+        "status": _token("status"),
+        "type": _coded({"snomed": "snomed_code"}, "description"),
+        "udi-carrier": _string("udi"),
+        "udi-di": _string("udi"),
+        "device-name": _string("description"),
+        "identifier": _token("id"),
+    },
+    "DiagnosticReport": {
+        "subject": _reference("patient_id", "Patient"),
+        "patient": _reference("patient_id", "Patient"),
+        "encounter": _reference("encounter_id", "Encounter"),
+        "status": _token("status"),
+        "code": _coded({"loinc": "loinc_code"}, "description"),
+        "date": _date("report_date"),
+        "issued": _date("report_date"),
+        "identifier": _token("id"),
+    },
+    "ImagingStudy": {
+        "subject": _reference("patient_id", "Patient"),
+        "patient": _reference("patient_id", "Patient"),
+        "status": _token("status"),
+        "modality": _token("modality"),
+        "started": _date("study_date"),
+        "body-site": _string("body_part"),
+        "identifier": _token("id"),
+    },
+}
+
+
+def _invalid_date(date_value: str) -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail={
+            "resourceType": "OperationOutcome",
+            "issue": [{
+                "severity": "error",
+                "code": "invalid",
+                "diagnostics": f"Invalid date format: '{date_value}'. Use YYYY, YYYY-MM, YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ",
+                "expression": ["Bundle.entry.request.url"]
+            }]
+        }
+    )
+
+
+def split_search_value(value: str) -> List[str]:
+    """Split a comma-separated search value (OR semantics)"""
+    return [v.strip() for v in value.split(",")] if "," in value else [value]
+
+
+def parse_token_value(value: str) -> Tuple[Optional[str], str]:
+    """Parse a token value that may use the system|code format"""
+    if "|" in value:
+        system, code = value.split("|", 1)
+        return system or None, code
+    return None, value
+
+
+def parse_reference_value(value: str, target: Optional[str]) -> str:
+    """Strip the resource type from a reference such as Patient/123"""
+    if "/" in value:
+        resource_type, resource_id = value.rsplit("/", 1)
+        if target is None or resource_type.endswith(target):
+            return resource_id
+    return value
+
+
+def parse_date_range(date_value: str) -> Tuple[datetime, datetime]:
+    """
+    Return the half-open [start, end) range a FHIR date covers at its precision.
+
+    "2023" covers the whole year, "2023-05" the month, "2023-05-14" the day and
+    a full timestamp the second it names (converted to UTC when it has an offset).
+    """
+    try:
+        if re.fullmatch(r"\d{4}", date_value):
+            start = datetime(int(date_value), 1, 1)
+            return start, start.replace(year=start.year + 1)
+        if re.fullmatch(r"\d{4}-\d{2}", date_value):
+            year, month = (int(part) for part in date_value.split("-"))
+            start = datetime(year, month, 1)
+            end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+            return start, end
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", date_value):
+            start = datetime.strptime(date_value, "%Y-%m-%d")
+            return start, start + timedelta(days=1)
+
+        start = datetime.fromisoformat(date_value.replace("Z", "+00:00"))
+        if start.tzinfo is not None:
+            # Stored timestamps are naive UTC
+            start = start.astimezone(timezone.utc).replace(tzinfo=None)
+        start = start.replace(microsecond=0)
+        return start, start + timedelta(seconds=1)
+    except ValueError:
+        raise _invalid_date(date_value)
+
+
+def parse_date_value(value: str, modifier: Optional[str]) -> Tuple[str, datetime, datetime]:
+    """Split a date search value into its prefix and the range it covers"""
+    if modifier in DATE_PREFIXES or modifier in ("above", "below"):
+        prefix, date_value = modifier, value
+    else:
+        match = re.match(r"^(eq|ne|gt|ge|lt|le|sa|eb)(.+)$", value)
+        if match:
+            prefix, date_value = match.groups()
+        else:
+            prefix, date_value = "eq", value
+
+    start, end = parse_date_range(date_value)
+    return prefix, start, end
+
+
+def parse_quantity_value(value: str, modifier: Optional[str]) -> Optional[Tuple[str, float, Optional[str]]]:
+    """Split a quantity search value (e.g. "gt5.4||mg") into prefix, number and unit"""
+    if modifier in ("above", "below"):
+        try:
+            return ("gt" if modifier == "above" else "lt"), float(value.split("||")[0]), None
+        except ValueError:
+            return None
+
+    match = re.match(r"^(eq|ne|gt|ge|lt|le)?([0-9.]+)(\|\|(.+))?$", value)
+    if not match:
+        return None
+    try:
+        number = float(match.group(2))
+    except ValueError:
+        return None
+    return match.group(1) or "eq", number, match.group(4)
+
+
+class SearchStep:
+    """One parsed search parameter of a plan, ready to be applied to a query"""
+
+    __slots__ = ("name", "parameter", "modifier", "chain_type", "chain_parameter", "operands")
+
+    def __init__(self, name, parameter, modifier, chain_type, chain_parameter, operands):
+        self.name = name
+        self.parameter = parameter
+        self.modifier = modifier
+        # Chained search: type and parameter searched on the referenced resource
+        self.chain_type = chain_type
+        self.chain_parameter = chain_parameter
+        # Parsed values; each operand is applied as a separate (AND) filter
+        self.operands = operands
+
+    @property
+    def effective_parameter(self) -> SearchParameter:
+        return self.chain_parameter or self.parameter
+
+
+class SearchRegistry:
+    """Compiled search parameter registry with a plan cache"""
+
+    def __init__(self, resource_models: Dict[str, Any],
+                 definitions: Dict[str, Dict[str, SearchParameter]] = SEARCH_PARAMETERS,
+                 cache_size: int = SEARCH_PLAN_CACHE_SIZE):
+        self.definitions = definitions
+        self._plans = LRUCache(cache_size)
+
+        for resource_type, parameters in definitions.items():
+            model = resource_models[resource_type]
+            for name, parameter in parameters.items():
+                parameter.bind(model, resource_type, name)
+
+    def get_parameter(self, resource_type: str, name: str) -> Optional[SearchParameter]:
+        return self.definitions.get(resource_type, {}).get(name)
+
+    def parameter_type(self, resource_type: str, name: str) -> str:
+        """FHIR search parameter type for the CapabilityStatement"""
+        parameter = self.get_parameter(resource_type, name)
+        if parameter is None or parameter.type == SearchParamType.SPECIAL:
+            return "token" if parameter else "string"
+        return parameter.type.value
+
+    @staticmethod
+    def normalize(resource_type: str, search_params: Dict[str, Any]) -> Tuple:
+        """Cache key for the filtering part of a search"""
+        items = []
+        for param, value in search_params.items():
+            if param.startswith("_"):
+                continue
+            values = tuple(sorted(value)) if isinstance(value, list) else (value,)
+            items.append((param, values))
+        return (resource_type, tuple(sorted(items)))
+
+    def plan(self, resource_type: str, search_params: Dict[str, Any]) -> Tuple[SearchStep, ...]:
+        """Return the (cached) search plan for a query"""
+        key = self.normalize(resource_type, search_params)
+        plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+
+        plan = tuple(
+            step for step in (
+                self._compile_step(resource_type, param, values)
+                for param, values in key[1]
+            ) if step is not None
+        )
+
+        self._plans.set(key, plan)
+        return plan
+
+    def _compile_step(self, resource_type: str, param: str, values: Tuple[str, ...]) -> Optional[SearchStep]:
+        """Parse one parameter: name, modifier, chain and values"""
+        parts = param.split(":")
+        name, rest = parts[0], parts[1:]
+        modifier = None
+        chain_type = chain_name = None
+
+        if rest and "." in rest[0]:
+            # Typed chain: subject:Patient.family
+            chain_type, chain_name = rest[0].split(".", 1)
+            modifier = rest[1] if len(rest) > 1 else None
+        else:
+            modifier = rest[0] if rest else None
+            if "." in name:
+                # Untyped chain: subject.family
+                name, chain_name = name.split(".", 1)
+
+        parameter = self.get_parameter(resource_type, name)
+        if parameter is None:
+            # Allowed but not implemented parameters are ignored
+            return None
+
+        chain_parameter = None
+        if chain_name:
+            if parameter.type != SearchParamType.REFERENCE:
+                return None
+            if chain_type and chain_type != parameter.target:
+                return None
+            chain_type = parameter.target
+            chain_parameter = self.get_parameter(chain_type, chain_name)
+            if chain_parameter is None or chain_parameter.type == SearchParamType.REFERENCE:
+                return None
+        elif parameter.type == SearchParamType.REFERENCE and modifier == parameter.target:
+            # subject:Patient=123 only restricts the reference type
+            modifier = None
+
+        effective = chain_parameter or parameter
+        operands = [self._parse_operand(effective, modifier, value) for value in values]
+        return SearchStep(name, parameter, modifier, chain_type, chain_parameter, operands)
+
+    @staticmethod
+    def _parse_operand(parameter: SearchParameter, modifier: Optional[str], value: str):
+        """Parse a raw value according to the parameter type"""
+        if parameter.type == SearchParamType.SPECIAL:
+            return value
+        if modifier == "missing":
+            return value.lower() == "true"
+        if parameter.type == SearchParamType.TOKEN:
+            return [parse_token_value(v) for v in split_search_value(value)]
+        if parameter.type == SearchParamType.REFERENCE:
+            return [parse_reference_value(v, parameter.target) for v in split_search_value(value)]
+        if parameter.type == SearchParamType.DATE:
+            return parse_date_value(value, modifier)
+        if parameter.type == SearchParamType.QUANTITY:
+            return parse_quantity_value(value, modifier)
+        return value
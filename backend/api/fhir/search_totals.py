@@ -0,0 +1,143 @@
+"""
+FHIR Search Totals
+Computes Bundle.total according to the _total parameter
+
+- accurate: run a COUNT for every search (the default)
+- estimate: use planner statistics for unfiltered searches, otherwise a
+  per-query-shape count cache with a TTL that is invalidated on writes
+- none: skip counting entirely
+"""
+
+import os
+import time
+from collections import defaultdict
+from typing import Dict, Any, Optional, Tuple
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+
+from services.lru_cache import LRUCache
+
+# Seconds a cached count stays valid, even without writes from this process
+SEARCH_COUNT_TTL = int(os.getenv("FHIR_SEARCH_COUNT_TTL", "300"))
+SEARCH_COUNT_CACHE_SIZE = int(os.getenv("FHIR_SEARCH_COUNT_CACHE_SIZE", "1024"))
+
+# Parameters that change paging or presentation but not the matching set
+NON_FILTER_PARAMS = {
+    "_count", "_offset", "_cursor", "_sort", "_include", "_revinclude",
+    "_total", "_summary", "_format", "_elements"
+}
+
+
+class SearchCountCache(LRUCache):
+    """Bounded LRU cache of search counts keyed by query shape"""
+
+    def __init__(self, ttl: int = SEARCH_COUNT_TTL, max_entries: int = SEARCH_COUNT_CACHE_SIZE):
+        super().__init__(max_entries)
+        self.ttl = ttl
+        self._generations: Dict[str, int] = defaultdict(int)
+
+    def _snapshot(self, tables: Tuple[str, ...]) -> Tuple[int, ...]:
+        return tuple(self._generations[table] for table in tables)
+
+    def get(self, key: Tuple, tables: Tuple[str, ...]) -> Optional[int]:
+        """Return a cached count if it is fresh and none of its tables changed"""
+        with self._lock:
+            entry = super().get(key)
+            if entry is None:
+                return None
+            count, stored_at, generations = entry
+            if time.monotonic() - stored_at > self.ttl or generations != self._snapshot(tables):
+                self.discard(key)
+                return None
+            return count
+
+    def set(self, key: Tuple, tables: Tuple[str, ...], count: int) -> None:
+        with self._lock:
+            super().set(key, (count, time.monotonic(), self._snapshot(tables)))
+
+    def invalidate(self, table_name: str) -> None:
+        """Mark every cached count that reads from this table as stale"""
+        with self._lock:
+            self._generations[table_name] += 1
+
+
+search_count_cache = SearchCountCache()
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_search_counts(session, flush_context):
+    """Invalidate cached counts for every table touched by a flush"""
+    tables = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(instance, "__table__", None)
+        if table is not None:
+            tables.add(table.name)
+    for table_name in tables:
+        search_count_cache.invalidate(table_name)
+
+
+def normalize_search_key(resource_type: str, search_params: Dict[str, Any]) -> Tuple:
+    """Build a cache key from the filtering parameters of a search"""
+    items = []
+    for param, value in search_params.items():
+        # Modifiers such as _include:iterate don't change the matching set either
+        if param.split(":")[0] in NON_FILTER_PARAMS:
+            continue
+        values = tuple(sorted(value)) if isinstance(value, list) else (value,)
+        items.append((param, values))
+    return (resource_type, tuple(sorted(items)))
+
+
+def _query_tables(query) -> Tuple[str, ...]:
+    """Names of every table a search query reads from, including joins"""
+    tables = find_tables(query.statement, check_columns=True, include_joins=True)
+    return tuple(sorted({table.name for table in tables if hasattr(table, "name")}))
+
+
+def _planner_estimate(db: Session, table_name: str) -> Optional[int]:
+    """Row count estimate from the database statistics, if available"""
+    dialect = db.get_bind().dialect.name
+    try:
+        # A savepoint, so a failed lookup leaves the caller's transaction alone
+        with db.begin_nested():
+            if dialect == "postgresql":
+                estimate = db.execute(
+                    text("SELECT reltuples::bigint FROM pg_class WHERE relname = :table"),
+                    {"table": table_name}
+                ).scalar()
+                # reltuples is -1 (or 0) until the table has been analyzed
+                return int(estimate) if estimate and estimate > 0 else None
+            if dialect == "sqlite":
+                # sqlite_stat1 only exists after ANALYZE; the first number is the row count
+                stat = db.execute(
+                    text("SELECT stat FROM sqlite_stat1 WHERE tbl = :table LIMIT 1"),
+                    {"table": table_name}
+                ).scalar()
+                return int(stat.split()[0]) if stat else None
+    except Exception:
+        pass
+    return None
+
+
+def count_search_results(query, model, resource_type: str,
+                         search_params: Dict[str, Any], total_mode: str) -> Optional[int]:
+    """Return Bundle.total for a search, or None when it should be omitted"""
+    if total_mode == "accurate":
+        return query.count()
+    if total_mode != "estimate":
+        return None
+
+    key = normalize_search_key(resource_type, search_params)
+    if not key[1]:
+        estimate = _planner_estimate(query.session, model.__tablename__)
+        if estimate is not None:
+            return estimate
+
+    tables = _query_tables(query)
+    total = search_count_cache.get(key, tables)
+    if total is None:
+        total = query.count()
+        search_count_cache.set(key, tables, total)
+    return total
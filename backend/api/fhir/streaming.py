@@ -0,0 +1,113 @@
+"""
+FHIR Bundle Streaming
+Incremental serialization of large searchset Bundles
+
+Rows are read from a server-side cursor in batches, each entry is encoded
+with orjson as soon as it is converted, and the encoded bytes are flushed in
+fixed-size chunks. Nothing holds the whole page, so memory stays flat
+regardless of _count and the first bytes go out before the last row is read.
+"""
+
+import os
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import orjson
+
+from .includes import IncludeResolver
+
+# Searches with a page size of at least this many entries are streamed
+STREAM_MIN_COUNT = int(os.getenv("FHIR_STREAM_MIN_COUNT", "200"))
+# Rows fetched from the cursor (and resolved for includes) at a time
+STREAM_BATCH_SIZE = int(os.getenv("FHIR_STREAM_BATCH_SIZE", "100"))
+# Encoded bytes buffered before a chunk is sent
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def encode_json(value: Any) -> bytes:
+    """Encode a FHIR resource, falling back to str() like the default encoder"""
+    return orjson.dumps(value, default=str)
+
+
+def stream_rows(query) -> Iterable[Any]:
+    """Iterate a query through a server-side cursor, STREAM_BATCH_SIZE rows at a time"""
+    return query.yield_per(STREAM_BATCH_SIZE)
+
+
+class SearchsetStream:
+    """Writes a searchset Bundle entry by entry"""
+
+    def __init__(self, resource_type: str, converter: Callable[[Any], Dict[str, Any]],
+                 self_url: str, total: Optional[int] = None,
+                 resolver: Optional[IncludeResolver] = None,
+                 include_params: Optional[Dict[str, List[str]]] = None):
+        self.resource_type = resource_type
+        self.converter = converter
+        self.self_url = self_url
+        self.total = total
+        self.resolver = resolver
+        self.include_params = include_params or {}
+        self._buffer = bytearray()
+        self._first_entry = True
+
+    def iter_bytes(self, rows: Iterable[Any], count: int,
+                   next_url: Callable[[Any, int, bool], Optional[str]]) -> Iterator[bytes]:
+        """
+        Yield the Bundle as JSON chunks.
+
+        At most `count` rows are written as matches; a further row only marks
+        that another page exists. next_url(last_row, emitted, has_more_rows)
+        builds the next link once the page has been written, which is why the
+        links are serialized after the entries.
+        """
+        self._buffer += b'{"resourceType":"Bundle","type":"searchset"'
+        if self.total is not None:
+            self._buffer += b',"total":' + encode_json(self.total)
+        self._buffer += b',"entry":['
+
+        emitted = 0
+        last = None
+        has_more = False
+        batch = []
+        for row in rows:
+            if emitted >= count:
+                has_more = True
+                continue
+            emitted += 1
+            last = row
+            self._write_entry({
+                "resource": self.converter(row),
+                "fullUrl": f"{self.resource_type}/{row.id}",
+                "search": {"mode": "match"}
+            })
+            if self.resolver is not None:
+                batch.append(row)
+                if len(batch) >= STREAM_BATCH_SIZE:
+                    self._write_includes(batch)
+                    batch = []
+            if len(self._buffer) >= STREAM_CHUNK_BYTES:
+                yield self._flush()
+
+        if self.resolver is not None and batch:
+            self._write_includes(batch)
+
+        links = [{"relation": "self", "url": self.self_url}]
+        url = next_url(last, emitted, has_more)
+        if url:
+            links.append({"relation": "next", "url": url})
+        self._buffer += b'],"link":' + encode_json(links) + b'}'
+        yield self._flush()
+
+    def _write_entry(self, entry: Dict[str, Any]) -> None:
+        if not self._first_entry:
+            self._buffer += b","
+        self._first_entry = False
+        self._buffer += encode_json(entry)
+
+    def _write_includes(self, batch: List[Any]) -> None:
+        for entry in self.resolver.resolve(self.resource_type, batch, **self.include_params):
+            self._write_entry(entry)
+
+    def _flush(self) -> bytes:
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
+        return chunk
@@ -24,9 +24,18 @@ from api import auth
 from api.imaging import router as imaging_router
 from api.dicomweb import router as dicomweb_router
 from database.database import engine, Base
+from services.background_tasks import run_in_background, cancel_tasks
 # Import all models so they get registered with Base
 from models.session import UserSession, PatientProviderAssignment
 from models.dicom_models import DICOMStudy, DICOMSeries, DICOMInstance, ImagingResult
+from models.export_models import ExportJob, ExportJobFile
+from models.cds_hook_models import CDSHook, CDSHookRegistryVersion
+from models.quality_report_models import QualityReport, QualityReportMeasure, QualityMeasurePeriod, QualityMeasureResult
+from models.dashboard_models import DashboardStatsSnapshot
+# Keep the latest_observation projection, patient data versions and dashboard write counts current on every write
+import services.latest_observation_service  # noqa: F401
+import services.patient_data_version_service  # noqa: F401
+import services.dashboard_stats_service  # noqa: F401
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
@@ -72,6 +81,42 @@ app.include_router(auth.router, prefix="/api/auth", tags=["Authentication"])
 app.include_router(imaging_router, prefix="/api/imaging", tags=["Medical Imaging"])
 app.include_router(dicomweb_router, prefix="/api/dicomweb", tags=["DICOMweb"])
 
+# Tasks running for the lifetime of the application, cancelled on shutdown
+_lifetime_tasks = []
+
+# Resume bulk export jobs left unfinished by a crashed or restarted worker
+@app.on_event("startup")
+async def start_export_job_watchdog():
+    from api.fhir.bulk_export import export_job_watchdog
+    _lifetime_tasks.append(run_in_background(export_job_watchdog()))
+
+# Resume quality reports left unfinished by a crashed or restarted worker
+@app.on_event("startup")
+async def start_quality_report_watchdog():
+    _lifetime_tasks.append(run_in_background(quality_router.quality_report_watchdog(engine)))
+
+# Keep the dashboard statistics snapshot fresh
+@app.on_event("startup")
+async def start_dashboard_stats_refresher():
+    from services.dashboard_stats_service import dashboard_stats_refresher
+    _lifetime_tasks.append(run_in_background(dashboard_stats_refresher()))
+
+# Stop the watchdogs and refreshers
+@app.on_event("shutdown")
+async def stop_lifetime_tasks():
+    await cancel_tasks(_lifetime_tasks)
+    _lifetime_tasks.clear()
+
+# Seed the CDS hook registry with the sample hooks on first start
+@app.on_event("startup")
+async def seed_cds_hooks():
+    from database.database import SessionLocal
+    db = SessionLocal()
+    try:
+        cds_hooks_router.initialize_sample_hooks(db)
+    finally:
+        db.close()
+
 # Root endpoint
 @app.get("/")
 async def root():
@@ -0,0 +1,34 @@
+"""CDS Hooks registry models"""
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, JSON
+from database.database import Base
+from datetime import datetime
+
+
+class CDSHook(Base):
+    """A CDS hook definition, shared by every worker through the database"""
+    __tablename__ = "cds_hooks"
+
+    id = Column(String, primary_key=True)
+    hook = Column(String, nullable=False, index=True)  # patient-view, medication-prescribe, ...
+    enabled = Column(Boolean, default=True, nullable=False)
+    priority = Column(Integer)
+    definition = Column(JSON, nullable=False)  # Hook as submitted: title, conditions, actions, prefetch, ...
+
+    # Registry version of the write that stored this definition (see CDSHookRegistryVersion)
+    version = Column(Integer, nullable=False, index=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class CDSHookRegistryVersion(Base):
+    """
+    Counter row moved forward by every hook create, update and delete.
+
+    Workers compare it with the version their compiled hooks were loaded at;
+    the row lock taken by the increment serializes concurrent writers.
+    """
+    __tablename__ = "cds_hook_registry_version"
+
+    id = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
@@ -1,5 +1,5 @@
 """Clinical task and inbox management models"""
-from sqlalchemy import Column, String, Text, DateTime, Boolean, ForeignKey, JSON
+from sqlalchemy import Column, String, Text, DateTime, Boolean, ForeignKey, JSON, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database.database import Base
@@ -148,6 +148,10 @@ class PatientList(Base):
 class PatientListMembership(Base):
     """Membership of patients in lists"""
     __tablename__ = 'patient_list_memberships'
+    __table_args__ = (
+        # Group exports page a list's members in patient_id order
+        Index('idx_patient_list_memberships_list_patient', 'patient_list_id', 'patient_id'),
+    )
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     patient_list_id = Column(String, ForeignKey('patient_lists.id'), nullable=False)
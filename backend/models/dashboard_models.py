@@ -0,0 +1,14 @@
+"""Dashboard statistics snapshot model"""
+from sqlalchemy import Column, String, DateTime, Float, JSON
+from database.database import Base
+from datetime import datetime
+
+
+class DashboardStatsSnapshot(Base):
+    """Pre-aggregated dashboard statistics, refreshed in the background and shared by every worker"""
+    __tablename__ = "dashboard_stats_snapshots"
+
+    id = Column(String, primary_key=True)
+    stats = Column(JSON, nullable=False)
+    refreshed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    elapsed_ms = Column(Float)  # Time the refresh took
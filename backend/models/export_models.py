@@ -0,0 +1,56 @@
+"""FHIR bulk export job models"""
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON, UniqueConstraint
+from sqlalchemy.orm import relationship
+from database.database import Base
+from datetime import datetime
+
+
+class ExportJob(Base):
+    """A bulk $export job, shared by every worker through the database"""
+    __tablename__ = "export_jobs"
+
+    id = Column(String, primary_key=True)
+    export_type = Column(String, nullable=False)  # system, patient, group
+    resource_types = Column(JSON, nullable=False)  # Requested resource types, in export order
+    since = Column(DateTime)
+    patient_ids = Column(JSON)  # Patient compartment, when restricted to specific patients
+    type_filters = Column(JSON)  # _typeFilter search parameters per resource type
+    group_id = Column(String)  # Patient list exported by Group/{id}/$export
+    status = Column(String, nullable=False, default="accepted", index=True)  # accepted, in-progress, completed, error, cancelled
+
+    transaction_time = Column(DateTime, default=datetime.utcnow)
+    request_time = Column(DateTime, default=datetime.utcnow, index=True)
+
+    # Progress
+    progress = Column(Integer, default=0)
+    total = Column(Integer, default=0)
+    completed_types = Column(JSON)  # Resource types whose files are all written
+    errors = Column(JSON)  # OperationOutcome-style error entries
+
+    # Ownership: the worker processing the job refreshes its heartbeat; a job
+    # whose heartbeat goes stale can be claimed and resumed by another worker
+    worker_id = Column(String)
+    heartbeat_at = Column(DateTime, index=True)
+
+    files = relationship("ExportJobFile", back_populates="job", cascade="all, delete-orphan",
+                         order_by="ExportJobFile.id")
+
+
+class ExportJobFile(Base):
+    """A finished NDJSON output file of an export job (one manifest entry)"""
+    __tablename__ = "export_job_files"
+    __table_args__ = (
+        UniqueConstraint("job_id", "resource_type", "file_number", name="uq_export_job_file"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, ForeignKey("export_jobs.id", ondelete="CASCADE"), nullable=False, index=True)
+    resource_type = Column(String, nullable=False)
+    file_number = Column(Integer, nullable=False)
+    filename = Column(String, nullable=False)
+    count = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+    last_key = Column(String)  # Keyset cursor of the last resource in the file, where a resumed export continues
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    job = relationship("ExportJob", back_populates="files")
@@ -0,0 +1,76 @@
+"""Quality report job and materialized measure result models"""
+from sqlalchemy import Column, Integer, String, Date, DateTime, Float, ForeignKey, JSON, UniqueConstraint
+from sqlalchemy.orm import relationship
+from database.database import Base
+from datetime import datetime
+
+
+class QualityReport(Base):
+    """A quality report generated in the background, readable by every worker through the database"""
+    __tablename__ = "quality_reports"
+
+    id = Column(String, primary_key=True)
+    name = Column(String, nullable=False)
+    period_start = Column(Date, nullable=False)
+    period_end = Column(Date, nullable=False)
+    status = Column(String, nullable=False, default="pending", index=True)  # pending, running, completed, error
+
+    overall_score = Column(Float)
+    summary = Column(JSON)
+    error = Column(String)
+
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    started_at = Column(DateTime)
+    completed_at = Column(DateTime)
+    heartbeat_at = Column(DateTime, index=True)  # Refreshed while a worker generates the report
+
+    measures = relationship("QualityReportMeasure", back_populates="report", cascade="all, delete-orphan",
+                            order_by="QualityReportMeasure.position")
+
+
+class QualityReportMeasure(Base):
+    """One measure of a quality report, with its progress, timing and result"""
+    __tablename__ = "quality_report_measures"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    report_id = Column(String, ForeignKey("quality_reports.id", ondelete="CASCADE"), nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+    measure_id = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="pending")  # pending, running, completed, error
+
+    result = Column(JSON)  # Measure result: numerator, denominator, score, ...
+    error = Column(String)
+
+    started_at = Column(DateTime)
+    completed_at = Column(DateTime)
+    elapsed_ms = Column(Float)
+
+    report = relationship("QualityReport", back_populates="measures")
+
+
+class QualityMeasurePeriod(Base):
+    """A measure materialized over one fixed reporting period (a calendar month)"""
+    __tablename__ = "quality_measure_periods"
+    __table_args__ = (
+        UniqueConstraint("measure_id", "period_start", "period_end", name="uq_quality_measure_period"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    measure_id = Column(String, nullable=False)
+    period_start = Column(Date, nullable=False)
+    period_end = Column(Date, nullable=False)
+    as_of = Column(Date)  # Date patient ages are computed at: the period end, or today while it is open
+
+    evaluated_at = Column(DateTime)  # Patient data changes before this are reflected in the results
+    refreshed_at = Column(DateTime)  # Last time any patient was (re-)evaluated
+    last_used_at = Column(DateTime, index=True)
+
+
+class QualityMeasureResult(Base):
+    """One contributing patient's results in a materialized measure period"""
+    __tablename__ = "quality_measure_results"
+
+    period_id = Column(Integer, ForeignKey("quality_measure_periods.id", ondelete="CASCADE"), primary_key=True)
+    patient_id = Column(String, primary_key=True)
+    denominator = Column(Integer, nullable=False, default=0)  # Patients, or discharges for encounter measures
+    numerator = Column(Integer)  # NULL when a patient measure found no result in the period
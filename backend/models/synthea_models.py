@@ -352,6 +352,31 @@ class Observation(Base):
     encounter = relationship("Encounter", back_populates="observations")
     provider = relationship("Provider")  # FHIR performer relationship
 
+class LatestObservation(Base):
+    """Most recent Observation per patient and LOINC code (maintained projection of observations)"""
+    __tablename__ = "latest_observation"
+    
+    patient_id = Column(String, primary_key=True)
+    loinc_code = Column(String, primary_key=True)
+    
+    # Copied from the latest observation of the code
+    observation_id = Column(String, nullable=False)
+    observation_date = Column(DateTime, nullable=False)
+    observation_type = Column(String)
+    display = Column(String)
+    value = Column(String)
+    value_quantity = Column(Float)
+    value_unit = Column(String)
+    status = Column(String)
+
+class PatientDataVersion(Base):
+    """Per-patient counter bumped by every write to the patient's clinical data"""
+    __tablename__ = "patient_data_versions"
+    
+    patient_id = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)  # Last write: finds the patients changed since
+
 class Procedure(Base):
     """Procedure model"""
     __tablename__ = "procedures"
@@ -625,4 +650,5 @@ Index('idx_encounters_date', Encounter.encounter_date)
 Index('idx_conditions_snomed', Condition.snomed_code)
 Index('idx_medications_rxnorm', Medication.rxnorm_code)
 Index('idx_observations_loinc', Observation.loinc_code)
+Index('idx_latest_observation_loinc', LatestObservation.loinc_code)
 Index('idx_procedures_snomed', Procedure.snomed_code)
\ No newline at end of file
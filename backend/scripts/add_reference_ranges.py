@@ -9,6 +9,9 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from sqlalchemy.orm import Session
 from database.database import get_db, engine
 from models.synthea_models import Observation
+# Keep the latest_observation projection and patient data versions current as data is added
+import services.latest_observation_service  # noqa: F401
+import services.patient_data_version_service  # noqa: F401
 import random
 
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Clinical Analytics Benchmark
+Times the lab value distributions (each test's values read as one numeric
+column and summarized with NumPy) and population demographics (one bucketed
+age query) against the previous loops (ORM rows summarized with
+sum/min/max, one count query per age bucket) on a synthetic population, and
+checks the counts, means and ranges match.
+
+Usage:
+    python scripts/benchmark_analytics.py --patients 50000
+    python scripts/benchmark_analytics.py --database-url postgresql://... --patients 50000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, func, text
+from sqlalchemy.orm import sessionmaker
+
+from database.database import Base
+from models.models import Patient, Observation
+from services.analytics_service import ClinicalAnalyticsService
+
+# LOINC code -> (display, mean, standard deviation)
+LAB_TESTS = {
+    '4548-4': ('Hemoglobin A1c', 6.5, 1.2),
+    '2345-7': ('Glucose', 105.0, 25.0),
+    '2093-3': ('Total Cholesterol', 190.0, 35.0),
+    '2160-0': ('Creatinine', 1.0, 0.3),
+    '718-7': ('Hemoglobin', 14.0, 1.5),
+}
+
+
+def populate(session, patients: int, batch_size: int = 10000):
+    """Insert patients of every age with a few results of each lab test"""
+    now = datetime.now()
+    for offset in range(0, patients, batch_size):
+        ids = [str(uuid.uuid4()) for _ in range(offset, min(offset + batch_size, patients))]
+        session.execute(Patient.__table__.insert(), [
+            {"id": pid, "first_name": "Bench", "last_name": f"Patient{offset + i}",
+             "date_of_birth": date.today() - timedelta(days=random.randint(0, 36000)),
+             "gender": random.choice(["male", "female"])}
+            for i, pid in enumerate(ids)
+        ])
+        session.execute(Observation.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "observation_type": "laboratory",
+             "loinc_code": code, "display": display, "value_quantity": round(random.gauss(mean, sd), 2),
+             "interpretation": random.choice(["Normal", "Normal", "High", "Low"]),
+             "observation_date": now - timedelta(days=random.randint(0, 1000))}
+            for pid in ids for code, (display, mean, sd) in LAB_TESTS.items() for _ in range(random.randint(0, 4))
+        ])
+        session.commit()
+        print(f"  inserted {offset + len(ids):,} / {patients:,} patients")
+
+    session.execute(text("ANALYZE"))
+    session.commit()
+
+
+def loop_lab_distributions(session):
+    """The previous implementation: one query per test, summarized with sum/min/max"""
+    distributions = {}
+    for loinc_code, (test_name, _, _) in LAB_TESTS.items():
+        values = session.query(Observation.value_quantity).filter(
+            Observation.loinc_code == loinc_code,
+            Observation.value_quantity.isnot(None)
+        ).all()
+        if values:
+            value_list = [v.value_quantity for v in values]
+            distributions[test_name] = {
+                'count': len(value_list),
+                'mean': round(sum(value_list) / len(value_list), 2),
+                'min': round(min(value_list), 2),
+                'max': round(max(value_list), 2)
+            }
+    return distributions
+
+
+def loop_demographics(session):
+    """The previous implementation: total, gender and race counts plus one count query per age bucket"""
+    session.query(Patient).count()
+    session.query(Patient.gender, func.count(Patient.id)).group_by(Patient.gender).all()
+    session.query(Patient.race, func.count(Patient.id)).group_by(Patient.race).all()
+    current_date = date.today()
+    counts = {}
+    for group, (min_age, max_age) in {'pediatric': (0, 17), 'young_adult': (18, 39),
+                                      'middle_aged': (40, 64), 'elderly': (65, 120)}.items():
+        counts[group] = session.query(Patient).filter(Patient.date_of_birth.between(
+            current_date - timedelta(days=max_age * 365), current_date - timedelta(days=min_age * 365)
+        )).count()
+    return counts
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized clinical analytics")
+    parser.add_argument("--patients", type=int, default=50000, help="Number of synthetic patients")
+    parser.add_argument("--database-url", help="Database to use (default: temporary SQLite file)")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    if session.query(Patient).count() < args.patients:
+        print(f"Populating {args.patients:,} synthetic patients in {database_url}")
+        populate(session, args.patients)
+
+    analytics = ClinicalAnalyticsService(session)
+
+    loop_labs, loop_time = timed(loop_lab_distributions, session)
+    labs, vectorized_time = timed(analytics.get_lab_value_distributions)
+    for test_name, expected in loop_labs.items():
+        summary = labs["distributions"][test_name]
+        if any(summary[key] != expected[key] for key in ("count", "mean", "min", "max")):
+            print(f"  {test_name}: summary differs from the loop")
+    results = sum(summary["count"] for summary in labs["distributions"].values())
+    print(f"\nLab distributions ({results:,} results, with std/percentiles/histograms): "
+          f"loop {loop_time * 1000:.0f}ms (count/mean/min/max only), "
+          f"vectorized {vectorized_time * 1000:.0f}ms incl. abnormal rates")
+
+    _, loop_time = timed(loop_demographics, session)
+    _, demographics_time = timed(analytics.get_population_demographics)
+    print(f"Demographics: per-bucket loop {loop_time * 1000:.0f}ms, one age query {demographics_time * 1000:.0f}ms")
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+FHIR Bulk Export Benchmark
+Measures $export throughput for a range of conversion process counts on a
+synthetic Patient/Encounter/Observation dataset.
+
+Each process count runs in a fresh interpreter (the pool size is read from
+FHIR_EXPORT_PROCESS_WORKERS at import) against the same database.
+
+Usage:
+    python scripts/benchmark_bulk_export.py --rows 500000 --workers 1,2,4,8
+    python scripts/benchmark_bulk_export.py --database-url postgresql://... --workers 1,4
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database.database import Base
+from models.synthea_models import Patient, Encounter, Observation
+from models.dicom_models import DICOMStudy  # noqa: F401 - resolves Patient.dicom_studies
+from models.export_models import ExportJob  # noqa: F401 - creates the job tables
+
+RESOURCE_TYPES = ["Patient", "Encounter", "Observation"]
+
+
+def populate(session, rows: int, batch_size: int = 50000):
+    """Insert synthetic patients, encounters and observations"""
+    patient_ids = [str(uuid.uuid4()) for _ in range(max(1, rows // 50))]
+    session.execute(Patient.__table__.insert(), [
+        {"id": pid, "first_name": "Bench", "last_name": f"Patient{i}",
+         "date_of_birth": datetime(1950, 1, 1).date() + timedelta(days=i % 20000), "gender": "female"}
+        for i, pid in enumerate(patient_ids)
+    ])
+    encounter_ids = [str(uuid.uuid4()) for _ in range(max(1, rows // 10))]
+    session.execute(Encounter.__table__.insert(), [
+        {"id": eid, "patient_id": random.choice(patient_ids),
+         "encounter_date": datetime(2020, 1, 1) + timedelta(hours=i),
+         "encounter_type": "ambulatory", "status": "finished"}
+        for i, eid in enumerate(encounter_ids)
+    ])
+    for offset in range(0, rows, batch_size):
+        session.execute(Observation.__table__.insert(), [
+            {
+                "id": str(uuid.uuid4()),
+                "patient_id": random.choice(patient_ids),
+                "encounter_id": random.choice(encounter_ids),
+                "observation_date": datetime(2020, 1, 1) + timedelta(minutes=i),
+                "observation_type": "vital-signs",
+                "loinc_code": "8867-4",
+                "display": "Heart rate",
+                "value": "72",
+                "value_quantity": random.uniform(50, 150),
+                "value_unit": "/min",
+                "status": "final",
+            }
+            for i in range(offset, min(offset + batch_size, rows))
+        ])
+        session.commit()
+        print(f"  inserted {min(offset + batch_size, rows):,} / {rows:,} observations")
+
+
+def run_export(database_url: str) -> None:
+    """Run one system export in this process and print resources per second"""
+    from api.fhir.bulk_export import BulkExportJob, BulkExportService
+    from api.fhir.export_pipeline import EXPORT_PROCESS_WORKERS
+
+    engine = create_engine(database_url)
+    session = sessionmaker(bind=engine)()
+    service = BulkExportService(session)
+    job = BulkExportJob(str(uuid.uuid4()), "system", RESOURCE_TYPES)
+    service.store.create(job)
+
+    started = time.perf_counter()
+    asyncio.run(service._process_export(job))
+    elapsed = time.perf_counter() - started
+
+    job = service.get_export_status(job.job_id)
+    print(f"  {EXPORT_PROCESS_WORKERS:>3} processes: {job.progress:,} resources in {elapsed:.1f}s "
+          f"({job.progress / elapsed:,.0f}/s), status {job.status}")
+    session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FHIR bulk export throughput")
+    parser.add_argument("--rows", type=int, default=200000, help="Number of synthetic observations")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated conversion process counts")
+    parser.add_argument("--database-url", help="Database to use (default: temporary SQLite file)")
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+
+    if args.run:
+        run_export(database_url)
+        return
+
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    if session.query(Observation).count() < args.rows:
+        print(f"Populating {args.rows:,} synthetic observations in {database_url}")
+        populate(session, args.rows)
+    session.close()
+
+    print("\nExport throughput")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        env = dict(os.environ, FHIR_EXPORT_PROCESS_WORKERS=str(workers))
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run", "--database-url", database_url],
+            env=env, check=True
+        )
+
+
+if __name__ == "__main__":
+    main()
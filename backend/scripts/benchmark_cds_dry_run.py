@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+CDS Hook Dry Run Benchmark
+Times the population-wide dry run of each sample CDS hook on a synthetic
+population (patients with diagnoses, medications, A1C results and blood
+pressure readings).
+
+Usage:
+    python scripts/benchmark_cds_dry_run.py --patients 100000
+    python scripts/benchmark_cds_dry_run.py --database-url postgresql://... --patients 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database.database import Base
+from models.models import Patient, Condition, Medication, Observation
+from services.latest_observation_service import rebuild_latest_observations
+from api.cds_hooks.cds_hooks_router import initialize_sample_hooks
+from api.cds_hooks.hook_registry import hook_registry
+from api.cds_hooks.rules import population_query
+
+MEDICATIONS = ["Metformin 500 MG", "Atorvastatin 20 MG", "Lisinopril 10 MG", "Oxycodone 5 MG"]
+
+
+def populate(session, patients: int, batch_size: int = 20000):
+    """Insert synthetic patients with one diagnosis, medication, A1C and BP reading each (roughly)"""
+    now = datetime.now()
+    for offset in range(0, patients, batch_size):
+        ids = [str(uuid.uuid4()) for _ in range(offset, min(offset + batch_size, patients))]
+        session.execute(Patient.__table__.insert(), [
+            {"id": pid, "first_name": "Bench", "last_name": f"Patient{offset + i}",
+             "date_of_birth": date(1930, 1, 1) + timedelta(days=random.randint(0, 30000)),
+             "gender": random.choice(["male", "female"])}
+            for i, pid in enumerate(ids)
+        ])
+        session.execute(Condition.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "snomed_code": random.choice(["44054006", "38341003"]),
+             "description": "Benchmark condition", "clinical_status": "active",
+             "onset_date": now - timedelta(days=1000)}
+            for pid in ids if random.random() < 0.4
+        ])
+        session.execute(Medication.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "medication_name": random.choice(MEDICATIONS),
+             "start_date": now.date(), "status": "active"}
+            for pid in ids if random.random() < 0.5
+        ])
+        session.execute(Observation.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "observation_type": "laboratory",
+             "loinc_code": "4548-4", "display": "Hemoglobin A1c", "value_quantity": random.uniform(5, 11),
+             "observation_date": now - timedelta(days=random.randint(0, 400))}
+            for pid in ids for _ in range(random.randint(0, 3))
+        ])
+        session.execute(Observation.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "observation_type": "vital-signs",
+             "loinc_code": "85354-9", "display": "Blood pressure",
+             "value": f"{random.randint(100, 190)}/{random.randint(60, 120)}",
+             "observation_date": now - timedelta(days=random.randint(0, 400))}
+            for pid in ids for _ in range(random.randint(0, 3))
+        ])
+        session.commit()
+        print(f"  inserted {offset + len(ids):,} / {patients:,} patients")
+
+    # Raw inserts bypass the ORM listener that maintains the projection
+    rebuild_latest_observations(session)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark population-wide CDS hook dry runs")
+    parser.add_argument("--patients", type=int, default=100000, help="Number of synthetic patients")
+    parser.add_argument("--database-url", help="Database to use (default: temporary SQLite file)")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    if session.query(Patient).count() < args.patients:
+        print(f"Populating {args.patients:,} synthetic patients in {database_url}")
+        populate(session, args.patients)
+    initialize_sample_hooks(session)
+
+    print("\nDry run per hook")
+    for hook in hook_registry.hooks(session):
+        started = time.perf_counter()
+        count = population_query(session, hook).order_by(None).count()
+        elapsed = time.perf_counter() - started
+        print(f"  {hook.id:<30} {count:>8,} patients in {elapsed * 1000:8.1f} ms")
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
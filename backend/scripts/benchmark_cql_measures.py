@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Simplified CQL Measure Benchmark
+Compares the set-based measure kernel (one query per population, ROW_NUMBER
+for "latest value") with the previous per-patient loop (one "latest HbA1c" or
+"any screening" query per patient) on a synthetic population, and checks both
+produce the same patients.
+
+Usage:
+    python scripts/benchmark_cql_measures.py --patients 20000
+    python scripts/benchmark_cql_measures.py --database-url postgresql://... --patients 20000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, or_, text
+from sqlalchemy.orm import sessionmaker
+
+from database.database import Base
+from models.models import Patient, Condition, Observation
+from services.cql_engine import SimplifiedCQLExecutor
+
+HBA1C_CODES = ['4548-4', '4549-2', '17856-6']
+MAMMOGRAPHY_CODES = ['24606-6', '26349-0', '26287-2']
+
+
+def populate(session, patients: int, batch_size: int = 20000):
+    """Insert patients, a third of them diabetic, with A1C results and mammograms"""
+    now = datetime.now()
+    for offset in range(0, patients, batch_size):
+        ids = [str(uuid.uuid4()) for _ in range(offset, min(offset + batch_size, patients))]
+        session.execute(Patient.__table__.insert(), [
+            {"id": pid, "first_name": "Bench", "last_name": f"Patient{offset + i}",
+             "date_of_birth": date(1940, 1, 1) + timedelta(days=random.randint(0, 25000)),
+             "gender": random.choice(["male", "female"]), "is_active": True}
+            for i, pid in enumerate(ids)
+        ])
+        diabetic = [pid for pid in ids if random.random() < 0.33]
+        session.execute(Condition.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "icd10_code": random.choice(["E11.9", "E10.9"]),
+             "description": "Diabetes mellitus", "clinical_status": "active",
+             "onset_date": now - timedelta(days=2000)}
+            for pid in diabetic
+        ])
+        session.execute(Observation.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "loinc_code": random.choice(HBA1C_CODES),
+             "display": "Hemoglobin A1c", "value_quantity": round(random.uniform(5, 12), 1),
+             "observation_date": now - timedelta(days=random.randint(0, 700))}
+            for pid in diabetic for _ in range(random.randint(0, 4))
+        ])
+        session.execute(Observation.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "loinc_code": random.choice(MAMMOGRAPHY_CODES),
+             "display": "Mammography", "observation_date": now - timedelta(days=random.randint(0, 1500))}
+            for pid in ids if random.random() < 0.3
+        ])
+        session.commit()
+        print(f"  inserted {offset + len(ids):,} / {patients:,} patients")
+
+    session.execute(text("ANALYZE"))
+    session.commit()
+
+
+def loop_diabetes_control(session):
+    """The previous implementation: one latest-HbA1c query per diabetic patient"""
+    diabetes_patients = session.query(Patient).join(Condition).filter(
+        or_(
+            Condition.icd10_code.like('E11%'),
+            Condition.icd10_code.like('E10%'),
+            Condition.icd10_code.like('E13%')
+        ),
+        Condition.clinical_status == 'active'
+    ).distinct().all()
+    initial_pop = [p.id for p in diabetes_patients]
+
+    numerator_patients = []
+    for patient_id in initial_pop:
+        latest_hba1c = session.query(Observation).filter(
+            Observation.patient_id == patient_id,
+            Observation.loinc_code.in_(HBA1C_CODES),
+            Observation.observation_date >= datetime.now() - timedelta(days=365)
+        ).order_by(Observation.observation_date.desc(), Observation.id.desc()).first()
+
+        if latest_hba1c and latest_hba1c.value_quantity is not None and latest_hba1c.value_quantity < 9.0:
+            numerator_patients.append(patient_id)
+    return sorted(initial_pop), sorted(numerator_patients)
+
+
+def loop_mammography(session):
+    """The previous implementation: one any-screening query per eligible patient"""
+    min_birth = datetime.now() - timedelta(days=74 * 365)
+    max_birth = datetime.now() - timedelta(days=50 * 365)
+    eligible_patients = session.query(Patient).filter(
+        Patient.gender == 'female',
+        Patient.date_of_birth.between(min_birth.date(), max_birth.date()),
+        Patient.is_active == True
+    ).all()
+    initial_pop = [p.id for p in eligible_patients]
+
+    screened_patients = []
+    for patient_id in initial_pop:
+        screening = session.query(Observation).filter(
+            Observation.patient_id == patient_id,
+            Observation.loinc_code.in_(MAMMOGRAPHY_CODES),
+            Observation.observation_date >= datetime.now() - timedelta(days=730)
+        ).first()
+        if screening:
+            screened_patients.append(patient_id)
+    return sorted(initial_pop), sorted(screened_patients)
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark set-based simplified CQL measures")
+    parser.add_argument("--patients", type=int, default=20000, help="Number of synthetic patients")
+    parser.add_argument("--database-url", help="Database to use (default: temporary SQLite file)")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    if session.query(Patient).count() < args.patients:
+        print(f"Populating {args.patients:,} synthetic patients in {database_url}")
+        populate(session, args.patients)
+
+    executor = SimplifiedCQLExecutor(session)
+    measures = [
+        ("diabetes_control", executor.execute_diabetes_control_measure, (), loop_diabetes_control),
+        ("mammography", executor.execute_preventive_screening_measure, ("mammography",), loop_mammography),
+    ]
+
+    print(f"\n{'measure':<20} {'population':>10} {'per-patient':>12} {'set-based':>10} {'speedup':>8}")
+    for name, measure, measure_args, loop in measures:
+        (loop_population, loop_numerator), loop_time = timed(loop, session)
+        result, kernel_time = timed(measure, *measure_args)
+        if (result["patients"]["initialPopulation"], result["patients"]["numerator"]) != \
+                (loop_population, loop_numerator):
+            print(f"  {name}: results differ from the per-patient loop")
+        print(f"{name:<20} {len(loop_population):>10,} {loop_time * 1000:>10.0f}ms "
+              f"{kernel_time * 1000:>8.0f}ms {loop_time / kernel_time:>7.1f}x")
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
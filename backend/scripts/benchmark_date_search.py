@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+FHIR Date Search Benchmark
+Compares the old substr() date equality with the half-open range predicates
+used by the FHIR search on a large synthetic Observation table.
+
+Prints the query plan for both forms (showing whether the observation_date
+index is used) and the average time per search.
+
+Usage:
+    python scripts/benchmark_date_search.py --rows 1000000
+    python scripts/benchmark_date_search.py --database-url postgresql://... --rows 2000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, func, text
+from sqlalchemy.orm import sessionmaker
+
+from database.database import Base
+from models.models import Patient, Observation
+from api.fhir.fhir_router import FHIRSearchProcessor
+
+
+def populate(session, rows: int, batch_size: int = 50000):
+    """Insert synthetic patients and observations spread over ten years"""
+    patient_ids = [str(uuid.uuid4()) for _ in range(max(1, rows // 100))]
+    session.execute(Patient.__table__.insert(), [
+        {"id": pid, "first_name": "Bench", "last_name": f"Patient{i}",
+         "date_of_birth": datetime(1950, 1, 1).date() + timedelta(days=i % 20000), "gender": "female"}
+        for i, pid in enumerate(patient_ids)
+    ])
+
+    start = datetime(2014, 1, 1)
+    span = int(timedelta(days=3650).total_seconds())
+    codes = ["8867-4", "8480-6", "8462-4", "4548-4", "2345-7"]
+    for offset in range(0, rows, batch_size):
+        session.execute(Observation.__table__.insert(), [
+            {
+                "id": str(uuid.uuid4()),
+                "patient_id": random.choice(patient_ids),
+                "observation_date": start + timedelta(seconds=random.randrange(span)),
+                "observation_type": "vital-signs",
+                "loinc_code": random.choice(codes),
+                "display": "Synthetic",
+                "value_quantity": random.uniform(50, 150),
+                "status": "final",
+            }
+            for _ in range(min(batch_size, rows - offset))
+        ])
+        session.commit()
+        print(f"  inserted {min(offset + batch_size, rows):,} / {rows:,} observations")
+
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(text("ANALYZE observations"))
+    else:
+        session.execute(text("ANALYZE"))
+    session.commit()
+
+
+def explain(session, query) -> str:
+    """Return the database's plan for a query"""
+    statement = query.statement.compile(
+        dialect=session.get_bind().dialect, compile_kwargs={"literal_binds": True}
+    )
+    if session.get_bind().dialect.name == "sqlite":
+        rows = session.execute(text(f"EXPLAIN QUERY PLAN {statement}")).fetchall()
+        return "\n".join(f"    {row[-1]}" for row in rows)
+    rows = session.execute(text(f"EXPLAIN {statement}")).fetchall()
+    return "\n".join(f"    {row[0]}" for row in rows)
+
+
+def time_query(query, iterations: int) -> float:
+    """Average milliseconds to fetch the first page"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        query.limit(50).all()
+    return (time.perf_counter() - started) * 1000 / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FHIR date search predicates")
+    parser.add_argument("--rows", type=int, default=500000, help="Number of synthetic observations")
+    parser.add_argument("--iterations", type=int, default=20, help="Runs per query")
+    parser.add_argument("--database-url", help="Database to use (default: temporary SQLite file)")
+    parser.add_argument("--day", default="2019-06-15", help="Day searched with date=YYYY-MM-DD")
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+
+    if session.query(Observation).count() < args.rows:
+        print(f"Populating {args.rows:,} synthetic observations in {database_url}")
+        populate(session, args.rows)
+
+    # Old implementation: function-wrapped column
+    legacy = session.query(Observation).filter(
+        func.substr(Observation.observation_date, 1, 10) == args.day
+    )
+    # Current implementation: half-open range built by the search processor
+    processor = FHIRSearchProcessor("Observation", session)
+
+    searches = [
+        (f"substr(observation_date) = '{args.day}' (previous)", legacy),
+        (f"date={args.day}", processor.build_query({"date": args.day})),
+        (f"date={args.day[:7]}", processor.build_query({"date": args.day[:7]})),
+        (f"date={args.day[:4]}", processor.build_query({"date": args.day[:4]})),
+    ]
+
+    for label, query in searches:
+        print(f"\n{label}")
+        print(explain(session, query))
+        print(f"    avg {time_query(query, args.iterations):.2f} ms per page")
+
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Quality Measure Benchmark
+Times the set-based QualityMeasureEngine against the previous per-patient
+loops (one Observation/Encounter query per eligible patient or discharge) on
+a synthetic population, and checks both give the same numerator and
+denominator for every measure. Then times the materialized results: the
+first calculation of the window's months, a refresh with no changed
+patients, the next day's window and a refresh after 1% of the patients'
+data changed, and counts the stored result rows.
+
+Usage:
+    python scripts/benchmark_quality_measures.py --patients 50000
+    python scripts/benchmark_quality_measures.py --patients 50000 --skip-loops
+    python scripts/benchmark_quality_measures.py --database-url postgresql://... --patients 50000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, or_, text
+from sqlalchemy.orm import sessionmaker
+
+from database.database import Base
+from models.models import Patient, Encounter, Observation, Condition, Medication
+from api.quality.quality_router import (
+    QualityMeasureEngine, MaterializedQualityMeasures, MEASURE_CALCULATORS, reporting_months
+)
+from models.quality_report_models import QualityMeasureResult
+from services.patient_data_version_service import bump_data_versions
+
+MEASURES = [
+    "calculate_diabetes_hba1c_control",
+    "calculate_hypertension_control",
+    "calculate_breast_cancer_screening",
+    "calculate_medication_reconciliation",
+    "calculate_readmission_rate",
+]
+
+
+def populate(session, patients: int, batch_size: int = 10000):
+    """Insert patients with chronic conditions, labs, vitals, mammograms and hospital encounters"""
+    now = datetime.now()
+
+    def when(max_days):
+        return now - timedelta(days=random.randint(0, max_days), minutes=random.randint(0, 1440))
+
+    for offset in range(0, patients, batch_size):
+        ids = [str(uuid.uuid4()) for _ in range(offset, min(offset + batch_size, patients))]
+        session.execute(Patient.__table__.insert(), [
+            {"id": pid, "first_name": "Bench", "last_name": f"Patient{offset + i}",
+             "date_of_birth": date(1935, 1, 1) + timedelta(days=random.randint(0, 30000)),
+             "gender": random.choice(["male", "female"])}
+            for i, pid in enumerate(ids)
+        ])
+        session.execute(Condition.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "icd10_code": code, "description": "Chronic condition",
+             "clinical_status": random.choice(["active", "active", "resolved"]), "onset_date": when(4000)}
+            for pid in ids for code in random.sample(["E11.9", "E10.9", "I10", "I11.9", "J45"], 2)
+        ])
+        session.execute(Observation.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "observation_type": "laboratory",
+             "loinc_code": "4548-4", "display": "Hemoglobin A1c", "value_quantity": round(random.uniform(5, 11), 1),
+             "observation_date": when(700)}
+            for pid in ids for _ in range(random.randint(0, 3))
+        ])
+        session.execute(Observation.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "observation_type": "vital-signs",
+             "loinc_code": "85354-9", "display": "Blood Pressure", "observation_date": when(700)}
+            for pid in ids for _ in range(random.randint(0, 2))
+        ])
+        session.execute(Observation.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "observation_type": "imaging",
+             "loinc_code": "24606-6", "display": "Mammography", "observation_date": when(1500)}
+            for pid in ids if random.random() < 0.3
+        ])
+        encounters = [
+            {"id": str(uuid.uuid4()), "patient_id": pid, "encounter_date": when(400),
+             "encounter_type": random.choice(["inpatient", "emergency", "ambulatory"]),
+             "status": random.choice(["finished", "finished", "in-progress"])}
+            for pid in ids for _ in range(random.randint(0, 3))
+        ]
+        session.execute(Encounter.__table__.insert(), encounters)
+        session.execute(Medication.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "patient_id": encounter["patient_id"], "encounter_id": encounter["id"],
+             "medication_name": "Lisinopril 10 MG", "start_date": now.date(), "status": "active"}
+            for encounter in encounters if random.random() < 0.5
+        ])
+        session.commit()
+        print(f"  inserted {offset + len(ids):,} / {patients:,} patients")
+
+    session.execute(text("ANALYZE"))
+    session.commit()
+
+
+class PerPatientQualityMeasures:
+    """The previous implementation: one query per eligible patient or discharge"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def _eligible(self, code_prefixes, min_age, max_age, extra=()):
+        today = date.today()
+        query = self.db.query(Patient).filter(
+            Patient.date_of_birth >= date(today.year - max_age, today.month, today.day),
+            Patient.date_of_birth <= date(today.year - min_age, today.month, today.day),
+            *extra
+        )
+        if code_prefixes:
+            ids = [p.id for p in self.db.query(Patient.id).join(Condition).filter(
+                Condition.clinical_status == 'active',
+                or_(*[Condition.icd10_code.like(f"{prefix}%") for prefix in code_prefixes])
+            ).distinct()]
+            query = query.filter(Patient.id.in_(ids))
+        return query.all()
+
+    def calculate_diabetes_hba1c_control(self, start_date, end_date):
+        eligible = self._eligible(['E10', 'E11'], 18, 75)
+        numerator = 0
+        for patient in eligible:
+            latest = self.db.query(Observation).filter(
+                Observation.patient_id == patient.id,
+                Observation.observation_type == 'laboratory',
+                or_(Observation.display.ilike('%hemoglobin a1c%'), Observation.display.ilike('%hba1c%'),
+                    Observation.loinc_code == '4548-4'),
+                Observation.observation_date >= start_date,
+                Observation.observation_date <= end_date
+            ).order_by(Observation.observation_date.desc()).first()
+            if latest and latest.value_quantity is not None and latest.value_quantity < 8.0:
+                numerator += 1
+        return {"numerator": numerator, "denominator": len(eligible)}
+
+    def calculate_hypertension_control(self, start_date, end_date):
+        eligible = self._eligible(['I10', 'I11', 'I12', 'I13', 'I14', 'I15'], 18, 85)
+        numerator = 0
+        for patient in eligible:
+            if self.db.query(Observation).filter(
+                Observation.patient_id == patient.id,
+                Observation.observation_type == 'vital-signs',
+                or_(Observation.display.ilike('%blood pressure%'), Observation.loinc_code == '85354-9'),
+                Observation.observation_date >= start_date,
+                Observation.observation_date <= end_date
+            ).count() > 0:
+                numerator += 1
+        return {"numerator": numerator, "denominator": len(eligible)}
+
+    def calculate_breast_cancer_screening(self, start_date, end_date):
+        eligible = self._eligible(None, 50, 74, extra=(Patient.gender.ilike('female'),))
+        numerator = 0
+        for patient in eligible:
+            if self.db.query(Observation).filter(
+                Observation.patient_id == patient.id,
+                or_(Observation.display.ilike('%mammogram%'), Observation.display.ilike('%mammography%'),
+                    Observation.loinc_code == '24606-6'),
+                Observation.observation_date >= end_date - timedelta(days=730),
+                Observation.observation_date <= end_date
+            ).first():
+                numerator += 1
+        return {"numerator": numerator, "denominator": len(eligible)}
+
+    def _discharges(self, start_date, end_date):
+        return self.db.query(Encounter).filter(
+            Encounter.encounter_type.in_(['inpatient', 'emergency']),
+            Encounter.status == 'finished',
+            Encounter.encounter_date >= start_date,
+            Encounter.encounter_date <= end_date
+        ).all()
+
+    def calculate_medication_reconciliation(self, start_date, end_date):
+        discharges = self._discharges(start_date, end_date)
+        numerator = sum(1 for encounter in discharges if self.db.query(Medication).filter(
+            Medication.patient_id == encounter.patient_id,
+            Medication.encounter_id == encounter.id,
+            Medication.status == 'active'
+        ).count() > 0)
+        return {"numerator": numerator, "denominator": len(discharges)}
+
+    def calculate_readmission_rate(self, start_date, end_date):
+        discharges = self._discharges(start_date, end_date)
+        numerator = sum(1 for discharge in discharges if self.db.query(Encounter).filter(
+            Encounter.patient_id == discharge.patient_id,
+            Encounter.id != discharge.id,
+            Encounter.encounter_type.in_(['inpatient', 'emergency']),
+            Encounter.encounter_date > discharge.encounter_date,
+            Encounter.encounter_date <= discharge.encounter_date + timedelta(days=30)
+        ).first())
+        return {"numerator": numerator, "denominator": len(discharges)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the set-based quality measure engine")
+    parser.add_argument("--patients", type=int, default=50000, help="Number of synthetic patients")
+    parser.add_argument("--database-url", help="Database to use (default: temporary SQLite file)")
+    parser.add_argument("--skip-loops", action="store_true", help="Only time the set-based engine")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    if session.query(Patient).count() < args.patients:
+        print(f"Populating {args.patients:,} synthetic patients in {database_url}")
+        populate(session, args.patients)
+
+    end_date = date.today()
+    start_date = end_date - timedelta(days=365)
+    set_based = QualityMeasureEngine(session)
+    per_patient = PerPatientQualityMeasures(session)
+
+    print(f"\n{'measure':<38} {'num/den':>14} {'set-based':>10} {'per-patient':>12}")
+    total = 0.0
+    for name in MEASURES:
+        started = time.perf_counter()
+        result = getattr(set_based, name)(start_date, end_date)
+        elapsed = time.perf_counter() - started
+        total += elapsed
+
+        loop_column = "skipped"
+        if not args.skip_loops:
+            started = time.perf_counter()
+            expected = getattr(per_patient, name)(start_date, end_date)
+            loop_column = f"{(time.perf_counter() - started) * 1000:.0f}ms"
+            if (expected["numerator"], expected["denominator"]) != (result["numerator"], result["denominator"]):
+                loop_column += f" MISMATCH {expected['numerator']}/{expected['denominator']}"
+
+        counts = f"{result['numerator']:,}/{result['denominator']:,}"
+        print(f"{name:<38} {counts:>14} {elapsed * 1000:>8.0f}ms {loop_column:>12}")
+    print(f"\nAll measures (set-based): {total:.2f}s")
+
+    materialized = MaterializedQualityMeasures(session)
+    patient_ids = [row[0] for row in session.query(Patient.id)]
+    print(f"\n{'materialized refresh':<38} {'evaluated':>10} {'elapsed':>10}")
+    windows = {
+        "first calculation": start_date,
+        "no changes": start_date,
+        "next day's window": start_date + timedelta(days=1),
+        "1% of patients changed": start_date + timedelta(days=1),
+    }
+    for label, window_start in windows.items():
+        if label == "1% of patients changed":
+            bump_data_versions(session.connection(), random.sample(patient_ids, max(1, len(patient_ids) // 100)))
+            session.commit()
+        started = time.perf_counter()
+        evaluated = sum(
+            materialized.calculate(measure_id, window_start, end_date)["materialized"]["evaluated_patients"]
+            for measure_id in MEASURE_CALCULATORS
+        )
+        print(f"{label:<38} {evaluated:>10,} {(time.perf_counter() - started) * 1000:>8.0f}ms")
+
+    months = len(reporting_months(start_date, end_date))
+    print(f"\nStored result rows: {session.query(QualityMeasureResult).count():,} "
+          f"(patients x months x measures: {len(patient_ids) * months * len(MEASURE_CALCULATORS):,})")
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,9 @@ from faker import Faker
 from database.database import get_db
 from models.synthea_models import Patient, Encounter, Observation, Condition, Medication
 from models.models import Provider
+# Keep the latest_observation projection and patient data versions current as data is added
+import services.latest_observation_service  # noqa: F401
+import services.patient_data_version_service  # noqa: F401
 
 fake = Faker()
 
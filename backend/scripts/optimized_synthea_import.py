@@ -27,6 +27,9 @@ from models.models import (
     Medication, Observation, Procedure, Immunization, Allergy,
     CarePlan, Payer, Claim, Device, DiagnosticReport, ImagingStudy
 )
+# Keep the latest_observation projection and patient data versions current as data is added
+import services.latest_observation_service  # noqa: F401
+import services.patient_data_version_service  # noqa: F401
 
 # Configure logging
 logging.basicConfig(
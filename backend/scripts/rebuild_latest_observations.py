@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Rebuild the latest_observation projection
+Recomputes the most recent Observation per (patient_id, loinc_code) from the
+observations table. Run after loading observations with raw SQL or to
+(re)create the projection on an existing database; ORM writes keep it
+current on their own.
+
+Usage:
+    python scripts/rebuild_latest_observations.py
+    python scripts/rebuild_latest_observations.py --database-url postgresql://...
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database.database import DATABASE_URL, Base
+import models.models  # noqa: F401 - registers every table
+from services.latest_observation_service import rebuild_latest_observations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the latest_observation projection")
+    parser.add_argument("--database-url", default=DATABASE_URL, help="Database to rebuild (default: DATABASE_URL)")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+
+    started = time.perf_counter()
+    rows = rebuild_latest_observations(session)
+    print(f"Rebuilt latest_observation: {rows:,} rows in {time.perf_counter() - started:.1f}s")
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,35 @@ quality measures, and clinical decision support analytics
 from typing import Dict, List, Any, Optional
 from datetime import datetime, date, timedelta
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_
+from sqlalchemy import func, and_, or_, case, select
+import numpy as np
 
 from models.models import Patient, Encounter, Observation, Condition, Medication
 
+# Percentiles and histogram bins reported for each lab value distribution
+LAB_PERCENTILES = (5, 25, 50, 75, 95)
+LAB_HISTOGRAM_BINS = 10
+
+
+def summarize_values(values: np.ndarray) -> Dict[str, Any]:
+    """Count, mean, standard deviation, range, percentiles and histogram of numeric values"""
+    percentiles = np.percentile(values, LAB_PERCENTILES)
+    counts, edges = np.histogram(values, bins=LAB_HISTOGRAM_BINS)
+    return {
+        'count': int(values.size),
+        'mean': round(float(values.mean()), 2),
+        'std': round(float(values.std(ddof=1)), 2) if values.size > 1 else 0.0,
+        'min': round(float(values.min()), 2),
+        'max': round(float(values.max()), 2),
+        'percentiles': {
+            f'p{percentile}': round(float(value), 2) for percentile, value in zip(LAB_PERCENTILES, percentiles)
+        },
+        'histogram': [
+            {'from': round(float(low), 2), 'to': round(float(high), 2), 'count': int(count)}
+            for low, high, count in zip(edges[:-1], edges[1:], counts)
+        ]
+    }
+
 
 class ClinicalAnalyticsService:
     """Service for clinical data analytics and population health insights"""
@@ -28,7 +53,7 @@ class ClinicalAnalyticsService:
             func.count(Patient.id).label('count')
         ).group_by(Patient.gender).all()
         
-        # Age distribution
+        # Age distribution, every bucket counted in one query
         current_date = date.today()
         age_groups = {
             'pediatric': (0, 17),
@@ -37,15 +62,18 @@ class ClinicalAnalyticsService:
             'elderly': (65, 120)
         }
         
+        age_group = case(*[
+            (and_(
+                Patient.date_of_birth > current_date - timedelta(days=(max_age + 1) * 365),
+                Patient.date_of_birth <= current_date - timedelta(days=min_age * 365)
+            ), group)
+            for group, (min_age, max_age) in age_groups.items()
+        ], else_=None).label('age_group')
+        age_counts = dict(self.db.query(age_group, func.count(Patient.id)).group_by(age_group).all())
+        
         age_distribution = {}
-        for group, (min_age, max_age) in age_groups.items():
-            min_birth = current_date - timedelta(days=max_age*365)
-            max_birth = current_date - timedelta(days=min_age*365)
-            
-            count = self.db.query(Patient).filter(
-                Patient.date_of_birth.between(min_birth, max_birth)
-            ).count()
-            
+        for group in age_groups:
+            count = age_counts.get(group, 0)
             age_distribution[group] = {
                 'count': count,
                 'percentage': round((count / total_patients * 100) if total_patients > 0 else 0, 1)
@@ -292,27 +320,24 @@ class ClinicalAnalyticsService:
             '718-7': 'Hemoglobin'
         }
         
+        # Each test's results read as one numeric column and summarized with NumPy
         lab_distributions = {}
         for loinc_code, test_name in lab_tests.items():
-            values = self.db.query(Observation.value).filter(
-                Observation.code == loinc_code,
-                Observation.value.isnot(None)
-            ).all()
+            values = np.fromiter(self.db.execute(
+                select(Observation.value_quantity).where(
+                    Observation.loinc_code == loinc_code,
+                    Observation.value_quantity.isnot(None)
+                )
+            ).scalars(), dtype=float)
             
-            if values:
-                value_list = [v.value for v in values]
-                lab_distributions[test_name] = {
-                    'count': len(value_list),
-                    'mean': round(sum(value_list) / len(value_list), 2),
-                    'min': round(min(value_list), 2),
-                    'max': round(max(value_list), 2)
-                }
+            if values.size:
+                lab_distributions[test_name] = summarize_values(values)
         
         # Abnormal lab rates
         abnormal_labs = self.db.query(
             Observation.display,
             func.count(Observation.id).label('total'),
-            func.sum(func.case(
+            func.sum(case(
                 (Observation.interpretation == 'High', 1),
                 (Observation.interpretation == 'Low', 1),
                 else_=0
@@ -0,0 +1,32 @@
+"""
+Background Tasks
+Starts tasks in the background of a worker and keeps a reference to each one
+until it finishes: the event loop only holds weak references to tasks, so an
+unreferenced task can be garbage-collected while it is still running.
+"""
+
+import asyncio
+from typing import Coroutine, Iterable, Set
+
+_tasks: Set[asyncio.Task] = set()
+
+
+def run_in_background(coroutine: Coroutine) -> asyncio.Task:
+    """Start a task on the running loop, referenced until it finishes"""
+    task = asyncio.create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+def background_tasks() -> Set[asyncio.Task]:
+    """Tasks started with run_in_background that have not finished yet"""
+    return set(_tasks)
+
+
+async def cancel_tasks(tasks: Iterable[asyncio.Task]) -> None:
+    """Cancel tasks and wait until they have stopped"""
+    tasks = list(tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
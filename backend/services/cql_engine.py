@@ -7,10 +7,31 @@ import re
 import json
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Tuple, Optional
-from sqlalchemy import and_, or_, func, case, text
-from sqlalchemy.orm import Session, Query
+from sqlalchemy import and_, or_, func, case, text, select, Select, bindparam
+from sqlalchemy.orm import Session, Query, aliased
 
 from models.models import Patient, Condition, Observation, Medication as MedicationRequest, Encounter, Provider as Practitioner
+from services.cql_library_cache import cql_library_cache
+
+# Measure populations and the population each is evaluated within
+POPULATION_PARENTS = {
+    "InitialPopulation": None,
+    "Denominator": "InitialPopulation",
+    "Numerator": "Denominator",
+}
+
+
+class CompiledLibrary:
+    """A parsed CQL library with its measure populations translated to SQL conditions"""
+    
+    def __init__(self, parsed: Dict[str, Any], populations: Dict[str, Any]):
+        self.parsed = parsed
+        self.populations = populations
+    
+    @property
+    def identifier(self) -> str:
+        library = self.parsed.get("library") or {}
+        return f"{library.get('name', 'anonymous')}|{library.get('version', '')}"
 
 
 class CQLTranslationEngine:
@@ -74,48 +95,89 @@ class CQLTranslationEngine:
         if context_match:
             parsed["contexts"].append(context_match.group(1))
         
-        # Extract define statements
-        define_pattern = r'define\s+"?(\w+)"?:\s*([^;]+);?'
-        define_matches = re.findall(define_pattern, cql_content, re.MULTILINE | re.DOTALL)
+        # Extract define statements - a definition runs until the next define (or a semicolon)
+        content = re.sub(r'//[^\n]*', '', cql_content)
+        define_pattern = r'^\s*define\s+(?:"([^"]+)"|(\w+))\s*:\s*(.*?)(?=;|^\s*define\s|\Z)'
+        define_matches = re.findall(define_pattern, content, re.MULTILINE | re.DOTALL)
         
-        for name, expression in define_matches:
+        for quoted_name, name, expression in define_matches:
             parsed["definitions"].append({
-                "name": name,
+                "name": quoted_name or name,
                 "expression": expression.strip()
             })
         
         return parsed
     
-    def translate_expression(self, expression: str, context: Dict[str, Any]) -> Query:
-        """Translate a CQL expression to a SQLAlchemy query"""
-        expression = expression.strip()
+    def translate_criterion(self, expression: str, context: Dict[str, Any]):
+        """
+        Translate a CQL boolean expression to a SQL condition on Patient.
         
-        # Handle patient context
-        if expression.startswith("["):
-            return self._translate_retrieve(expression, context)
+        Retrieves become EXISTS subqueries correlated to Patient.id, so the
+        condition selects every qualifying patient in one query (population
+        context) or tests one patient when combined with Patient.id == ...
+        References to earlier definitions reuse their condition.
+        """
+        expression = self._strip_parentheses(expression.strip())
+        
+        # Reference to another definition
+        reference = expression.strip('"')
+        if reference in context.get("definitions", {}):
+            return context["definitions"][reference]
         
         # Handle exists
         if expression.startswith("exists"):
-            inner_expr = re.search(r'exists\s*\((.*)\)', expression, re.DOTALL)
+            inner_expr = re.match(r'exists\s*\((.*)\)\s*$', expression, re.DOTALL)
             if inner_expr:
-                subquery = self.translate_expression(inner_expr.group(1), context)
-                return subquery.exists()
+                query = self.translate_expression(inner_expr.group(1), context)
+                return query.exists() if query is not None else None
+        
+        # A retrieve used as a criterion is true when it returns anything
+        if expression.startswith("["):
+            query = self.translate_expression(expression, context)
+            return query.exists() if query is not None else None
+        
+        return None
+    
+    def translate_expression(self, expression: str, context: Dict[str, Any]) -> Optional[Select]:
+        """Translate a CQL query expression to a SELECT of the matching resources"""
+        expression = self._strip_parentheses(expression.strip())
         
         # Handle where clause
         if " where " in expression:
             parts = expression.split(" where ", 1)
-            base_query = self.translate_expression(parts[0], context)
-            condition = self._translate_condition(parts[1], context)
-            return base_query.filter(condition)
+            retrieve = self._translate_retrieve(parts[0], context)
+            if retrieve is None:
+                return None
+            query, model = retrieve
+            condition = self._translate_where(parts[1], model)
+            return query.where(condition) if condition is not None else query
         
-        # Handle simple references
-        if expression in context:
-            return context[expression]
+        # Handle retrieves
+        if expression.startswith("["):
+            retrieve = self._translate_retrieve(expression, context)
+            return retrieve[0] if retrieve else None
         
         return None
     
-    def _translate_retrieve(self, expression: str, context: Dict[str, Any]) -> Query:
-        """Translate a CQL retrieve expression like [Condition: "Diabetes"]"""
+    @staticmethod
+    def _strip_parentheses(expression: str) -> str:
+        """Remove parentheses wrapping the whole expression"""
+        while expression.startswith("(") and expression.endswith(")"):
+            depth = 0
+            for position, char in enumerate(expression):
+                depth += {"(": 1, ")": -1}.get(char, 0)
+                if depth == 0 and position < len(expression) - 1:
+                    return expression
+            expression = expression[1:-1].strip()
+        return expression
+    
+    def _value_set_codes(self, value_set: str, suffix: str = "") -> Optional[List[str]]:
+        """Codes of a named value set, e.g. "Diabetes" -> diabetes_conditions"""
+        key = value_set.lower().replace(" ", "_")
+        return self.value_sets.get(key + suffix) or self.value_sets.get(key)
+    
+    def _translate_retrieve(self, expression: str, context: Dict[str, Any]) -> Optional[Tuple[Select, Any]]:
+        """Translate a CQL retrieve like [Condition: "Diabetes"] to a SELECT correlated to Patient.id"""
         # Parse the retrieve expression
         match = re.match(r'\[(\w+)(?::\s*"([^"]+)")?\]', expression)
         if not match:
@@ -126,135 +188,169 @@ class CQLTranslationEngine:
         
         # Get the appropriate model and query
         if resource_type == "Condition":
-            query = self.session.query(Condition)
-            if context.get("patient_id"):
-                query = query.filter(Condition.patient_id == context["patient_id"])
-            if value_set and value_set.lower() in self.value_sets:
-                codes = self.value_sets[value_set.lower() + "_conditions"]
-                query = query.filter(
-                    or_(*[Condition.code.like(f"{code}%") for code in codes])
-                )
-            return query
+            query = select(Condition.id).where(Condition.patient_id == Patient.id)
+            codes = self._value_set_codes(value_set, "_conditions") if value_set else None
+            if codes:
+                query = query.where(or_(
+                    Condition.snomed_code.in_(codes),
+                    *[Condition.icd10_code.like(f"{code}%") for code in codes]
+                ))
+            return query, Condition
             
         elif resource_type == "Observation":
-            query = self.session.query(Observation)
-            if context.get("patient_id"):
-                query = query.filter(Observation.patient_id == context["patient_id"])
-            if value_set and value_set.lower() + "_codes" in self.value_sets:
-                codes = self.value_sets[value_set.lower() + "_codes"]
-                query = query.filter(Observation.code.in_(codes))
-            return query
+            query = select(Observation.id).where(Observation.patient_id == Patient.id)
+            codes = self._value_set_codes(value_set, "_codes") if value_set else None
+            if codes:
+                query = query.where(Observation.loinc_code.in_(codes))
+            return query, Observation
             
         elif resource_type == "MedicationRequest":
-            query = self.session.query(MedicationRequest)
-            if context.get("patient_id"):
-                query = query.filter(MedicationRequest.patient_id == context["patient_id"])
-            if value_set and value_set.lower() in self.value_sets:
-                meds = self.value_sets[value_set.lower()]
-                query = query.filter(
+            query = select(MedicationRequest.id).where(MedicationRequest.patient_id == Patient.id)
+            meds = self._value_set_codes(value_set) if value_set else None
+            if meds:
+                query = query.where(
                     or_(*[MedicationRequest.medication_name.ilike(f"%{med}%") for med in meds])
                 )
-            return query
+            return query, MedicationRequest
             
         elif resource_type == "Patient":
-            query = self.session.query(Patient)
-            if context.get("patient_id"):
-                query = query.filter(Patient.id == context["patient_id"])
-            return query
+            subject = aliased(Patient)
+            return select(subject.id).where(subject.id == Patient.id), subject
             
         return None
     
-    def _translate_condition(self, condition: str, context: Dict[str, Any]):
-        """Translate a CQL condition to SQLAlchemy filter"""
-        # Handle date comparisons
-        date_match = re.match(r'(\w+)\.(\w+)\s*(>=?|<=?|=)\s*(.+)', condition)
-        if date_match:
-            alias = date_match.group(1)
-            field = date_match.group(2)
-            operator = date_match.group(3)
-            value = date_match.group(4)
-            
-            # Resolve the field reference
-            if field == "onset" or field == "recordedDate":
-                field_ref = Condition.onset_date
-            elif field == "effectiveDateTime":
-                field_ref = Observation.effective_date
-            elif field == "authoredOn":
-                field_ref = MedicationRequest.authored_on
+    def _translate_where(self, condition: str, model):
+        """Translate a where clause; terms the translator does not understand are skipped"""
+        parts = re.split(r'\s+(and|or)\s+', condition.strip())
+        clause = self._translate_condition(parts[0], model)
+        for operator, term in zip(parts[1::2], parts[2::2]):
+            translated = self._translate_condition(term, model)
+            if translated is None:
+                continue
+            if clause is None:
+                clause = translated
             else:
+                clause = and_(clause, translated) if operator == "and" else or_(clause, translated)
+        return clause
+    
+    def _translate_condition(self, condition: str, model):
+        """Translate a CQL comparison (alias.field op value) to a SQLAlchemy filter"""
+        match = re.match(r'(\w+)\.(\w+)\s*(>=|<=|>|<|=)\s*(.+)', condition.strip())
+        if not match:
+            return None
+        field = match.group(2)
+        operator = match.group(3)
+        value = match.group(4).strip()
+        
+        # Resolve the field reference
+        fields = {
+            Condition: {"onset": Condition.onset_date, "recordedDate": Condition.recorded_date},
+            Observation: {"effectiveDateTime": Observation.observation_date, "value": Observation.value_quantity},
+            MedicationRequest: {"authoredOn": MedicationRequest.start_date},
+        }
+        field_ref = fields.get(model, {}).get(field)
+        if field_ref is None:
+            return None
+        
+        if field == "value":
+            # Quantities may carry a unit: 9 '%'
+            number = re.match(r'-?\d+(\.\d+)?', value)
+            if not number:
+                return None
+            compare_value = float(number.group(0))
+        elif "Today()" in value:
+            # Evaluated when the query runs, so compiled libraries can be cached
+            days_match = re.search(r'Today\(\)\s*-\s*(\d+)\s*days', value)
+            days = int(days_match.group(1)) if days_match else 0
+            compare_value = bindparam(
+                None, callable_=lambda: datetime.now() - timedelta(days=days), type_=field_ref.type
+            )
+        else:
+            # Try to parse as date string
+            try:
+                compare_value = datetime.strptime(value.strip("'\""), "%Y-%m-%d")
+            except ValueError:
                 return None
-            
-            # Parse the date value
-            if "Today()" in value:
-                days_match = re.search(r'Today\(\)\s*-\s*(\d+)\s*days', value)
-                if days_match:
-                    days = int(days_match.group(1))
-                    date_value = datetime.now() - timedelta(days=days)
-                else:
-                    date_value = datetime.now()
-            else:
-                # Try to parse as date string
-                date_value = datetime.strptime(value.strip("'\""), "%Y-%m-%d")
-            
-            # Apply the operator
-            if operator == ">=":
-                return field_ref >= date_value
-            elif operator == "<=":
-                return field_ref <= date_value
-            elif operator == ">":
-                return field_ref > date_value
-            elif operator == "<":
-                return field_ref < date_value
-            elif operator == "=":
-                return field_ref == date_value
+        
+        # Apply the operator
+        if operator == ">=":
+            return field_ref >= compare_value
+        elif operator == "<=":
+            return field_ref <= compare_value
+        elif operator == ">":
+            return field_ref > compare_value
+        elif operator == "<":
+            return field_ref < compare_value
+        elif operator == "=":
+            return field_ref == compare_value
         
         return None
     
-    def execute_measure(self, measure_cql: str, patient_id: Optional[int] = None) -> Dict[str, Any]:
-        """Execute a CQL measure and return results"""
-        parsed = self.parse_cql(measure_cql)
-        results = {}
-        context = {"patient_id": patient_id} if patient_id else {}
+    def _evaluate_population(self, criterion, patient_id: Optional[str]):
+        """Patients meeting a criterion (one query), or whether one patient does"""
+        query = self.session.query(Patient.id).filter(criterion)
+        if patient_id:
+            return query.filter(Patient.id == patient_id).first() is not None
+        return [pid for (pid,) in query.order_by(Patient.id)]
+    
+    def compile_library(self, cql_content: str) -> "CompiledLibrary":
+        """Parse and translate a library, reusing the cached compilation of identical text"""
+        key = cql_library_cache.key(cql_content, self.value_sets)
+        library = cql_library_cache.get(key)
+        if library is None:
+            library = self._compile(self.parse_cql(cql_content))
+            cql_library_cache.set(key, library)
+        return library
+    
+    def _compile(self, parsed: Dict[str, Any]) -> "CompiledLibrary":
+        """Translate the measure populations of a parsed library to SQL conditions"""
+        context = {"definitions": {}}
+        populations = {}
         
-        # Execute each definition
         for definition in parsed["definitions"]:
-            name = definition["name"]
+            name = definition["name"].replace(" ", "")
             expression = definition["expression"]
             
             # Skip measure metadata definitions
             if name in ["Measure", "Patient"]:
                 continue
             
-            # Translate and execute the expression
-            if name == "InitialPopulation":
-                query = self.translate_expression(expression, context)
-                if query:
-                    if patient_id:
-                        results[name] = query.count() > 0
-                    else:
-                        results[name] = [p.id for p in query.all()]
-                        
-            elif name == "Denominator":
-                # Usually same as initial population
-                if "InitialPopulation" in results:
-                    results[name] = results["InitialPopulation"]
-                    
-            elif name == "Numerator":
-                # Execute the numerator logic
-                query = self.translate_expression(expression, context)
-                if query:
-                    if patient_id:
-                        results[name] = query.count() > 0
-                    else:
-                        # Get list of qualifying patients
-                        numerator_patients = []
-                        if isinstance(results.get("InitialPopulation"), list):
-                            for pid in results["InitialPopulation"]:
-                                context["patient_id"] = pid
-                                subquery = self.translate_expression(expression, context)
-                                if subquery and subquery.count() > 0:
-                                    numerator_patients.append(pid)
-                        results[name] = numerator_patients
+            # Translate the expression; later definitions may refer to it by name
+            criterion = self.translate_criterion(expression, context)
+            if criterion is None:
+                continue
+            context["definitions"][definition["name"]] = criterion
+            
+            if name not in POPULATION_PARENTS:
+                continue
+            
+            # Populations nest: Denominator within InitialPopulation, Numerator within Denominator
+            parent = populations.get(POPULATION_PARENTS[name])
+            if parent is None and name == "Numerator":
+                parent = populations.get("InitialPopulation")
+            if parent is not None and parent is not criterion:
+                criterion = and_(parent, criterion)
+            populations[name] = criterion
+        
+        return CompiledLibrary(parsed, populations)
+    
+    def execute_measure(self, measure_cql: str, patient_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Execute a CQL measure and return results.
+        
+        Each population is one query over all patients: the Denominator is
+        evaluated within the InitialPopulation and the Numerator within the
+        Denominator, as nested SQL conditions rather than per-patient loops.
+        """
+        library = self.compile_library(measure_cql)
+        results = {
+            name: self._evaluate_population(criterion, patient_id)
+            for name, criterion in library.populations.items()
+        }
+        
+        # Denominator defaults to the initial population
+        if "Denominator" not in results and "InitialPopulation" in results:
+            results["Denominator"] = results["InitialPopulation"]
         
         # Calculate measure score if applicable
         if "Denominator" in results and "Numerator" in results:
@@ -276,44 +372,71 @@ class CQLTranslationEngine:
         self.value_sets[name.lower()] = codes
 
 
-class SimplifiedCQLExecutor:
+class MeasureKernel:
     """
-    Simplified CQL executor that works directly with the current schema
-    Focuses on common quality measure patterns
+    Set-based building blocks for population measures
+    
+    Populations are SQL conditions on Patient, so a measure costs one query
+    per population however many patients it covers. "Most recent value"
+    semantics use ROW_NUMBER() OVER (PARTITION BY patient_id ORDER BY date
+    DESC), available on both SQLite (3.25+) and PostgreSQL.
     """
     
     def __init__(self, session: Session):
         self.session = session
-        self.engine = CQLTranslationEngine(session)
     
-    def execute_diabetes_control_measure(self) -> Dict[str, Any]:
-        """Execute diabetes control measure"""
-        # Initial Population: Patients with diabetes
-        diabetes_patients = self.session.query(Patient).join(Condition).filter(
-            or_(
-                Condition.code.like('E11%'),
-                Condition.code.like('E10%'),
-                Condition.code.like('E13%')
-            ),
-            Condition.status == 'active'
-        ).distinct().all()
-        
-        initial_pop = [p.id for p in diabetes_patients]
-        
-        # Numerator: Patients with HbA1c < 9% in last year
-        numerator_patients = []
-        for patient_id in initial_pop:
-            latest_hba1c = self.session.query(Observation).filter(
-                Observation.patient_id == patient_id,
-                Observation.code.in_(['4548-4', '4549-2', '17856-6']),
-                Observation.effective_date >= datetime.now() - timedelta(days=365)
-            ).order_by(Observation.effective_date.desc()).first()
-            
-            if latest_hba1c and latest_hba1c.value_quantity < 9.0:
-                numerator_patients.append(patient_id)
+    @staticmethod
+    def latest_observations(codes: List[str], since: datetime):
+        """The most recent observation of the codes per patient since a date"""
+        ranked = select(
+            Observation.patient_id,
+            Observation.value_quantity,
+            Observation.observation_date,
+            func.row_number().over(
+                partition_by=Observation.patient_id,
+                order_by=(Observation.observation_date.desc(), Observation.id.desc())
+            ).label("rank")
+        ).where(
+            Observation.loinc_code.in_(codes),
+            Observation.observation_date >= since
+        ).subquery()
+        return select(ranked).where(ranked.c.rank == 1).subquery()
+    
+    @classmethod
+    def latest_value(cls, codes: List[str], since: datetime, predicate):
+        """Patients whose most recent value of the codes satisfies predicate(value_quantity)"""
+        latest = cls.latest_observations(codes, since)
+        return Patient.id.in_(select(latest.c.patient_id).where(predicate(latest.c.value_quantity)))
+    
+    @staticmethod
+    def has_observation(codes: List[str], since: datetime):
+        """Patients with any observation of the codes since a date"""
+        return select(Observation.id).where(
+            Observation.patient_id == Patient.id,
+            Observation.loinc_code.in_(codes),
+            Observation.observation_date >= since
+        ).exists()
+    
+    @staticmethod
+    def has_condition(code_prefixes: List[str], status: str = "active"):
+        """Patients with a condition whose ICD-10 code starts with one of the prefixes"""
+        return select(Condition.id).where(
+            Condition.patient_id == Patient.id,
+            or_(*[Condition.icd10_code.like(f"{prefix}%") for prefix in code_prefixes]),
+            Condition.clinical_status == status
+        ).exists()
+    
+    def patients(self, *criteria) -> List[str]:
+        """Ids of the patients meeting every criterion, in one query"""
+        return [pid for (pid,) in self.session.query(Patient.id).filter(*criteria).order_by(Patient.id)]
+    
+    def evaluate(self, measure_id: str, initial_population, numerator) -> Dict[str, Any]:
+        """Evaluate a proportion measure whose denominator is its initial population"""
+        initial_pop = self.patients(initial_population)
+        numerator_patients = self.patients(initial_population, numerator)
         
         return {
-            "measureId": "DiabetesHbA1cControl",
+            "measureId": measure_id,
             "initialPopulation": len(initial_pop),
             "denominator": len(initial_pop),
             "numerator": len(numerator_patients),
@@ -323,6 +446,32 @@ class SimplifiedCQLExecutor:
                 "numerator": numerator_patients
             }
         }
+
+
+class SimplifiedCQLExecutor:
+    """
+    Simplified CQL executor that works directly with the current schema
+    Focuses on common quality measure patterns
+    """
+    
+    def __init__(self, session: Session):
+        self.session = session
+        self.engine = CQLTranslationEngine(session)
+        self.kernel = MeasureKernel(session)
+    
+    def execute_diabetes_control_measure(self) -> Dict[str, Any]:
+        """Execute diabetes control measure"""
+        # Initial Population: Patients with diabetes
+        initial_population = MeasureKernel.has_condition(['E11', 'E10', 'E13'])
+        
+        # Numerator: Patients whose latest HbA1c in the last year is < 9%
+        numerator = MeasureKernel.latest_value(
+            ['4548-4', '4549-2', '17856-6'],
+            datetime.now() - timedelta(days=365),
+            lambda value: value < 9.0
+        )
+        
+        return self.kernel.evaluate("DiabetesHbA1cControl", initial_population, numerator)
     
     def execute_preventive_screening_measure(self, screening_type: str) -> Dict[str, Any]:
         """Execute preventive screening measures"""
@@ -331,11 +480,11 @@ class SimplifiedCQLExecutor:
             min_birth = datetime.now() - timedelta(days=74*365)
             max_birth = datetime.now() - timedelta(days=50*365)
             
-            eligible_patients = self.session.query(Patient).filter(
+            initial_population = and_(
                 Patient.gender == 'female',
-                Patient.date_of_birth.between(min_birth, max_birth),
+                Patient.date_of_birth.between(min_birth.date(), max_birth.date()),
                 Patient.is_active == True
-            ).all()
+            )
             
             screening_codes = ['24606-6', '26349-0', '26287-2']
             lookback_days = 730  # 2 years
@@ -345,10 +494,10 @@ class SimplifiedCQLExecutor:
             min_birth = datetime.now() - timedelta(days=75*365)
             max_birth = datetime.now() - timedelta(days=50*365)
             
-            eligible_patients = self.session.query(Patient).filter(
-                Patient.date_of_birth.between(min_birth, max_birth),
+            initial_population = and_(
+                Patient.date_of_birth.between(min_birth.date(), max_birth.date()),
                 Patient.is_active == True
-            ).all()
+            )
             
             screening_codes = ['34120-2', '19774-9']
             lookback_days = 3650  # 10 years
@@ -356,28 +505,9 @@ class SimplifiedCQLExecutor:
         else:
             return {"error": "Unknown screening type"}
         
-        initial_pop = [p.id for p in eligible_patients]
+        # Numerator: any screening in the lookback period
+        numerator = MeasureKernel.has_observation(
+            screening_codes, datetime.now() - timedelta(days=lookback_days)
+        )
         
-        # Find patients with screening in lookback period
-        screened_patients = []
-        for patient_id in initial_pop:
-            screening = self.session.query(Observation).filter(
-                Observation.patient_id == patient_id,
-                Observation.code.in_(screening_codes),
-                Observation.effective_date >= datetime.now() - timedelta(days=lookback_days)
-            ).first()
-            
-            if screening:
-                screened_patients.append(patient_id)
-        
-        return {
-            "measureId": f"PreventiveScreening_{screening_type}",
-            "initialPopulation": len(initial_pop),
-            "denominator": len(initial_pop),
-            "numerator": len(screened_patients),
-            "measureScore": (len(screened_patients) / len(initial_pop) * 100) if initial_pop else 0,
-            "patients": {
-                "initialPopulation": initial_pop,
-                "numerator": screened_patients
-            }
-        }
\ No newline at end of file
+        return self.kernel.evaluate(f"PreventiveScreening_{screening_type}", initial_population, numerator)
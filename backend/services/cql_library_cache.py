@@ -0,0 +1,48 @@
+"""
+CQL Library Cache
+Per-worker LRU cache of compiled CQL libraries
+
+A library is keyed by the SHA-256 of its text and of the value sets it was
+translated against, so a measure run again and again (dashboard refreshes)
+is parsed and translated once. Compiled populations are SQL conditions with
+no patient or date baked in - Today() is a bind parameter evaluated on every
+execution - so they can be reused by any request.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, Tuple
+
+from services.lru_cache import LRUCache
+
+CQL_LIBRARY_CACHE_SIZE = int(os.getenv("CQL_LIBRARY_CACHE_SIZE", "256"))
+
+
+class CQLLibraryCache(LRUCache):
+    """Bounded LRU cache of compiled CQL libraries keyed by content hash"""
+
+    def __init__(self, max_entries: int = CQL_LIBRARY_CACHE_SIZE):
+        super().__init__(max_entries)
+
+    @staticmethod
+    def key(cql_content: str, value_sets: Dict[str, Any]) -> Tuple[str, str]:
+        """Cache key of a library translated against the given value sets"""
+        return (
+            hashlib.sha256(cql_content.encode("utf-8")).hexdigest(),
+            hashlib.sha256(json.dumps(value_sets, sort_keys=True).encode("utf-8")).hexdigest()
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            libraries = [library.identifier for library in self._entries.values()]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "libraries": libraries
+            }
+
+
+cql_library_cache = CQLLibraryCache()
@@ -0,0 +1,181 @@
+"""
+Dashboard Statistics Service
+Maintains a pre-aggregated snapshot of the dashboard statistics (patient,
+encounter, provider, condition and medication counts, the most common
+conditions and daily encounter counts) so dashboards read one row instead of
+counting the clinical tables on every page load.
+
+A background task refreshes the snapshot once it is older than
+DASHBOARD_STATS_INTERVAL_SECONDS, or sooner once this worker has written
+DASHBOARD_STATS_WRITE_THRESHOLD rows the statistics count.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime, date, timedelta
+from typing import Optional
+
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database.database import SessionLocal
+from models.dashboard_models import DashboardStatsSnapshot
+from models.synthea_models import Patient, Encounter, Provider, Condition, Medication
+
+logger = logging.getLogger(__name__)
+
+# Refresh the snapshot when it is older than this (seconds)
+DASHBOARD_STATS_INTERVAL_SECONDS = int(os.getenv("DASHBOARD_STATS_INTERVAL_SECONDS", "300"))
+
+# ... or once this many counted rows were written since the last refresh
+DASHBOARD_STATS_WRITE_THRESHOLD = int(os.getenv("DASHBOARD_STATS_WRITE_THRESHOLD", "100"))
+
+# How often the background task checks whether a refresh is due (seconds)
+DASHBOARD_STATS_CHECK_SECONDS = int(os.getenv("DASHBOARD_STATS_CHECK_SECONDS", "5"))
+
+# Days of daily encounter counts kept in the snapshot
+DASHBOARD_STATS_HISTORY_DAYS = int(os.getenv("DASHBOARD_STATS_HISTORY_DAYS", "365"))
+
+SNAPSHOT_ID = "dashboard"
+
+# Tables whose writes move the statistics
+COUNTED_MODELS = (Patient, Encounter, Provider, Condition, Medication)
+
+_pending_writes = 0
+_pending_lock = threading.Lock()
+
+
+def pending_writes() -> int:
+    """Counted rows this worker has written since its last refresh"""
+    return _pending_writes
+
+
+def compute_dashboard_stats(db: Session) -> dict:
+    """Count the dashboard statistics from the clinical tables"""
+    history_start = date.today() - timedelta(days=DASHBOARD_STATS_HISTORY_DAYS)
+
+    # Every count in one round trip
+    counts = db.execute(select(
+        select(func.count(Patient.id)).scalar_subquery(),
+        select(func.count(Encounter.id)).scalar_subquery(),
+        select(func.count(Provider.id)).where(Provider.active == True).scalar_subquery(),
+        select(func.count(Encounter.id)).where(
+            Encounter.encounter_date >= datetime.now() - timedelta(days=7)
+        ).scalar_subquery(),
+        select(func.count(Condition.id)).where(Condition.clinical_status == 'active').scalar_subquery(),
+        select(func.count(Medication.id)).where(Medication.status == 'active').scalar_subquery()
+    )).one()
+    total_patients, total_encounters, active_providers, recent_encounters, active_conditions, active_medications = counts
+
+    common_conditions = db.query(
+        Condition.description, func.count(Condition.id)
+    ).filter(
+        Condition.description.isnot(None)
+    ).group_by(Condition.description).order_by(
+        func.count(Condition.id).desc(), Condition.description
+    ).limit(5).all()
+
+    encounter_day = func.date(Encounter.encounter_date)
+    encounters_by_date = db.query(encounter_day, func.count(Encounter.id)).filter(
+        Encounter.encounter_date >= history_start
+    ).group_by(encounter_day).all()
+
+    return {
+        "total_patients": total_patients,
+        "total_encounters": total_encounters,
+        "active_providers": active_providers,
+        "recent_encounters": recent_encounters,
+        "active_conditions": active_conditions,
+        "active_medications": active_medications,
+        "common_conditions": [
+            {"name": description, "count": count} for description, count in common_conditions
+        ],
+        "encounters_by_date": {str(day): count for day, count in encounters_by_date if day is not None},
+        "encounters_by_date_since": history_start.isoformat()
+    }
+
+
+def encounters_since(stats: dict, start_date: date) -> Optional[int]:
+    """Encounters dated start_date or later, if the snapshot's daily counts reach back that far"""
+    if start_date.isoformat() < stats["encounters_by_date_since"]:
+        return None
+    start = start_date.isoformat()
+    return sum(count for day, count in stats["encounters_by_date"].items() if day >= start)
+
+
+def refresh_dashboard_stats(db: Session) -> DashboardStatsSnapshot:
+    """Recount the statistics and store them as the current snapshot"""
+    global _pending_writes
+    with _pending_lock:
+        _pending_writes = 0
+
+    started = time.perf_counter()
+    stats = compute_dashboard_stats(db)
+
+    snapshot = db.get(DashboardStatsSnapshot, SNAPSHOT_ID)
+    if snapshot is None:
+        snapshot = DashboardStatsSnapshot(id=SNAPSHOT_ID)
+        db.add(snapshot)
+    snapshot.stats = stats
+    snapshot.refreshed_at = datetime.utcnow()
+    snapshot.elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another worker stored the first snapshot at the same time
+        db.rollback()
+        snapshot = db.get(DashboardStatsSnapshot, SNAPSHOT_ID)
+    return snapshot
+
+
+def get_dashboard_snapshot(db: Session) -> DashboardStatsSnapshot:
+    """The current snapshot, computed on first use"""
+    return db.get(DashboardStatsSnapshot, SNAPSHOT_ID) or refresh_dashboard_stats(db)
+
+
+def snapshot_due(snapshot: Optional[DashboardStatsSnapshot]) -> bool:
+    """Snapshot is missing, older than the refresh interval, or behind enough writes"""
+    if snapshot is None or _pending_writes >= DASHBOARD_STATS_WRITE_THRESHOLD:
+        return True
+    return datetime.utcnow() - snapshot.refreshed_at >= timedelta(seconds=DASHBOARD_STATS_INTERVAL_SECONDS)
+
+
+def refresh_if_due(bind=None) -> bool:
+    """Refresh the snapshot if it is due, in a session of its own"""
+    db = Session(bind=bind) if bind is not None else SessionLocal()
+    try:
+        if not snapshot_due(db.get(DashboardStatsSnapshot, SNAPSHOT_ID)):
+            return False
+        refresh_dashboard_stats(db)
+        return True
+    finally:
+        db.close()
+
+
+async def dashboard_stats_refresher(bind=None):
+    """Keep the snapshot fresh, counting on a pool thread so requests are not blocked"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, refresh_if_due, bind)
+        except Exception as e:
+            logger.error(f"Error refreshing dashboard statistics: {e}")
+
+        await asyncio.sleep(DASHBOARD_STATS_CHECK_SECONDS)
+
+
+@event.listens_for(Session, "after_flush")
+def _count_dashboard_writes(session, flush_context):
+    """Count the writes that move the dashboard statistics"""
+    global _pending_writes
+    written = sum(
+        1 for instance in list(session.new) + list(session.dirty) + list(session.deleted)
+        if isinstance(instance, COUNTED_MODELS)
+    )
+    if written:
+        with _pending_lock:
+            _pending_writes += written
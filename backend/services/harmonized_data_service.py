@@ -19,6 +19,7 @@ from models.clinical.catalogs import MedicationCatalog, LabTestCatalog, ImagingS
 from models.clinical.notes import ClinicalNote
 from models.clinical.orders import Order
 from models.clinical.tasks import ClinicalTask, InboxItem
+from services.latest_observation_service import get_latest_observations
 
 class HarmonizedDataService:
     """Centralized service for consistent data access across EMR"""
@@ -213,21 +214,17 @@ class HarmonizedDataService:
             '39156-5': 'bmi'              # BMI
         }
         
+        # One lookup in the latest_observation projection for all codes
+        latest = get_latest_observations(self.db, patient_id, vital_codes.keys(), status='final')
+        
         vitals = {}
         for loinc_code, vital_name in vital_codes.items():
-            latest_obs = self.db.query(Observation).filter(
-                and_(
-                    Observation.patient_id == patient_id,
-                    Observation.loinc_code == loinc_code,
-                    Observation.status == 'final'
-                )
-            ).order_by(desc(Observation.effective_datetime)).first()
-            
+            latest_obs = latest.get(loinc_code)
             if latest_obs:
                 vitals[vital_name] = {
                     'value': latest_obs.value,
-                    'unit': latest_obs.unit,
-                    'date': latest_obs.effective_datetime.isoformat() if latest_obs.effective_datetime else None
+                    'unit': latest_obs.value_unit,
+                    'date': latest_obs.observation_date.isoformat() if latest_obs.observation_date else None
                 }
         
         return vitals
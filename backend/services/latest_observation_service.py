@@ -0,0 +1,176 @@
+"""
+Latest Observation Service
+Maintains the latest_observation projection: the most recent Observation per
+(patient_id, loinc_code)
+
+Every flush that inserts, updates or deletes Observations recomputes the
+projection rows of the keys it touched, inside the same transaction, so
+"latest value of a code" is one primary-key lookup instead of a sorted scan
+of the patient's observations. rebuild_latest_observations() recomputes the
+whole table, for databases loaded with raw SQL or before the projection
+existed (see scripts/rebuild_latest_observations.py).
+
+Modules that write Observations outside the API (import scripts) import this
+module so the listener is registered.
+"""
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, delete, event, func, inspect, insert, or_, select, tuple_
+from sqlalchemy.orm import Session
+
+from models.synthea_models import Observation, LatestObservation
+from services.patient_data_version_service import UPSERT_DIALECTS
+
+# (patient_id, loinc_code) keys recomputed per statement
+KEY_CHUNK_SIZE = 500
+
+PROJECTED_COLUMNS = [
+    "patient_id", "loinc_code", "observation_id", "observation_date", "observation_type",
+    "display", "value", "value_quantity", "value_unit", "status"
+]
+
+
+def _latest_select(keys: Optional[List[Tuple[str, str]]] = None, status: Optional[str] = None):
+    """Latest observation per (patient_id, loinc_code), optionally limited to some keys or a status"""
+    ranked = select(
+        Observation.patient_id,
+        Observation.loinc_code,
+        Observation.id.label("observation_id"),
+        Observation.observation_date,
+        Observation.observation_type,
+        Observation.display,
+        Observation.value,
+        Observation.value_quantity,
+        Observation.value_unit,
+        Observation.status,
+        func.row_number().over(
+            partition_by=(Observation.patient_id, Observation.loinc_code),
+            order_by=(Observation.observation_date.desc(), Observation.id.desc())
+        ).label("rank")
+    ).where(
+        Observation.loinc_code.isnot(None),
+        Observation.observation_date.isnot(None)
+    )
+    if keys is not None:
+        ranked = ranked.where(tuple_(Observation.patient_id, Observation.loinc_code).in_(keys))
+    if status is not None:
+        ranked = ranked.where(Observation.status == status)
+    ranked = ranked.subquery()
+
+    return select(*[ranked.c[name] for name in PROJECTED_COLUMNS]).where(ranked.c.rank == 1)
+
+
+def refresh_latest_observations(connection, keys: Iterable[Tuple[str, str]],
+                                replaced: Iterable[Tuple[str, str, str]] = ()) -> None:
+    """
+    Recompute the projection rows of the given (patient_id, loinc_code) keys.
+
+    `replaced` are the (patient_id, loinc_code, observation_id) rows whose observation
+    this transaction updated or deleted; they are dropped first, as they may no longer
+    be the latest. Otherwise a row is only replaced by a newer observation, so
+    transactions refreshing the same key concurrently leave the newest in place.
+    """
+    keys = sorted(key for key in set(keys) if key[0] and key[1])
+    upsert = UPSERT_DIALECTS.get(connection.dialect.name)
+    if upsert is None:
+        # Other databases: replace the rows outright
+        for start in range(0, len(keys), KEY_CHUNK_SIZE):
+            chunk = keys[start:start + KEY_CHUNK_SIZE]
+            connection.execute(
+                delete(LatestObservation).where(
+                    tuple_(LatestObservation.patient_id, LatestObservation.loinc_code).in_(chunk)
+                )
+            )
+            connection.execute(
+                insert(LatestObservation).from_select(PROJECTED_COLUMNS, _latest_select(chunk))
+            )
+        return
+
+    replaced = sorted(row for row in set(replaced) if row[0] and row[1])
+    for start in range(0, len(replaced), KEY_CHUNK_SIZE):
+        connection.execute(
+            delete(LatestObservation).where(tuple_(
+                LatestObservation.patient_id, LatestObservation.loinc_code, LatestObservation.observation_id
+            ).in_(replaced[start:start + KEY_CHUNK_SIZE]))
+        )
+
+    for start in range(0, len(keys), KEY_CHUNK_SIZE):
+        statement = upsert(LatestObservation).from_select(
+            PROJECTED_COLUMNS, _latest_select(keys[start:start + KEY_CHUNK_SIZE])
+        )
+        excluded = statement.excluded
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[LatestObservation.patient_id, LatestObservation.loinc_code],
+            set_={name: excluded[name] for name in PROJECTED_COLUMNS[2:]},
+            where=or_(
+                excluded.observation_date > LatestObservation.observation_date,
+                and_(
+                    excluded.observation_date == LatestObservation.observation_date,
+                    excluded.observation_id >= LatestObservation.observation_id
+                )
+            )
+        ))
+
+
+def rebuild_latest_observations(db: Session) -> int:
+    """Recompute the whole projection from the observations table; returns its row count"""
+    db.execute(delete(LatestObservation))
+    db.execute(insert(LatestObservation).from_select(PROJECTED_COLUMNS, _latest_select()))
+    db.commit()
+    return db.query(func.count()).select_from(LatestObservation).scalar()
+
+
+def _touched_keys(session: Session) -> Tuple[Set[Tuple[str, str]], Set[Tuple[str, str, str]]]:
+    """
+    Keys of every Observation the flush wrote, including the keys it moved away from,
+    and the projection rows the updated or deleted Observations may occupy
+    """
+    keys = set()
+    replaced = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(instance, Observation):
+            continue
+        state = inspect(instance)
+        old_patients = state.attrs.patient_id.history.deleted or [instance.patient_id]
+        old_codes = state.attrs.loinc_code.history.deleted or [instance.loinc_code]
+        touched = {(instance.patient_id, instance.loinc_code)}
+        touched.update((patient_id, code) for patient_id in old_patients for code in old_codes)
+        keys.update(touched)
+        if instance not in session.new:
+            replaced.update((patient_id, code, instance.id) for patient_id, code in touched)
+    return keys, replaced
+
+
+@event.listens_for(Session, "after_flush")
+def _maintain_latest_observations(session, flush_context):
+    """Keep latest_observation current for the Observations written by a flush"""
+    keys, replaced = _touched_keys(session)
+    if keys:
+        refresh_latest_observations(session.connection(), keys, replaced)
+
+
+def get_latest_observations(db: Session, patient_id: str, loinc_codes: Iterable[str],
+                            status: Optional[str] = None) -> Dict[str, LatestObservation]:
+    """
+    Latest observation of each code for a patient, by LOINC code (one indexed lookup).
+
+    With a status, the latest observation having that status: codes whose
+    projected row has another status (a newer preliminary or amended result)
+    are looked up in the observations table, in one ranked query.
+    """
+    rows = db.query(LatestObservation).filter(
+        LatestObservation.patient_id == patient_id,
+        LatestObservation.loinc_code.in_(list(loinc_codes))
+    )
+    latest = {row.loinc_code: row for row in rows}
+    if status is None:
+        return latest
+
+    other = [code for code, row in latest.items() if row.status != status]
+    for code in other:
+        del latest[code]
+    if other:
+        for row in db.execute(_latest_select([(patient_id, code) for code in other], status)):
+            latest[row.loinc_code] = LatestObservation(**row._mapping)
+    return latest
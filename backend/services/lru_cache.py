@@ -0,0 +1,62 @@
+"""
+LRU Cache
+Thread-safe bounded mapping shared by the per-worker caches
+
+Reads move an entry to the most recently used end and writes evict from the
+other end once there are more than max_entries. Hits and misses are counted
+for the caches that report them. The lock is re-entrant so subclasses can
+hold it around several calls that must see the same entries.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, List
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded least-recently-used cache"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def values(self) -> List[Any]:
+        """Cached values, least recently used first"""
+        with self._lock:
+            return list(self._entries.values())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,94 @@
+"""
+Patient Data Version Service
+Maintains a per-patient data version: a counter bumped, in the same
+transaction, by every flush that writes the patient's clinical data
+
+Anything derived from a patient's chart (CDS cards, for example) can be
+cached under the version it was computed from and is stale as soon as the
+version moves. Modules that write clinical data outside the API (import
+scripts) import this module so the listener is registered.
+"""
+
+from datetime import datetime
+from typing import Iterable, Set
+
+from sqlalchemy import event, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models.synthea_models import (
+    Patient, Encounter, Condition, Medication, Observation, Procedure, Immunization,
+    Allergy, CarePlan, Device, DiagnosticReport, ImagingStudy, PatientDataVersion
+)
+
+# Tables whose rows are part of a patient's chart
+CLINICAL_MODELS = (
+    Encounter, Condition, Medication, Observation, Procedure, Immunization,
+    Allergy, CarePlan, Device, DiagnosticReport, ImagingStudy
+)
+
+# INSERT ... ON CONFLICT constructs of the databases that have one
+UPSERT_DIALECTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def get_data_version(db: Session, patient_id: str) -> int:
+    """Current data version of a patient (0 until its data is first written)"""
+    version = db.query(PatientDataVersion.version).filter(
+        PatientDataVersion.patient_id == patient_id
+    ).scalar()
+    return version or 0
+
+
+def bump_data_versions(connection, patient_ids: Iterable[str]) -> None:
+    """Increment the data version of each patient"""
+    patient_ids = sorted(set(patient_id for patient_id in patient_ids if patient_id))
+    if not patient_ids:
+        return
+
+    now = datetime.utcnow()
+    upsert = UPSERT_DIALECTS.get(connection.dialect.name)
+    if upsert is not None:
+        statement = upsert(PatientDataVersion).values([
+            {"patient_id": patient_id, "version": 1, "updated_at": now} for patient_id in patient_ids
+        ])
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[PatientDataVersion.patient_id],
+            set_={"version": PatientDataVersion.version + 1, "updated_at": now}
+        ))
+        return
+
+    # Other databases: increment the existing counters, then create the missing ones
+    connection.execute(
+        update(PatientDataVersion)
+        .where(PatientDataVersion.patient_id.in_(patient_ids))
+        .values(version=PatientDataVersion.version + 1, updated_at=now)
+    )
+    existing = {row[0] for row in connection.execute(
+        PatientDataVersion.__table__.select()
+        .with_only_columns(PatientDataVersion.patient_id)
+        .where(PatientDataVersion.patient_id.in_(patient_ids))
+    )}
+    missing = [patient_id for patient_id in patient_ids if patient_id not in existing]
+    if missing:
+        connection.execute(PatientDataVersion.__table__.insert(), [
+            {"patient_id": patient_id, "version": 1, "updated_at": now} for patient_id in missing
+        ])
+
+
+def _touched_patients(session: Session) -> Set[str]:
+    """Patients whose chart the flush wrote"""
+    patient_ids = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Patient):
+            patient_ids.add(instance.id)
+        elif isinstance(instance, CLINICAL_MODELS):
+            patient_ids.add(instance.patient_id)
+    return patient_ids
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_patient_data_versions(session, flush_context):
+    """Move the data version of every patient whose chart a flush wrote"""
+    patient_ids = _touched_patients(session)
+    if patient_ids:
+        bump_data_versions(session.connection(), patient_ids)
@@ -0,0 +1,34 @@
+"""
+Shared test fixtures
+"""
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture
+def count_statements():
+    """
+    Record the SQL statements run through a session's bind inside a with block.
+
+        with count_statements(db_session) as statements:
+            ...
+        assert len(statements) == 2
+    """
+    @contextmanager
+    def counting(session):
+        statements = []
+        bind = session.get_bind()
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(bind, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(bind, "before_cursor_execute", record)
+
+    return counting
@@ -0,0 +1,116 @@
+"""
+Unit tests for the clinical analytics service
+"""
+
+import statistics
+
+import pytest
+from datetime import datetime, date, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from database.database import Base
+from models.models import Patient, Observation
+from services.analytics_service import ClinicalAnalyticsService
+
+
+@pytest.fixture
+def db_session():
+    """Create test database session"""
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    session = TestingSessionLocal()
+    yield session
+    session.close()
+
+
+class TestPopulationDemographics:
+    """Test the population demographics"""
+
+    def test_age_buckets_in_one_query(self, db_session, count_statements):
+        # patient id -> age in days
+        ages = {
+            "infant": 100,
+            "teen": 17 * 365 + 200,  # 17 and a half: still pediatric
+            "adult": 30 * 365,
+            "middle": 50 * 365,
+            "senior": 80 * 365,
+        }
+        for patient_id, days in ages.items():
+            db_session.add(Patient(id=patient_id, first_name="Age", last_name=patient_id,
+                                   date_of_birth=date.today() - timedelta(days=days), gender="female"))
+        db_session.commit()
+
+        demographics = ClinicalAnalyticsService(db_session).get_population_demographics()
+
+        counts = {group: bucket["count"] for group, bucket in demographics["age_distribution"].items()}
+        assert counts == {"pediatric": 2, "young_adult": 1, "middle_aged": 1, "elderly": 1}
+        assert demographics["age_distribution"]["pediatric"]["percentage"] == 40.0
+
+        with count_statements(db_session) as statements:
+            ClinicalAnalyticsService(db_session).get_population_demographics()
+        assert len(statements) == 4
+
+
+class TestLabValueDistributions:
+    """Test the laboratory value distributions"""
+
+    @pytest.fixture
+    def lab_results(self, db_session):
+        db_session.add(Patient(id="lab-patient", first_name="Lab", last_name="Patient",
+                               date_of_birth=date(1970, 1, 1), gender="male"))
+        glucose = [72.0, 85.0, 90.0, 95.0, 101.0, 110.0, 126.0, 140.0, 180.0, 250.0]
+        for number, value in enumerate(glucose):
+            db_session.add(Observation(
+                id=f"glucose-{number}", patient_id="lab-patient", observation_type="laboratory",
+                loinc_code="2345-7", display="Glucose", value_quantity=value,
+                interpretation="High" if value > 125 else "Normal",
+                observation_date=datetime.now() - timedelta(days=number)
+            ))
+        db_session.add(Observation(
+            id="a1c-0", patient_id="lab-patient", observation_type="laboratory",
+            loinc_code="4548-4", display="Hemoglobin A1c", value_quantity=6.5,
+            observation_date=datetime.now()
+        ))
+        db_session.add(Observation(
+            id="a1c-text", patient_id="lab-patient", observation_type="laboratory",
+            loinc_code="4548-4", display="Hemoglobin A1c", value="pending",
+            observation_date=datetime.now()
+        ))
+        db_session.commit()
+        return glucose
+
+    def test_distribution_statistics(self, db_session, lab_results):
+        result = ClinicalAnalyticsService(db_session).get_lab_value_distributions()
+        glucose = result["distributions"]["Glucose"]
+
+        assert glucose["count"] == 10
+        assert glucose["mean"] == round(statistics.mean(lab_results), 2)
+        assert glucose["std"] == round(statistics.stdev(lab_results), 2)
+        assert (glucose["min"], glucose["max"]) == (72.0, 250.0)
+        assert glucose["percentiles"]["p50"] == statistics.median(lab_results)
+        assert glucose["percentiles"]["p5"] < glucose["percentiles"]["p25"] < glucose["percentiles"]["p75"]
+
+        histogram = glucose["histogram"]
+        assert len(histogram) == 10
+        assert sum(bucket["count"] for bucket in histogram) == 10
+        assert (histogram[0]["from"], histogram[-1]["to"]) == (72.0, 250.0)
+
+        # Single results have no spread; text-only results are left out
+        a1c = result["distributions"]["Hemoglobin A1c"]
+        assert (a1c["count"], a1c["std"], a1c["percentiles"]["p95"]) == (1, 0.0, 6.5)
+        assert "Creatinine" not in result["distributions"]
+
+    def test_abnormal_rates(self, db_session, lab_results):
+        result = ClinicalAnalyticsService(db_session).get_lab_value_distributions()
+        assert result["abnormal_rates"] == [
+            {"test": "Glucose", "total_results": 10, "abnormal_results": 4, "abnormal_rate": 40.0}
+        ]
+
+    def test_one_column_extract_per_test(self, db_session, lab_results, count_statements):
+        with count_statements(db_session) as statements:
+            ClinicalAnalyticsService(db_session).get_lab_value_distributions()
+        # Five value columns and the abnormal rates
+        assert len(statements) == 6
+        assert all(statement.startswith("SELECT observations.value_quantity \nFROM observations")
+                   for statement in statements[:5])
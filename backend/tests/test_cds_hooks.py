@@ -2,21 +2,40 @@
 Unit tests for CDS Hooks implementation
 """
 
+import time
+
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime, date
+from sqlalchemy.pool import StaticPool
+from datetime import datetime, date, timedelta
 
 from main import app
 from database.database import get_db, Base
 from models.models import Patient, Provider, Encounter, Observation, Condition, Medication
+from api.cds_hooks import cds_hooks_router
+from api.cds_hooks.cds_hooks_router import CDSHookEngine, initialize_sample_hooks
+from api.cds_hooks.card_cache import card_cache
+from api.cds_hooks.hook_registry import HookRegistry, hook_registry
+from api.cds_hooks.rules import CompiledHook
+from api.cds_hooks.patient_context import PatientContext
+from api.cds_hooks.cds_services import (
+    DiabetesManagementService, HypertensionManagementService, DrugInteractionService,
+    PreventiveCareService, execute_services
+)
+from api.cds_hooks.prefetch import PrefetchResolver
+from models.cds_hook_models import CDSHook
 
 
 @pytest.fixture
 def db_session():
     """Create test database session"""
-    engine = create_engine("sqlite:///:memory:")
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool
+    )
     Base.metadata.create_all(bind=engine)
     TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     session = TestingSessionLocal()
@@ -34,9 +53,13 @@ def test_client(db_session):
             pass
     
     app.dependency_overrides[get_db] = override_get_db
+    hook_registry.clear()
+    card_cache.clear()
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
+    hook_registry.clear()
+    card_cache.clear()
 
 
 @pytest.fixture
@@ -402,5 +425,574 @@ class TestCDSHooksErrorHandling:
         assert data["outcome"] == "accepted"
 
 
+
+@pytest.fixture
+def rule_patient_data(db_session):
+    """Patient with conditions, medications and repeated observations for rule evaluation"""
+    now = datetime.now()
+    db_session.add(Patient(
+        id="rule-patient-1",
+        first_name="Rita",
+        last_name="Rules",
+        date_of_birth=date(1950, 3, 1),
+        gender="female"
+    ))
+    db_session.add(Condition(
+        id="rule-condition-1",
+        patient_id="rule-patient-1",
+        snomed_code="44054006",
+        description="Diabetes mellitus type 2",
+        clinical_status="active",
+        onset_date=now - timedelta(days=2000)
+    ))
+    db_session.add(Medication(
+        id="rule-medication-1",
+        patient_id="rule-patient-1",
+        medication_name="Metformin hydrochloride 500 MG",
+        start_date=date.today(),
+        status="active"
+    ))
+    # Older A1C readings are high, the latest one is at target
+    for days_ago, a1c in [(100, 9.5), (40, 8.1), (10, 6.4)]:
+        db_session.add(Observation(
+            id=f"rule-a1c-{days_ago}",
+            patient_id="rule-patient-1",
+            observation_type="laboratory",
+            loinc_code="4548-4",
+            display="Hemoglobin A1c",
+            value=str(a1c),
+            value_quantity=a1c,
+            observation_date=now - timedelta(days=days_ago)
+        ))
+    for days_ago, bp in [(30, "150/95"), (2, "128/82")]:
+        db_session.add(Observation(
+            id=f"rule-bp-{days_ago}",
+            patient_id="rule-patient-1",
+            observation_type="vital-signs",
+            loinc_code="85354-9",
+            display="Blood pressure panel",
+            value=bp,
+            observation_date=now - timedelta(days=days_ago)
+        ))
+    db_session.commit()
+    return "rule-patient-1"
+
+
+def _hook(conditions, hook_id="rule-test", **fields):
+    return {
+        "id": hook_id,
+        "hook": "patient-view",
+        "conditions": conditions,
+        "actions": [{"type": "info-card", "parameters": {"summary": "Fired"}}],
+        **fields
+    }
+
+
+def _compiled(conditions):
+    return CompiledHook("rule-test", _hook(conditions))
+
+
+class TestCDSHookPatientContext:
+    """Test condition evaluation against the per-invocation patient snapshot"""
+
+    def test_latest_observation_per_code(self, db_session, rule_patient_data):
+        """Lab and vital conditions use the most recent result within the timeframe"""
+        engine = CDSHookEngine(db_session)
+        context = {"patientId": rule_patient_data}
+
+        def fires(condition):
+            return len(engine.evaluate_hook(_compiled([condition]), context)) == 1
+
+        lab = {"type": "lab-value", "parameters": {"code": "4548-4", "operator": "gt", "value": "7.0", "timeframe": "180"}}
+        assert not fires(lab)
+        lab["parameters"]["operator"] = "lt"
+        assert fires(lab)
+        # The latest result is 10 days old, so it is outside a 5 day window
+        lab["parameters"]["timeframe"] = "5"
+        assert not fires(lab)
+
+        assert fires({"type": "lab-missing", "parameters": {"labTest": "4548-4", "timeframe": "5"}})
+        assert not fires({"type": "lab-missing", "parameters": {"labTest": "4548-4", "timeframe": "90"}})
+        assert fires({"type": "lab-missing", "parameters": {"labTest": "2339-0", "timeframe": "90"}})
+
+        bp = {"type": "vital-sign", "parameters": {"type": "85354-9", "component": "systolic",
+                                                      "operator": "ge", "value": "140", "timeframe": "90"}}
+        assert not fires(bp)
+        bp["parameters"].update({"component": "diastolic", "operator": "ge", "value": "80"})
+        assert fires(bp)
+
+    def test_demographic_diagnosis_and_medication_conditions(self, db_session, rule_patient_data):
+        """Demographic, diagnosis and medication conditions are evaluated in memory"""
+        engine = CDSHookEngine(db_session)
+        context = {"patientId": rule_patient_data}
+
+        cards = engine.evaluate_hook(_compiled([
+            {"type": "patient-age", "parameters": {"operator": "ge", "value": "65"}},
+            {"type": "patient-gender", "parameters": {"value": "Female"}},
+            {"type": "diagnosis-code", "parameters": {"codes": "44054006, E11.9", "operator": "in"}},
+            {"type": "medication-active", "parameters": {"medications": "metformin"}},
+            {"type": "medication-missing", "parameters": {"medications": "atorvastatin,simvastatin"}}
+        ]), context)
+        assert len(cards) == 1
+
+        assert engine.evaluate_hook(_compiled([
+            {"type": "diagnosis-code", "parameters": {"codes": "38341003", "operator": "in"}}
+        ]), context) == []
+        assert engine.evaluate_hook(_compiled([
+            {"type": "patient-age", "parameters": {"operator": "ge", "value": "65"}}
+        ]), {"patientId": "no-such-patient"}) == []
+
+    def test_constant_query_count(self, db_session, rule_patient_data, count_statements):
+        """A hook costs the same number of queries however many conditions it has"""
+        conditions = [
+            {"type": "patient-age", "parameters": {"operator": "ge", "value": "18"}},
+            {"type": "diagnosis-code", "parameters": {"codes": "44054006"}},
+            {"type": "medication-active", "parameters": {"medications": "metformin"}},
+            {"type": "lab-value", "parameters": {"code": "4548-4", "operator": "gt", "value": "5", "timeframe": "180"}},
+            {"type": "vital-sign", "parameters": {"type": "85354-9", "operator": "gt", "value": "100", "timeframe": "90"}}
+        ]
+        with count_statements(db_session) as statements:
+            engine = CDSHookEngine(db_session)
+            assert len(engine.evaluate_hook(_compiled(conditions), {"patientId": rule_patient_data})) == 1
+            single = len(statements)
+
+            statements.clear()
+            assert len(engine.evaluate_hook(_compiled(conditions * 4), {"patientId": rule_patient_data})) == 1
+            assert len(statements) == single
+
+        # Demographics, conditions, medications and one ranked observation query
+        assert single == 4
+
+
+
+class TestCDSPrefetch:
+    """Test shared prefetch resolution for the CDS service classes"""
+
+    SERVICES = [DiabetesManagementService(), HypertensionManagementService(),
+                DrugInteractionService(), PreventiveCareService()]
+
+    @pytest.fixture
+    def bp_components(self, db_session, rule_patient_data):
+        now = datetime.now()
+        for days_ago, systolic, diastolic in [(20, 150.0, 95.0), (5, 146.0, 92.0)]:
+            for code, value in [("8480-6", systolic), ("8462-4", diastolic)]:
+                db_session.add(Observation(
+                    id=f"prefetch-{code}-{days_ago}",
+                    patient_id=rule_patient_data,
+                    observation_type="vital-signs",
+                    loinc_code=code,
+                    display="Blood pressure component",
+                    value=str(value),
+                    value_quantity=value,
+                    observation_date=now - timedelta(days=days_ago)
+                ))
+        db_session.commit()
+        return rule_patient_data
+
+    def test_prefetch_per_service(self, db_session, bp_components):
+        diabetes, hypertension, interactions, preventive = PrefetchResolver(db_session).resolve(
+            self.SERVICES, {"patientId": bp_components}
+        )
+
+        assert [condition.snomed_code for condition in diabetes["conditions"]] == ["44054006"]
+        assert diabetes["a1c"].value == 6.4
+        # Newest readings first; panels keep their "systolic/diastolic" text and have no numeric value
+        bp = hypertension["bp"]
+        assert [(obs.code, obs.text, obs.value) for obs in (bp[0], bp[-1])] == [
+            ("85354-9", "128/82", None), ("85354-9", "150/95", None)
+        ]
+        assert [{obs.value for obs in bp[i:i + 2]} for i in (1, 3)] == [{146.0, 92.0}, {150.0, 95.0}]
+        assert preventive["patient"]["birthDate"] == "1950-03-01"
+
+        # The three services asking for active medications share one result
+        assert diabetes["medications"] is hypertension["medications"] is interactions["medications"]
+        assert [med.medication_name for med in diabetes["medications"]] == ["Metformin hydrochloride 500 MG"]
+
+        # Without a patient in context nothing can be prefetched
+        assert PrefetchResolver(db_session).resolve(self.SERVICES, {}) == [{}, {}, {}, {}]
+
+    def test_one_query_per_resource_type(self, db_session, bp_components, count_statements):
+        with count_statements(db_session) as statements:
+            result = execute_services(db_session, self.SERVICES, {"patientId": bp_components})
+
+        # Patient, conditions, medications and one observation read for A1C and the BP codes
+        assert len(statements) == 4
+        summaries = {card["summary"] for card in result["cards"]}
+        assert "Blood Pressure Above Goal" in summaries
+        assert "Annual Diabetes Screenings Due" in summaries
+        assert "Consider Metformin" not in summaries
+        assert "Pneumococcal Vaccine Recommended" in summaries
+
+
+    def test_builtin_services_endpoint(self, test_client, db_session, rule_patient_data):
+        """Built-in services run with their prefetch, reading BP panels and skipping text-only results"""
+        now = datetime.now()
+        db_session.add(Observation(id="services-a1c-pending", patient_id=rule_patient_data,
+                                   observation_type="laboratory", loinc_code="4548-4", display="Hemoglobin A1c",
+                                   value="pending", observation_date=now))
+        db_session.add(Observation(id="services-bp-high", patient_id=rule_patient_data,
+                                   observation_type="vital-signs", loinc_code="85354-9",
+                                   display="Blood pressure panel", value="160/100",
+                                   observation_date=now - timedelta(days=1)))
+        db_session.commit()
+
+        response = test_client.post("/cds-hooks/services/patient-view", json={
+            "context": {"patientId": rule_patient_data}
+        })
+        assert response.status_code == 200
+        summaries = {card["summary"] for card in response.json()["cards"]}
+        # Panels 160/100, 128/82 and 150/95 average above goal
+        assert "Blood Pressure Above Goal" in summaries
+        assert not summaries & {"High A1C Alert", "A1C Above Goal"}
+
+        assert test_client.post("/cds-hooks/services/no-such-hook", json={}).status_code == 404
+
+
+class TestCDSHooksFanOut:
+    """Test concurrent evaluation of every hook of a hook type"""
+
+    def test_fan_out_patient_view(self, test_client, db_session, rule_patient_data, monkeypatch):
+        """All enabled hooks of the type run, and a failing one does not affect the rest"""
+        initialize_sample_hooks(db_session)
+        for hook_config in [
+            _hook([{"type": "diagnosis-code", "parameters": {"codes": "44054006"}}], "fan-out-fires"),
+            _hook([], "fan-out-broken"),
+            _hook([], "fan-out-disabled", enabled=False)
+        ]:
+            assert test_client.post("/cds-hooks/hooks", json=hook_config).status_code == 200
+
+        evaluate = CDSHookEngine.evaluate_with_context
+
+        def broken_evaluate(self, hook_config, context, patient_context):
+            if hook_config.id == "fan-out-broken":
+                raise ValueError("broken action")
+            return evaluate(self, hook_config, context, patient_context)
+
+        monkeypatch.setattr(CDSHookEngine, "evaluate_with_context", broken_evaluate)
+
+        response = test_client.post("/cds-hooks/fan-out/patient-view", json={
+            "hookInstance": "fan-out-test",
+            "context": {"patientId": rule_patient_data}
+        })
+        assert response.status_code == 200
+
+        services = {service["id"]: service for service in response.json()["services"]}
+        assert "fan-out-disabled" not in services
+        assert "opioid-risk-assessment" not in services  # medication-prescribe hook
+        assert services["fan-out-broken"]["status"] == "error"
+        assert services["fan-out-broken"]["cards"] == []
+        assert services["fan-out-fires"]["status"] == "ok"
+        assert len(services["fan-out-fires"]["cards"]) == 1
+        assert all(service["status"] == "ok" for hook_id, service in services.items() if hook_id != "fan-out-broken")
+        assert len(response.json()["cards"]) == sum(len(service["cards"]) for service in services.values())
+
+    def test_fan_out_snapshot_timeout(self, test_client, db_session, rule_patient_data, monkeypatch):
+        """A slow snapshot load is cut off; hooks that need it return no cards, the others still fire"""
+        for hook_config in [
+            _hook([{"type": "diagnosis-code", "parameters": {"codes": "44054006"}}], "fan-out-needs-data"),
+            _hook([], "fan-out-always")
+        ]:
+            assert test_client.post("/cds-hooks/hooks", json=hook_config).status_code == 200
+        monkeypatch.setattr(cds_hooks_router, "SNAPSHOT_TIMEOUT_SECONDS", 0.3)
+
+        def slow_load(bind, context, conditions):
+            time.sleep(1.0)
+            return None
+
+        monkeypatch.setattr(cds_hooks_router, "_load_snapshot", slow_load)
+
+        started = time.perf_counter()
+        response = test_client.post("/cds-hooks/fan-out/patient-view", json={
+            "context": {"patientId": rule_patient_data}
+        })
+        assert response.status_code == 200
+        assert time.perf_counter() - started < 1.0
+
+        services = {service["id"]: service for service in response.json()["services"]}
+        assert services["fan-out-needs-data"]["status"] == "snapshot-timeout"
+        assert services["fan-out-needs-data"]["cards"] == []
+        assert services["fan-out-always"]["status"] == "ok"
+        assert len(services["fan-out-always"]["cards"]) == 1
+
+        # Timed out hooks are not cached, so the next request evaluates them again
+        monkeypatch.undo()
+        response = test_client.post("/cds-hooks/fan-out/patient-view", json={
+            "context": {"patientId": rule_patient_data}
+        })
+        services = {service["id"]: service for service in response.json()["services"]}
+        assert services["fan-out-needs-data"]["status"] == "ok"
+        assert len(services["fan-out-needs-data"]["cards"]) == 1
+
+    def test_fan_out_shares_one_snapshot(self, test_client, db_session, rule_patient_data, monkeypatch):
+        """The patient snapshot is loaded once for all fanned-out hooks"""
+        initialize_sample_hooks(db_session)
+        loads = []
+        load = PatientContext.load
+
+        def counting_load(db, patient_id, conditions):
+            loads.append(patient_id)
+            return load(db, patient_id, conditions)
+
+        monkeypatch.setattr(PatientContext, "load", staticmethod(counting_load))
+
+        response = test_client.post("/cds-hooks/fan-out/patient-view", json={
+            "context": {"patientId": rule_patient_data}
+        })
+        assert response.status_code == 200
+        assert loads == [rule_patient_data]
+        assert len(response.json()["services"]) > 1
+
+
+
+class TestCDSHookRegistry:
+    """Test the database-backed hook registry"""
+
+    def test_hooks_persist_with_versions(self, test_client, db_session):
+        """Hooks are stored in the database and every write moves the version forward"""
+        created = test_client.post("/cds-hooks/hooks", json=_hook(
+            [{"type": "patient-age", "parameters": {"operator": "ge", "value": "65"}}], "registry-hook"
+        ))
+        assert created.status_code == 200
+        assert created.json()["version"] == 1
+        assert db_session.query(CDSHook).filter(CDSHook.id == "registry-hook").count() == 1
+
+        updated = test_client.put("/cds-hooks/hooks/registry-hook", json=_hook(
+            [{"type": "patient-age", "parameters": {"operator": "ge", "value": "70"}}], "registry-hook",
+            title="Seventy plus"
+        ))
+        assert updated.status_code == 200
+        assert updated.json()["version"] == 2
+        assert updated.json()["created_at"] == created.json()["created_at"]
+
+        # A new worker (empty compiled cache) sees the same hook
+        hook_registry.clear()
+        services = test_client.get("/cds-hooks/").json()["services"]
+        assert [service["title"] for service in services if service["id"] == "registry-hook"] == ["Seventy plus"]
+        assert hook_registry.get(db_session, "registry-hook").conditions[0].value == 70
+
+        assert test_client.delete("/cds-hooks/hooks/registry-hook").status_code == 200
+        assert test_client.get("/cds-hooks/hooks/registry-hook").status_code == 404
+        assert hook_registry.get(db_session, "registry-hook") is None
+
+    def test_only_changed_hooks_recompile(self, test_client, db_session):
+        """Unchanged hooks keep their compiled form across refreshes"""
+        test_client.post("/cds-hooks/hooks", json=_hook([], "registry-a"))
+        test_client.post("/cds-hooks/hooks", json=_hook([], "registry-b"))
+        compiled_a = hook_registry.get(db_session, "registry-a")
+        compiled_b = hook_registry.get(db_session, "registry-b")
+        assert hook_registry.get(db_session, "registry-a") is compiled_a
+
+        test_client.put("/cds-hooks/hooks/registry-b", json=_hook([], "registry-b", title="Changed"))
+        assert hook_registry.get(db_session, "registry-a") is compiled_a
+        assert hook_registry.get(db_session, "registry-b") is not compiled_b
+        assert hook_registry.get(db_session, "registry-b").service["title"] == "Changed"
+
+    def test_delete_and_create_is_seen(self, test_client, db_session):
+        """A delete followed by a create never looks like the registry the worker already has"""
+        test_client.post("/cds-hooks/hooks", json=_hook([], "registry-a"))
+        test_client.post("/cds-hooks/hooks", json=_hook([], "registry-b"))
+        deleted_version = hook_registry.get(db_session, "registry-b").version
+
+        assert test_client.delete("/cds-hooks/hooks/registry-b").status_code == 200
+        created = test_client.post("/cds-hooks/hooks", json=_hook([], "registry-c"))
+        assert created.json()["version"] > deleted_version
+
+        assert hook_registry.get(db_session, "registry-b") is None
+        assert hook_registry.get(db_session, "registry-c") is not None
+
+    def test_stored_hook_that_no_longer_compiles(self, test_client, db_session):
+        """A stored definition that fails to compile is skipped instead of breaking every hook"""
+        test_client.post("/cds-hooks/hooks", json=_hook([], "registry-good"))
+        broken = _hook([{"type": "no-such-condition", "parameters": {}}], "registry-broken")
+        db_session.add(CDSHook(id="registry-broken", hook="patient-view", enabled=True,
+                               definition=broken, version=HookRegistry.next_version(db_session)))
+        db_session.commit()
+
+        assert hook_registry.get(db_session, "registry-broken") is None
+        assert hook_registry.get(db_session, "registry-good") is not None
+        services = test_client.get("/cds-hooks/").json()["services"]
+        assert "registry-good" in [service["id"] for service in services]
+
+    def test_invalid_hooks_rejected(self, test_client):
+        """Definitions that do not compile are rejected when saved"""
+        for conditions in [
+            [{"type": "no-such-condition", "parameters": {}}],
+            [{"type": "lab-value", "parameters": {"code": "4548-4", "value": "high"}}],
+            [{"type": "vital-sign", "parameters": {"type": "8867-4", "operator": "between"}}],
+            [{"type": "diagnosis-code", "parameters": {}}]
+        ]:
+            response = test_client.post("/cds-hooks/hooks", json=_hook(conditions, "invalid-hook"))
+            assert response.status_code == 400
+        assert test_client.get("/cds-hooks/hooks/invalid-hook").status_code == 404
+
+
+
+class TestCDSCardCache:
+    """Test caching of hook cards by hook and patient data version"""
+
+    def _execute(self, test_client, patient_id):
+        response = test_client.post("/cds-hooks/cached-a1c", json={"context": {"patientId": patient_id}})
+        assert response.status_code == 200
+        return response.json()["cards"]
+
+    def test_cards_cached_until_data_changes(self, test_client, db_session, rule_patient_data):
+        """Repeat executions hit the cache; patient writes and hook edits invalidate it"""
+        high_a1c = _hook([{"type": "lab-value", "parameters": {
+            "code": "4548-4", "operator": "gt", "value": "7.0", "timeframe": "180"}}], "cached-a1c")
+        test_client.post("/cds-hooks/hooks", json=high_a1c)
+
+        assert self._execute(test_client, rule_patient_data) == []
+        assert self._execute(test_client, rule_patient_data) == []
+        assert card_cache.hits == 1
+
+        # A new high A1C moves the patient's data version
+        db_session.add(Observation(
+            id="rule-a1c-new", patient_id=rule_patient_data, observation_type="laboratory",
+            loinc_code="4548-4", display="Hemoglobin A1c", value="8.3", value_quantity=8.3,
+            observation_date=datetime.now()
+        ))
+        db_session.commit()
+        first = self._execute(test_client, rule_patient_data)
+        assert len(first) == 1
+        assert card_cache.hits == 1
+
+        again = self._execute(test_client, rule_patient_data)
+        assert card_cache.hits == 2
+        assert again[0]["summary"] == first[0]["summary"]
+        assert again[0]["uuid"] != first[0]["uuid"]
+
+        # Editing the hook moves its version
+        high_a1c["conditions"][0]["parameters"]["value"] = "9.0"
+        test_client.put("/cds-hooks/hooks/cached-a1c", json=high_a1c)
+        assert self._execute(test_client, rule_patient_data) == []
+        assert card_cache.hits == 2
+
+    def test_fan_out_uses_cache(self, test_client, db_session, rule_patient_data):
+        """A repeat chart open answers every hook from the cache"""
+        initialize_sample_hooks(db_session)
+        request = {"context": {"patientId": rule_patient_data}}
+        first = test_client.post("/cds-hooks/fan-out/patient-view", json=request).json()
+        assert not any(service["cached"] for service in first["services"])
+
+        second = test_client.post("/cds-hooks/fan-out/patient-view", json=request).json()
+        assert all(service["cached"] for service in second["services"])
+        assert [card["summary"] for card in second["cards"]] == [card["summary"] for card in first["cards"]]
+        assert {card["uuid"] for card in second["cards"]}.isdisjoint(card["uuid"] for card in first["cards"])
+
+
+
+@pytest.fixture
+def population_data(db_session):
+    """A small population with varied demographics, diagnoses, medications and results"""
+    now = datetime.now()
+    today = date.today()
+    patients = [
+        # id, birth date, gender, diabetic, medication, latest A1C (days ago, value), BP (days ago, value)
+        ("pop-1", date(1940, 1, 1), "female", True, "Atorvastatin 20 MG", (10, 8.2), (1, "185/125")),
+        ("pop-2", date(1985, 6, 1), "male", True, "Metformin 500 MG", (200, 9.1), (30, "135/85")),
+        ("pop-3", date(2000, 3, 3), "female", False, None, None, (2, "118/76")),
+        ("pop-4", today.replace(year=today.year - 65), "male", True, "Oxycodone 5 MG", (5, 6.8), None),
+        ("pop-5", today.replace(year=today.year - 40) + timedelta(days=1), "female", True, None, (400, 7.5), (100, "150/95")),
+        ("pop-6", date(1955, 9, 9), "male", False, "Simvastatin 10 MG", (1, 7.0), (5, "garbled")),
+    ]
+    for patient_id, birth_date, gender, diabetic, medication, a1c, bp in patients:
+        db_session.add(Patient(id=patient_id, first_name="Pop", last_name=patient_id,
+                               date_of_birth=birth_date, gender=gender))
+        if diabetic:
+            db_session.add(Condition(id=f"{patient_id}-dm", patient_id=patient_id, snomed_code="44054006",
+                                     description="Diabetes", clinical_status="active",
+                                     onset_date=now - timedelta(days=1000)))
+        if medication:
+            db_session.add(Medication(id=f"{patient_id}-med", patient_id=patient_id, medication_name=medication,
+                                      start_date=today, status="active"))
+        if a1c:
+            db_session.add(Observation(id=f"{patient_id}-a1c", patient_id=patient_id, observation_type="laboratory",
+                                       loinc_code="4548-4", display="Hemoglobin A1c", value=str(a1c[1]),
+                                       value_quantity=a1c[1], observation_date=now - timedelta(days=a1c[0])))
+        if bp:
+            db_session.add(Observation(id=f"{patient_id}-bp", patient_id=patient_id, observation_type="vital-signs",
+                                       loinc_code="85354-9", display="Blood pressure", value=bp[1],
+                                       observation_date=now - timedelta(days=bp[0])))
+    db_session.commit()
+    return [patient[0] for patient in patients]
+
+
+class TestCDSHookDryRun:
+    """Test population-wide dry runs of hooks"""
+
+    def test_dry_run_matches_per_patient_evaluation(self, test_client, db_session, population_data):
+        """The set-based query fires for exactly the patients per-patient evaluation does"""
+        initialize_sample_hooks(db_session)
+        for hook_config in [
+            _hook([{"type": "patient-age", "parameters": {"operator": "eq", "value": "40"}}], "dry-age-eq"),
+            _hook([{"type": "patient-age", "parameters": {"operator": "lt", "value": "65"}}], "dry-age-lt"),
+            _hook([{"type": "patient-age", "parameters": {"operator": "le", "value": "40"}}], "dry-age-le"),
+            _hook([{"type": "patient-age", "parameters": {"operator": "gt", "value": "65"}}], "dry-age-gt"),
+            _hook([{"type": "patient-gender", "parameters": {"value": "Male"}}], "dry-gender"),
+            _hook([{"type": "diagnosis-code", "parameters": {"codes": "44054006", "operator": "not-in"}}], "dry-no-dm"),
+            _hook([{"type": "lab-value", "parameters": {"code": "4548-4", "operator": "eq", "value": "7.0",
+                                                        "timeframe": "30"}}], "dry-lab-eq"),
+            _hook([{"type": "lab-value", "parameters": {"code": "4548-4", "operator": "missing",
+                                                        "timeframe": "30"}}], "dry-lab-missing"),
+            _hook([{"type": "vital-sign", "parameters": {"type": "85354-9", "component": "diastolic",
+                                                         "operator": "lt", "value": "90", "timeframe": "60"}}], "dry-dbp"),
+        ]:
+            assert test_client.post("/cds-hooks/hooks", json=hook_config).status_code == 200
+
+        engine = CDSHookEngine(db_session)
+        for hook in hook_registry.hooks(db_session):
+            expected = sorted(
+                patient_id for patient_id in population_data
+                if engine.evaluate_hook(hook, {"patientId": patient_id})
+            )
+            response = test_client.get(f"/cds-hooks/hooks/{hook.id}/dry-run", params={"limit": 100})
+            assert response.status_code == 200
+            data = response.json()
+            assert data["count"] == len(expected), hook.id
+            assert sorted(patient["id"] for patient in data["patients"]) == expected, hook.id
+
+    def test_dry_run_reads_string_only_labs_like_evaluation(self, test_client, db_session, population_data):
+        """Labs with only a value string are compared the same way by the dry run and evaluation"""
+        now = datetime.now()
+        # patient id -> (value string, value_quantity)
+        glucose = {"pop-1": (" 130 ", None), "pop-2": ("+95.", None), "pop-3": ("1e3", None),
+                   "pop-4": ("high", None), "pop-5": ("140", 140.0)}
+        for patient_id, (value, quantity) in glucose.items():
+            db_session.add(Observation(id=f"{patient_id}-glucose", patient_id=patient_id,
+                                       observation_type="laboratory", loinc_code="2345-7", display="Glucose",
+                                       value=value, value_quantity=quantity, observation_date=now - timedelta(days=1)))
+        db_session.commit()
+        for operator, value in [("gt", "100"), ("le", "100"), ("eq", "95")]:
+            test_client.post("/cds-hooks/hooks", json=_hook([{"type": "lab-value", "parameters": {
+                "code": "2345-7", "operator": operator, "value": value, "timeframe": "30"
+            }}], f"dry-glucose-{operator}", enabled=False))
+
+        engine = CDSHookEngine(db_session)
+        fired = {}
+        for operator in ("gt", "le", "eq"):
+            hook = hook_registry.get(db_session, f"dry-glucose-{operator}")
+            expected = sorted(
+                patient_id for patient_id in population_data
+                if engine.evaluate_hook(hook, {"patientId": patient_id})
+            )
+            data = test_client.get(f"/cds-hooks/hooks/{hook.id}/dry-run", params={"limit": 100}).json()
+            assert sorted(patient["id"] for patient in data["patients"]) == expected, hook.id
+            fired[operator] = expected
+        assert fired == {"gt": ["pop-1", "pop-5"], "le": ["pop-2"], "eq": ["pop-2"]}
+
+    def test_dry_run_paging(self, test_client, db_session, population_data):
+        """Patients are returned a page at a time with the full count"""
+        test_client.post("/cds-hooks/hooks", json=_hook([], "dry-everyone", enabled=False))
+
+        first = test_client.get("/cds-hooks/hooks/dry-everyone/dry-run", params={"limit": 4}).json()
+        second = test_client.get("/cds-hooks/hooks/dry-everyone/dry-run", params={"limit": 4, "offset": 4}).json()
+        assert first["count"] == second["count"] == len(population_data)
+        assert len(first["patients"]) == 4
+        assert len(second["patients"]) == len(population_data) - 4
+        assert sorted(p["id"] for p in first["patients"] + second["patients"]) == sorted(population_data)
+
+        assert test_client.get("/cds-hooks/hooks/no-such-hook/dry-run").status_code == 404
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
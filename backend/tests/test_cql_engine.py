@@ -0,0 +1,240 @@
+"""
+Unit tests for the CQL translation engine
+"""
+
+import pytest
+from datetime import datetime, date, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from database.database import Base
+from models.models import Patient, Observation, Condition
+from services.cql_engine import CQLTranslationEngine, SimplifiedCQLExecutor
+from services.cql_library_cache import CQLLibraryCache, cql_library_cache
+
+
+DIABETES_MEASURE = """library DiabetesHbA1cControl version '1.0.0'
+
+using FHIR version '4.0.1'
+
+context Patient
+
+define "Initial Population":
+  exists([Condition: "Diabetes"])
+
+define "Denominator":
+  "Initial Population"
+
+define "Numerator":
+  exists(
+    [Observation: "HbA1c"] A
+      where A.effectiveDateTime >= Today() - 365 days
+        and A.value < 9 '%'
+  )"""
+
+
+@pytest.fixture
+def db_session():
+    """Create test database session"""
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    session = TestingSessionLocal()
+    yield session
+    session.close()
+
+
+@pytest.fixture(autouse=True)
+def clear_library_cache():
+    cql_library_cache.clear()
+    yield
+    cql_library_cache.clear()
+
+
+@pytest.fixture
+def measure_population(db_session):
+    """Diabetic patients with controlled, uncontrolled, stale and missing A1C results, plus a non-diabetic"""
+    now = datetime.now()
+    # patient id -> (diabetic, A1C value, days ago)
+    patients = {
+        "cql-controlled": (True, 7.2, 30),
+        "cql-uncontrolled": (True, 10.1, 30),
+        "cql-stale": (True, 6.5, 500),
+        "cql-untested": (True, None, None),
+        "cql-healthy": (False, 5.1, 30),
+    }
+    for patient_id, (diabetic, a1c, days_ago) in patients.items():
+        db_session.add(Patient(
+            id=patient_id,
+            first_name="Cql",
+            last_name=patient_id,
+            date_of_birth=date(1960, 1, 1),
+            gender="female"
+        ))
+        if diabetic:
+            db_session.add(Condition(
+                id=f"{patient_id}-dm",
+                patient_id=patient_id,
+                icd10_code="E11.9",
+                description="Type 2 diabetes mellitus",
+                onset_date=now - timedelta(days=1000)
+            ))
+        if a1c is not None:
+            db_session.add(Observation(
+                id=f"{patient_id}-a1c",
+                patient_id=patient_id,
+                loinc_code="4548-4",
+                display="Hemoglobin A1c",
+                value_quantity=a1c,
+                observation_date=now - timedelta(days=days_ago)
+            ))
+    db_session.commit()
+    return patients
+
+
+class TestCQLMeasureExecution:
+    """Test set-based evaluation of measure populations"""
+
+    def test_parse_quoted_definitions(self, db_session):
+        parsed = CQLTranslationEngine(db_session).parse_cql(DIABETES_MEASURE)
+        assert [d["name"] for d in parsed["definitions"]] == ["Initial Population", "Denominator", "Numerator"]
+        assert parsed["definitions"][1]["expression"] == '"Initial Population"'
+
+    def test_population_measure(self, db_session, measure_population):
+        results = CQLTranslationEngine(db_session).execute_measure(DIABETES_MEASURE)
+
+        assert results["InitialPopulation"] == ["cql-controlled", "cql-stale", "cql-uncontrolled", "cql-untested"]
+        assert results["Denominator"] == results["InitialPopulation"]
+        assert results["Numerator"] == ["cql-controlled"]
+        assert results["MeasureScore"] == 25
+
+    def test_one_query_per_population(self, db_session, measure_population, count_statements):
+        with count_statements(db_session) as statements:
+            CQLTranslationEngine(db_session).execute_measure(DIABETES_MEASURE)
+
+        assert len(statements) == 3
+
+    def test_patient_context(self, db_session, measure_population):
+        engine = CQLTranslationEngine(db_session)
+
+        controlled = engine.execute_measure(DIABETES_MEASURE, patient_id="cql-controlled")
+        assert controlled["InitialPopulation"] is True
+        assert controlled["Numerator"] is True
+        assert controlled["MeasureScore"] == 100
+
+        # The numerator is evaluated within the initial population
+        healthy = engine.execute_measure(DIABETES_MEASURE, patient_id="cql-healthy")
+        assert healthy["InitialPopulation"] is False
+        assert healthy["Numerator"] is False
+
+
+class TestCQLLibraryCache:
+    """Test reuse of compiled libraries across executions"""
+
+    def test_repeated_runs_skip_parsing(self, db_session, measure_population, monkeypatch):
+        first = CQLTranslationEngine(db_session).execute_measure(DIABETES_MEASURE)
+        assert cql_library_cache.stats()["misses"] == 1
+
+        def fail(self, cql_content):
+            raise AssertionError("library parsed again")
+
+        monkeypatch.setattr(CQLTranslationEngine, "parse_cql", fail)
+        assert CQLTranslationEngine(db_session).execute_measure(DIABETES_MEASURE) == first
+
+        stats = cql_library_cache.stats()
+        assert (stats["hits"], stats["misses"]) == (1, 1)
+        assert stats["libraries"] == ["DiabetesHbA1cControl|1.0.0"]
+
+    def test_cached_library_sees_current_data(self, db_session, measure_population):
+        engine = CQLTranslationEngine(db_session)
+        assert engine.execute_measure(DIABETES_MEASURE, patient_id="cql-untested")["Numerator"] is False
+
+        db_session.add(Observation(
+            id="cql-untested-a1c",
+            patient_id="cql-untested",
+            loinc_code="4548-4",
+            display="Hemoglobin A1c",
+            value_quantity=6.8,
+            observation_date=datetime.now()
+        ))
+        db_session.commit()
+        assert engine.execute_measure(DIABETES_MEASURE, patient_id="cql-untested")["Numerator"] is True
+
+    def test_changed_text_or_value_sets_recompile(self, db_session, measure_population):
+        engine = CQLTranslationEngine(db_session)
+        engine.execute_measure(DIABETES_MEASURE)
+        engine.execute_measure(DIABETES_MEASURE.replace("< 9 '%'", "< 8 '%'"))
+        engine.add_value_set("hba1c_codes", ["17856-6"])
+        assert engine.execute_measure(DIABETES_MEASURE)["Numerator"] == []
+        assert cql_library_cache.stats()["misses"] == 3
+
+    def test_least_recently_used_library_is_evicted(self):
+        cache = CQLLibraryCache(max_entries=2)
+        cache.set("a", "library-a")
+        cache.set("b", "library-b")
+        assert cache.get("a") == "library-a"
+        cache.set("c", "library-c")
+        assert cache.get("b") is None
+        assert (cache.get("a"), cache.get("c")) == ("library-a", "library-c")
+        assert (cache.hits, cache.misses, len(cache)) == (3, 1, 2)
+
+
+class TestSimplifiedMeasures:
+    """Test the set-based simplified measures"""
+
+    def test_diabetes_control_uses_latest_result(self, db_session, measure_population):
+        # An older controlled result does not count once a newer one is above goal
+        db_session.add(Observation(
+            id="cql-uncontrolled-a1c-old",
+            patient_id="cql-uncontrolled",
+            loinc_code="4548-4",
+            display="Hemoglobin A1c",
+            value_quantity=6.9,
+            observation_date=datetime.now() - timedelta(days=200)
+        ))
+        db_session.commit()
+
+        results = SimplifiedCQLExecutor(db_session).execute_diabetes_control_measure()
+
+        assert results["measureId"] == "DiabetesHbA1cControl"
+        assert results["patients"]["initialPopulation"] == [
+            "cql-controlled", "cql-stale", "cql-uncontrolled", "cql-untested"
+        ]
+        assert results["patients"]["numerator"] == ["cql-controlled"]
+        assert (results["initialPopulation"], results["denominator"], results["numerator"]) == (4, 4, 1)
+        assert results["measureScore"] == 25
+
+    def test_mammography_screening(self, db_session):
+        today = date.today()
+        # patient id -> (gender, age, days since mammogram)
+        patients = {
+            "mammo-screened": ("female", 60, 100),
+            "mammo-overdue": ("female", 60, 900),
+            "mammo-never": ("female", 55, None),
+            "mammo-too-young": ("female", 45, 100),
+            "mammo-male": ("male", 60, 100),
+        }
+        for patient_id, (gender, age, days_ago) in patients.items():
+            db_session.add(Patient(
+                id=patient_id,
+                first_name="Mammo",
+                last_name=patient_id,
+                date_of_birth=today - timedelta(days=age * 365 + 30),
+                gender=gender
+            ))
+            if days_ago is not None:
+                db_session.add(Observation(
+                    id=f"{patient_id}-mammogram",
+                    patient_id=patient_id,
+                    loinc_code="24606-6",
+                    display="Mammography",
+                    observation_date=datetime.now() - timedelta(days=days_ago)
+                ))
+        db_session.commit()
+
+        results = SimplifiedCQLExecutor(db_session).execute_preventive_screening_measure("mammography")
+
+        assert results["patients"]["initialPopulation"] == ["mammo-never", "mammo-overdue", "mammo-screened"]
+        assert results["patients"]["numerator"] == ["mammo-screened"]
+        assert SimplifiedCQLExecutor(db_session).execute_preventive_screening_measure("x-ray") == {
+            "error": "Unknown screening type"
+        }
@@ -0,0 +1,151 @@
+"""
+Unit tests for the dashboard statistics snapshot
+"""
+
+import pytest
+from datetime import datetime, date, timedelta
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import main
+from main import app
+from database.database import Base, get_db
+from api.auth import get_current_user_optional
+from models.models import Patient, Encounter, Provider, Condition, Medication
+from services import dashboard_stats_service
+from services.dashboard_stats_service import (
+    get_dashboard_snapshot, refresh_if_due, encounters_since
+)
+
+
+@pytest.fixture
+def db_session(tmp_path):
+    """Create test database session (a file database, usable from the test client's thread)"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'dashboard.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    session = TestingSessionLocal()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def clinic(db_session):
+    """Patients with conditions, medications and encounters spread over the last months"""
+    db_session.add(Provider(id="dash-provider", first_name="Dash", last_name="Board", active=True))
+    db_session.add(Provider(id="dash-retired", first_name="Old", last_name="Timer", active=False))
+    for number in range(3):
+        patient_id = f"dash-patient-{number}"
+        db_session.add(Patient(id=patient_id, first_name="Dash", last_name=str(number),
+                               date_of_birth=date(1970, 1, 1), gender="female"))
+        db_session.add(Condition(id=f"{patient_id}-htn", patient_id=patient_id, icd10_code="I10",
+                                 description="Hypertension", clinical_status="active",
+                                 onset_date=datetime(2020, 1, 1)))
+        db_session.add(Encounter(id=f"{patient_id}-recent", patient_id=patient_id, encounter_type="ambulatory",
+                                 status="finished", encounter_date=datetime.now() - timedelta(days=number + 1)))
+        db_session.add(Encounter(id=f"{patient_id}-old", patient_id=patient_id, encounter_type="ambulatory",
+                                 status="finished", encounter_date=datetime.now() - timedelta(days=60)))
+    db_session.add(Condition(id="dash-patient-0-dm", patient_id="dash-patient-0", icd10_code="E11.9",
+                             description="Diabetes", clinical_status="resolved", onset_date=datetime(2020, 1, 1)))
+    db_session.add(Medication(id="dash-med", patient_id="dash-patient-0", medication_name="Lisinopril",
+                              start_date=date(2020, 1, 1), status="active"))
+    db_session.commit()
+
+
+class TestDashboardStatsSnapshot:
+    """Test the pre-aggregated dashboard statistics"""
+
+    def test_snapshot_counts(self, db_session, clinic):
+        stats = get_dashboard_snapshot(db_session).stats
+
+        assert (stats["total_patients"], stats["total_encounters"], stats["active_providers"]) == (3, 6, 1)
+        assert stats["recent_encounters"] == 3
+        assert (stats["active_conditions"], stats["active_medications"]) == (3, 1)
+        assert stats["common_conditions"] == [
+            {"name": "Hypertension", "count": 3}, {"name": "Diabetes", "count": 1}
+        ]
+        assert encounters_since(stats, date.today() - timedelta(days=30)) == 3
+        assert encounters_since(stats, date.today() - timedelta(days=90)) == 6
+        assert encounters_since(stats, date.today() - timedelta(days=5000)) is None
+
+    def test_served_without_counting(self, db_session, clinic, count_statements):
+        snapshot = get_dashboard_snapshot(db_session)
+        with count_statements(db_session) as statements:
+            assert get_dashboard_snapshot(db_session) is snapshot
+            db_session.expire_all()
+            get_dashboard_snapshot(db_session)
+
+        # One primary key lookup per read, whatever the table sizes
+        assert len(statements) == 2
+        assert all("FROM dashboard_stats_snapshots \nWHERE dashboard_stats_snapshots.id = ?" in statement
+                   for statement in statements)
+
+    def test_refresh_due_after_interval_or_writes(self, db_session, clinic, monkeypatch):
+        bind = db_session.get_bind()
+        monkeypatch.setattr(dashboard_stats_service, "DASHBOARD_STATS_WRITE_THRESHOLD", 2)
+        assert refresh_if_due(bind) is True
+        assert refresh_if_due(bind) is False
+
+        # Writes below the threshold leave the snapshot alone
+        db_session.add(Patient(id="dash-new-1", first_name="New", last_name="One", date_of_birth=date(1980, 1, 1),
+                               gender="male"))
+        db_session.commit()
+        assert refresh_if_due(bind) is False
+
+        db_session.add(Patient(id="dash-new-2", first_name="New", last_name="Two", date_of_birth=date(1980, 1, 1),
+                               gender="male"))
+        db_session.commit()
+        assert refresh_if_due(bind) is True
+        db_session.expire_all()
+        assert get_dashboard_snapshot(db_session).stats["total_patients"] == 5
+
+        # An old snapshot is refreshed without writes
+        monkeypatch.setattr(dashboard_stats_service, "DASHBOARD_STATS_INTERVAL_SECONDS", 0)
+        assert refresh_if_due(bind) is True
+
+
+class TestDashboardEndpoints:
+    """Test the dashboard endpoints served from the snapshot"""
+
+    @pytest.fixture
+    def client(self, db_session):
+        app.dependency_overrides[get_db] = lambda: db_session
+        yield TestClient(app)
+        app.dependency_overrides.clear()
+
+    def test_stats_from_snapshot(self, client, db_session, clinic):
+        first = client.get("/api/dashboard/stats").json()
+        assert first["total_patients"] == 3
+        assert first["common_conditions"][0] == {"name": "Hypertension", "count": 3}
+        assert "refreshed_at" in first and "age_seconds" in first
+
+        # New data shows once the snapshot is refreshed
+        db_session.add(Patient(id="dash-new", first_name="New", last_name="Patient", date_of_birth=date(1990, 1, 1),
+                               gender="male"))
+        db_session.commit()
+        assert client.get("/api/dashboard/stats").json()["total_patients"] == 3
+
+        app.dependency_overrides[get_current_user_optional] = lambda: db_session.get(Provider, "dash-provider")
+        refreshed = client.post("/api/dashboard/stats/refresh")
+        assert refreshed.status_code == 200
+        assert refreshed.json()["refreshed_at"] >= first["refreshed_at"]
+        assert client.get("/api/dashboard/stats").json()["total_patients"] == 4
+
+    def test_refresher_cancelled_on_shutdown(self):
+        with TestClient(app):
+            [refresher] = [task for task in main._lifetime_tasks
+                           if "dashboard_stats_refresher" in repr(task.get_coro())]
+        assert refresher.cancelled()
+
+    def test_refresh_requires_sign_in(self, client, clinic):
+        assert client.post("/api/dashboard/stats/refresh").status_code == 401
+
+    def test_quality_dashboard_summary(self, client, db_session, clinic):
+        summary = client.get("/api/quality/dashboard", params={"days": 30}).json()["summary"]
+        assert summary["total_patients"] == 3
+        assert (summary["total_encounters"], summary["active_conditions"], summary["active_medications"]) == (3, 3, 1)
+        assert summary["refreshed_at"] == get_dashboard_snapshot(db_session).refreshed_at.isoformat()
+
+        # Beyond the snapshot's daily counts the encounters are counted live
+        summary = client.get("/api/quality/dashboard", params={"days": 5000}).json()["summary"]
+        assert summary["total_encounters"] == 6
@@ -1,18 +1,24 @@
 """
 Test Advanced FHIR Features:
-- _revinclude parameter
+- _include/_revinclude parameters (including :iterate)
+- Streaming of large searchset Bundles
 - Additional search modifiers (:missing, :above, :below, :text)
 - Batch and transaction operations
 """
 
 import pytest
 import json
+import re
 from datetime import datetime, timedelta
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
 from main import app
+from api.fhir.fhir_router import SEARCH_REGISTRY, INCLUDE_GRAPH, RESOURCE_CONVERTERS
+from api.fhir.includes import IncludeResolver
+from api.fhir.pagination import keyset_page_query
+from api.fhir.search_totals import _planner_estimate
 from database.database import Base, get_db
 from models.synthea_models import Patient, Encounter, Observation, Condition, Medication
 
@@ -448,6 +454,553 @@ class TestFHIRBatchTransaction:
         assert data["entry"][0]["resource"]["name"][0]["family"] == "Test"
 
 
+class TestFHIRKeysetPagination:
+    """Test _cursor based keyset pagination"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        # Clear existing data
+        db.query(Observation).delete()
+        db.query(Patient).delete()
+        db.commit()
+        
+        patient = Patient(
+            id="keyset-patient",
+            first_name="Page",
+            last_name="Keyset",
+            date_of_birth=datetime(1975, 3, 1).date(),
+            gender="F"
+        )
+        db.add(patient)
+        
+        base_date = datetime(2023, 1, 1, 8, 0, 0)
+        for i in range(7):
+            db.add(Observation(
+                id=f"keyset-obs-{i}",
+                patient_id=patient.id,
+                # Two observations share each date to exercise the id tie-breaker
+                observation_date=base_date + timedelta(days=i // 2),
+                observation_type="laboratory",
+                loinc_code="2345-7",
+                display="Glucose",
+                value=str(90 + i),
+                value_quantity=float(90 + i),
+                status="final"
+            ))
+        db.commit()
+        db.close()
+    
+    def _collect_pages(self, url):
+        ids = []
+        pages = 0
+        while url:
+            response = client.get(url)
+            assert response.status_code == 200
+            data = response.json()
+            ids.extend(entry["resource"]["id"] for entry in data["entry"])
+            next_link = next((link for link in data["link"] if link["relation"] == "next"), None)
+            url = next_link["url"] if next_link else None
+            pages += 1
+        return ids, pages
+    
+    def test_next_link_uses_cursor(self):
+        """Test that the next link carries a _cursor instead of an _offset"""
+        response = client.get("/fhir/R4/Observation?_count=3")
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert len(data["entry"]) == 3
+        next_link = next(link for link in data["link"] if link["relation"] == "next")
+        assert "_cursor=" in next_link["url"]
+        assert "_offset=" not in next_link["url"]
+    
+    def test_cursor_walks_all_pages(self):
+        """Test that following cursors returns every resource exactly once"""
+        ids, pages = self._collect_pages("/fhir/R4/Observation?_count=3")
+        assert pages == 3
+        assert ids == sorted(ids)
+        assert ids == [f"keyset-obs-{i}" for i in range(7)]
+    
+    def test_cursor_with_descending_sort(self):
+        """Test cursor paging on a descending sort key with duplicate values"""
+        ids, _ = self._collect_pages("/fhir/R4/Observation?_sort=-observation_date&_count=2")
+        # Newest date first, ties broken by ascending id
+        assert ids == [f"keyset-obs-{i}" for i in (6, 4, 5, 2, 3, 0, 1)]
+    
+    def test_offset_paging_still_supported(self):
+        """Test that explicit _offset requests keep offset based next links"""
+        response = client.get("/fhir/R4/Observation?_count=3&_offset=3")
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert len(data["entry"]) == 3
+        next_link = next(link for link in data["link"] if link["relation"] == "next")
+        assert "_offset=6" in next_link["url"]
+    
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected with an OperationOutcome"""
+        response = client.get("/fhir/R4/Observation?_cursor=not-a-cursor")
+        assert response.status_code == 400
+        assert response.json()["detail"]["resourceType"] == "OperationOutcome"
+    
+    def _page_plan(self, sort_keys, cursor=None):
+        db = TestingSessionLocal()
+        try:
+            _, page = keyset_page_query(db.query(Observation), Observation, sort_keys, 3, cursor)
+            sql = str(page.statement.compile(engine, compile_kwargs={"literal_binds": True}))
+            return " | ".join(row[-1] for row in db.execute(text("EXPLAIN QUERY PLAN " + sql)))
+        finally:
+            db.close()
+    
+    def test_nullable_sort_without_nulls_uses_index(self):
+        """Test that a nullable sort column holding no NULLs is paged through its index"""
+        links = client.get("/fhir/R4/Observation?_sort=loinc_code&_count=3").json()["link"]
+        next_link = next(link for link in links if link["relation"] == "next")
+        plan = self._page_plan([(Observation.loinc_code, False)], next_link["url"].split("_cursor=")[1])
+        # Either of the two loinc_code indexes; only the id tie-breaker may be sorted
+        assert re.search(r"SEARCH observations USING INDEX \w+ \(loinc_code>\?\)", plan)
+        assert "USE TEMP B-TREE FOR ORDER BY" not in plan
+    
+    def test_nullable_sort_places_nulls_last(self):
+        """Test that NULL sort values come after every other value when they exist"""
+        db = TestingSessionLocal()
+        db.add(Observation(id="keyset-obs-null", patient_id="keyset-patient", observation_date=datetime(2023, 1, 1),
+                           observation_type="laboratory", display="Unknown", status="final"))
+        db.commit()
+        db.close()
+        
+        ids, _ = self._collect_pages("/fhir/R4/Observation?_sort=loinc_code&_count=3")
+        assert ids == [f"keyset-obs-{i}" for i in range(7)] + ["keyset-obs-null"]
+
+
+class TestFHIRSearchTotals:
+    """Test _total=accurate|estimate|none handling"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        # Clear existing data
+        db.query(Observation).delete()
+        db.query(Patient).delete()
+        db.commit()
+        
+        patient = Patient(
+            id="totals-patient",
+            first_name="Count",
+            last_name="Totals",
+            date_of_birth=datetime(1960, 7, 4).date(),
+            gender="M"
+        )
+        db.add(patient)
+        for i in range(4):
+            db.add(Observation(
+                id=f"totals-obs-{i}",
+                patient_id=patient.id,
+                observation_date=datetime(2023, 2, 1) + timedelta(days=i),
+                observation_type="laboratory",
+                loinc_code="4548-4",
+                display="Hemoglobin A1c",
+                value=str(6 + i),
+                value_quantity=float(6 + i),
+                status="final"
+            ))
+        db.commit()
+        db.close()
+    
+    def test_total_none_omits_total_but_keeps_next_link(self):
+        """Test _total=none skips counting and still pages when the page is full"""
+        response = client.get("/fhir/R4/Observation?_total=none&_count=2")
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert "total" not in data
+        assert len(data["entry"]) == 2
+        assert any(link["relation"] == "next" for link in data["link"])
+    
+    def test_total_none_with_offset_paging(self):
+        """Test _total=none with offset paging emits next only for a full page"""
+        response = client.get("/fhir/R4/Observation?_total=none&_count=2&_offset=2")
+        data = response.json()
+        assert "total" not in data
+        assert any(link["relation"] == "next" for link in data["link"])
+        
+        response = client.get("/fhir/R4/Observation?_total=none&_count=3&_offset=3")
+        data = response.json()
+        assert len(data["entry"]) == 1
+        assert not any(link["relation"] == "next" for link in data["link"])
+    
+    def test_total_estimate_invalidated_by_writes(self):
+        """Test that cached estimates are refreshed after a write to the table"""
+        url = "/fhir/R4/Observation?code=4548-4&_total=estimate"
+        assert client.get(url).json()["total"] == 4
+        
+        db = TestingSessionLocal()
+        db.add(Observation(
+            id="totals-obs-new",
+            patient_id="totals-patient",
+            observation_date=datetime(2023, 3, 1),
+            observation_type="laboratory",
+            loinc_code="4548-4",
+            display="Hemoglobin A1c",
+            value="7.1",
+            value_quantity=7.1,
+            status="final"
+        ))
+        db.commit()
+        db.close()
+        
+        assert client.get(url).json()["total"] == 5
+    
+    def test_failed_planner_estimate_keeps_transaction(self):
+        """Test that a missing statistics table does not roll back the caller's work"""
+        memory_engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(bind=memory_engine)
+        db = sessionmaker(bind=memory_engine)()
+        db.add(Patient(id="pending-patient", first_name="Not", last_name="Committed",
+                       date_of_birth=datetime(1990, 1, 1).date(), gender="F"))
+        db.flush()
+        
+        # No ANALYZE has run, so sqlite_stat1 does not exist
+        assert _planner_estimate(db, "patients") is None
+        assert db.query(Patient).count() == 1
+        db.close()
+
+
+class TestFHIRSearchPlanner:
+    """Test the compiled search parameter registry"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        # Clear existing data
+        db.query(Observation).delete()
+        db.query(Patient).delete()
+        db.commit()
+        
+        for patient_id, last_name in [("planner-patient-1", "Alvarez"), ("planner-patient-2", "Baker")]:
+            db.add(Patient(
+                id=patient_id,
+                first_name="Plan",
+                last_name=last_name,
+                date_of_birth=datetime(1985, 5, 5).date(),
+                gender="F"
+            ))
+            for code in ["2345-7", "4548-4"]:
+                db.add(Observation(
+                    id=f"{patient_id}-{code}",
+                    patient_id=patient_id,
+                    observation_date=datetime(2023, 6, 1),
+                    observation_type="laboratory",
+                    loinc_code=code,
+                    display=f"Lab {code}",
+                    value="1",
+                    value_quantity=1.0,
+                    status="final"
+                ))
+        db.commit()
+        db.close()
+    
+    def test_plan_is_cached_by_normalized_query(self):
+        """Test that equivalent queries share one compiled plan"""
+        first = SEARCH_REGISTRY.plan("Observation", {"code": "2345-7", "patient": "Patient/x", "_count": "5"})
+        second = SEARCH_REGISTRY.plan("Observation", {"patient": "Patient/x", "code": "2345-7"})
+        assert first is second
+        assert {step.name for step in first} == {"code", "patient"}
+    
+    def test_token_values_are_ored(self):
+        """Test comma-separated codes with and without a system"""
+        response = client.get("/fhir/R4/Observation?code=http://loinc.org|2345-7,4548-4&patient=planner-patient-1")
+        assert response.status_code == 200
+        assert len(response.json()["entry"]) == 2
+    
+    def test_typed_chain(self):
+        """Test subject:Patient.family chained search"""
+        response = client.get("/fhir/R4/Observation?subject:Patient.family=Baker")
+        assert response.status_code == 200
+        
+        ids = {entry["resource"]["id"] for entry in response.json()["entry"]}
+        assert ids == {"planner-patient-2-2345-7", "planner-patient-2-4548-4"}
+
+
+class TestFHIRDateSearch:
+    """Test date searches at year, month and day precision"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        # Clear existing data
+        db.query(Observation).delete()
+        db.query(Patient).delete()
+        db.commit()
+        
+        db.add(Patient(
+            id="date-patient",
+            first_name="Date",
+            last_name="Range",
+            date_of_birth=datetime(1990, 12, 31).date(),
+            gender="F"
+        ))
+        dates = {
+            "date-obs-1": datetime(2022, 12, 31, 23, 59, 59),
+            "date-obs-2": datetime(2023, 5, 1, 0, 0, 0),
+            "date-obs-3": datetime(2023, 5, 31, 18, 30, 0),
+            "date-obs-4": datetime(2023, 11, 2, 9, 15, 0),
+            "date-obs-5": datetime(2024, 1, 1, 0, 0, 0),
+        }
+        for obs_id, observation_date in dates.items():
+            db.add(Observation(
+                id=obs_id,
+                patient_id="date-patient",
+                observation_date=observation_date,
+                observation_type="vital-signs",
+                loinc_code="8867-4",
+                display="Heart rate",
+                value="70",
+                value_quantity=70.0,
+                status="final"
+            ))
+        db.commit()
+        db.close()
+    
+    def _ids(self, query):
+        response = client.get(f"/fhir/R4/Observation?{query}")
+        assert response.status_code == 200
+        return sorted(entry["resource"]["id"] for entry in response.json()["entry"])
+    
+    def test_year_precision(self):
+        """Test date=YYYY matches the whole year"""
+        assert self._ids("date=2023") == ["date-obs-2", "date-obs-3", "date-obs-4"]
+    
+    def test_month_precision(self):
+        """Test date=YYYY-MM matches the whole month"""
+        assert self._ids("date=2023-05") == ["date-obs-2", "date-obs-3"]
+    
+    def test_day_precision_and_ne(self):
+        """Test day equality and the ne prefix"""
+        assert self._ids("date=2023-05-31") == ["date-obs-3"]
+        assert self._ids("date=ne2023-05-31") == ["date-obs-1", "date-obs-2", "date-obs-4", "date-obs-5"]
+    
+    def test_range_prefixes(self):
+        """Test gt/lt use the end/start of the searched period"""
+        assert self._ids("date=gt2023-05") == ["date-obs-4", "date-obs-5"]
+        assert self._ids("date=lt2023") == ["date-obs-1"]
+        assert self._ids("date=ge2023-05&date=le2023") == ["date-obs-2", "date-obs-3", "date-obs-4"]
+    
+    def test_date_column_precision(self):
+        """Test year and month precision on a Date column"""
+        for value in ["1990", "1990-12", "1990-12-31"]:
+            response = client.get(f"/fhir/R4/Patient?birthdate={value}")
+            assert len(response.json()["entry"]) == 1
+        response = client.get("/fhir/R4/Patient?birthdate=1991")
+        assert len(response.json()["entry"]) == 0
+
+
+class TestFHIRIncludes:
+    """Test the batched _include engine, :iterate and the include cap"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        # Clear existing data
+        db.query(Observation).delete()
+        db.query(Encounter).delete()
+        db.query(Patient).delete()
+        db.commit()
+        
+        db.add(Patient(
+            id="inc-patient",
+            first_name="Ina",
+            last_name="Include",
+            date_of_birth=datetime(1975, 3, 1).date(),
+            gender="F"
+        ))
+        db.add(Encounter(
+            id="inc-encounter",
+            patient_id="inc-patient",
+            encounter_date=datetime(2023, 1, 10),
+            encounter_type="ambulatory",
+            status="finished"
+        ))
+        for i in range(3):
+            db.add(Observation(
+                id=f"inc-obs-{i}",
+                patient_id="inc-patient",
+                encounter_id="inc-encounter",
+                observation_date=datetime(2023, 1, 10, 9, i),
+                observation_type="vital-signs",
+                loinc_code="8867-4",
+                display="Heart rate",
+                value="70",
+                value_quantity=70.0,
+                status="final"
+            ))
+        db.commit()
+        db.close()
+    
+    def _modes(self, data):
+        return sorted(
+            (entry["resource"]["resourceType"], entry["search"]["mode"]) for entry in data["entry"]
+        )
+    
+    def test_include_deduplicates_targets(self):
+        """Test a reference shared by every match is included once"""
+        response = client.get("/fhir/R4/Observation?code=8867-4&_include=Observation:encounter")
+        assert response.status_code == 200
+        assert self._modes(response.json()) == [
+            ("Encounter", "include"),
+            ("Observation", "match"), ("Observation", "match"), ("Observation", "match")
+        ]
+    
+    def test_include_iterate(self):
+        """Test :iterate follows references of included resources"""
+        response = client.get(
+            "/fhir/R4/Observation?_id=inc-obs-0"
+            "&_include=Observation:encounter"
+            "&_include:iterate=Encounter:patient"
+        )
+        assert response.status_code == 200
+        assert self._modes(response.json()) == [
+            ("Encounter", "include"), ("Observation", "match"), ("Patient", "include")
+        ]
+    
+    def test_revinclude_iterate(self):
+        """Test :iterate on _revinclude from an included resource"""
+        response = client.get(
+            "/fhir/R4/Patient?_id=inc-patient"
+            "&_revinclude=Encounter:patient"
+            "&_revinclude:iterate=Observation:encounter"
+        )
+        assert response.status_code == 200
+        modes = self._modes(response.json())
+        assert modes.count(("Observation", "include")) == 3
+        assert ("Encounter", "include") in modes
+    
+    def test_include_cap(self):
+        """Test included entries are capped with a too-costly outcome"""
+        db = TestingSessionLocal()
+        try:
+            patient = db.query(Patient).filter(Patient.id == "inc-patient").one()
+            resolver = IncludeResolver(db, INCLUDE_GRAPH, RESOURCE_CONVERTERS, limit=2)
+            entries = resolver.resolve("Patient", [patient], revincludes=["Observation:patient"])
+        finally:
+            db.close()
+        
+        assert len(entries) == 3
+        assert entries[-1]["search"]["mode"] == "outcome"
+        assert entries[-1]["resource"]["issue"][0]["code"] == "too-costly"
+    
+    def test_include_cap_skips_already_seen_resources(self):
+        """Test matches already in the Bundle do not hide other resources behind the cap"""
+        def resolve(limit):
+            db = TestingSessionLocal()
+            try:
+                matches = db.query(Observation).filter(Observation.id.in_(["inc-obs-0", "inc-obs-1"])).all()
+                resolver = IncludeResolver(db, INCLUDE_GRAPH, RESOURCE_CONVERTERS, limit=limit)
+                entries = resolver.resolve("Observation", matches, includes=["Observation:patient"],
+                                           iterate_revincludes=["Observation:patient"])
+                return [entry.get("fullUrl", "outcome") for entry in entries]
+            finally:
+                db.close()
+        
+        # The patient's other observations are read past the two matches
+        assert resolve(2) == ["Patient/inc-patient", "Observation/inc-obs-2"]
+        # ... and reported as truncated when they no longer fit
+        assert resolve(1) == ["Patient/inc-patient", "outcome"]
+    
+    def test_include_near_cap_reads_in_one_batch(self, count_statements):
+        """Test already included rows near the cap do not shrink the batches read"""
+        db = TestingSessionLocal()
+        try:
+            matches = db.query(Observation).filter(Observation.id.in_(["inc-obs-0", "inc-obs-1"])).all()
+            resolver = IncludeResolver(db, INCLUDE_GRAPH, RESOURCE_CONVERTERS, limit=2)
+            with count_statements(db) as statements:
+                entries = resolver.resolve("Observation", matches, includes=["Observation:patient"],
+                                           iterate_revincludes=["Observation:patient"])
+            assert [entry["fullUrl"] for entry in entries] == ["Patient/inc-patient", "Observation/inc-obs-2"]
+            assert len([sql for sql in statements if "observations.patient_id IN" in sql]) == 1
+        finally:
+            db.close()
+
+
+class TestFHIRStreamingBundles:
+    """Test large pages are streamed with the same Bundle contents"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        # Clear existing data
+        db.query(Observation).delete()
+        db.query(Encounter).delete()
+        db.query(Patient).delete()
+        db.commit()
+        
+        db.add(Patient(
+            id="stream-patient",
+            first_name="Stream",
+            last_name="Bundle",
+            date_of_birth=datetime(1960, 6, 1).date(),
+            gender="M"
+        ))
+        start = datetime(2023, 1, 1)
+        for i in range(250):
+            db.add(Observation(
+                id=f"stream-obs-{i:03d}",
+                patient_id="stream-patient",
+                observation_date=start + timedelta(hours=i),
+                observation_type="vital-signs",
+                loinc_code="8867-4",
+                display="Heart rate",
+                value=str(60 + i % 40),
+                value_quantity=float(60 + i % 40),
+                status="final"
+            ))
+        db.commit()
+        db.close()
+    
+    def test_streamed_pages(self):
+        """Test a streamed page and its next link cover all results once"""
+        response = client.get("/fhir/R4/Observation?_count=200&_sort=date")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["resourceType"] == "Bundle"
+        assert data["total"] == 250
+        assert len(data["entry"]) == 200
+        assert data["entry"][0]["resource"]["id"] == "stream-obs-000"
+        
+        links = {link["relation"]: link["url"] for link in data["link"]}
+        next_page = client.get(links["next"]).json()
+        assert len(next_page["entry"]) == 50
+        assert next_page["entry"][-1]["resource"]["id"] == "stream-obs-249"
+        assert "next" not in {link["relation"] for link in next_page["link"]}
+    
+    def test_streamed_matches_buffered(self):
+        """Test streamed and buffered responses contain the same entries"""
+        streamed = client.get("/fhir/R4/Observation?_count=250&_total=none").json()
+        assert "total" not in streamed
+        
+        buffered = []
+        url = "/fhir/R4/Observation?_count=100&_total=none"
+        while url:
+            page = client.get(url).json()
+            buffered.extend(page["entry"])
+            url = next((link["url"] for link in page["link"] if link["relation"] == "next"), None)
+        # meta.lastUpdated is stamped at conversion time
+        for entry in streamed["entry"] + buffered:
+            entry["resource"].pop("meta", None)
+        assert streamed["entry"] == buffered
+    
+    def test_streamed_includes_and_offset(self):
+        """Test includes and offset paging in streamed responses"""
+        data = client.get(
+            "/fhir/R4/Observation?_count=200&_offset=200&_include=Observation:patient"
+        ).json()
+        modes = [entry["search"]["mode"] for entry in data["entry"]]
+        assert modes.count("match") == 50
+        assert modes.count("include") == 1
+        assert "next" not in {link["relation"] for link in data["link"]}
+
+
 # Run tests
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
\ No newline at end of file
@@ -5,6 +5,9 @@ Tests all FHIR resources, search parameters, chained queries, and bulk operation
 
 import pytest
 import json
+import asyncio
+import gzip
+import uuid
 from datetime import datetime, timedelta
 from urllib.parse import quote
 from fastapi.testclient import TestClient
@@ -13,7 +16,14 @@ from sqlalchemy.orm import sessionmaker
 
 from main import app
 from database.database import Base, get_db
-from models.synthea_models import Patient, Provider, Organization, Location, Encounter, Observation, Condition, Medication
+from models.synthea_models import Patient, Provider, Organization, Location, Encounter, Observation, Condition, Medication, Immunization
+from models.export_models import ExportJob
+from api.fhir.bulk_export import BulkExportJob, BulkExportService, BulkExportRouter, JobReleased, EXPORT_DIR
+from api.fhir.fhir_router import RESOURCE_MAPPINGS
+from api.fhir.export_pipeline import NDJSONGzipWriter
+from api.fhir.pagination import encode_cursor, get_keyset_columns
+from models.clinical.tasks import PatientList, PatientListMembership
+from services.background_tasks import background_tasks
 
 # Test database setup
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test_fhir.db"
@@ -738,6 +748,324 @@ class TestFHIRBulkExport:
             assert "output" in data
 
 
+class TestFHIRBulkExportJobStore:
+    """Test export jobs are persisted and resumable"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        db.query(Patient).delete()
+        for i in range(5):
+            db.add(Patient(
+                id=f"export-patient-{i}",
+                first_name="Export",
+                last_name=f"Patient{i}",
+                date_of_birth=datetime(1970 + i, 1, 1).date(),
+                gender="female"
+            ))
+        db.commit()
+        db.close()
+    
+    def test_status_from_database(self):
+        """Test the job is stored so any worker can answer $export-status"""
+        response = client.get("/fhir/R4/$export?_type=Patient")
+        export_id = response.headers["Content-Location"].split("/")[-1]
+        
+        db = TestingSessionLocal()
+        try:
+            record = db.query(ExportJob).filter(ExportJob.id == export_id).first()
+            assert record is not None
+            assert record.resource_types == ["Patient"]
+            # A fresh service (as on another worker) sees the same job
+            assert BulkExportService(db).get_export_status(export_id).job_id == export_id
+        finally:
+            db.close()
+    
+    def test_resume_after_crash(self):
+        """Test a stale job is claimed and resumed after its last finished file"""
+        db = TestingSessionLocal()
+        try:
+            service = BulkExportService(db)
+            job = BulkExportJob(str(uuid.uuid4()), "system", ["Patient"])
+            service.store.create(job)
+            
+            # The first run finished one file, then its worker died
+            job_dir = EXPORT_DIR / job.job_id
+            job_dir.mkdir(parents=True, exist_ok=True)
+            writer = NDJSONGzipWriter(job_dir, "Patient")
+            cursor = encode_cursor(get_keyset_columns(Patient, []), Patient(id="export-patient-1"))
+            writer.write(b'{"resourceType":"Patient"}\n' * 2, 2, cursor)
+            for finished in writer.close():
+                service.store.add_file(job, "Patient", **finished)
+            db.query(ExportJob).filter(ExportJob.id == job.job_id).update(
+                {"heartbeat_at": datetime.utcnow() - timedelta(hours=1)}
+            )
+            db.commit()
+            
+            claimed = [j for j in service.store.claim_stale() if j.job_id == job.job_id]
+            assert len(claimed) == 1
+            asyncio.run(BulkExportService(db)._process_export(claimed[0]))
+            
+            status = service.get_export_status(job.job_id)
+            assert status.status == "completed"
+            assert [entry["count"] for entry in status.output] == [2, 3]
+            assert status.progress == status.total == 5
+            
+            # The original worker lost its claim
+            with pytest.raises(JobReleased):
+                service.store.save_progress(job)
+        finally:
+            db.close()
+
+    
+    def test_started_job_task_is_kept(self):
+        """Test the job's task is referenced until it finishes"""
+        db = TestingSessionLocal()
+        try:
+            async def start():
+                running = background_tasks()
+                job_id = await BulkExportService(db).create_export_job("system", ["Patient"])
+                [task] = background_tasks() - running
+                await task
+                return job_id, task in background_tasks()
+            
+            job_id, still_referenced = asyncio.run(start())
+            assert not still_referenced
+            assert BulkExportService(db).get_export_status(job_id).status == "completed"
+        finally:
+            db.close()
+
+
+class TestFHIRBulkExportPipeline:
+    """Test the process-pool conversion and gzip NDJSON writer"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        db.query(Encounter).delete()
+        db.query(Patient).delete()
+        for i in range(5):
+            db.add(Patient(
+                id=f"pipeline-patient-{i}",
+                first_name="Pipeline",
+                last_name=f"Patient{i}",
+                date_of_birth=datetime(1980 + i, 1, 1).date(),
+                gender="male"
+            ))
+            db.add(Encounter(
+                id=f"pipeline-encounter-{i}",
+                patient_id=f"pipeline-patient-{i}",
+                encounter_date=datetime(2023, 1, 1 + i),
+                encounter_type="ambulatory",
+                status="finished"
+            ))
+        db.commit()
+        db.close()
+    
+    def test_writer_rolls_over_files(self):
+        """Test files are split on the bytes written, at batch boundaries"""
+        job_dir = EXPORT_DIR / str(uuid.uuid4())
+        job_dir.mkdir(parents=True)
+        writer = NDJSONGzipWriter(job_dir, "Patient", max_bytes=30)
+        finished = []
+        for i in range(3):
+            finished += writer.write(b'{"resourceType":"Patient"}\n', 1, f"p{i}")
+        finished += writer.close()
+        
+        assert [(f["filename"], f["count"], f["last_key"]) for f in finished] == [
+            ("Patient-1.ndjson.gz", 1, "p0"),
+            ("Patient-2.ndjson.gz", 1, "p1"),
+            ("Patient-3.ndjson.gz", 1, "p2")
+        ]
+        assert not list(job_dir.glob("*.part"))
+    
+    def test_concurrent_type_export(self):
+        """Test resource types are exported concurrently into gzip NDJSON"""
+        db = TestingSessionLocal()
+        try:
+            service = BulkExportService(db)
+            job = BulkExportJob(str(uuid.uuid4()), "system", ["Patient", "Encounter"])
+            service.store.create(job)
+            asyncio.run(service._process_export(job))
+            
+            status = service.get_export_status(job.job_id)
+            assert status.status == "completed"
+            assert sorted(status.completed_types) == ["Encounter", "Patient"]
+            for entry in status.output:
+                with gzip.open(EXPORT_DIR / job.job_id / entry["url"].split("/")[-1]) as f:
+                    lines = [json.loads(line) for line in f]
+                assert len(lines) == entry["count"] == 5
+                assert {line["resourceType"] for line in lines} == {entry["type"]}
+        finally:
+            db.close()
+
+
+class TestFHIRBulkExportTypes:
+    """Test every mapped resource type can be exported, and _typeFilter"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        db.query(Immunization).delete()
+        db.query(Observation).delete()
+        db.query(Patient).delete()
+        db.add(Patient(
+            id="typefilter-patient",
+            first_name="Type",
+            last_name="Filter",
+            date_of_birth=datetime(1990, 1, 1).date(),
+            gender="female"
+        ))
+        for i, code in enumerate(["8867-4", "8867-4", "8480-6"]):
+            db.add(Observation(
+                id=f"typefilter-obs-{i}",
+                patient_id="typefilter-patient",
+                observation_date=datetime(2023, 1, 1 + i),
+                observation_type="vital-signs",
+                loinc_code=code,
+                display="Vital sign",
+                value="80",
+                value_quantity=80.0,
+                status="final"
+            ))
+        db.add(Immunization(
+            id="typefilter-imm",
+            patient_id="typefilter-patient",
+            immunization_date=datetime(2023, 2, 1),
+            cvx_code="140",
+            description="Influenza vaccine"
+        ))
+        db.commit()
+        db.close()
+    
+    def _export(self, resource_types, search_filters=None):
+        db = TestingSessionLocal()
+        try:
+            service = BulkExportService(db)
+            type_filters = BulkExportRouter.parse_type_filters(search_filters, resource_types, db)
+            job = BulkExportJob(str(uuid.uuid4()), "system", resource_types, type_filters=type_filters)
+            service.store.create(job)
+            asyncio.run(service._process_export(job))
+            status = service.get_export_status(job.job_id)
+            assert status.status == "completed"
+            return {entry["type"]: entry["count"] for entry in status.output}
+        finally:
+            db.close()
+    
+    def test_all_mapped_types_requested(self):
+        """Test a system export without _type covers every mapped resource type"""
+        response = client.get("/fhir/R4/$export")
+        export_id = response.headers["Content-Location"].split("/")[-1]
+        db = TestingSessionLocal()
+        try:
+            record = db.query(ExportJob).filter(ExportJob.id == export_id).first()
+            assert sorted(record.resource_types) == sorted(RESOURCE_MAPPINGS.keys())
+        finally:
+            db.close()
+    
+    def test_new_type_export(self):
+        """Test a type outside the original eight is exported"""
+        assert self._export(["Immunization"]) == {"Immunization": 1}
+    
+    def test_type_filter(self):
+        """Test _typeFilter restricts a type in SQL and ORs repeated filters"""
+        assert self._export(["Observation"], ["Observation?code=8867-4"]) == {"Observation": 2}
+        counts = self._export(
+            ["Observation", "Immunization"],
+            ["Observation?code=8480-6,Observation?date=2023-01-01"]
+        )
+        assert counts == {"Observation": 2, "Immunization": 1}
+    
+    def test_invalid_type_filter(self):
+        """Test an unknown search parameter in _typeFilter fails the kick-off"""
+        response = client.get("/fhir/R4/$export", params={"_typeFilter": "Observation?bogus=1"})
+        assert response.status_code == 400
+
+
+class TestFHIRGroupExport:
+    """Test Group/{id}/$export over a patient list"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        db = TestingSessionLocal()
+        db.query(PatientListMembership).delete()
+        db.query(PatientList).delete()
+        db.query(Observation).delete()
+        db.query(Patient).delete()
+        db.add(PatientList(id="export-group", name="Export cohort", owner_id="test-provider"))
+        for i in range(5):
+            patient_id = f"group-patient-{i}"
+            db.add(Patient(
+                id=patient_id,
+                first_name="Group",
+                last_name=f"Member{i}",
+                date_of_birth=datetime(1960 + i, 1, 1).date(),
+                gender="female"
+            ))
+            for j in range(2):
+                db.add(Observation(
+                    id=f"group-obs-{i}-{j}",
+                    patient_id=patient_id,
+                    observation_date=datetime(2023, 3, 1 + j),
+                    observation_type="vital-signs",
+                    loinc_code="8867-4",
+                    display="Heart rate",
+                    value="75",
+                    value_quantity=75.0,
+                    status="final"
+                ))
+            # Patients 0-2 are in the group
+            if i < 3:
+                db.add(PatientListMembership(patient_list_id="export-group", patient_id=patient_id))
+        db.commit()
+        db.close()
+    
+    def test_group_export_endpoint(self):
+        """Test the kick-off request and the 404 for unknown groups"""
+        response = client.get("/fhir/R4/Group/export-group/$export")
+        assert response.status_code == 202
+        assert client.get("/fhir/R4/Group/missing-group/$export").status_code == 404
+    
+    def test_group_compartment_in_chunks(self, monkeypatch):
+        """Test only member resources are exported when members are chunked"""
+        monkeypatch.setattr("api.fhir.bulk_export.GROUP_CHUNK_SIZE", 2)
+        db = TestingSessionLocal()
+        try:
+            service = BulkExportService(db)
+            job = BulkExportJob(str(uuid.uuid4()), "group", ["Patient", "Observation", "Practitioner"],
+                                group_id="export-group")
+            service.store.create(job)
+            asyncio.run(service._process_export(job))
+            
+            status = service.get_export_status(job.job_id)
+            assert status.status == "completed"
+            assert {entry["type"]: entry["count"] for entry in status.output} == {
+                "Patient": 3, "Observation": 6
+            }
+            observation_file = next(e for e in status.output if e["type"] == "Observation")
+            with gzip.open(EXPORT_DIR / job.job_id / observation_file["url"].split("/")[-1]) as f:
+                subjects = [json.loads(line)["subject"]["reference"] for line in f]
+            assert subjects == sorted(subjects)
+            assert set(subjects) == {f"Patient/group-patient-{i}" for i in range(3)}
+        finally:
+            db.close()
+    
+    def test_group_chunk_bound_uses_index(self, count_statements):
+        """Test the next chunk bound is read from the list/patient membership index"""
+        db = TestingSessionLocal()
+        try:
+            with count_statements(db) as statements:
+                BulkExportService(db)._chunk_upper_bound("export-group", "group-patient-0")
+            sql = statements[-1]
+            plan = " | ".join(
+                row[-1] for row in db.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + sql, (1,) * sql.count("?"))
+            )
+            assert "USING COVERING INDEX idx_patient_list_memberships_list_patient" in plan
+            assert "USE TEMP B-TREE FOR ORDER BY" not in plan
+        finally:
+            db.close()
+
+
 class TestFHIRSearchModifiers:
     """Test FHIR search modifiers and advanced search features"""
     
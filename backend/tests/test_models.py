@@ -3,11 +3,13 @@ Unit tests for database models
 """
 
 import pytest
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from database.database import Base
-from models.models import Patient, Provider, Location, Encounter, Observation, Condition, Medication
+from models.models import Patient, Provider, Location, Encounter, Observation, Condition, Medication, LatestObservation
+from services.harmonized_data_service import HarmonizedDataService
+from services.latest_observation_service import rebuild_latest_observations
 
 
 @pytest.fixture
@@ -231,6 +233,119 @@ class TestObservationModel:
         assert saved_lab.interpretation == "High"
 
 
+
+class TestLatestObservationProjection:
+    """Test maintenance of the latest_observation projection"""
+    
+    def _add_observation(self, db_session, obs_id, days_ago, value, loinc_code="8867-4", status="final"):
+        db_session.add(Observation(
+            id=obs_id,
+            patient_id="latest-patient",
+            observation_type="vital-signs",
+            loinc_code=loinc_code,
+            display="Heart rate",
+            value=str(value),
+            value_quantity=value,
+            value_unit="/min",
+            status=status,
+            observation_date=datetime.now() - timedelta(days=days_ago)
+        ))
+        db_session.commit()
+    
+    def _latest(self, db_session, loinc_code="8867-4"):
+        return db_session.query(LatestObservation).filter(
+            LatestObservation.patient_id == "latest-patient",
+            LatestObservation.loinc_code == loinc_code
+        ).first()
+    
+    def test_projection_follows_writes(self, db_session):
+        """Inserts, updates and deletes keep the latest observation per code"""
+        db_session.add(Patient(id="latest-patient", first_name="Lee", last_name="Latest",
+                               date_of_birth=date(1980, 1, 1), gender="female"))
+        self._add_observation(db_session, "hr-old", 10, 70)
+        assert self._latest(db_session).observation_id == "hr-old"
+        
+        self._add_observation(db_session, "hr-new", 1, 88)
+        # An older reading added later does not replace the newer one
+        self._add_observation(db_session, "hr-older", 20, 60)
+        latest = self._latest(db_session)
+        assert latest.observation_id == "hr-new"
+        assert latest.value_quantity == 88
+        
+        # Moving the latest reading back in time hands the slot to the next one
+        obs = db_session.query(Observation).filter(Observation.id == "hr-new").first()
+        obs.observation_date = datetime.now() - timedelta(days=30)
+        db_session.commit()
+        assert self._latest(db_session).observation_id == "hr-old"
+        
+        # Re-coding an observation updates both the old and the new code
+        obs.loinc_code = "9279-1"
+        db_session.commit()
+        assert self._latest(db_session, "9279-1").observation_id == "hr-new"
+        
+        db_session.delete(db_session.query(Observation).filter(Observation.id == "hr-old").first())
+        db_session.commit()
+        assert self._latest(db_session).observation_id == "hr-older"
+    
+    def test_rebuild_and_latest_vitals(self, db_session):
+        """The projection can be rebuilt and serves the latest vitals lookup"""
+        db_session.add(Patient(id="latest-patient", first_name="Lee", last_name="Latest",
+                               date_of_birth=date(1980, 1, 1), gender="female"))
+        self._add_observation(db_session, "hr-1", 5, 72)
+        self._add_observation(db_session, "hr-2", 2, 80)
+        self._add_observation(db_session, "rr-1", 2, 16, loinc_code="9279-1")
+        
+        db_session.query(LatestObservation).delete()
+        db_session.commit()
+        assert rebuild_latest_observations(db_session) == 2
+        assert self._latest(db_session).observation_id == "hr-2"
+        
+        vitals = HarmonizedDataService(db_session).get_latest_vital_signs("latest-patient")
+        assert set(vitals) == {"heart_rate", "respiratory_rate"}
+        assert vitals["heart_rate"]["value"] == "80"
+        assert vitals["heart_rate"]["unit"] == "/min"
+    
+    def test_latest_vitals_skip_newer_unfinished_results(self, db_session):
+        """A newer preliminary reading does not hide the latest final one"""
+        db_session.add(Patient(id="latest-patient", first_name="Lee", last_name="Latest",
+                               date_of_birth=date(1980, 1, 1), gender="female"))
+        self._add_observation(db_session, "hr-final", 5, 72)
+        self._add_observation(db_session, "hr-preliminary", 1, 95, status="preliminary")
+        self._add_observation(db_session, "rr-preliminary", 1, 16, loinc_code="9279-1", status="preliminary")
+        assert self._latest(db_session).observation_id == "hr-preliminary"
+        
+        vitals = HarmonizedDataService(db_session).get_latest_vital_signs("latest-patient")
+        assert set(vitals) == {"heart_rate"}
+        assert vitals["heart_rate"]["value"] == "72"
+
+    
+    def test_concurrent_refresh_keeps_newer_row(self, tmp_path):
+        """A transaction refreshing a key never replaces the newer row another one committed"""
+        engine = create_engine(f"sqlite:///{tmp_path / 'latest.db'}")
+        Base.metadata.create_all(bind=engine)
+        Sessions = sessionmaker(bind=engine)
+        first, second = Sessions(), Sessions()
+        first.add(Patient(id="latest-patient", first_name="Lee", last_name="Latest",
+                          date_of_birth=date(1980, 1, 1), gender="female"))
+        first.commit()
+        
+        self._add_observation(second, "hr-second", 5, 70)
+        
+        # The first transaction commits a newer observation's row, which the second one's next
+        # refresh does not see the observation of
+        first.query(LatestObservation).update({"observation_id": "hr-first",
+                                               "observation_date": datetime.now() - timedelta(days=1)})
+        first.commit()
+        self._add_observation(second, "hr-second-older", 6, 65)
+        assert self._latest(second).observation_id == "hr-first"
+        
+        # A newer reading still takes the slot
+        self._add_observation(second, "hr-second-newest", 0, 75)
+        assert self._latest(first).observation_id == "hr-second-newest"
+        first.close()
+        second.close()
+
+
 class TestMedicationModel:
     """Test Medication model functionality"""
     
@@ -0,0 +1,428 @@
+"""
+Unit tests for the quality measure engine
+"""
+
+import asyncio
+
+import pytest
+from datetime import datetime, date, timedelta
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import main
+from main import app
+from database.database import Base, get_db
+from models.models import Patient, Encounter, Observation, Condition, Medication
+from models.quality_report_models import (
+    QualityReport, QualityReportMeasure, QualityMeasurePeriod, QualityMeasureResult
+)
+from api.quality import quality_router
+from services.background_tasks import background_tasks
+from api.quality.quality_router import (
+    QualityMeasureEngine, MaterializedQualityMeasures, MEASURE_CALCULATORS, reporting_months
+)
+
+
+PERIOD_START = date.today() - timedelta(days=365)
+PERIOD_END = date.today()
+
+
+@pytest.fixture
+def db_session(tmp_path):
+    """Create test database session (a file database, so report workers get their own connections)"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'quality.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    session = TestingSessionLocal()
+    yield session
+    session.close()
+
+
+def _days_ago(days: int) -> datetime:
+    return datetime.combine(PERIOD_END, datetime.min.time()) - timedelta(days=days)
+
+
+@pytest.fixture
+def quality_population(db_session):
+    """Patients and encounters covering each measure's numerator and denominator cases"""
+    def patient(patient_id, age, gender="female"):
+        db_session.add(Patient(
+            id=patient_id,
+            first_name="Quality",
+            last_name=patient_id,
+            date_of_birth=date.today() - timedelta(days=age * 365 + 40),
+            gender=gender
+        ))
+
+    def condition(patient_id, icd10_code, status="active"):
+        db_session.add(Condition(
+            id=f"{patient_id}-{icd10_code}",
+            patient_id=patient_id,
+            icd10_code=icd10_code,
+            description="Condition",
+            clinical_status=status,
+            onset_date=_days_ago(2000)
+        ))
+
+    def observation(observation_id, patient_id, observation_type, display, days_ago, **values):
+        db_session.add(Observation(
+            id=observation_id,
+            patient_id=patient_id,
+            observation_type=observation_type,
+            display=display,
+            observation_date=_days_ago(days_ago),
+            **values
+        ))
+
+    def encounter(encounter_id, patient_id, days_ago, encounter_type="inpatient", status="finished"):
+        db_session.add(Encounter(
+            id=encounter_id,
+            patient_id=patient_id,
+            encounter_type=encounter_type,
+            status=status,
+            encounter_date=_days_ago(days_ago)
+        ))
+
+    # Diabetes: the latest result in the period decides
+    patient("dm-controlled", 50)
+    condition("dm-controlled", "E11.9")
+    observation("dm-controlled-old", "dm-controlled", "laboratory", "Hemoglobin A1c", 200, value_quantity=9.5)
+    observation("dm-controlled-new", "dm-controlled", "laboratory", "Hemoglobin A1c", 20, value_quantity=7.1)
+    patient("dm-relapsed", 60)
+    condition("dm-relapsed", "E10.9")
+    observation("dm-relapsed-old", "dm-relapsed", "laboratory", "HbA1c", 200, value="6.5")
+    observation("dm-relapsed-new", "dm-relapsed", "laboratory", "HbA1c", 20, value="8.4")
+    patient("dm-text-value", 40)
+    condition("dm-text-value", "E11.65")
+    observation("dm-text-value-a1c", "dm-text-value", "laboratory", "Hemoglobin A1c", 20, value="pending")
+    patient("dm-untested", 70)
+    condition("dm-untested", "E11.9")
+    patient("dm-resolved", 50)
+    condition("dm-resolved", "E11.9", status="resolved")
+    patient("dm-too-old", 80)
+    condition("dm-too-old", "E11.9")
+
+    # Hypertension: any BP reading in the period
+    patient("htn-monitored", 65, gender="male")
+    condition("htn-monitored", "I10")
+    observation("htn-monitored-bp", "htn-monitored", "vital-signs", "Blood Pressure", 30, loinc_code="85354-9")
+    patient("htn-unmonitored", 55, gender="male")
+    condition("htn-unmonitored", "I11.9")
+    observation("htn-unmonitored-bp", "htn-unmonitored", "vital-signs", "Blood Pressure", 500)
+
+    # Breast cancer screening: women 50-74 with a mammogram in two years
+    observation("dm-controlled-mammo", "dm-controlled", "imaging", "Mammography", 300)
+    observation("dm-relapsed-mammo", "dm-relapsed", "imaging", "Mammogram", 800)
+
+    # Discharges: one readmitted within 30 days with medications recorded, one not
+    encounter("enc-discharge-1", "dm-controlled", 100)
+    encounter("enc-readmit-1", "dm-controlled", 80, encounter_type="emergency", status="in-progress")
+    encounter("enc-discharge-2", "dm-relapsed", 100)
+    encounter("enc-followup-2", "dm-relapsed", 90, encounter_type="ambulatory")
+    encounter("enc-late-2", "dm-relapsed", 50)
+    db_session.add(Medication(
+        id="med-discharge-1",
+        patient_id="dm-controlled",
+        encounter_id="enc-discharge-1",
+        medication_name="Metformin 500 MG",
+        start_date=date.today(),
+        status="active"
+    ))
+    db_session.commit()
+
+
+class TestQualityMeasureEngine:
+    """Test the set-based quality measures"""
+
+    def _measure(self, db_session, name):
+        return getattr(QualityMeasureEngine(db_session), name)(PERIOD_START, PERIOD_END)
+
+    def test_diabetes_hba1c_control(self, db_session, quality_population):
+        result = self._measure(db_session, "calculate_diabetes_hba1c_control")
+        assert (result["numerator"], result["denominator"]) == (1, 4)
+        assert result["score"] == 25
+
+    def test_hypertension_control(self, db_session, quality_population):
+        result = self._measure(db_session, "calculate_hypertension_control")
+        assert (result["numerator"], result["denominator"]) == (1, 2)
+
+    def test_breast_cancer_screening(self, db_session, quality_population):
+        result = self._measure(db_session, "calculate_breast_cancer_screening")
+        # dm-controlled, dm-relapsed, dm-untested and dm-resolved are women aged 50-74
+        assert (result["numerator"], result["denominator"]) == (1, 4)
+
+    def test_discharge_measures(self, db_session, quality_population):
+        reconciliation = self._measure(db_session, "calculate_medication_reconciliation")
+        assert (reconciliation["numerator"], reconciliation["denominator"]) == (1, 3)
+
+        readmission = self._measure(db_session, "calculate_readmission_rate")
+        assert (readmission["numerator"], readmission["denominator"]) == (1, 3)
+
+    def test_constant_round_trips(self, db_session, quality_population, count_statements):
+        engine = QualityMeasureEngine(db_session)
+        with count_statements(db_session) as statements:
+            for name in ["calculate_diabetes_hba1c_control", "calculate_hypertension_control",
+                         "calculate_breast_cancer_screening", "calculate_medication_reconciliation",
+                         "calculate_readmission_rate"]:
+                getattr(engine, name)(PERIOD_START, PERIOD_END)
+
+        assert len(statements) == 5
+
+
+class TestMaterializedQualityMeasures:
+    """Test per-patient measure results stored by reporting month and refreshed incrementally"""
+
+    MONTHS = reporting_months(PERIOD_START, PERIOD_END)
+
+    @pytest.fixture(autouse=True)
+    def no_change_margin(self, monkeypatch):
+        monkeypatch.setattr(quality_router, "QUALITY_RESULTS_CHANGE_MARGIN_SECONDS", 0)
+
+    def _expected(self, db_session, calculator):
+        """The engine's result over the whole months, with ages at today (the open month's as-of date)"""
+        (first_day, _), (_, last_day) = self.MONTHS[0], self.MONTHS[-1]
+        engine = QualityMeasureEngine(db_session, as_of=date.today())
+        return getattr(engine, calculator)(first_day, datetime.combine(last_day, datetime.max.time()))
+
+    def test_matches_engine(self, db_session, quality_population):
+        for measure_id, calculator in MEASURE_CALCULATORS.items():
+            expected = self._expected(db_session, calculator)
+            result = MaterializedQualityMeasures(db_session).calculate(measure_id, PERIOD_START, PERIOD_END)
+            assert (result["numerator"], result["denominator"]) == (expected["numerator"], expected["denominator"])
+            assert result["name"] == expected["name"]
+            assert (result["period_start"], result["period_end"]) == (
+                self.MONTHS[0][0].isoformat(), self.MONTHS[-1][1].isoformat()
+            )
+            assert result["materialized"]["periods"] == len(self.MONTHS)
+            assert result["materialized"]["evaluated_patients"] == 8 * len(self.MONTHS)
+
+    def test_only_contributing_patients_stored(self, db_session, quality_population):
+        materialized = MaterializedQualityMeasures(db_session)
+        materialized.calculate("diabetes-hba1c", PERIOD_START, PERIOD_END)
+        materialized.calculate("readmission-rate", PERIOD_START, PERIOD_END)
+
+        rows = db_session.query(QualityMeasurePeriod.measure_id, QualityMeasureResult).join(
+            QualityMeasureResult, QualityMeasureResult.period_id == QualityMeasurePeriod.id
+        ).all()
+        diabetes = [row for measure_id, row in rows if measure_id == "diabetes-hba1c"]
+        assert {row.patient_id for row in diabetes} == {"dm-controlled", "dm-relapsed", "dm-text-value", "dm-untested"}
+        assert len(diabetes) == 4 * len(self.MONTHS)
+        # dm-untested never had an HbA1c
+        assert all(row.numerator is None for row in diabetes if row.patient_id == "dm-untested")
+
+        readmissions = [row for measure_id, row in rows if measure_id == "readmission-rate"]
+        assert sum(row.denominator for row in readmissions) == 3
+        assert all(row.denominator > 0 for row in readmissions)
+
+    def test_unchanged_data_not_reevaluated(self, db_session, quality_population, count_statements):
+        materialized = MaterializedQualityMeasures(db_session)
+        first = materialized.calculate("diabetes-hba1c", PERIOD_START, PERIOD_END)
+
+        with count_statements(db_session) as statements:
+            second = materialized.calculate("diabetes-hba1c", PERIOD_START, PERIOD_END)
+
+        assert second["materialized"]["evaluated_patients"] == 0
+        assert second["materialized"]["refreshed_at"] == first["materialized"]["refreshed_at"]
+        assert (second["numerator"], second["denominator"]) == (1, 4)
+        assert not any("observations" in statement for statement in statements)
+
+    def test_changed_patients_reevaluated(self, db_session, quality_population):
+        materialized = MaterializedQualityMeasures(db_session)
+        materialized.calculate("diabetes-hba1c", PERIOD_START, PERIOD_END)
+
+        # A controlled result for one patient, a new diabetic patient and a removed one
+        db_session.add(Observation(
+            id="dm-untested-a1c",
+            patient_id="dm-untested",
+            observation_type="laboratory",
+            display="Hemoglobin A1c",
+            observation_date=_days_ago(5),
+            value_quantity=6.9
+        ))
+        db_session.add(Patient(id="dm-new", first_name="Quality", last_name="dm-new",
+                               date_of_birth=date(1970, 1, 1), gender="male"))
+        db_session.add(Condition(id="dm-new-E11.9", patient_id="dm-new", icd10_code="E11.9",
+                                 description="Condition", clinical_status="active", onset_date=_days_ago(100)))
+        db_session.delete(db_session.get(Condition, "dm-text-value-E11.65"))
+        db_session.commit()
+
+        result = materialized.calculate("diabetes-hba1c", PERIOD_START, PERIOD_END)
+        assert result["materialized"]["evaluated_patients"] == 3 * len(self.MONTHS)
+        assert (result["numerator"], result["denominator"]) == (2, 4)
+
+        expected = self._expected(db_session, "calculate_diabetes_hba1c_control")
+        assert (result["numerator"], result["denominator"]) == (expected["numerator"], expected["denominator"])
+
+    def test_rolling_window_reuses_months(self, db_session, quality_population):
+        materialized = MaterializedQualityMeasures(db_session)
+        materialized.calculate("hypertension-control", PERIOD_START, PERIOD_END)
+        periods = db_session.query(QualityMeasurePeriod).count()
+        assert periods == len(self.MONTHS)
+
+        # The next day's window is served from the same months
+        result = materialized.calculate("hypertension-control", PERIOD_START + timedelta(days=1), PERIOD_END)
+        assert db_session.query(QualityMeasurePeriod).count() == periods
+        assert result["materialized"]["evaluated_patients"] == 0
+        assert (result["numerator"], result["denominator"]) == (1, 2)
+
+        # Ages are computed at each month's end, or today for the open month
+        periods = db_session.query(QualityMeasurePeriod).order_by(QualityMeasurePeriod.period_start).all()
+        assert [(period.period_start, period.period_end) for period in periods] == self.MONTHS
+        assert [period.as_of for period in periods] == [end for _, end in self.MONTHS[:-1]] + [date.today()]
+
+    def test_open_month_reevaluated_when_the_day_changes(self, db_session, quality_population):
+        materialized = MaterializedQualityMeasures(db_session)
+        materialized.calculate("breast-cancer-screening", PERIOD_START, PERIOD_END)
+
+        open_month = db_session.query(QualityMeasurePeriod).filter(
+            QualityMeasurePeriod.period_start == self.MONTHS[-1][0]
+        ).one()
+        open_month.as_of = date.today() - timedelta(days=1)
+        db_session.commit()
+
+        result = materialized.calculate("breast-cancer-screening", PERIOD_START, PERIOD_END)
+        assert result["materialized"]["evaluated_patients"] == 8
+        assert (result["numerator"], result["denominator"]) == (1, 4)
+        assert open_month.as_of == date.today()
+
+    def test_dashboard_uses_materialized_results(self, db_session, quality_population):
+        app.dependency_overrides[get_db] = lambda: db_session
+        try:
+            client = TestClient(app)
+            dashboard = client.get("/api/quality/dashboard").json()
+            period, first = dashboard["period"], dashboard["quality_measures"]
+            second = client.get("/api/quality/dashboard").json()["quality_measures"]
+        finally:
+            app.dependency_overrides.clear()
+
+        months = reporting_months(PERIOD_END - timedelta(days=30), PERIOD_END)
+        assert period == f"{months[0][0].isoformat()} to {months[-1][1].isoformat()}"
+        months = len(months)
+        assert [m["measure_id"] for m in second] == ["diabetes-hba1c", "hypertension-control",
+                                                     "breast-cancer-screening"]
+        assert [m["materialized"]["evaluated_patients"] for m in first] == [8 * months] * 3
+        assert [m["materialized"]["evaluated_patients"] for m in second] == [0, 0, 0]
+        assert [m["numerator"] for m in first] == [m["numerator"] for m in second]
+
+
+class TestQualityReports:
+    """Test background generation of stored quality reports"""
+
+    @pytest.fixture
+    def client(self, db_session, monkeypatch):
+        started = []
+        monkeypatch.setattr(quality_router, "start_quality_report",
+                            lambda report_id, bind: started.append((report_id, bind)))
+        app.dependency_overrides[get_db] = lambda: db_session
+        yield TestClient(app), started
+        app.dependency_overrides.clear()
+
+    def _generate(self, client, measures):
+        return client.post("/api/quality/reports/generate", params={
+            "report_name": "Annual report",
+            "start_date": PERIOD_START.isoformat(),
+            "end_date": PERIOD_END.isoformat(),
+            "measures": measures
+        })
+
+    def test_report_generated_in_background(self, client, db_session, quality_population):
+        client, started = client
+        response = self._generate(client, ["diabetes-hba1c", "readmission-rate", "unknown-measure"])
+        assert response.status_code == 202
+        report = response.json()
+        assert report["status"] == "pending"
+        assert report["progress"] == {"completed": 0, "total": 2, "percentage": 0}
+        assert [m["status"] for m in report["measures"]] == ["pending", "pending"]
+
+        # Run the job the endpoint started
+        [(report_id, bind)] = started
+        asyncio.run(quality_router.run_quality_report(report_id, bind))
+
+        report = client.get(f"/api/quality/reports/{report_id}").json()
+        assert report["status"] == "completed"
+        assert report["progress"]["percentage"] == 100
+        diabetes, readmission = report["measures"]
+        assert (diabetes["measure_id"], diabetes["numerator"], diabetes["denominator"]) == ("diabetes-hba1c", 1, 4)
+        assert (readmission["numerator"], readmission["denominator"]) == (1, 3)
+        assert all(m["status"] == "completed" and m["elapsed_ms"] is not None for m in report["measures"])
+        assert report["overall_score"] == pytest.approx((25 + 100 / 3) / 2)
+        assert report["summary"]["successful_calculations"] == 2
+
+        # A second run of the same report does nothing
+        asyncio.run(quality_router.run_quality_report(report_id, bind))
+        db_session.expire_all()
+        assert db_session.get(QualityReport, report_id).completed_at is not None
+
+    def test_failed_measure_recorded(self, client, db_session, quality_population, monkeypatch):
+        client, started = client
+
+        def fail(self, start_date, end_date):
+            raise RuntimeError("measure exploded")
+
+        monkeypatch.setattr(QualityMeasureEngine, "calculate_hypertension_control", fail)
+        report_id = self._generate(client, ["hypertension-control", "breast-cancer-screening"]).json()["id"]
+        asyncio.run(quality_router.run_quality_report(report_id, started[0][1]))
+
+        report = client.get(f"/api/quality/reports/{report_id}").json()
+        assert report["status"] == "completed"
+        assert [m["status"] for m in report["measures"]] == ["error", "completed"]
+        assert report["measures"][0]["error"] == "measure exploded"
+        assert report["summary"]["failed_calculations"] == 1
+
+    def _stored_report(self, db_session, status, heartbeat_at):
+        report = QualityReport(id=f"report-{status}", name="Stored", period_start=PERIOD_START,
+                               period_end=PERIOD_END, status=status, created_at=datetime.utcnow(),
+                               heartbeat_at=heartbeat_at)
+        report.measures = [
+            QualityReportMeasure(position=0, measure_id="diabetes-hba1c", status="completed",
+                                 result={"measure_id": "diabetes-hba1c", "score": 10.0}),
+            QualityReportMeasure(position=1, measure_id="readmission-rate", status="running",
+                                 started_at=datetime.utcnow())
+        ]
+        db_session.add(report)
+        db_session.commit()
+        return report.id
+
+    def test_stale_report_resumed(self, db_session, quality_population):
+        stale = self._stored_report(db_session, "running", datetime.utcnow() - timedelta(hours=1))
+        live = self._stored_report(db_session, "pending", datetime.utcnow())
+        bind = db_session.get_bind()
+
+        assert quality_router.claim_stale_reports(bind) == [stale]
+        assert quality_router.claim_stale_reports(bind) == []
+        asyncio.run(quality_router.run_quality_report(stale, bind))
+
+        db_session.expire_all()
+        report = db_session.get(QualityReport, stale)
+        assert report.status == "completed"
+        # The measure finished before the worker died is kept; the interrupted one is calculated
+        finished, resumed = report.measures
+        assert finished.result["score"] == 10.0
+        assert (resumed.status, resumed.result["numerator"], resumed.result["denominator"]) == ("completed", 1, 3)
+        assert report.overall_score == pytest.approx((10 + 100 / 3) / 2)
+        assert db_session.get(QualityReport, live).status == "pending"
+
+    def test_started_report_task_is_kept(self, db_session, quality_population):
+        report_id = self._stored_report(db_session, "pending", datetime.utcnow())
+
+        async def start():
+            running = background_tasks()
+            quality_router.start_quality_report(report_id, db_session.get_bind())
+            [task] = background_tasks() - running
+            await task
+            return task in background_tasks()
+
+        assert asyncio.run(start()) is False
+        db_session.expire_all()
+        assert db_session.get(QualityReport, report_id).status == "completed"
+
+    def test_watchdog_cancelled_on_shutdown(self):
+        with TestClient(app):
+            tasks = list(main._lifetime_tasks)
+            assert any("quality_report_watchdog" in repr(task.get_coro()) for task in tasks)
+        assert all(task.cancelled() for task in tasks)
+        assert main._lifetime_tasks == []
+
+    def test_unknown_report(self, client):
+        client, _ = client
+        assert client.get("/api/quality/reports/missing").status_code == 404